@@ -3,6 +3,7 @@
 import al
 import audit
 import db
+import searchindex
 import sys
 import utils
 from i18n import _, python2display
@@ -113,6 +114,36 @@ def get_additional_fields_ids(dbo, rows, linktype = "animal"):
         "WHERE a.LinkType IN (%s) AND a.LinkID IN (%s) " \
         "ORDER BY af.DisplayIndex" % ( animalclause, personclause, inclause, ",".join(links)))
 
+def get_additional_fields_many(dbo, linkids, linktype = "animal"):
+    """
+    Returns a dictionary of linkid to the list of additional fields for
+    that link, in the same form as get_additional_fields, for every 
+    linkid in the list linkids. One query is made for the field 
+    definitions and one for the values of each block of 1000 links.
+    """
+    fields = get_field_definitions(dbo, linktype)
+    values = {}
+    for i in xrange(0, len(linkids), 1000):
+        rows = [ { "ID": x } for x in linkids[i:i+1000] ]
+        for v in get_additional_fields_ids(dbo, rows, linktype):
+            values[(v["LINKID"], v["ID"])] = v
+    results = {}
+    for linkid in linkids:
+        add = []
+        for f in fields:
+            af = dict(f)
+            af["VALUE"] = None
+            af["ANIMALNAME"] = ""
+            af["OWNERNAME"] = ""
+            if values.has_key((linkid, f["ID"])):
+                v = values[(linkid, f["ID"])]
+                af["VALUE"] = v["VALUE"]
+                af["ANIMALNAME"] = v["ANIMALNAME"]
+                af["OWNERNAME"] = v["OWNERNAME"]
+            add.append(af)
+        results[linkid] = add
+    return results
+
 def get_field_definitions(dbo, linktype = "animal"):
     """
     Returns the field definition info for the linktype given,
@@ -178,14 +209,22 @@ def update_field_from_form(dbo, username, post):
     db.execute(dbo, sql)
     postaudit = db.query(dbo, "SELECT * FROM additionalfield WHERE ID = %d" % aid)
     audit.edit(dbo, username, "additionalfield", aid, audit.map_diff(preaudit, postaudit))
+    # Values of fields that have been made searchable or not searchable
+    # need adding to or removing from the search index
+    if len(preaudit) > 0 and preaudit[0]["SEARCHABLE"] != postaudit[0]["SEARCHABLE"]:
+        searchindex.update_links(dbo, searchindex.get_field_links(dbo, aid))
 
 def delete_field(dbo, username, fid):
     """
     Deletes the selected additional field, along with all data held by it.
     """
     audit.delete(dbo, username, "additionalfield", fid, audit.dump_row(dbo, "additionalfield", fid))
+    links = {}
+    if 1 == db.query_int(dbo, "SELECT Searchable FROM additionalfield WHERE ID = %d" % int(fid)):
+        links = searchindex.get_field_links(dbo, int(fid))
     db.execute(dbo, "DELETE FROM additionalfield WHERE ID = %d" % int(fid))
     db.execute(dbo, "DELETE FROM additional WHERE AdditionalFieldID = %d" % int(fid))
+    searchindex.update_links(dbo, links)
 
 def delete_values_for_link(dbo, linkid, linktype = "animal"):
     """
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+"""
+    Module for the alert totals shown on the main screen.
+
+    The totals for the whole database are stored in the alertcount
+    table. Functions that change the rows an alert counts call
+    invalidate with the tables they wrote to, which increments the
+    Version of the alerts that depend on those tables. A stored total
+    is only used if it was calculated today for the current Version
+    (CalcVersion), otherwise it is recalculated when it is read. 
+    Totals are only stored if the Version hasn't changed since the 
+    calculation started, so a slow calculation can never overwrite 
+    a later invalidation.
+"""
+
+import al
+import configuration
+import db
+from i18n import now, add_days, subtract_days
+
+# Each alert, the tables it counts from and the subquery that counts it
+ALERTS = (
+    ( "duevacc", ( "animal", "animalvaccination", "configuration" ),
+        "SELECT COUNT(*) FROM animalvaccination INNER JOIN animal ON animal.ID = animalvaccination.AnimalID " \
+        "LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation WHERE " \
+        "DateOfVaccination Is Null AND DeceasedDate Is Null %(shelterfilter)s AND " \
+        "DateRequired  >= %(oneyear)s AND DateRequired <= %(today)s %(locfilter)s" ),
+    ( "expvacc", ( "animal", "animalvaccination", "configuration" ),
+        "SELECT COUNT(*) FROM animalvaccination av1 INNER JOIN animal ON animal.ID = av1.AnimalID " \
+        "LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation WHERE " \
+        "av1.DateOfVaccination Is Not Null AND DeceasedDate Is Null %(shelterfilter)s AND " \
+        "av1.DateExpires  >= %(oneyear)s AND av1.DateExpires <= %(today)s %(locfilter)s AND " \
+        "0 = (SELECT COUNT(*) FROM animalvaccination av2 WHERE av2.AnimalID = av1.AnimalID AND " \
+        "av2.DateRequired > av1.DateRequired AND av2.VaccinationID = av1.VaccinationID)" ),
+    ( "duetest", ( "animal", "animaltest", "configuration" ),
+        "SELECT COUNT(*) FROM animaltest INNER JOIN animal ON animal.ID = animaltest.AnimalID " \
+        "LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation WHERE " \
+        "DateOfTest Is Null AND DeceasedDate Is Null %(shelterfilter)s AND " \
+        "DateRequired >= %(oneyear)s AND DateRequired <= %(today)s %(locfilter)s" ),
+    ( "duemed", ( "animal", "animalmedical", "animalmedicaltreatment", "configuration" ),
+        "SELECT COUNT(*) FROM animalmedicaltreatment INNER JOIN animal ON animal.ID = animalmedicaltreatment.AnimalID " \
+        "INNER JOIN animalmedical ON animalmedicaltreatment.AnimalMedicalID = animalmedical.ID " \
+        "LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation WHERE " \
+        "DateGiven Is Null AND DeceasedDate Is Null %(shelterfilter)s AND " \
+        "Status = 0 AND DateRequired  >= %(oneyear)s AND DateRequired <= %(today)s %(locfilter)s" ),
+    ( "urgentwl", ( "animalwaitinglist", "owner" ),
+        "SELECT COUNT(*) FROM animalwaitinglist INNER JOIN owner ON owner.ID = animalwaitinglist.OwnerID " \
+        "WHERE Urgency = 1 AND DateRemovedFromList Is Null" ),
+    ( "rsvhck", ( "adoption", "owner" ),
+        "SELECT COUNT(*) FROM adoption INNER JOIN owner ON owner.ID = adoption.OwnerID WHERE " \
+        "MovementType = 0 AND ReservationDate Is Not Null AND ReservationCancelledDate Is Null AND IDCheck = 0" ),
+    ( "duedon", ( "ownerdonation", ),
+        "SELECT COUNT(DISTINCT OwnerID) FROM ownerdonation WHERE DateDue <= %(today)s AND Date Is Null" ),
+    ( "endtrial", ( "adoption", ),
+        "SELECT COUNT(*) FROM adoption WHERE IsTrial = 1 AND ReturnDate Is Null AND MovementType = 1 AND TrialEndDate <= %(oneweek)s" ),
+    ( "longrsv", ( "adoption", "animal" ),
+        "SELECT COUNT(*) FROM adoption INNER JOIN animal ON adoption.AnimalID = animal.ID WHERE " \
+        "Archived = 0 AND DeceasedDate Is Null AND ReservationDate Is Not Null AND ReservationDate <= %(oneweek)s " \
+        "AND ReservationCancelledDate Is Null AND MovementType = 0 AND MovementDate Is Null" ),
+    ( "notneu", ( "animal", ),
+        "SELECT COUNT(*) FROM animal LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation " \
+        "WHERE Neutered = 0 AND ActiveMovementType = 1 AND " \
+        "ActiveMovementDate > %(onemonth)s %(locfilter)s" ),
+    ( "notchip", ( "animal", ),
+        "SELECT COUNT(*) FROM animal LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation " \
+        "WHERE Identichipped = 0 AND Archived = 0 %(locfilter)s" ),
+    ( "notadopt", ( "animal", ),
+        "SELECT COUNT(*) FROM animal LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation " \
+        "WHERE IsNotAvailableForAdoption = 1 AND Archived = 0 %(locfilter)s" ),
+    ( "holdtoday", ( "animal", ),
+        "SELECT COUNT(*) FROM animal WHERE IsHold = 1 AND HoldUntilDate = %(today)s AND Archived = 0" ),
+    ( "inform", ( "onlineformincoming", ),
+        "SELECT COUNT(DISTINCT CollationID) FROM onlineformincoming" ),
+    ( "acunfine", ( "ownercitation", ),
+        "SELECT COUNT(*) FROM ownercitation WHERE FineDueDate Is Not Null AND FineDueDate <= %(today)s AND FinePaidDate Is Null" ),
+    ( "acundisp", ( "animalcontrol", ),
+        "SELECT COUNT(*) FROM animalcontrol WHERE CompletedDate Is Null AND DispatchDateTime Is Null AND CallDateTime Is Not Null" ),
+    ( "acuncomp", ( "animalcontrol", ),
+        "SELECT COUNT(*) FROM animalcontrol WHERE CompletedDate Is Null" ),
+    ( "acfoll", ( "animalcontrol", ),
+        "SELECT COUNT(*) FROM animalcontrol WHERE (" \
+        "(FollowupDateTime Is Not Null AND FollowupDateTime <= %(endoftoday)s AND NOT FollowupComplete = 1) OR " \
+        "(FollowupDateTime2 Is Not Null AND FollowupDateTime2 <= %(endoftoday)s AND NOT FollowupComplete2 = 1) OR " \
+        "(FollowupDateTime3 Is Not Null AND FollowupDateTime3 <= %(endoftoday)s) AND NOT FollowupComplete3 = 1)" ),
+    ( "tlover", ( "ownertraploan", ),
+        "SELECT COUNT(*) FROM ownertraploan WHERE ReturnDueDate Is Not Null AND ReturnDueDate <= %(today)s AND ReturnDate Is Null" ),
+    ( "stexpsoon", ( "stocklevel", ),
+        "SELECT COUNT(*) FROM stocklevel WHERE Balance > 0 AND Expiry Is Not Null AND Expiry > %(today)s AND Expiry <= %(futuremonth)s" ),
+    ( "stexp", ( "stocklevel", ),
+        "SELECT COUNT(*) FROM stocklevel WHERE Balance > 0 AND Expiry Is Not Null AND Expiry <= %(today)s" ),
+    ( "trnodrv", ( "animaltransport", ),
+        "SELECT COUNT(*) FROM animaltransport WHERE (DriverOwnerID = 0 OR DriverOwnerID Is Null) AND Status < 10" ),
+    ( "lngterm", ( "animal", ),
+        "SELECT COUNT(*) FROM animal WHERE Archived = 0 AND DaysOnShelter > 182" )
+)
+
+ALERT_NAMES = [ x[0] for x in ALERTS ]
+
+def get_alerts_query(dbo, locationfilter = "", names = ALERT_NAMES):
+    """
+    Returns the query that calculates the alerts in names, with
+    one column for each alert.
+    locationfilter: A clause to restrict the animals counted, beginning with AND
+                    (see animal.get_location_filter_clause)
+    """
+    futuremonth = db.dd(add_days(now(dbo.timezone), 31))
+    oneyear = db.dd(subtract_days(now(dbo.timezone), 365))
+    onemonth = db.dd(subtract_days(now(dbo.timezone), 31))
+    oneweek = db.dd(subtract_days(now(dbo.timezone), 7))
+    today = db.dd(now(dbo.timezone))
+    endoftoday = now(dbo.timezone)
+    endoftoday = db.ddt(endoftoday.replace(hour = 23, minute = 59, second = 59))
+    shelterfilter = ""
+    if not configuration.include_off_shelter_medical(dbo):
+        shelterfilter = " AND (Archived = 0 OR ActiveMovementType = 2)"
+    cols = []
+    for name, tables, sql in ALERTS:
+        if name in names:
+            cols.append("(%s) AS %s" % (sql, name))
+    return "SELECT %s FROM animal LIMIT 1" % ", ".join(cols) \
+        % { "today": today, "endoftoday": endoftoday, "oneweek": oneweek, "oneyear": oneyear, "onemonth": onemonth,
+            "futuremonth": futuremonth, "locfilter": locationfilter, "shelterfilter": shelterfilter }
+
+def get_alerts(dbo):
+    """
+    Returns the alert totals for the whole database, recalculating
+    any that have been invalidated or were calculated before today.
+    Failing to store the totals is logged, the calculated values are 
+    still returned.
+    """
+    calcdate = now(dbo.timezone).replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+    alerts = {}
+    versions = {}
+    for r in db.query(dbo, "SELECT AlertName, AlertValue, Version, " \
+        "CASE WHEN CalcDate = %s AND CalcVersion = Version THEN 1 ELSE 0 END AS Valid FROM alertcount" % db.dd(calcdate)):
+        versions[r["ALERTNAME"]] = r["VERSION"] or 0
+        if r["VALID"] == 1: alerts[r["ALERTNAME"]] = r["ALERTVALUE"]
+    missing = [ x for x in ALERT_NAMES if not alerts.has_key(x) ]
+    if len(missing) == 0: return [ upper_keys(alerts) ]
+    # Create the rows for any alerts we haven't stored before so that
+    # invalidations during the calculation are recorded against them
+    absent = [ x for x in missing if not versions.has_key(x) ]
+    try:
+        db.execute_many(dbo, "INSERT INTO alertcount (AlertName, AlertValue, CalcDate, Version, CalcVersion) VALUES (%s, %s, %s, %s, %s)",
+            [ ( x, 0, calcdate, 0, -1 ) for x in absent ])
+    except Exception,err:
+        # Another request created them first
+        al.error("failed creating alert totals for %s: %s" % (absent, err), "alerts.get_alerts", dbo)
+    for x in absent: versions[x] = 0
+    rows = db.query(dbo, get_alerts_query(dbo, "", missing))
+    # There are no alerts until there's at least one animal
+    if len(rows) == 0: return []
+    for x in missing:
+        alerts[x] = rows[0][x.upper()]
+    try:
+        db.execute_many(dbo, "UPDATE alertcount SET AlertValue = %s, CalcDate = %s, CalcVersion = Version WHERE AlertName = %s AND Version = %s",
+            [ ( alerts[x], calcdate, x, versions[x] ) for x in missing ])
+    except Exception,err:
+        al.error("failed storing alert totals for %s: %s" % (missing, err), "alerts.get_alerts", dbo)
+    return [ upper_keys(alerts) ]
+
+def upper_keys(alerts):
+    """
+    Returns a copy of the dictionary alerts with upper case keys
+    """
+    result = {}
+    for k, v in alerts.iteritems():
+        result[k.upper()] = v
+    return result
+
+def invalidate(dbo, *tables):
+    """
+    Called after writing to tables, invalidates the stored totals
+    for the alerts that count from any of them.
+    """
+    names = [ "'%s'" % name for name, alerttables, sql in ALERTS if len(set(tables).intersection(alerttables)) > 0 ]
+    if len(names) == 0: return
+    try:
+        db.execute(dbo, "UPDATE alertcount SET Version = Version + 1 WHERE AlertName IN (%s)" % ",".join(names))
+    except Exception,err:
+        # Failing to invalidate must never stop the change being saved,
+        # the stored totals are recalculated by the batch anyway
+        al.error("failed invalidating alerts for %s: %s" % (tables, err), "alerts.invalidate", dbo)
+
+def rebuild(dbo):
+    """
+    Recalculates all the stored alert totals
+    """
+    db.execute(dbo, "UPDATE alertcount SET Version = Version + 1")
+    return get_alerts(dbo)
@@ -2,6 +2,7 @@
 
 import additional
 import al
+import alerts
 import animalname
 import audit
 import configuration
@@ -15,6 +16,9 @@ import log
 import lookups
 import media
 import movement
+import searchindex
+import stats
+import timeline
 import utils
 from i18n import _, date_diff, date_diff_days, format_diff, now, today, python2display, subtract_years, subtract_months, add_days, subtract_days, monday_of_week, first_of_month, last_of_month, first_of_year
 from random import choice
@@ -366,6 +370,9 @@ def get_animal_find_simple(dbo, query, classfilter = "all", limit = 0, locationf
         return db.query(dbo, sql)
     ors = []
     query = query.replace("'", "`")
+    # Narrow the search to candidates from the search index if we can
+    ids = searchindex.get_candidates(dbo, searchindex.ANIMAL, query)
+    if ids is not None and len(ids) == 0: return []
     def add(field):
         return utils.where_text_filter(dbo, field, query)
     ors.append(add("a.AnimalName"))
@@ -382,7 +389,9 @@ def get_animal_find_simple(dbo, query, classfilter = "all", limit = 0, locationf
     ors.append(u"EXISTS(SELECT ad.Value FROM additional ad " \
         "INNER JOIN additionalfield af ON af.ID = ad.AdditionalFieldID AND af.Searchable = 1 " \
         "WHERE ad.LinkID=a.ID AND ad.LinkType IN (%s) AND LOWER(ad.Value) LIKE '%%%s%%')" % (additional.ANIMAL_IN, query.lower()))
-    if not dbo.is_large_db: 
+    # Large databases only search the less expensive fields unless they
+    # have been narrowed by the index
+    if not dbo.is_large_db or ids is not None: 
         ors.append(add("a.Markings"))
         ors.append(add("a.HiddenAnimalDetails"))
         ors.append(add("a.AnimalComments"))
@@ -424,6 +433,8 @@ def get_animal_find_simple(dbo, query, classfilter = "all", limit = 0, locationf
     elif classfilter == "female":
         sql += u" a.Sex = 0 AND "
     sql += get_location_filter_clause(locationfilter=locationfilter, tablequalifier="a", siteid=siteid, andsuffix=True)
+    if ids is not None:
+        sql += u"a.ID IN (%s) AND " % ",".join([ str(x) for x in ids ])
     sql += "(" + u" OR ".join(ors) + ") ORDER BY a.Archived, a.AnimalName"
     if limit > 0: sql += " LIMIT " + str(limit)
     return db.query(dbo, sql)
@@ -661,73 +672,14 @@ def get_animals_recently_deceased(dbo):
 
 def get_alerts(dbo, locationfilter = "", siteid = 0):
     """
-    Returns the alert totals for the main screen.
+    Returns the alert totals for the main screen. Totals for the
+    whole database are read from the stored alert counts, 
+    location filtered totals are calculated.
     """
-    futuremonth = db.dd(add_days(now(dbo.timezone), 31))
-    oneyear = db.dd(subtract_days(now(dbo.timezone), 365))
-    onemonth = db.dd(subtract_days(now(dbo.timezone), 31))
-    oneweek = db.dd(subtract_days(now(dbo.timezone), 7))
-    today = db.dd(now(dbo.timezone))
-    endoftoday = now(dbo.timezone)
-    endoftoday = db.ddt(endoftoday.replace(hour = 23, minute = 59, second = 59))
     locationfilter = get_location_filter_clause(locationfilter=locationfilter, siteid=siteid, andprefix=True)
-    shelterfilter = ""
-    if not configuration.include_off_shelter_medical(dbo):
-        shelterfilter = " AND (Archived = 0 OR ActiveMovementType = 2)"
-    sql = "SELECT " \
-        "(SELECT COUNT(*) FROM animalvaccination INNER JOIN animal ON animal.ID = animalvaccination.AnimalID " \
-            "LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation WHERE " \
-            "DateOfVaccination Is Null AND DeceasedDate Is Null %(shelterfilter)s AND " \
-            "DateRequired  >= %(oneyear)s AND DateRequired <= %(today)s %(locfilter)s) AS duevacc," \
-        "(SELECT COUNT(*) FROM animalvaccination av1 INNER JOIN animal ON animal.ID = av1.AnimalID " \
-            "LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation WHERE " \
-            "av1.DateOfVaccination Is Not Null AND DeceasedDate Is Null %(shelterfilter)s AND " \
-            "av1.DateExpires  >= %(oneyear)s AND av1.DateExpires <= %(today)s %(locfilter)s AND " \
-            "0 = (SELECT COUNT(*) FROM animalvaccination av2 WHERE av2.AnimalID = av1.AnimalID AND " \
-            "av2.DateRequired > av1.DateRequired AND av2.VaccinationID = av1.VaccinationID)) AS expvacc," \
-        "(SELECT COUNT(*) FROM animaltest INNER JOIN animal ON animal.ID = animaltest.AnimalID " \
-            "LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation WHERE " \
-            "DateOfTest Is Null AND DeceasedDate Is Null %(shelterfilter)s AND " \
-            "DateRequired >= %(oneyear)s AND DateRequired <= %(today)s %(locfilter)s) AS duetest," \
-        "(SELECT COUNT(*) FROM animalmedicaltreatment INNER JOIN animal ON animal.ID = animalmedicaltreatment.AnimalID " \
-            "INNER JOIN animalmedical ON animalmedicaltreatment.AnimalMedicalID = animalmedical.ID " \
-            "LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation WHERE " \
-            "DateGiven Is Null AND DeceasedDate Is Null %(shelterfilter)s AND " \
-            "Status = 0 AND DateRequired  >= %(oneyear)s AND DateRequired <= %(today)s %(locfilter)s) AS duemed," \
-        "(SELECT COUNT(*) FROM animalwaitinglist INNER JOIN owner ON owner.ID = animalwaitinglist.OwnerID " \
-            "WHERE Urgency = 1 AND DateRemovedFromList Is Null) AS urgentwl," \
-        "(SELECT COUNT(*) FROM adoption INNER JOIN owner ON owner.ID = adoption.OwnerID WHERE " \
-            "MovementType = 0 AND ReservationDate Is Not Null AND ReservationCancelledDate Is Null AND IDCheck = 0) AS rsvhck," \
-        "(SELECT COUNT(DISTINCT OwnerID) FROM ownerdonation WHERE DateDue <= %(today)s AND Date Is Null) AS duedon," \
-        "(SELECT COUNT(*) FROM adoption WHERE IsTrial = 1 AND ReturnDate Is Null AND MovementType = 1 AND TrialEndDate <= %(oneweek)s) AS endtrial," \
-        "(SELECT COUNT(*) FROM adoption INNER JOIN animal ON adoption.AnimalID = animal.ID WHERE " \
-            "Archived = 0 AND DeceasedDate Is Null AND ReservationDate Is Not Null AND ReservationDate <= %(oneweek)s " \
-            "AND ReservationCancelledDate Is Null AND MovementType = 0 AND MovementDate Is Null) AS longrsv," \
-        "(SELECT COUNT(*) FROM animal LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation " \
-            "WHERE Neutered = 0 AND ActiveMovementType = 1 AND " \
-            "ActiveMovementDate > %(onemonth)s %(locfilter)s) AS notneu," \
-        "(SELECT COUNT(*) FROM animal LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation " \
-            "WHERE Identichipped = 0 AND Archived = 0 %(locfilter)s) AS notchip, " \
-        "(SELECT COUNT(*) FROM animal LEFT OUTER JOIN internallocation il ON il.ID = animal.ShelterLocation " \
-            "WHERE IsNotAvailableForAdoption = 1 AND Archived = 0 %(locfilter)s) AS notadopt, " \
-        "(SELECT COUNT(*) FROM animal WHERE IsHold = 1 AND HoldUntilDate = %(today)s AND Archived = 0) AS holdtoday, " \
-        "(SELECT COUNT(DISTINCT CollationID) FROM onlineformincoming) AS inform, " \
-        "(SELECT COUNT(*) FROM ownercitation WHERE FineDueDate Is Not Null AND FineDueDate <= %(today)s AND FinePaidDate Is Null) AS acunfine, " \
-        "(SELECT COUNT(*) FROM animalcontrol WHERE CompletedDate Is Null AND DispatchDateTime Is Null AND CallDateTime Is Not Null) AS acundisp, " \
-        "(SELECT COUNT(*) FROM animalcontrol WHERE CompletedDate Is Null) AS acuncomp, " \
-        "(SELECT COUNT(*) FROM animalcontrol WHERE (" \
-            "(FollowupDateTime Is Not Null AND FollowupDateTime <= %(endoftoday)s AND NOT FollowupComplete = 1) OR " \
-            "(FollowupDateTime2 Is Not Null AND FollowupDateTime2 <= %(endoftoday)s AND NOT FollowupComplete2 = 1) OR " \
-            "(FollowupDateTime3 Is Not Null AND FollowupDateTime3 <= %(endoftoday)s) AND NOT FollowupComplete3 = 1)) AS acfoll, " \
-        "(SELECT COUNT(*) FROM ownertraploan WHERE ReturnDueDate Is Not Null AND ReturnDueDate <= %(today)s AND ReturnDate Is Null) AS tlover, " \
-        "(SELECT COUNT(*) FROM stocklevel WHERE Balance > 0 AND Expiry Is Not Null AND Expiry > %(today)s AND Expiry <= %(futuremonth)s) AS stexpsoon, " \
-        "(SELECT COUNT(*) FROM stocklevel WHERE Balance > 0 AND Expiry Is Not Null AND Expiry <= %(today)s) AS stexp, " \
-        "(SELECT COUNT(*) FROM animaltransport WHERE (DriverOwnerID = 0 OR DriverOwnerID Is Null) AND Status < 10) AS trnodrv, " \
-        "(SELECT COUNT(*) FROM animal WHERE Archived = 0 AND DaysOnShelter > 182) AS lngterm " \
-        "FROM animal LIMIT 1" \
-            % { "today": today, "endoftoday": endoftoday, "oneweek": oneweek, "oneyear": oneyear, "onemonth": onemonth, 
-                "futuremonth": futuremonth, "locfilter": locationfilter, "shelterfilter": shelterfilter }
-    return db.query_cache(dbo, sql)
+    if locationfilter == "":
+        return alerts.get_alerts(dbo)
+    return db.query_cache(dbo, alerts.get_alerts_query(dbo, locationfilter))
 
 def get_stats(dbo):
     """
@@ -739,6 +691,8 @@ def get_stats(dbo):
     if statperiod == "thismonth": statdate = first_of_month(statdate)
     if statperiod == "thisyear": statdate = first_of_year(statdate)
     if statperiod == "alltime": statdate = datetime.datetime(1900, 1, 1)
+    if stats.daily_stats_built(dbo):
+        return stats.get_totals(dbo, statdate)
     countfrom = db.dd(statdate)
     sql = "SELECT " \
         "(SELECT COUNT(*) FROM animal WHERE NonShelterAnimal = 0 AND DateBroughtIn >= %(from)s) AS Entered," \
@@ -799,162 +753,16 @@ def embellish_timeline(l, rows):
         r["DESCRIPTION"] = desc
     return rows
 
-def get_timeline(dbo, limit = 500):
+def get_timeline(dbo, limit = 500, beforedate = None, beforeid = 0):
     """
     Returns a list of recent events at the shelter.
+    To page back through older events, pass the EVENTDATE and
+    EVENTID of the last event returned as beforedate and beforeid.
     """
-    sql = "SELECT * FROM (" \
-        "(SELECT 'animal' AS LinkTarget, 'ENTERED' AS Category, DateBroughtIn AS EventDate, ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
-            "WHERE NonShelterAnimal = 0 " \
-            "ORDER BY DateBroughtIn DESC, ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal' AS LinkTarget, 'MICROCHIP' AS Category, IdentichipDate AS EventDate, ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
-            "WHERE NonShelterAnimal = 0 AND IdentichipDate Is Not Null " \
-            "ORDER BY IdentichipDate DESC, ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal' AS LinkTarget, 'NEUTERED' AS Category, NeuteredDate AS EventDate, ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
-            "WHERE NonShelterAnimal = 0 AND NeuteredDate Is Not Null " \
-            "ORDER BY NeuteredDate DESC, ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_movements' AS LinkTarget, 'RESERVED' AS Category, ReservationDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
-            "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
-            "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
-            "WHERE NonShelterAnimal = 0 AND MovementDate Is Null AND ReservationDate Is Not Null " \
-            "ORDER BY ReservationDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_movements' AS LinkTarget, 'ADOPTED' AS Category, MovementDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
-            "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
-            "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
-            "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 1 " \
-            "ORDER BY MovementDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_movements' AS LinkTarget, 'FOSTERED' AS Category, MovementDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
-            "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
-            "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
-            "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 2 " \
-            "ORDER BY MovementDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_movements' AS LinkTarget, 'TRANSFER' AS Category, MovementDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
-            "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
-            "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
-            "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 3 " \
-            "ORDER BY MovementDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_movements' AS LinkTarget, 'ESCAPED' AS Category, MovementDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, adoption.LastChangedBy FROM animal " \
-            "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
-            "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 4 " \
-            "ORDER BY MovementDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_movements' AS LinkTarget, 'RECLAIMED' AS Category, MovementDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
-            "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
-            "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
-            "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 5 " \
-            "ORDER BY MovementDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_movements' AS LinkTarget, 'STOLEN' AS Category, MovementDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, adoption.LastChangedBy FROM animal " \
-            "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
-            "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 6 " \
-            "ORDER BY MovementDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_movements' AS LinkTarget, 'RELEASED' AS Category, MovementDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, adoption.LastChangedBy FROM animal " \
-            "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
-            "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 7 " \
-            "ORDER BY MovementDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_movements' AS LinkTarget, 'RETAILER' AS Category, MovementDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
-            "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
-            "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
-            "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 8 " \
-            "ORDER BY MovementDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_movements' AS LinkTarget, 'RETURNED' AS Category, ReturnDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
-            "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
-            "LEFT OUTER JOIN owner ON adoption.OwnerID = owner.ID " \
-            "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND ReturnDate Is Not Null " \
-            "ORDER BY ReturnDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal' AS LinkTarget, 'DIED' AS Category, DeceasedDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, ReasonName AS Text3, animal.LastChangedBy FROM animal " \
-            "INNER JOIN deathreason ON animal.PTSReasonID = deathreason.ID " \
-            "WHERE NonShelterAnimal = 0 AND DiedOffShelter = 0 AND PutToSleep = 0 AND DeceasedDate Is Not Null " \
-            "ORDER BY DeceasedDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal' AS LinkTarget, 'EUTHANISED' AS Category, DeceasedDate AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, ReasonName AS Text3, animal.LastChangedBy FROM animal " \
-            "INNER JOIN deathreason ON animal.PTSReasonID = deathreason.ID " \
-            "WHERE NonShelterAnimal = 0 AND DiedOffShelter = 0 AND PutToSleep = 1 AND DeceasedDate Is Not Null " \
-            "ORDER BY DeceasedDate DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal' AS LinkTarget, 'FIVP' AS Category, CombiTestDate AS EventDate, ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
-            "WHERE NonShelterAnimal = 0 AND CombiTested = 1 AND CombiTestDate Is Not Null AND CombiTestResult = 2 " \
-            "ORDER BY CombiTestDate DESC, ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal' AS LinkTarget, 'FLVP' AS Category, CombiTestDate AS EventDate, ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
-            "WHERE NonShelterAnimal = 0 AND CombiTested = 1 AND CombiTestDate Is Not Null AND FLVResult = 2 " \
-            "ORDER BY CombiTestDate DESC, ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal' AS LinkTarget, 'HWP' AS Category, CombiTestDate AS EventDate, ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
-            "WHERE NonShelterAnimal = 0 AND HeartwormTested = 1 AND HeartwormTestDate Is Not Null AND HeartwormTestResult = 2 " \
-            "ORDER BY HeartwormTestDate DESC, ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal' AS LinkTarget, 'QUARANTINE' AS Category, LastChangedDate AS EventDate, ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
-            "WHERE NonShelterAnimal = 0 AND IsQuarantine = 1 " \
-            "ORDER BY LastChangedDate DESC, ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal' AS LinkTarget, 'HOLD' AS Category, DateBroughtIn AS EventDate, ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
-            "WHERE NonShelterAnimal = 0 AND IsHold = 1 " \
-            "ORDER BY DateBroughtIn DESC, ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal' AS LinkTarget, 'NOTADOPT' AS Category, DateBroughtIn AS EventDate, ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
-            "WHERE NonShelterAnimal = 0 AND IsNotAvailableForAdoption = 1 " \
-            "ORDER BY DateBroughtIn DESC, ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal' AS LinkTarget, 'AVAILABLE' AS Category, ActiveMovementReturn AS EventDate, ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
-            "WHERE NonShelterAnimal = 0 AND ActiveMovementReturn Is Not Null AND IsNotAvailableForAdoption = 0 " \
-            "ORDER BY ActiveMovementReturn DESC, ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_vaccination' AS LinkTarget, 'VACC' AS Category, DateOfVaccination AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, VaccinationType AS Text3, animalvaccination.LastChangedBy FROM animal " \
-            "INNER JOIN animalvaccination ON animalvaccination.AnimalID = animal.ID " \
-            "INNER JOIN vaccinationtype ON vaccinationtype.ID = animalvaccination.VaccinationID " \
-            "WHERE NonShelterAnimal = 0 AND DateOfVaccination Is Not Null " \
-            "ORDER BY DateOfVaccination DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_test' AS LinkTarget, 'TEST' AS Category, DateOfTest AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, TestName AS Text3, animaltest.LastChangedBy FROM animal " \
-            "INNER JOIN animaltest ON animaltest.AnimalID = animal.ID " \
-            "INNER JOIN testtype ON testtype.ID = animaltest.TestTypeID " \
-            "WHERE NonShelterAnimal = 0 AND DateOfTest Is Not Null " \
-            "ORDER BY DateOfTest DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'animal_medical' AS LinkTarget, 'MEDICAL' AS Category, DateGiven AS EventDate, animal.ID, " \
-            "ShelterCode AS Text1, AnimalName AS Text2, TreatmentName AS Text3, animalmedicaltreatment.LastChangedBy FROM animal " \
-            "INNER JOIN animalmedicaltreatment ON animalmedicaltreatment.AnimalID = animal.ID " \
-            "INNER JOIN animalmedical ON animalmedicaltreatment.AnimalMedicalID = animalmedical.ID " \
-            "WHERE NonShelterAnimal = 0 AND DateGiven Is Not Null " \
-            "ORDER BY DateGiven DESC, animal.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'incident' AS LinkTarget, 'INCIDENTOPEN' AS Category, IncidentDateTime AS EventDate, animalcontrol.ID, " \
-            "IncidentName AS Text1, DispatchAddress AS Text2, '' AS Text3, LastChangedBy FROM animalcontrol " \
-            "INNER JOIN incidenttype ON incidenttype.ID = animalcontrol.IncidentTypeID " \
-            "ORDER BY IncidentDateTime DESC, animalcontrol.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'incident' AS LinkTarget, 'INCIDENTCLOSE' AS Category, CompletedDate AS EventDate, animalcontrol.ID, " \
-            "IncidentName AS Text1, DispatchAddress AS Text2, CompletedName AS Text3, LastChangedBy FROM animalcontrol " \
-            "INNER JOIN incidenttype ON incidenttype.ID = animalcontrol.IncidentTypeID " \
-            "INNER JOIN incidentcompleted ON incidentcompleted.ID = animalcontrol.IncidentCompletedID " \
-            "ORDER BY CompletedDate DESC, animalcontrol.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'lostanimal' AS LinkTarget, 'LOST' AS Category, DateLost AS EventDate, animallost.ID, " \
-            "DistFeat AS Text1, AreaLost AS Text2, SpeciesName AS Text3, LastChangedBy FROM animallost " \
-            "INNER JOIN species ON animallost.AnimalTypeID = species.ID " \
-            "ORDER BY DateLost DESC, animallost.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'foundanimal' AS LinkTarget, 'FOUND' AS Category, DateFound AS EventDate, animalfound.ID, " \
-            "DistFeat AS Text1, AreaFound AS Text2, SpeciesName AS Text3, LastChangedBy FROM animalfound " \
-            "INNER JOIN species ON animalfound.AnimalTypeID = species.ID " \
-            "ORDER BY DateFound DESC, animalfound.ID LIMIT %(limit)s) " \
-        "UNION ALL (SELECT 'waitinglist' AS LinkTarget, 'WAITINGLIST' AS Category, DatePutOnList AS EventDate, animalwaitinglist.ID, " \
-            "AnimalDescription AS Text1, lkurgency.Urgency AS Text2, '' AS Text3, LastChangedBy FROM animalwaitinglist " \
-            "INNER JOIN lkurgency ON lkurgency.ID = animalwaitinglist.Urgency " \
-            "ORDER BY DatePutOnList DESC, animalwaitinglist.ID LIMIT %(limit)s) " \
-        ") dummy " \
-        "WHERE EventDate <= %(today)s " \
-        "ORDER BY EventDate DESC, ID " \
-        "LIMIT %(limit)s" % { "today": db.ddt(now(dbo.timezone)), "limit": str(limit) }
-    return embellish_timeline(dbo.locale, db.query_cache(dbo, sql, 120))
+    if timeline.timeline_built(dbo):
+        return embellish_timeline(dbo.locale, timeline.get_timeline(dbo, limit, beforedate, beforeid))
+    # The events are calculated from the records until the timeline has been built
+    return embellish_timeline(dbo.locale, db.query_cache(dbo, timeline.get_timeline_query(dbo, limit), 120))
 
 def calc_most_recent_entry(dbo, animalid, a = None):
     """
@@ -1043,7 +851,8 @@ def calc_total_days_on_shelter(dbo, animalid, a = None, movements = None):
     Returns the total number of days an animal has been on the shelter (counting all stays) as an int
     (int) animalid: The animal to get the number of days on shelter for
     a: The animal already loaded, needs Archived, DateBroughtIn, DeceasedDate, ActiveMovementDate
-    movements: A list of movements that includes MovementDate and ReturnDate for this (and possibly other) animal(s) ordered by animalid
+    movements: A list of movements that includes MovementDate and ReturnDate for this (and possibly other) animal(s) ordered by animalid,
+        or a dictionary of animalid to the list of movements for that animal (see get_movement_index)
     """
     stop = now()
     if a is None:
@@ -1069,6 +878,8 @@ def calc_total_days_on_shelter(dbo, animalid, a = None, movements = None):
             "WHERE AnimalID = %d AND MovementType <> 2 " \
             "AND MovementDate Is Not Null AND ReturnDate Is Not Null " \
             "ORDER BY AnimalID" % animalid)
+    if type(movements) == dict:
+        movements = movements.get(animalid, [])
     seen = False
     for m in movements:
         if m["ANIMALID"] == animalid:
@@ -1083,17 +894,43 @@ def calc_total_days_on_shelter(dbo, animalid, a = None, movements = None):
 
     return daysonshelter
 
-def calc_age_group(dbo, animalid, a = None, bands = None):
+def get_movement_index(movements):
     """
-    Returns the age group the animal fits into based on its
-    date of birth.
-    (int) animalid: The animal to calculate the age group for
+    Groups a list of movement rows by their ANIMALID so that the
+    movements for an animal can be found without scanning the list.
+    Returns a dictionary of animalid: [ movements ]
     """
-    def bv(item, bands):
+    index = {}
+    for m in movements:
+        index.setdefault(m["ANIMALID"], []).append(m)
+    return index
+
+def get_age_group_bands(dbo, bands = None):
+    """
+    Returns the age group bands as a list of (upper limit in days, name) 
+    tuples in the order they should be checked.
+    bands: Optional list of ItemName/ItemValue configuration rows to 
+           parse instead of reading the configuration.
+    """
+    def bv(item):
+        if bands is None: return configuration.cstring(dbo, item)
         for b in bands:
             if b["ITEMNAME"] == item:
                 return b["ITEMVALUE"]
         return ""
+    parsed = []
+    for i in xrange(0, 20):
+        parsed.append((utils.cfloat(bv("AgeGroup%d" % i)) * 365, bv("AgeGroup%dName" % i)))
+    return parsed
+
+def calc_age_group(dbo, animalid, a = None, bands = None):
+    """
+    Returns the age group the animal fits into based on its
+    date of birth.
+    (int) animalid: The animal to calculate the age group for
+    bands: Optional age group bands, either as returned by get_age_group_bands
+           or ItemName/ItemValue configuration rows.
+    """
     # Calculate animal's age in days
     dob = None
     if a is None:
@@ -1101,15 +938,13 @@ def calc_age_group(dbo, animalid, a = None, bands = None):
     else:
         dob = a["DATEOFBIRTH"]
     days = date_diff_days(dob, now())
-    # Load age group bands if they weren't passed
-    if bands is None:
-        bands = db.query(dbo, "SELECT ItemName, ItemValue FROM configuration WHERE ItemName LIKE 'AgeGroup%' ORDER BY ItemName")
+    # Parse age group bands if they weren't passed ready parsed
+    if bands is None or (len(bands) > 0 and type(bands[0]) != tuple):
+        bands = get_age_group_bands(dbo, bands)
     # Loop through the bands until we find one that the age in days fits into
-    for i in xrange(0, 20):
-        band = bv("AgeGroup%d" % i, bands)
-        years = utils.cfloat(band)
-        if days <= years * 365:
-            return bv("AgeGroup%dName" % i, bands)
+    for maxdays, name in bands:
+        if days <= maxdays:
+            return name
     # Out of bands and none matched
     return ""
 
@@ -1971,6 +1806,10 @@ def insert_animal_from_form(dbo, post, username):
     update_animal_check_bonds(dbo, nextid)
     update_animal_status(dbo, nextid)
     update_variable_animal_data(dbo, nextid)
+    searchindex.update(dbo, searchindex.ANIMAL, nextid)
+    timeline.update(dbo, timeline.ANIMAL, nextid)
+    alerts.invalidate(dbo, "animal")
+    stats.update_days(dbo, stats.get_days(dbo, "animal", "ID = %d" % nextid))
 
     # If a fosterer was specified, foster the animal
     if post.integer("fosterer") > 0:
@@ -2095,6 +1934,7 @@ def update_animal_from_form(dbo, post, username):
     flagstr = "|".join(flags) + "|"
 
     preaudit = db.query(dbo, "SELECT * FROM animal WHERE ID = %d" % ki("id"))
+    statdays = stats.get_days(dbo, "animal", "ID = %d" % ki("id"))
     db.execute(dbo, db.make_update_user_sql(dbo, "animal", username, "ID=%d" % ki("id"), (
         ( "NonShelterAnimal", db.di(nonshelter)),
         ( "IsNotAvailableForAdoption", db.di(notforadoption)),
@@ -2192,6 +2032,10 @@ def update_animal_from_form(dbo, post, username):
     update_animal_check_bonds(dbo, ki("id"))
     update_animal_status(dbo, ki("id"))
     update_variable_animal_data(dbo, ki("id"))
+    searchindex.update(dbo, searchindex.ANIMAL, ki("id"))
+    timeline.update(dbo, timeline.ANIMAL, ki("id"), [ "animal" ])
+    alerts.invalidate(dbo, "animal")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "animal", "ID = %d" % ki("id")))
 
     # Update any diary notes linked to this animal
     update_diary_linkinfo(dbo, ki("id"))
@@ -2258,6 +2102,9 @@ def update_animals_from_form(dbo, post, username):
                 "returncategory"        : str(default_return_reason)
             }
             movement.insert_movement_from_form(dbo, username, utils.PostedData(move_dict, dbo.locale))
+    searchindex.update(dbo, searchindex.ANIMAL, post.integer_list("animals"))
+    timeline.update(dbo, timeline.ANIMAL, post.integer_list("animals"), [ "animal" ])
+    alerts.invalidate(dbo, "animal")
     return len(post.integer_list("animals"))
 
 def update_deceased_from_form(dbo, username, post):
@@ -2274,12 +2121,17 @@ def update_deceased_from_form(dbo, username, post):
         ( "PTSReason", post.db_string("ptsreason"))
     ))
     preaudit = db.query(dbo, "SELECT * FROM animal WHERE ID = %d" % animalid)
+    statdays = stats.get_days(dbo, "animal", "ID = %d" % animalid)
     db.execute(dbo, sql)
     postaudit = db.query(dbo, "SELECT * FROM animal WHERE ID = %d" % animalid)
     audit.edit(dbo, username, "animal", animalid, audit.map_diff(preaudit, postaudit, [ "ANIMALNAME", ]))
     # Update denormalised fields after the deceased change
     update_animal_status(dbo, animalid)
     update_variable_animal_data(dbo, animalid)
+    alerts.invalidate(dbo, "animal")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "animal", "ID = %d" % animalid))
+    timeline.update(dbo, timeline.ANIMAL, animalid, [ "animal" ])
+    searchindex.update(dbo, searchindex.ANIMAL, animalid)
 
 def update_diary_linkinfo(dbo, animalid, a = None, diaryupdatebatch = None):
     """
@@ -2325,6 +2177,8 @@ def update_location_unit(dbo, username, animalid, newlocationid, newunit = ""):
     db.execute(dbo, "UPDATE animal SET ShelterLocation = %s, ShelterLocationUnit = %s WHERE ID = %s" % (db.di(newlocationid), db.ds(newunit), db.di(animalid)))
     audit.edit(dbo, username, "animal", animalid, "%s: moved to location: %s, unit: %s" % ( animalid, newlocationid, newunit ))
     update_animal_status(dbo, animalid)
+    searchindex.update(dbo, searchindex.ANIMAL, animalid)
+    alerts.invalidate(dbo, "animal")
 
 def clone_animal(dbo, username, animalid):
     """
@@ -2612,6 +2466,10 @@ def clone_animal(dbo, username, animalid):
     audit.create(dbo, username, "animal", nid, audit.dump_row(dbo, "animal", nid))
     update_animal_status(dbo, nid)
     update_variable_animal_data(dbo, nid)
+    searchindex.update(dbo, searchindex.ANIMAL, nid)
+    alerts.invalidate(dbo, "animal")
+    stats.update_days(dbo, stats.get_animal_days(dbo, nid))
+    timeline.update(dbo, timeline.ANIMAL, nid)
     return nid
 
 def clone_from_template(dbo, username, animalid, dob, animaltypeid, speciesid):
@@ -2757,6 +2615,8 @@ def clone_from_template(dbo, username, animalid, dob, animaltypeid, speciesid):
             ( "Description", db.ds(c["DESCRIPTION"]))
         ))
         db.execute(dbo, sql)
+    stats.update_days(dbo, stats.get_animal_days(dbo, animalid))
+    timeline.update(dbo, timeline.ANIMAL, animalid)
 
 def delete_animal(dbo, username, animalid):
     """
@@ -2766,6 +2626,7 @@ def delete_animal(dbo, username, animalid):
     if db.query_int(dbo, "SELECT COUNT(ID) FROM adoption WHERE AnimalID=%d" % animalid):
         raise utils.ASMValidationError(_("This animal has movements and cannot be removed.", l))
     audit.delete(dbo, username, "animal", animalid, audit.dump_row(dbo, "animal", animalid))
+    statdays = stats.get_animal_days(dbo, animalid)
     db.execute(dbo, "DELETE FROM media WHERE LinkID = %d AND LinkTypeID = %d" % (animalid, 0))
     db.execute(dbo, "DELETE FROM diary WHERE LinkID = %d AND LinkType = %d" % (animalid, 1))
     db.execute(dbo, "DELETE FROM log WHERE LinkID = %d AND LinkType = %d" % (animalid, 0))
@@ -2777,6 +2638,10 @@ def delete_animal(dbo, username, animalid):
     db.execute(dbo, "DELETE FROM animalvaccination WHERE AnimalID = %d" % animalid)
     dbfs.delete_path(dbo, "/animal/%d" % animalid)
     db.execute(dbo, "DELETE FROM animal WHERE ID = %d" % animalid)
+    searchindex.delete(dbo, searchindex.ANIMAL, animalid)
+    alerts.invalidate(dbo, "animal", "adoption", "animalmedical", "animalmedicaltreatment", "animalvaccination", "animaltest")
+    stats.update_days(dbo, statdays)
+    timeline.update(dbo, timeline.ANIMAL, animalid)
 
 def update_daily_boarding_cost(dbo, username, animalid, cost):
     """
@@ -2857,6 +2722,7 @@ def insert_cost_from_form(dbo, username, post):
     db.execute(dbo, sql)
     audit.create(dbo, username, "animalcost", ncostid, audit.dump_row(dbo, "animalcost", ncostid))
     financial.update_matching_cost_transaction(dbo, username, ncostid)
+    stats.update_days(dbo, stats.get_days(dbo, "animalcost", "ID = %d" % ncostid))
     return ncostid
 
 def update_cost_from_form(dbo, username, post):
@@ -2872,17 +2738,21 @@ def update_cost_from_form(dbo, username, post):
         ( "Description", post.db_string("description"))
         ))
     preaudit = db.query(dbo, "SELECT * FROM animalcost WHERE ID = %d" % costid)
+    statdays = stats.get_days(dbo, "animalcost", "ID = %d" % costid)
     db.execute(dbo, sql)
     postaudit = db.query(dbo, "SELECT * FROM animalcost WHERE ID = %d" % costid)
     audit.edit(dbo, username, "animalcost", costid, audit.map_diff(preaudit, postaudit))
     financial.update_matching_cost_transaction(dbo, username, costid)
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "animalcost", "ID = %d" % costid))
 
 def delete_cost(dbo, username, cid):
     """
     Deletes a cost record
     """
     audit.delete(dbo, username, "animalcost", cid, audit.dump_row(dbo, "animalcost", cid))
+    statdays = stats.get_days(dbo, "animalcost", "ID = %d" % cid)
     db.execute(dbo, "DELETE FROM animalcost WHERE ID = %d" % cid)
+    stats.update_days(dbo, statdays)
 
 def insert_litter_from_form(dbo, username, post):
     """
@@ -2946,17 +2816,19 @@ def update_variable_animal_data(dbo, animalid, a = None, animalupdatebatch = Non
     (int) animalid: The animal to update
     a: An animal result to use instead of looking it up from the id
     animalupdatebatch: A batch of update parameters
-    bands: List of loaded age group bands
-    movements: List of loaded movements
+    bands: List of loaded age group bands (see get_age_group_bands)
+    movements: List of loaded movements or a movement index (see get_movement_index)
     """
     if animalupdatebatch is not None:
+        daysonshelter = calc_days_on_shelter(dbo, animalid, a)
+        totaldaysonshelter = calc_total_days_on_shelter(dbo, animalid, a, movements)
         animalupdatebatch.append((
-            calc_time_on_shelter(dbo, animalid, a),
+            format_diff(dbo.locale, daysonshelter),
             calc_age_group(dbo, animalid, a, bands),
             calc_age(dbo, animalid, a),
-            calc_days_on_shelter(dbo, animalid, a),
-            calc_total_time_on_shelter(dbo, animalid, a, movements),
-            calc_total_days_on_shelter(dbo, animalid, a, movements),
+            daysonshelter,
+            format_diff(dbo.locale, totaldaysonshelter),
+            totaldaysonshelter,
             animalid
         ))
     else:
@@ -2970,9 +2842,12 @@ def update_variable_animal_data(dbo, animalid, a = None, animalupdatebatch = Non
         ))
         db.execute(dbo, s)
 
-def update_all_variable_animal_data(dbo, include_deceased=False, check_config=True):
+def update_all_variable_animal_data(dbo, include_deceased=False, check_config=True, chunksize=1000):
     """
-    Updates variable animal data for all animals
+    Updates variable animal data for all animals.
+    Animals are processed in ID order, chunksize animals at a time, so that
+    only one chunk of animals and their movements is held in memory and
+    written back at once.
     """
     l = dbo.locale
     
@@ -2983,37 +2858,46 @@ def update_all_variable_animal_data(dbo, include_deceased=False, check_config=Tr
             al.debug("already done today", "animal.update_all_variable_animal_data", dbo)
             return
 
-    animalupdatebatch = []
-
-    # Load age group bands now to save repeated looped lookups
-    bands = db.query(dbo, "SELECT ItemName, ItemValue FROM configuration WHERE ItemName LIKE 'AgeGroup%' ORDER BY ItemName")
+    # Parse age group bands now to save repeated looped lookups
+    bands = get_age_group_bands(dbo)
 
     # Update variable data for either all or non-deceased animals
     where = ""
     if not include_deceased:
         where = "AND DeceasedDate Is Null"
-    animals = db.query(dbo, "SELECT ID, DateBroughtIn, DeceasedDate, DiedOffShelter, Archived, ActiveMovementDate, " \
-        "MostRecentEntryDate, DateOfBirth FROM animal WHERE ID>0 %s" % where)
 
-    # Get a single lookup of movements for our animals
-    movements = db.query(dbo, "SELECT ad.AnimalID, ad.MovementDate, ad.ReturnDate " \
-        "FROM adoption ad INNER JOIN animal a ON a.ID = ad.AnimalID " \
-        "WHERE ad.MovementType <> 2 AND ad.MovementDate Is Not Null AND ad.ReturnDate Is Not Null %s " \
-        "ORDER BY AnimalID" % where)
-
-    for a in animals:
-        update_variable_animal_data(dbo, int(a["ID"]), a, animalupdatebatch, bands, movements)
+    lastid = 0
+    total = 0
+    while True:
+        animals = db.query(dbo, "SELECT ID, DateBroughtIn, DeceasedDate, DiedOffShelter, Archived, ActiveMovementDate, " \
+            "MostRecentEntryDate, DateOfBirth FROM animal WHERE ID>%d %s ORDER BY ID LIMIT %d" % (lastid, where, chunksize))
+        if len(animals) == 0: break
+        firstid = animals[0]["ID"]
+        lastid = animals[-1]["ID"]
+
+        # Get a single lookup of movements for this chunk of animals
+        movements = get_movement_index(db.query(dbo, "SELECT ad.AnimalID, ad.MovementDate, ad.ReturnDate " \
+            "FROM adoption ad INNER JOIN animal a ON a.ID = ad.AnimalID " \
+            "WHERE ad.MovementType <> 2 AND ad.MovementDate Is Not Null AND ad.ReturnDate Is Not Null " \
+            "AND ad.AnimalID >= %d AND ad.AnimalID <= %d %s " \
+            "ORDER BY AnimalID" % (firstid, lastid, where)))
+
+        animalupdatebatch = []
+        for a in animals:
+            update_variable_animal_data(dbo, int(a["ID"]), a, animalupdatebatch, bands, movements)
 
-    db.execute_many(dbo, "UPDATE animal SET " \
-        "TimeOnShelter = %s, " \
-        "AgeGroup = %s, " \
-        "AnimalAge = %s, " \
-        "DaysOnShelter = %s, " \
-        "TotalTimeOnShelter = %s, " \
-        "TotalDaysOnShelter = %s " \
-        "WHERE ID = %s", animalupdatebatch)
+        db.execute_many(dbo, "UPDATE animal SET " \
+            "TimeOnShelter = %s, " \
+            "AgeGroup = %s, " \
+            "AnimalAge = %s, " \
+            "DaysOnShelter = %s, " \
+            "TotalTimeOnShelter = %s, " \
+            "TotalDaysOnShelter = %s " \
+            "WHERE ID = %s", animalupdatebatch)
+        total += len(animals)
+        if len(animals) < chunksize: break
 
-    al.debug("updated variable data for %d animals (locale %s)" % (len(animals), l), "animal.update_all_variable_animal_data", dbo)
+    al.debug("updated variable data for %d animals (locale %s)" % (total, l), "animal.update_all_variable_animal_data", dbo)
 
     # Mark the data as updated today
     configuration.set_variable_data_updated_today(dbo)
@@ -3264,6 +3148,12 @@ def update_animal_status(dbo, animalid, a = None, animalupdatebatch = None, diar
         # No - don't do anything
         return
 
+    # The alerts only count animals by their archived flag and active movement,
+    # the other fields changing doesn't need them recalculating
+    alertschanged = a["ARCHIVED"] != b2i(not on_shelter) or \
+       a["ACTIVEMOVEMENTTYPE"] != activemovementtype or \
+       a["ACTIVEMOVEMENTDATE"] != activemovementdate
+
     # Update our in memory animal
     a["ARCHIVED"] = b2i(not on_shelter)
     a["ACTIVEMOVEMENTID"] = activemovementid
@@ -3308,6 +3198,7 @@ def update_animal_status(dbo, animalid, a = None, animalupdatebatch = None, diar
             ( "HasPermanentFoster", db.di(b2i(has_permanent_foster)) ),
             ( "MostRecentEntryDate", db.ddt(mostrecententrydate) )
             )))
+        if alertschanged: alerts.invalidate(dbo, "animal")
 
 def get_number_animals_on_shelter(dbo, date, speciesid = 0, animaltypeid = 0, internallocationid = 0, ageselection = 0, startofday = False):
     """
@@ -3377,6 +3268,117 @@ def get_number_animals_on_foster(dbo, date, speciesid = 0, animaltypeid = 0):
     sql += " AND (ReturnDate > %s OR ReturnDate Is Null))" % sdate
     return db.query_int(dbo, sql)
 
+def get_number_animals_on_shelter_foster_days(dbo, dates, startofday = False):
+    """
+    Returns the number of animals on shelter, the number of animals on
+    foster and the number of active litters for each of a list of dates
+    (in ascending order). The intake, deceased, movement and litter data
+    covering the dates is loaded once and every count is produced in a
+    single pass, instead of running a query per date as
+    get_number_animals_on_shelter, get_number_animals_on_foster and 
+    get_number_litters_on_shelter do. The rules for what is counted on each
+    date are the same as those functions.
+    startofday: movements that took place on a date are not counted as on shelter if true
+    Returns a dictionary of:
+        onshelter: { ("SP", speciesid, ageselection) or ("AT", animaltypeid, ageselection): [ count for each date ] }
+        onfoster:  { ("SP", speciesid) or ("AT", animaltypeid): [ count for each date ] }
+        litters:   { speciesid (0 for all): [ count for each date ] }
+    ageselection is 0 for all ages, 1 for under six months and 2 for over six months.
+    """
+    import bisect
+    n = len(dates)
+    result = { "onshelter": {}, "onfoster": {}, "litters": {} }
+    if n == 0: return result
+    sod = [ datetime.datetime(d.year, d.month, d.day) for d in dates ]
+    eod = [ d.replace(hour=23, minute=59, second=59) for d in sod ]
+    sixmonthsago = [ subtract_days(d, 182) for d in sod ]
+    shelterdates = eod
+    if startofday: shelterdates = sod
+
+    def inc(counts, key, lo, hi):
+        if key not in counts: counts[key] = [0] * n
+        c = counts[key]
+        for i in xrange(lo, hi):
+            c[i] += 1
+
+    def inc_flags(counts, key, flags):
+        if key not in counts: counts[key] = [0] * n
+        c = counts[key]
+        for i in xrange(0, n):
+            if flags[i]: c[i] += 1
+
+    animals = db.query(dbo, "SELECT ID, SpeciesID, AnimalTypeID, DateOfBirth, DateBroughtIn, DeceasedDate " \
+        "FROM animal WHERE NonShelterAnimal = 0 AND DateBroughtIn <= %s " \
+        "AND (DeceasedDate Is Null OR DeceasedDate > %s)" % (db.ddt(eod[-1]), db.dd(sod[0])))
+    movements = {}
+    for m in db.query(dbo, "SELECT adoption.AnimalID, adoption.MovementType, adoption.MovementDate, adoption.ReturnDate " \
+        "FROM adoption INNER JOIN animal ON animal.ID = adoption.AnimalID " \
+        "WHERE animal.NonShelterAnimal = 0 AND adoption.MovementDate Is Not Null AND adoption.MovementDate <= %s " \
+        "AND (adoption.ReturnDate Is Null OR adoption.ReturnDate >= %s)" % (db.ddt(eod[-1]), db.dd(sod[0]))):
+        movements.setdefault(m["ANIMALID"], []).append(m)
+
+    for a in animals:
+        bi = a["DATEBROUGHTIN"]
+        dec = a["DECEASEDDATE"]
+        dob = a["DATEOFBIRTH"]
+        amoves = movements.get(a["ID"], [])
+
+        # On shelter: brought in on or before the date, not deceased
+        # and with no active movement other than a foster
+        lo = bisect.bisect_left(shelterdates, bi)
+        hi = n
+        if dec is not None: hi = bisect.bisect_left(shelterdates, dec)
+        if lo < hi:
+            flags = [ lo <= i < hi for i in xrange(0, n) ]
+            for m in amoves:
+                if m["MOVEMENTTYPE"] == movement.FOSTER: continue
+                if startofday:
+                    mlo = bisect.bisect_right(sod, m["MOVEMENTDATE"])
+                else:
+                    mlo = bisect.bisect_left(eod, m["MOVEMENTDATE"])
+                mhi = n
+                if m["RETURNDATE"] is not None: mhi = bisect.bisect_right(shelterdates, m["RETURNDATE"])
+                for i in xrange(max(lo, mlo), min(hi, mhi)):
+                    flags[i] = False
+            inc_flags(result["onshelter"], ("SP", a["SPECIESID"], 0), flags)
+            inc_flags(result["onshelter"], ("AT", a["ANIMALTYPEID"], 0), flags)
+            if dob is not None:
+                under = [ flags[i] and dob >= sixmonthsago[i] for i in xrange(0, n) ]
+                over = [ flags[i] and dob < sixmonthsago[i] for i in xrange(0, n) ]
+                inc_flags(result["onshelter"], ("SP", a["SPECIESID"], 1), under)
+                inc_flags(result["onshelter"], ("AT", a["ANIMALTYPEID"], 1), under)
+                inc_flags(result["onshelter"], ("SP", a["SPECIESID"], 2), over)
+                inc_flags(result["onshelter"], ("AT", a["ANIMALTYPEID"], 2), over)
+
+        # On foster: brought in on or before the start of the date, not
+        # deceased and with a foster movement active at the start of the date
+        lo = bisect.bisect_left(sod, bi)
+        hi = n
+        if dec is not None: hi = bisect.bisect_left(sod, dec)
+        if lo < hi:
+            flags = [False] * n
+            for m in amoves:
+                if m["MOVEMENTTYPE"] != movement.FOSTER: continue
+                mlo = bisect.bisect_left(sod, m["MOVEMENTDATE"])
+                mhi = n
+                if m["RETURNDATE"] is not None: mhi = bisect.bisect_left(sod, m["RETURNDATE"])
+                for i in xrange(max(lo, mlo), min(hi, mhi)):
+                    flags[i] = True
+            inc_flags(result["onfoster"], ("SP", a["SPECIESID"]), flags)
+            inc_flags(result["onfoster"], ("AT", a["ANIMALTYPEID"]), flags)
+
+    # Litters: started on or before the date and not invalid yet
+    for r in db.query(dbo, "SELECT SpeciesID, Date, InvalidDate FROM animallitter " \
+        "WHERE Date <= %s AND (InvalidDate Is Null OR InvalidDate > %s)" % (db.ddt(sod[-1]), db.dd(sod[0]))):
+        lo = bisect.bisect_left(sod, r["DATE"])
+        hi = n
+        if r["INVALIDDATE"] is not None: hi = bisect.bisect_left(sod, r["INVALIDDATE"])
+        if lo < hi:
+            inc(result["litters"], r["SPECIESID"], lo, hi)
+            inc(result["litters"], 0, lo, hi)
+
+    return result
+
 def update_animal_figures(dbo, month = 0, year = 0):
     """
     Updates the animal figures table for the month and year given.
@@ -3528,6 +3530,20 @@ def update_animal_figures(dbo, month = 0, year = 0):
     daysinmonth = lom.day
     loopdays = daysinmonth + 1
 
+    # Calculate the daily on shelter, on foster and litter counts
+    # for every species and type in one pass
+    occupancy = get_number_animals_on_shelter_foster_days(dbo, [ datetime.datetime(year, month, i) for i in xrange(1, loopdays) ])
+    usedspecies = set([ r["SPECIESID"] for r in db.query(dbo, "SELECT DISTINCT SpeciesID FROM animal") ])
+    usedtypes = set([ r["ANIMALTYPEID"] for r in db.query(dbo, "SELECT DISTINCT AnimalTypeID FROM animal") ])
+
+    def occupancy_days(counts, key):
+        """ Returns a day dictionary from one of our occupancy count lists """
+        d = {}
+        c = counts.get(key, [0] * daysinmonth)
+        for i in xrange(1, loopdays):
+            d["D%d" % i] = c[i-1]
+        return d
+
     # Species =====================================
     allspecies = lookups.get_species(dbo)
     for sp in allspecies:
@@ -3535,24 +3551,16 @@ def update_animal_figures(dbo, month = 0, year = 0):
         speciesid = int(sp["ID"])
 
         # If we never had anything for this species, skip it
-        if 0 == db.query_int(dbo, "SELECT COUNT(*) FROM animal WHERE SpeciesID = %d" % speciesid):
+        if speciesid not in usedspecies:
             continue
 
         # On Shelter
-        onshelter = {}
-        for i in xrange(1, loopdays):
-            d = datetime.datetime(year, month, i)
-            dk = "D%d" % i
-            onshelter[dk] = get_number_animals_on_shelter(dbo, d, speciesid)
+        onshelter = occupancy_days(occupancy["onshelter"], ("SP", speciesid, 0))
         add_row(1, "SP_ONSHELTER", 0, speciesid, daysinmonth, _("On Shelter", l), 0, False, onshelter)
 
         # On Foster (if foster on shelter set)
         if configuration.foster_on_shelter(dbo):
-            onfoster = {}
-            for i in xrange(1, loopdays):
-                d = datetime.datetime(year, month, i)
-                dk = "D%d" % i
-                onfoster[dk] = get_number_animals_on_foster(dbo, d, speciesid)
+            onfoster = occupancy_days(occupancy["onfoster"], ("SP", speciesid))
             add_row(2, "SP_ONFOSTER", 0, speciesid, daysinmonth, _("On Foster (in figures)", l), 0, False, onfoster)
             #sheltertotal = add_days((onshelter, onfoster)) double count
             sheltertotal = onshelter
@@ -3560,11 +3568,7 @@ def update_animal_figures(dbo, month = 0, year = 0):
             sheltertotal = onshelter
 
         # Litters
-        litters = {}
-        for i in xrange(1, loopdays):
-            d = datetime.datetime(year, month, i)
-            dk = "D%d" % i
-            litters[dk] = get_number_litters_on_shelter(dbo, d, speciesid)
+        litters = occupancy_days(occupancy["litters"], speciesid)
         add_row(3, "SP_LITTERS", 0, speciesid, daysinmonth, _("Litters", l), 0, False, litters)
 
         # Start of day total - handled at the end.
@@ -3732,24 +3736,16 @@ def update_animal_figures(dbo, month = 0, year = 0):
         typeid = int(at["ID"])
 
         # If we never had anything for this type, skip it
-        if 0 == db.query_int(dbo, "SELECT COUNT(*) FROM animal WHERE AnimalTypeID = %d" % typeid):
+        if typeid not in usedtypes:
             continue
 
         # On Shelter
-        onshelter = {}
-        for i in xrange(1, loopdays):
-            d = datetime.datetime(year, month, i)
-            dk = "D%d" % i
-            onshelter[dk] = get_number_animals_on_shelter(dbo, d, 0, typeid)
+        onshelter = occupancy_days(occupancy["onshelter"], ("AT", typeid, 0))
         add_row(1, "AT_ONSHELTER", typeid, 0, daysinmonth, _("On Shelter", l), 0, False, onshelter)
 
         # On Foster (if foster on shelter set)
         if configuration.foster_on_shelter(dbo):
-            onfoster = {}
-            for i in xrange(1, loopdays):
-                d = datetime.datetime(year, month, i)
-                dk = "D%d" % i
-                onfoster[dk] = get_number_animals_on_foster(dbo, d, 0, typeid)
+            onfoster = occupancy_days(occupancy["onfoster"], ("AT", typeid))
             add_row(2, "AT_ONFOSTER", typeid, 0, daysinmonth, _("On Foster (in figures)", l), 0, False, onfoster)
             #sheltertotal = add_days((onshelter, onfoster)) double count
             sheltertotal = onshelter
@@ -5031,10 +5027,12 @@ def auto_cancel_holds(dbo):
     """
     Automatically cancels holds after the hold until date value set
     """
-    sql = "UPDATE animal SET IsHold = 0 WHERE IsHold = 1 AND " \
-        "HoldUntilDate Is Not Null AND " \
+    where = "IsHold = 1 AND HoldUntilDate Is Not Null AND " \
         "HoldUntilDate <= %s" % db.dd(now(dbo.timezone))
-    count = db.execute(dbo, sql)
+    heldids = [ r["ID"] for r in db.query(dbo, "SELECT ID FROM animal WHERE %s" % where) ]
+    count = db.execute(dbo, "UPDATE animal SET IsHold = 0 WHERE %s" % where)
+    alerts.invalidate(dbo, "animal")
+    timeline.update(dbo, timeline.ANIMAL, heldids, [ "animal" ])
     al.debug("cancelled %d holds" % (count), "animal.auto_cancel_holds", dbo)
 
 def maintenance_reassign_all_codes(dbo):
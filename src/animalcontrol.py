@@ -1,12 +1,15 @@
 #!/usr/bin/python
 
 import additional
+import alerts
 import audit
 import configuration
 import db
 import diary
 import log
 import media
+import searchindex
+import timeline
 import users
 import utils
 from i18n import _, now, subtract_days, python2display, format_time_now
@@ -111,6 +114,9 @@ def get_animalcontrol_find_simple(dbo, query = "", username = "", limit = 0):
     if query == "":
         ors.append("ac.IncidentDateTime > %s AND ac.CompletedDate Is Null" % db.dd(subtract_days(now(dbo.timezone), 30)))
     else:
+        # Narrow the search to candidates from the search index if we can
+        ids = searchindex.get_candidates(dbo, searchindex.ANIMALCONTROL, query)
+        if ids is not None and len(ids) == 0: return []
         if utils.is_numeric(query):
             ors.append("ac.ID = " + str(utils.cint(query)))
         ors.append(add("co.OwnerName"))
@@ -124,9 +130,11 @@ def get_animalcontrol_find_simple(dbo, query = "", username = "", limit = 0):
         ors.append(u"EXISTS(SELECT ad.Value FROM additional ad " \
             "INNER JOIN additionalfield af ON af.ID = ad.AdditionalFieldID AND af.Searchable = 1 " \
             "WHERE ad.LinkID=ac.ID AND ad.LinkType IN (%s) AND LOWER(ad.Value) LIKE '%%%s%%')" % (additional.INCIDENT_IN, query.lower()))
-        if not dbo.is_large_db:
+        if not dbo.is_large_db or ids is not None:
             ors.append(add("ac.CallNotes"))
             ors.append(add("ac.AnimalDescription"))
+        if ids is not None:
+            ors = [ "ac.ID IN (%s) AND (%s)" % (",".join([ str(x) for x in ids ]), " OR ".join(ors)) ]
     sql = get_animalcontrol_query(dbo) + " WHERE " + " OR ".join(ors)
     if limit > 0: sql += " LIMIT " + str(limit)
     return reduce_find_results(dbo, username, db.query(dbo, sql))
@@ -324,6 +332,8 @@ def update_animalcontrol_completenow(dbo, acid, username, completetype):
     Updates an animal control incident record, marking it completed now with the type specified
     """
     db.execute(dbo, "UPDATE animalcontrol SET IncidentCompletedID=%s, CompletedDate=%s WHERE ID=%d" % (db.di(completetype), db.dd(now(dbo.timezone)), acid))
+    alerts.invalidate(dbo, "animalcontrol")
+    timeline.update(dbo, timeline.INCIDENT, acid)
     audit.edit(dbo, username, "animalcontrol", acid, "completetype=%s, completedate=%s" % (completetype, now(dbo.timezone)))
 
 def update_animalcontrol_dispatchnow(dbo, acid, username):
@@ -332,6 +342,7 @@ def update_animalcontrol_dispatchnow(dbo, acid, username):
     now with the current user as ACO.
     """
     db.execute(dbo, "UPDATE animalcontrol SET DispatchedACO=%s, DispatchDateTime=%s WHERE ID=%d" % (db.ds(username), db.ddt(now(dbo.timezone)), acid))
+    alerts.invalidate(dbo, "animalcontrol")
     audit.edit(dbo, username, "animalcontrol", acid, "aco=%s, dispatch=%s" % (username, now(dbo.timezone)))
 
 def update_animalcontrol_respondnow(dbo, acid, username):
@@ -390,7 +401,10 @@ def update_animalcontrol_from_form(dbo, post, username):
         ( "Sex", post.db_integer("sex")),
         ( "AgeGroup", post.db_string("agegroup"))
     )))
+    alerts.invalidate(dbo, "animalcontrol")
     additional.save_values_for_link(dbo, post, acid, "incident")
+    searchindex.update(dbo, searchindex.ANIMALCONTROL, acid)
+    timeline.update(dbo, timeline.INCIDENT, acid)
     postaudit = db.query(dbo, "SELECT * FROM animalcontrol WHERE ID = %d" % acid)
     audit.edit(dbo, username, "animalcontrol", acid, audit.map_diff(preaudit, postaudit))
 
@@ -466,10 +480,13 @@ def insert_animalcontrol_from_form(dbo, post, username):
         ( "Sex", post.db_integer("sex")),
         ( "AgeGroup", post.db_string("agegroup"))
         )))
+    alerts.invalidate(dbo, "animalcontrol")
     audit.create(dbo, username, "animalcontrol", nid, audit.dump_row(dbo, "animalcontrol", nid))
 
     # Save any additional field values given
     additional.save_values_for_link(dbo, post, nid, "incident")
+    searchindex.update(dbo, searchindex.ANIMALCONTROL, nid)
+    timeline.update(dbo, timeline.INCIDENT, nid)
 
     # Update view/edit roles
     db.execute(dbo, "DELETE FROM animalcontrolrole WHERE AnimalControlID = %d" % nid)
@@ -489,10 +506,13 @@ def delete_animalcontrol(dbo, username, acid):
     """
     audit.delete(dbo, username, "animalcontrol", acid, audit.dump_row(dbo, "animalcontrol", acid))
     db.execute(dbo, "DELETE FROM animalcontrol WHERE ID = %d" % acid)
+    alerts.invalidate(dbo, "animalcontrol")
     db.execute(dbo, "DELETE FROM media WHERE LinkID = %d AND LinkTypeID = %d" % (acid, media.ANIMALCONTROL))
     db.execute(dbo, "DELETE FROM diary WHERE LinkID = %d AND LinkType = %d" % (acid, diary.ANIMALCONTROL))
     db.execute(dbo, "DELETE FROM log WHERE LinkID = %d AND LinkType = %d" % (acid, log.ANIMALCONTROL))
     db.execute(dbo, "DELETE FROM additional WHERE LinkID = %d AND LinkType IN (%s)" % (acid, additional.INCIDENT_IN))
+    searchindex.delete(dbo, searchindex.ANIMALCONTROL, acid)
+    timeline.update(dbo, timeline.INCIDENT, acid)
 
 def insert_animalcontrol(dbo, username):
     """
@@ -527,6 +547,7 @@ def insert_traploan_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "ownertraploan")
     audit.create(dbo, username, "ownertraploan", traploanid, audit.dump_row(dbo, "ownertraploan", traploanid))
     return traploanid
 
@@ -548,6 +569,7 @@ def update_traploan_from_form(dbo, username, post):
     ))
     preaudit = db.query(dbo, "SELECT * FROM ownertraploan WHERE ID = %d" % traploanid)
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "ownertraploan")
     postaudit = db.query(dbo, "SELECT * FROM ownertraploan WHERE ID = %d" % traploanid)
     audit.edit(dbo, username, "ownertraploan", traploanid, audit.map_diff(preaudit, postaudit))
 
@@ -557,6 +579,7 @@ def delete_traploan(dbo, username, tid):
     """
     audit.delete(dbo, username, "ownertraploan", tid, audit.dump_row(dbo, "ownertraploan", tid))
     db.execute(dbo, "DELETE FROM ownertraploan WHERE ID = %d" % int(tid))
+    alerts.invalidate(dbo, "ownertraploan")
 
 def update_dispatch_latlong(dbo, incidentid, latlong):
     """
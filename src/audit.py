@@ -11,6 +11,8 @@ MOVE = 3
 LOGIN = 4
 LOGOUT = 5
 
+INSERT_SQL = "INSERT INTO audittrail (Action, AuditDate, UserName, TableName, LinkID, Description) VALUES (%s, %s, %s, %s, %s, %s)"
+
 def get_audit_for_link(dbo, tablename, linkid):
     """ Returns the audit records for a particular link and table """
     return db.query(dbo, "SELECT * FROM audittrail WHERE tablename = %s AND linkid = %s ORDER BY AuditDate DESC" % (db.ds(tablename), db.di(linkid)))
@@ -52,6 +54,13 @@ def map_diff(row1, row2, ref = []):
 def dump_row(dbo, tablename, rowid):
     return str(db.query(dbo, "SELECT * FROM %s WHERE ID = %s" % (tablename, rowid)))
 
+def dump_dict(row):
+    """
+    Returns a description of a row we are inserting (a dict of column 
+    names to values) in the same format as dump_row
+    """
+    return str([ dict([ (k.upper(), v) for k, v in row.iteritems() ]) ])
+
 def create(dbo, username, tablename, linkid, description):
     action(dbo, ADD, username, tablename, linkid, description)
 
@@ -74,9 +83,7 @@ def action(dbo, action, username, tablename, linkid, description):
     """
     Adds an audit record
     """
-    # Truncate description field to 16k if it's very long
-    if len(description) > 16384:
-        description = description[0:16384]
+    description = truncate(description)
 
     sql = db.make_insert_sql("audittrail", (
         ( "Action", db.ds(action) ),
@@ -88,6 +95,21 @@ def action(dbo, action, username, tablename, linkid, description):
         ))
     db.execute(dbo, sql)
 
+def action_params(dbo, action, username, tablename, linkid, description):
+    """
+    Returns a tuple of parameters for INSERT_SQL, so that many audit 
+    records can be added with db.execute_many
+    """
+    return ( action, i18n.now(dbo.timezone), username, tablename, linkid, truncate(description) )
+
+def truncate(description):
+    """
+    Truncates the description field to 16k if it's very long
+    """
+    if len(description) > 16384:
+        description = description[0:16384]
+    return description
+
 def clean(dbo):
     """
     Deletes audit trail records older than three months
@@ -9,6 +9,7 @@ import al
 import cPickle as pickle
 import hashlib
 import os
+import tempfile
 import time
 from sitedefs import DISK_CACHE
 
@@ -30,7 +31,7 @@ def delete(key):
     """
     try:
         fname = _getfilename(key)
-        os.unlink(fname)
+        if os.path.exists(fname): os.unlink(fname)
     except Exception,err:
         al.error(str(err), "cachedisk.delete")
 
@@ -71,6 +72,7 @@ def put(key, value, ttl):
     will be removed if it is accessed past the ttl.
     """
     f = None
+    tmpname = None
     try:
         fname = _getfilename(key)
 
@@ -79,12 +81,21 @@ def put(key, value, ttl):
             "value": value
         }
 
-        # Write the entry
-        f = open(fname, "w")
+        # Write the entry to a temporary file and move it into place
+        # so that other threads and processes never read a partially 
+        # written entry
+        fd, tmpname = tempfile.mkstemp(dir = DISK_CACHE)
+        f = os.fdopen(fd, "w")
         pickle.dump(o, f)
+        f.close()
+        os.rename(tmpname, fname)
 
     except Exception,err:
         al.error(str(err), "cachedisk.put")
+        try:
+            if tmpname is not None and os.path.exists(tmpname): os.unlink(tmpname)
+        except:
+            pass
     finally:
         try:
             f.close()
@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-import os, sys
+import os, sys, traceback
 
 # The path to the folder containing the ASM3 modules
 PATH = os.path.dirname(os.path.abspath(__file__)) + os.sep
@@ -376,6 +376,23 @@ def full_or_json(modulename, s, c, json = False):
         if c.endswith(","): c = c[0:len(c)-1]
         return "{ %s }" % c
 
+def report_stream(dbo, chunks):
+    """
+    Returns the chunks of HTML from reports.execute_stream to web.py.
+    Errors while rendering the rest of the report happen after the 
+    response has started and cannot become a 500 page, so they are 
+    logged, emailed to the admin if EMAIL_ERRORS is set and shown at 
+    the end of the report instead.
+    """
+    try:
+        for c in chunks:
+            yield c
+    except Exception,err:
+        al.error("report failed: %s" % str(err), "code.report_stream", dbo, sys.exc_info())
+        if EMAIL_ERRORS:
+            utils.send_email(dbo, ADMIN_EMAIL, ADMIN_EMAIL, "", "Report error @ %s" % dbo.database, traceback.format_exc(), "plain")
+        yield "<p>%s: %s</p>" % (_("Error", dbo.locale), err)
+
 # SSL for the server can be passed as an extra startup argument, eg:
 # python code.py 5000 ssl=true,cert=/etc/cert.crt,key=/etc/cert.key,chain=/etc/chain.crt
 if len(sys.argv) > 2:
@@ -468,15 +485,32 @@ class database:
 class image:
     def GET(self):
         utils.check_loggedin(session, web)
-        post = utils.PostedData(web.input(mode = "animal", id = "0", seq = -1), session.locale)
+        post = utils.PostedData(web.input(mode = "animal", id = "0", seq = -1, size = ""), session.locale)
+        mode = post["mode"]
+        size = extmedia.get_image_size(mode, post["size"])
+        etag = ""
+        mm = None
+        try:
+            if mode != "dbfs":
+                mm = extmedia.get_image_file_media(session.dbo, mode, post["id"], post.integer("seq"))
+                if len(mm) > 0: etag = extmedia.get_image_etag(session.dbo, mm[0], size)
+        except Exception,err:
+            al.error("%s" % str(err), "code.image", session.dbo)
+            return ""
+        # Let the browser use the copy it has if the image hasn't changed
+        if etag != "":
+            lastmod = extmedia.get_image_last_modified(session.dbo, mm[0])
+            if lastmod is not None: web.lastmodified(lastmod)
+            web.header("Cache-Control", "max-age=86400")
+            web.modified(etag=etag)
         try:
-            lastmod, imagedata = extmedia.get_image_file_data(session.dbo, post["mode"], post["id"], post.integer("seq"), False)
+            lastmod, imagedata = extmedia.get_image_file_data(session.dbo, mode, post["id"], post.integer("seq"), False, size, mm)
         except Exception,err:
             al.error("%s" % str(err), "code.image", session.dbo)
             return ""
         if imagedata != "NOPIC":
             web.header("Content-Type", "image/jpeg")
-            web.header("Cache-Control", "max-age=86400")
+            if etag == "": web.header("Cache-Control", "max-age=86400")
             return imagedata
         else:
             web.header("Content-Type", "image/jpeg")
@@ -711,7 +745,7 @@ class mobile_report:
         # If the report doesn't take criteria, just show it
         if crit == "":
             al.debug("report %d has no criteria, displaying" % crid, "code.mobile_report", dbo)
-            return extreports.execute(dbo, crid, user)
+            return report_stream(dbo, extreports.execute_stream(dbo, crid, user))
         # If we're in criteria mode (and there are some to get here), ask for them
         elif mode == "criteria":
             title = extreports.get_title(dbo, crid)
@@ -722,7 +756,7 @@ class mobile_report:
         elif mode == "exec":
             al.debug("got criteria (%s), executing report %d" % (str(post.data), crid), "code.report", dbo)
             p = extreports.get_criteria_params(dbo, crid, post)
-            return extreports.execute(dbo, crid, user, p)
+            return report_stream(dbo, extreports.execute_stream(dbo, crid, user, p))
 
 class mobile_sign:
     def GET(self):
@@ -5726,7 +5760,7 @@ class report:
         # If the report doesn't take criteria, just show it
         if crit == "":
             al.debug("report %d has no criteria, displaying" % crid, "code.report", dbo)
-            return extreports.execute(dbo, crid, user)
+            return report_stream(dbo, extreports.execute_stream(dbo, crid, user))
         # If we're in criteria mode (and there are some to get here), ask for them
         elif mode == "criteria":
             title = extreports.get_title(dbo, crid)
@@ -5748,7 +5782,7 @@ class report:
         elif mode == "exec":
             al.debug("got criteria (%s), executing report %d" % (str(post.data), crid), "code.report", dbo)
             p = extreports.get_criteria_params(dbo, crid, post)
-            return extreports.execute(dbo, crid, user, p)
+            return report_stream(dbo, extreports.execute_stream(dbo, crid, user, p))
 
 class report_export:
     def GET(self):
@@ -6269,7 +6303,10 @@ class timeline:
         l = session.locale
         dbo = session.dbo
         post = utils.PostedData(web.input(), session.locale)
-        evts = extanimal.get_timeline(dbo, 500)
+        # Older events are paged with the date and ID of the last event shown
+        beforedate = None
+        if post["beforedate"] != "": beforedate = post.datetime("beforedate", "beforetime")
+        evts = extanimal.get_timeline(dbo, 500, beforedate, post.integer("beforeid"))
         s = html.header("", session)
         c = html.controller_json("recent", evts)
         c += html.controller_str("explain", _("Showing {0} timeline events.", l).format(len(evts)));
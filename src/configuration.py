@@ -1,10 +1,13 @@
 #!/usr/bin/python
 
+import alerts
 import audit
+import cachemem
 import db
 import i18n
+import threading
 import time
-from sitedefs import LOCALE, TIMEZONE
+from sitedefs import LOCALE, TIMEZONE, CACHE_CONFIGURATION, CACHE_VERSION_CHECK
 
 QUICKLINKS_SET = {
     1: ("animal_find", "asm-icon-animal-find", i18n._("Find animal")),
@@ -288,8 +291,88 @@ DEFAULTS = {
     "WeightChangeLogType": "4"
 }
 
+# In-process snapshots of each database's configuration table, keyed
+# by database. Each entry is a dict containing the version token it was
+# loaded under, the time it was loaded, the time the token was last
+# checked, the raw rows and a lookup of lower cased item names to values.
+config_snapshots = {}
+config_lock = threading.Lock()
+
+def _snapshot_key(dbo):
+    return "%s:%s:%s:%s" % (dbo.host, dbo.port, dbo.database, dbo.alias)
+
+def _version_key(dbo):
+    return "config:ver:%s" % _snapshot_key(dbo)
+
+def _version(dbo):
+    """
+    Returns the current configuration version token for dbo. The token is
+    held in cachemem so that it is shared between processes when memcached
+    is in use. If there isn't one, a new token is issued.
+    """
+    v = cachemem.get(_version_key(dbo))
+    if v is None:
+        v = "%0.6f" % time.time()
+        cachemem.put(_version_key(dbo), v, 86400)
+    return v
+
+def _current(dbo, snap):
+    """
+    Returns True if snap can still be used. The version token is only
+    read from the cache once every CACHE_VERSION_CHECK seconds.
+    """
+    if snap is None or time.time() - snap["loaded"] >= CACHE_CONFIGURATION: return False
+    if time.time() - snap["checked"] < CACHE_VERSION_CHECK: return True
+    if snap["version"] != _version(dbo): return False
+    snap["checked"] = time.time()
+    return True
+
+def _snapshot(dbo):
+    """
+    Returns the configuration snapshot for dbo, loading the whole
+    configuration table in a single query if we don't have a snapshot
+    or the one we have has been invalidated or is older than
+    CACHE_CONFIGURATION seconds.
+    """
+    key = _snapshot_key(dbo)
+    snap = config_snapshots.get(key)
+    if _current(dbo, snap): return snap
+    config_lock.acquire()
+    try:
+        # Another thread may have reloaded while we waited for the lock
+        snap = config_snapshots.get(key)
+        if _current(dbo, snap): return snap
+        version = _version(dbo)
+        rows = db.query(dbo, "SELECT ITEMNAME, ITEMVALUE FROM configuration ORDER BY ITEMNAME")
+        values = {}
+        for r in rows:
+            name = str(r["ITEMNAME"]).lower()
+            if not values.has_key(name): values[name] = r["ITEMVALUE"]
+        snap = { "version": version, "loaded": time.time(), "checked": time.time(), "rows": rows, "values": values }
+        config_snapshots[key] = snap
+        return snap
+    finally:
+        config_lock.release()
+
+def invalidate(dbo):
+    """
+    Discards the configuration snapshot for dbo in this process and issues
+    a new version token so that any other process sharing the cache
+    reloads its snapshot on next read.
+    """
+    config_lock.acquire()
+    try:
+        config_snapshots.pop(_snapshot_key(dbo), None)
+        cachemem.put(_version_key(dbo), "%0.6f" % time.time(), 86400)
+    finally:
+        config_lock.release()
+
 def cstring(dbo, key, default = ""):
     try:
+        if CACHE_CONFIGURATION > 0:
+            v = _snapshot(dbo)["values"].get(key.lower())
+            if v is None or v == "": return default
+            return v
         rows = db.query(dbo, "SELECT ITEMVALUE FROM configuration WHERE ITEMNAME LIKE '%s'" % key)
         if len(rows) == 0: return default
         v = rows[0]["ITEMVALUE"]
@@ -334,6 +417,7 @@ def cset(dbo, key, value = "", ignoreDBLock = False, sanitiseXSS = True):
         affected = db.execute(dbo, "UPDATE configuration SET ItemValue = %s WHERE ItemName LIKE %s" % (db.ds(value, sanitiseXSS), db.ds(key)))
         if affected == 0:
             db.execute(dbo, "INSERT INTO configuration VALUES (%s, %s)" % ( db.ds(key), db.ds(value, sanitiseXSS) ), ignoreDBLock)
+    invalidate(dbo)
 
 def cset_db(dbo, key, value = ""):
     """
@@ -394,8 +478,13 @@ def csave(dbo, username, post):
         else:
             # Must be a string
             cset(dbo, k, v)
+    invalidate(dbo)
+    alerts.invalidate(dbo, "configuration")
     audit.edit(dbo, username, "configuration", 0, str(post))
 
+def account_balances_updated(dbo):
+    return cstring(dbo, "AccountBalancesUpdated")
+
 def account_period_totals(dbo):
     return cboolean(dbo, "AccountPeriodTotals")
 
@@ -531,6 +620,9 @@ def create_cost_trx(dbo):
 def create_donation_trx(dbo):
     return cboolean(dbo, "CreateDonationTrx")
 
+def daily_stats_updated(dbo):
+    return cstring(dbo, "DailyStatsUpdated")
+
 def dbv(dbo, v = None):
     if v is None:
         return cstring(dbo, "DBV", "2870")
@@ -542,6 +634,8 @@ def db_lock(dbo):
     Locks the database for updates, returns True if the lock was
     successful.
     """
+    # Always check the lock against the database, another process may hold it
+    invalidate(dbo)
     if cboolean(dbo, "DBLock"): return False
     cset_db(dbo, "DBLock", "Yes")
     return True
@@ -695,7 +789,10 @@ def get_map(dbo):
         if s is None: return ""
         s = str(s)
         return s.replace("\"", "\\\"")
-    rows = db.query(dbo, "SELECT ITEMNAME, ITEMVALUE FROM configuration ORDER BY ITEMNAME")
+    if CACHE_CONFIGURATION > 0:
+        rows = _snapshot(dbo)["rows"]
+    else:
+        rows = db.query(dbo, "SELECT ITEMNAME, ITEMVALUE FROM configuration ORDER BY ITEMNAME")
     cmap = DEFAULTS.copy()
     for r in rows:
         cmap[r["ITEMNAME"]] = escape(r["ITEMVALUE"])
@@ -743,6 +840,15 @@ def lostfound_last_match_count(dbo, newcount = -1):
     else:
         cset(dbo, "LostFoundLastMatchCount", "%d" % newcount)
 
+def lostfound_match_full(dbo):
+    return cstring(dbo, "LostFoundMatchFull")
+
+def lostfound_match_settings(dbo):
+    return cstring(dbo, "LostFoundMatchSettings")
+
+def lostfound_match_updated(dbo):
+    return cstring(dbo, "LostFoundMatchUpdated")
+
 def main_screen_animal_link_mode(dbo):
     return cstring(dbo, "MainScreenAnimalLinkMode", DEFAULTS["MainScreenAnimalLinkMode"])
 
@@ -949,6 +1055,9 @@ def retailer_on_shelter(dbo):
 def scale_pdfs(dbo):
     return cboolean(dbo, "ScalePDFs", DEFAULTS["ScalePDFs"] == "Yes")
 
+def search_index_updated(dbo):
+    return cstring(dbo, "SearchIndexUpdated")
+
 def search_sort(dbo):
     return cint(dbo, "SearchSort", 3)
 
@@ -958,6 +1067,27 @@ def service_enabled(dbo):
 def service_auth_enabled(dbo):
     return cboolean(dbo, "ServiceAuthEnabled", DEFAULTS["ServiceAuthEnabled"] == "Yes")
 
+def set_account_balances_updated(dbo, built = True):
+    cset_db(dbo, "AccountBalancesUpdated", built and time.strftime("%Y%m%d%H%M%S", i18n.now().timetuple()) or "")
+
+def set_daily_stats_updated(dbo, built = True):
+    cset_db(dbo, "DailyStatsUpdated", built and time.strftime("%Y%m%d%H%M%S", i18n.now().timetuple()) or "")
+
+def set_lostfound_match_full(dbo, d):
+    cset_db(dbo, "LostFoundMatchFull", time.strftime("%Y%m%d%H%M%S", d.timetuple()))
+
+def set_lostfound_match_settings(dbo, s):
+    cset_db(dbo, "LostFoundMatchSettings", s)
+
+def set_lostfound_match_updated(dbo, d):
+    cset_db(dbo, "LostFoundMatchUpdated", time.strftime("%Y%m%d%H%M%S", d.timetuple()))
+
+def set_search_index_updated(dbo, built = True):
+    cset_db(dbo, "SearchIndexUpdated", built and time.strftime("%Y%m%d%H%M%S", i18n.now().timetuple()) or "")
+
+def set_timeline_updated(dbo, built = True):
+    cset_db(dbo, "TimelineUpdated", built and time.strftime("%Y%m%d%H%M%S", i18n.now().timetuple()) or "")
+
 def set_variable_data_updated_today(dbo):
     cset_db(dbo, "VariableAnimalDataUpdated", time.strftime("%Y%m%d", i18n.now().timetuple()))
 
@@ -1012,6 +1142,9 @@ def use_short_shelter_codes(dbo):
 def third_party_publisher_sig(dbo):
     return cstring(dbo, "TPPublisherSig")
 
+def timeline_updated(dbo):
+    return cstring(dbo, "TimelineUpdated")
+
 def timezone(dbo):
     return cint(dbo, "Timezone", TIMEZONE)
 
@@ -7,6 +7,7 @@ sys.path.append(os.getcwd())
 sys.path.append(os.getcwd() + os.sep + "locale")
 
 import al
+import alerts
 import audit
 import animal
 import configuration
@@ -14,6 +15,7 @@ import db
 import dbfs
 import dbupdate
 import diary
+import financial
 import i18n
 import lostfound
 import media
@@ -22,7 +24,10 @@ import onlineform
 import person
 import publish
 import reports as extreports
+import searchindex
 import smcom
+import stats
+import timeline
 import utils
 import waitinglist
 from sitedefs import LOCALE, TIMEZONE, MULTIPLE_DATABASES, MULTIPLE_DATABASES_TYPE, MULTIPLE_DATABASES_MAP, SCALE_PDF_DURING_BATCH
@@ -67,6 +72,30 @@ def daily(dbo):
             em = str(sys.exc_info()[0])
             al.error("FAIL: running variable data update: %s" % em, "cron.daily", dbo, sys.exc_info())
 
+        try:
+            # Rebuild the search index to pick up any changes made
+            # outside of the normal record screens
+            searchindex.rebuild(dbo)
+        except:
+            em = str(sys.exc_info()[0])
+            al.error("FAIL: running search index rebuild: %s" % em, "cron.daily", dbo, sys.exc_info())
+
+        try:
+            # Check the account balance ledger against the transactions
+            # and rebuild it if it's out of step or hasn't been built
+            financial.check_account_balances(dbo)
+        except:
+            em = str(sys.exc_info()[0])
+            al.error("FAIL: running account balance check: %s" % em, "cron.daily", dbo, sys.exc_info())
+
+        try:
+            # Check the daily stats against the records and rebuild
+            # them if they're out of step or haven't been built
+            stats.check_daily_stats(dbo)
+        except:
+            em = str(sys.exc_info()[0])
+            al.error("FAIL: running daily stats check: %s" % em, "cron.daily", dbo, sys.exc_info())
+
         try:
             # Update animal figures for reports
             animal.update_animal_figures(dbo)
@@ -113,6 +142,23 @@ def daily(dbo):
         if SCALE_PDF_DURING_BATCH:
             media.check_and_scale_pdfs(dbo)
 
+        try:
+            # Recalculate the stored main screen alert totals for today
+            # to pick up any changes made outside of the normal screens
+            alerts.rebuild(dbo)
+        except:
+            em = str(sys.exc_info()[0])
+            al.error("FAIL: running alert totals rebuild: %s" % em, "cron.daily", dbo, sys.exc_info())
+
+        try:
+            # Check the timeline events against the records and correct
+            # the ones changed outside of the normal screens, or build 
+            # them the first time to backfill them
+            timeline.check_timeline(dbo)
+        except:
+            em = str(sys.exc_info()[0])
+            al.error("FAIL: running timeline check: %s" % em, "cron.daily", dbo, sys.exc_info())
+
     except:
         em = str(sys.exc_info()[0])
         al.error("FAIL: running batch tasks: %s" % em, "cron.daily", dbo, sys.exc_info())
@@ -158,7 +204,7 @@ def reports_email(dbo):
         al.error("FAIL: running daily email of reports_email: %s" % em, "cron.reports_email", dbo, sys.exc_info())
     al.info("end batch reports_email", "cron.reports_email", dbo)
 
-def publish_ap(dbo):
+def publish_ap(dbo, snapshot = None):
     try :
 
         pc = publish.PublishCriteria(configuration.publisher_presets(dbo))
@@ -169,6 +215,7 @@ def publish_ap(dbo):
         if publishers.find("ap") != -1:
             al.info("start adoptapet publisher", "cron.publish_ap", dbo)
             ap = publish.AdoptAPetPublisher(dbo, pc)
+            ap.snapshot = snapshot
             ap.run()
             al.info("end adoptapet publisher", "cron.publish_ap", dbo)
 
@@ -194,7 +241,7 @@ def publish_fa(dbo):
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running foundanimals publisher: %s" % em, "cron.publish_fa", dbo, sys.exc_info())
 
-def publish_mp(dbo):
+def publish_mp(dbo, snapshot = None):
     try :
 
         pc = publish.PublishCriteria(configuration.publisher_presets(dbo))
@@ -205,6 +252,7 @@ def publish_mp(dbo):
         if publishers.find("mp") != -1:
             al.info("start meetapet publisher", "cron.publish_mp", dbo)
             mp = publish.MeetAPetPublisher(dbo, pc)
+            mp.snapshot = snapshot
             mp.run()
             al.info("end meetapet publisher", "cron.publish_mp", dbo)
 
@@ -212,7 +260,7 @@ def publish_mp(dbo):
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running meetapet publisher: %s" % em, "cron.publish_mp", dbo, sys.exc_info())
 
-def publish_hlp(dbo):
+def publish_hlp(dbo, snapshot = None):
     try :
 
         pc = publish.PublishCriteria(configuration.publisher_presets(dbo))
@@ -223,6 +271,7 @@ def publish_hlp(dbo):
         if publishers.find("hlp") != -1:
             al.info("start helpinglostpets publisher", "cron.publish_hlp", dbo)
             pn = publish.HelpingLostPetsPublisher(dbo, pc)
+            pn.snapshot = snapshot
             pn.run()
             al.info("end helpinglostpets publisher", "cron.publish_hlp", dbo)
 
@@ -230,7 +279,7 @@ def publish_hlp(dbo):
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running helpinglostpets publisher: %s" % em, "cron.publish_hlp", dbo, sys.exc_info())
 
-def publish_html(dbo):
+def publish_html(dbo, snapshot = None):
     try :
 
         pc = publish.PublishCriteria(configuration.publisher_presets(dbo))
@@ -239,6 +288,7 @@ def publish_html(dbo):
         if publishers.find("html") != -1:
             al.info("start html publisher", "cron.publish_html", dbo)
             h = publish.HTMLPublisher(dbo, pc, "cron")
+            h.snapshot = snapshot
             h.run()
             al.info("end html publisher", "cron.publish_html", dbo)
 
@@ -246,7 +296,7 @@ def publish_html(dbo):
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running html publisher: %s" % em, "cron.publish_html", dbo, sys.exc_info())
 
-def publish_pf(dbo):
+def publish_pf(dbo, snapshot = None):
     try :
 
         pc = publish.PublishCriteria(configuration.publisher_presets(dbo))
@@ -257,6 +307,7 @@ def publish_pf(dbo):
         if publishers.find("pf") != -1:
             al.info("start petfinder publisher", "cron.publish_pf", dbo)
             pf = publish.PetFinderPublisher(dbo, pc)
+            pf.snapshot = snapshot
             pf.run()
             al.info("end petfinder publisher", "cron.publish_pf", dbo)
 
@@ -282,7 +333,7 @@ def publish_pl(dbo):
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running petlink publisher: %s" % em, "cron.publish_pl", dbo, sys.exc_info())
 
-def publish_pcuk(dbo):
+def publish_pcuk(dbo, snapshot = None):
     try :
 
         pc = publish.PublishCriteria(configuration.publisher_presets(dbo))
@@ -293,6 +344,7 @@ def publish_pcuk(dbo):
         if publishers.find("pcuk") != -1:
             al.info("start petslocated uk publisher", "cron.publish_pcuk", dbo)
             pn = publish.PetsLocatedUKPublisher(dbo, pc)
+            pn.snapshot = snapshot
             pn.run()
             al.info("end petslocated uk publisher", "cron.publish_pcuk", dbo)
 
@@ -300,7 +352,7 @@ def publish_pcuk(dbo):
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running petslocated publisher: %s" % em, "cron.publish_pcuk", dbo, sys.exc_info())
 
-def publish_pr(dbo):
+def publish_pr(dbo, snapshot = None):
     try :
 
         pc = publish.PublishCriteria(configuration.publisher_presets(dbo))
@@ -311,6 +363,7 @@ def publish_pr(dbo):
         if publishers.find("pr") != -1:
             al.info("start petrescue publisher", "cron.publish_pr", dbo)
             pn = publish.PetRescuePublisher(dbo, pc)
+            pn.snapshot = snapshot
             pn.run()
             al.info("end petrescue publisher", "cron.publish_pr", dbo)
 
@@ -318,7 +371,7 @@ def publish_pr(dbo):
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running petrescue publisher: %s" % em, "cron.publish_pr", dbo, sys.exc_info())
 
-def publish_rg(dbo):
+def publish_rg(dbo, snapshot = None):
     try :
 
         pc = publish.PublishCriteria(configuration.publisher_presets(dbo))
@@ -329,6 +382,7 @@ def publish_rg(dbo):
         if publishers.find("rg") != -1:
             al.info("start rescuegroups publisher", "cron.publish_rg", dbo)
             rg = publish.RescueGroupsPublisher(dbo, pc)
+            rg.snapshot = snapshot
             rg.run()
             al.info("end rescuegroups publisher", "cron.publish_rg", dbo)
 
@@ -372,7 +426,7 @@ def publish_ptuk(dbo):
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running pettrac uk publisher: %s" % em, "cron.publish_ptuk", dbo, sys.exc_info())
 
-def publish_st(dbo):
+def publish_st(dbo, snapshot = None):
     try :
 
         pc = publish.PublishCriteria(configuration.publisher_presets(dbo))
@@ -383,6 +437,7 @@ def publish_st(dbo):
         if publishers.find("st") != -1:
             al.info("start smarttag publisher", "cron.publish_st", dbo)
             ap = publish.SmartTagPublisher(dbo, pc)
+            ap.snapshot = snapshot
             ap.run()
             al.info("end smarttag publisher", "cron.publish_st", dbo)
 
@@ -426,6 +481,28 @@ def publish_veha(dbo):
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running homeagain publisher: %s" % em, "cron.publish_veha", dbo, sys.exc_info())
 
+def publish_all(dbo):
+    """
+    Runs all the publishers in one pass, sharing a single snapshot
+    of the adoptable animals and their images between them.
+    """
+    snapshot = publish.PublishSnapshot(dbo)
+    try:
+        publish_ap(dbo, snapshot)
+        publish_hlp(dbo, snapshot)
+        publish_html(dbo, snapshot)
+        publish_mp(dbo, snapshot)
+        publish_pf(dbo, snapshot)
+        publish_pl(dbo)
+        publish_pcuk(dbo, snapshot)
+        publish_pr(dbo, snapshot)
+        publish_abuk(dbo)
+        publish_ptuk(dbo)
+        publish_rg(dbo, snapshot)
+        publish_st(dbo, snapshot)
+    finally:
+        snapshot.cleanup()
+
 def maint_reinstall_default_media(dbo):
     try:
         dbupdate.install_default_media(dbo, True)
@@ -454,6 +531,13 @@ def maint_recode_shelter(dbo):
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running maint_recode_shelter: %s" % em, "cron.maint_recode_shelter", dbo, sys.exc_info())
 
+def maint_alerts(dbo):
+    try:
+        alerts.rebuild(dbo)
+    except:
+        em = str(sys.exc_info()[0])
+        al.error("FAIL: uncaught error running maint_alerts: %s" % em, "cron.maint_alerts", dbo, sys.exc_info())
+
 def maint_animal_figures(dbo):
     try:
         animal.update_all_animal_statuses(dbo)
@@ -551,6 +635,50 @@ def maint_deduplicate_people(dbo):
         em = str(sys.exc_info()[0])
         al.error("FAIL: uncaught error running maint_deduplicate_people: %s" % em, "cron.maint_deduplicate_people", dbo, sys.exc_info())
 
+def maint_account_balances(dbo):
+    try:
+        financial.rebuild_account_balances(dbo)
+    except:
+        em = str(sys.exc_info()[0])
+        al.error("FAIL: uncaught error running maint_account_balances: %s" % em, "cron.maint_account_balances", dbo, sys.exc_info())
+
+def maint_check_account_balances(dbo):
+    try:
+        errors = financial.check_account_balances(dbo, rebuild = False)
+        print "%d account balance periods differ from the transactions" % errors
+    except:
+        em = str(sys.exc_info()[0])
+        al.error("FAIL: uncaught error running maint_check_account_balances: %s" % em, "cron.maint_check_account_balances", dbo, sys.exc_info())
+
+def maint_daily_stats(dbo):
+    try:
+        stats.rebuild_daily_stats(dbo)
+    except:
+        em = str(sys.exc_info()[0])
+        al.error("FAIL: uncaught error running maint_daily_stats: %s" % em, "cron.maint_daily_stats", dbo, sys.exc_info())
+
+def maint_check_daily_stats(dbo):
+    try:
+        errors = stats.check_daily_stats(dbo, rebuild = False)
+        print "%d days of stats differ from the records" % errors
+    except:
+        em = str(sys.exc_info()[0])
+        al.error("FAIL: uncaught error running maint_check_daily_stats: %s" % em, "cron.maint_check_daily_stats", dbo, sys.exc_info())
+
+def maint_search_index(dbo):
+    try:
+        searchindex.rebuild(dbo)
+    except:
+        em = str(sys.exc_info()[0])
+        al.error("FAIL: uncaught error running maint_search_index: %s" % em, "cron.maint_search_index", dbo, sys.exc_info())
+
+def maint_timeline(dbo):
+    try:
+        timeline.rebuild(dbo)
+    except:
+        em = str(sys.exc_info()[0])
+        al.error("FAIL: uncaught error running maint_timeline: %s" % em, "cron.maint_timeline", dbo, sys.exc_info())
+
 def maint_scale_animal_images(dbo):
     try:
         media.scale_animal_images(dbo)
@@ -588,24 +716,15 @@ def run(dbo, mode):
         daily(dbo)
         reports(dbo)
         reports_email(dbo)
-        publish_ap(dbo)
-        publish_hlp(dbo)
-        publish_html(dbo)
-        publish_mp(dbo)
-        publish_pf(dbo)
-        publish_pl(dbo)
-        publish_pcuk(dbo)
-        publish_pr(dbo)
-        publish_abuk(dbo)
-        publish_ptuk(dbo)
-        publish_rg(dbo)
-        publish_st(dbo)
+        publish_all(dbo)
     elif mode == "daily":
         daily(dbo)
     elif mode == "reports":
         reports(dbo)
     elif mode == "reports_email":
         reports_email(dbo)
+    elif mode == "publish_all":
+        publish_all(dbo)
     elif mode == "publish_ap":
         publish_ap(dbo)
     elif mode == "publish_fa":
@@ -646,8 +765,22 @@ def run(dbo, mode):
         maint_scale_odts(dbo)
     elif mode == "maint_scale_pdfs":
         maint_scale_pdfs(dbo)
+    elif mode == "maint_account_balances":
+        maint_account_balances(dbo)
+    elif mode == "maint_check_account_balances":
+        maint_check_account_balances(dbo)
+    elif mode == "maint_daily_stats":
+        maint_daily_stats(dbo)
+    elif mode == "maint_check_daily_stats":
+        maint_check_daily_stats(dbo)
+    elif mode == "maint_search_index":
+        maint_search_index(dbo)
+    elif mode == "maint_timeline":
+        maint_timeline(dbo)
     elif mode == "maint_variable_data":
         maint_variable_data(dbo)
+    elif mode == "maint_alerts":
+        maint_alerts(dbo)
     elif mode == "maint_animal_figures":
         maint_animal_figures(dbo)
     elif mode == "maint_animal_figures_annual":
@@ -726,6 +859,7 @@ def print_usage():
     print "       daily - daily batch tasks"
     print "       reports - update cached copies of some long running reports"
     print "       reports_email - email reports with dailyemail set (run this target once per hour)"
+    print "       publish_all - run all publishers from one shared animal and image snapshot"
     print "       publish_ap - publish to adoptapet.com"
     print "       publish_fa - update foundanimals.org"
     print "       publish_hlp - publish to helpinglostpets.com"
@@ -741,8 +875,13 @@ def print_usage():
     print "       publish_ptuk - update pettrac uk"
     print "       publish_pcuk - publish to petslocated.com uk"
     print "       publish_pr - update petrescue aus"
+    print "       maint_account_balances - rebuild the account balance ledger"
+    print "       maint_alerts - recalculate the stored main screen alert totals"
     print "       maint_animal_figures - calculate all monthly/annual figures for all time"
     print "       maint_animal_figures_annual - calculate all annual figures for all time"
+    print "       maint_check_account_balances - check the account balance ledger against the transactions"
+    print "       maint_check_daily_stats - check the daily stats against the records"
+    print "       maint_daily_stats - rebuild the daily stats"
     print "       maint_db_diagnostic - run database diagnostics"
     print "       maint_db_dump - produce a dump of INSERT statements to recreate the db"
     print "       maint_db_dump_dbfs - produce a dump of INSERT statements to recreate the dbfs"
@@ -759,6 +898,8 @@ def print_usage():
     print "       maint_scale_animal_images - re-scales all the animal images in the database"
     print "       maint_scale_odts - re-scales all odt files attached to records (remove images)"
     print "       maint_scale_pdfs - re-scales all the PDFs in the database"
+    print "       maint_search_index - rebuild the search index"
+    print "       maint_timeline - rebuild the timeline events"
     print "       maint_variable_data - recalculate all variable data for all animals"
 
 if __name__ == "__main__": 
@@ -3,6 +3,8 @@
 import additional
 import al
 import animal
+import async
+import audit
 import configuration
 import csv
 import datetime
@@ -10,13 +12,19 @@ import db
 import dbupdate
 import financial
 import i18n
+import lookups
 import movement
 import person
 import re
+import searchindex
+import stats
 import sys
 import utils
 from cStringIO import StringIO
 
+# The number of CSV rows read and written at a time
+BATCH_SIZE = 500
+
 VALID_FIELDS = [
     "ANIMALNAME", "ANIMALSEX", "ANIMALTYPE", "ANIMALCOLOR", "ANIMALBREED1", 
     "ANIMALBREED2", "ANIMALDOB", "ANIMALLOCATION", "ANIMALUNIT", 
@@ -133,54 +141,208 @@ def gkynu(m, f):
     if m[f].upper().startswith("N") or m[f] == "1": return 1
     return 2
 
-def gkbr(dbo, m, f, speciesid, create):
+def gkbr(dbo, m, f, speciesid, create, cache = None):
     """ reads lookup field f from map m, returning a str(int) that
         corresponds to a lookup match for BreedName in breed.
         if create is True, adds a row to the table if it doesn't
         find a match and then returns str(newid)
         speciesid is the linked species for any newly created breed
+        cache is an optional dict of previously resolved values
         returns "0" if key not present, or if no match was found and create is off """
     if not m.has_key(f): return "0"
     lv = m[f]
+    if cache is not None and cache.has_key(("breed", lv)): return cache[("breed", lv)]
     matchid = db.query_int(dbo, "SELECT ID FROM breed WHERE BreedName = '%s'" % (lv.replace("'", "`")))
     if matchid == 0 and create:
         nextid = db.get_id(dbo, "breed")
         sql = "INSERT INTO breed (ID, SpeciesID, BreedName) VALUES (%d, %s, '%s')" % (nextid, speciesid, lv.replace("'", "`"))
         db.execute(dbo, sql)
-        return str(nextid)
+        lookups.invalidate(dbo)
+        matchid = nextid
+    if cache is not None: cache[("breed", lv)] = str(matchid)
     return str(matchid)
 
-def gkl(dbo, m, f, table, namefield, create):
+def gkl(dbo, m, f, table, namefield, create, cache = None):
     """ reads lookup field f from map m, returning a str(int) that
         corresponds to a lookup match for namefield in table.
         if create is True, adds a row to the table if it doesn't
         find a match and then returns str(newid)
+        cache is an optional dict of previously resolved values
         returns "0" if key not present, or if no match was found and create is off """
     if not m.has_key(f): return "0"
     lv = m[f]
+    if cache is not None and cache.has_key((table, lv)): return cache[(table, lv)]
     matchid = db.query_int(dbo, "SELECT ID FROM %s WHERE %s = '%s'" % (table, namefield, lv.replace("'", "`")))
     if matchid == 0 and create:
         nextid = db.get_id(dbo, table)
         sql = "INSERT INTO %s (ID, %s) VALUES (%d, '%s')" % (table, namefield, nextid, lv.replace("'", "`"))
         db.execute(dbo, sql)
-        return str(nextid)
+        lookups.invalidate(dbo)
+        matchid = nextid
+    if cache is not None: cache[(table, lv)] = str(matchid)
     return str(matchid)
 
-def create_additional_fields(dbo, row, errors, rowno, csvkey = "ANIMALADDITIONAL", linktype = "animal", linkid = 0):
-    # Identify any additional fields that may have been specified with
-    # ANIMALADDITIONAL<fieldname>
-    for a in additional.get_field_definitions(dbo, linktype):
+def batch_add(batch, table, r, rowno):
+    """ Adds record r from row rowno of the CSV file to the table batch """
+    batch[table].append(r)
+    batch["rownos"][table].append(rowno)
+
+def batch_additional_fields(batch, fields, row, csvkey, linkid, rowno = 0):
+    """ Adds any additional fields given in row as csvkey<fieldname> for the 
+        field definitions in fields to the additional batch. linkid is either
+        an ID or a batched record whose ID will be used when it's written """
+    for a in fields:
         v = gks(row, csvkey + str(a["FIELDNAME"]).upper())
         if v != "":
-            sql = db.make_insert_sql("additional", (
-                ( "LinkType", db.di(a["LINKTYPE"]) ),
-                ( "LinkID", db.di(int(linkid)) ),
-                ( "AdditionalFieldID", db.di(a["ID"]) ),
-                ( "Value", db.ds(v) ) ))
-            try:
-                db.execute(dbo, sql)
-            except Exception,e:
-                errors.append( (rowno, str(row), str(e)) )
+            batch_add(batch, "additional", ( a["LINKTYPE"], linkid, a["ID"], db.ds_param(v) ), rowno)
+
+def batch_person(dbo, batch, p, ownertype = 0, rowno = 0):
+    """ Adds a person record built from import dictionary p to the owner 
+        batch. The ID is assigned when the batch is written. Returns the
+        record, which has the same columns as insert_person_from_form """
+    flags = p.get("flags", "").split(",")
+    def bi(f): return f in flags and 1 or 0
+    surname = p.get("surname", "")
+    r = {
+        "ID": 0,
+        "OwnerName": db.ds_param(person.calculate_owner_name(dbo, ownertype, p["title"], p["initials"], p["forenames"], surname)),
+        "OwnerType": ownertype,
+        "OwnerTitle": db.ds_param(p["title"]),
+        "OwnerInitials": db.ds_param(p["initials"]),
+        "OwnerForenames": db.ds_param(p["forenames"]),
+        "OwnerSurname": db.ds_param(surname),
+        "OwnerAddress": db.ds_param(p["address"]),
+        "OwnerTown": db.ds_param(p["town"]),
+        "OwnerCounty": db.ds_param(p["county"]),
+        "OwnerPostcode": db.ds_param(p["postcode"]),
+        "LatLong": "",
+        "HomeTelephone": db.ds_param(p["hometelephone"]),
+        "WorkTelephone": db.ds_param(p["worktelephone"]),
+        "MobileTelephone": db.ds_param(p["mobiletelephone"]),
+        "EmailAddress": db.ds_param(p["emailaddress"]),
+        "ExcludeFromBulkEmail": 0,
+        "IDCheck": bi("homechecked"),
+        "Comments": db.ds_param(p.get("comments", "")),
+        "SiteID": 0,
+        "IsAdoptionCoordinator": bi("coordinator"),
+        "IsBanned": bi("banned"),
+        "IsVolunteer": bi("volunteer"),
+        "IsMember": bi("member"),
+        "MembershipExpiryDate": i18n.display2python(dbo.locale, p.get("membershipexpires", "")),
+        "MembershipNumber": "",
+        "IsHomeChecker": bi("homechecker"),
+        "IsDeceased": bi("deceased"),
+        "IsDonor": bi("donor"),
+        "IsDriver": bi("driver"),
+        "IsShelter": bi("shelter"),
+        "IsACO": bi("aco"),
+        "IsStaff": bi("staff"),
+        "IsFosterer": bi("fosterer"),
+        "FosterCapacity": 0,
+        "IsRetailer": bi("retailer"),
+        "IsVet": bi("vet"),
+        "IsGiftAid": bi("giftaid"),
+        "AdditionalFlags": db.ds_param("|".join(flags) + "|"),
+        "HomeCheckAreas": "",
+        "HomeCheckedBy": 0,
+        "MatchActive": 0,
+        "MatchSex": -1,
+        "MatchSize": -1,
+        "MatchColour": -1,
+        "MatchAgeFrom": 0,
+        "MatchAgeTo": 0,
+        "MatchAnimalType": -1,
+        "MatchSpecies": -1,
+        "MatchBreed": -1,
+        "MatchBreed2": -1,
+        "MatchGoodWithCats": -1,
+        "MatchGoodWithDogs": -1,
+        "MatchGoodWithChildren": -1,
+        "MatchHouseTrained": -1,
+        "MatchCommentsContain": ""
+    }
+    batch_add(batch, "owner", r, rowno)
+    return r
+
+def batch_donation(dbo, batch, d, rowno = 0):
+    """ Adds a donation record built from import dictionary d to the
+        ownerdonation batch, with the same columns as insert_donation_from_form """
+    r = {
+        "ID": 0,
+        "OwnerID": d["person"],
+        "AnimalID": d["animal"],
+        "MovementID": d["movement"],
+        "DonationTypeID": d["type"],
+        "DonationPaymentID": d["payment"],
+        "Frequency": 0,
+        "Quantity": 0,
+        "UnitPrice": 0,
+        "Donation": d["amount"],
+        "DateDue": None,
+        "Date": i18n.display2python(dbo.locale, d["received"]),
+        "NextCreated": 0,
+        "ChequeNumber": "",
+        "ReceiptNumber": "",
+        "IsGiftAid": 0,
+        "IsVAT": 0,
+        "VATRate": 0.0,
+        "VATAmount": 0,
+        "Comments": db.ds_param(d["comments"])
+    }
+    batch_add(batch, "ownerdonation", r, rowno)
+    return r
+
+def new_batch():
+    """ Returns an empty batch. rownos holds the CSV row number of each 
+        batched record so that the batch can be split by row """
+    return { "owner": [], "ownerdonation": [], "additional": [], 
+        "rownos": { "owner": [], "ownerdonation": [], "additional": [] } }
+
+def split_batch(batch):
+    """ Splits batch into a batch for the records of each row of the 
+        CSV file. Returns a list of (rowno, batch) tuples in row order. """
+    rowbatches = {}
+    for table in ( "owner", "ownerdonation", "additional" ):
+        for r, rowno in zip(batch[table], batch["rownos"][table]):
+            if not rowbatches.has_key(rowno): rowbatches[rowno] = new_batch()
+            batch_add(rowbatches[rowno], table, r, rowno)
+    return sorted(rowbatches.items())
+
+def write_batch(dbo, batch, username = "import"):
+    """ Writes the records in batch with execute_many in a single 
+        transaction, allocating a block of IDs for each table and auditing 
+        the new records. If anything fails, none of the batch is written.
+        People are added to the search index and donations to the daily
+        stats. Clears the batch. """
+    now = i18n.now(dbo.timezone)
+    statements = []
+    audits = []
+    for table in ( "owner", "ownerdonation" ):
+        rows = batch[table]
+        if len(rows) == 0: continue
+        ids = db.get_ids(dbo, table, len(rows))
+        for r, rid in zip(rows, ids):
+            r["ID"] = rid
+            if table == "owner": r["OwnerCode"] = person.calculate_owner_code(rid, r["OwnerSurname"])
+            if table == "ownerdonation": r["ReceiptNumber"] = utils.padleft(rid, 8)
+            r["RecordVersion"] = db.recordversion()
+            r["CreatedBy"] = username
+            r["CreatedDate"] = now
+            r["LastChangedBy"] = username
+            r["LastChangedDate"] = now
+            audits.append(audit.action_params(dbo, audit.ADD, username, table, rid, audit.dump_dict(r)))
+        cols = sorted(rows[0].keys())
+        statements.append(( "INSERT INTO %s (%s) VALUES (%s)" % (table, ",".join(cols), ",".join([ "%s" ] * len(cols))), 
+            [ tuple([ r[c] for c in cols ]) for r in rows ] ))
+    statements.append(( "INSERT INTO additional (LinkType, LinkID, AdditionalFieldID, Value) VALUES (%s, %s, %s, %s)", 
+        [ (lt, type(lid) == dict and lid["ID"] or lid, fid, v) for lt, lid, fid, v in batch["additional"] ] ))
+    statements.append(( audit.INSERT_SQL, audits ))
+    db.execute_transaction(dbo, statements)
+    if len(batch["owner"]) > 0:
+        searchindex.update(dbo, searchindex.PERSON, [ r["ID"] for r in batch["owner"] ])
+    if len(batch["ownerdonation"]) > 0:
+        stats.update_days(dbo, stats.get_days(dbo, "ownerdonation", "ID IN (%s)" % ",".join([ str(r["ID"]) for r in batch["ownerdonation"] ])))
+    batch.update(new_batch())
 
 def csvimport(dbo, csvdata, createmissinglookups = False, cleartables = False, checkduplicates = False):
     """
@@ -258,136 +420,145 @@ def csvimport(dbo, csvdata, createmissinglookups = False, cleartables = False, c
     if hasdonation and not (haspersonlastname or haspersonname):
         return [ (0, "", "Your CSV file has donation fields, but no person to apply the donation to"), ]
 
-    # Read the whole CSV file into a list of maps. Note, the
-    # reader has a cursor at the second row already because
-    # we read the header in the first row above
-    data = []
-    for row in reader:
-        currow = {}
-        for i, col in enumerate(row):
-            if i >= len(cols): continue # skip if we run out of cols
-            currow[cols[i]] = col
-        data.append(currow)
+    # Count the rows so we can report progress, then start again 
+    # and stream through them, importing BATCH_SIZE rows at a time
+    rowcount = 0
+    for row in reader: rowcount += 1
+    reader = csv.reader(StringIO(csvdata), dialect="excel")
+    reader.next()
 
-    al.debug("reading CSV data, found %d rows" % len(data), "csvimport.csvimport", dbo)
+    al.debug("reading CSV data, found %d rows" % rowcount, "csvimport.csvimport", dbo)
 
     # If we're clearing down tables first, do it now
     if cleartables:
         al.debug("Resetting the database by removing all non-lookup data", "csvimport.csvimport", dbo)
         dbupdate.reset_db(dbo)
 
-    # Now that we've read them in, go through all the rows
-    # and start importing.
+    # Everything that would otherwise be looked up for each row
+    opts = {
+        "hasanimal": hasanimal, "hasperson": hasperson, "hasmovement": hasmovement, "hasdonation": hasdonation,
+        "createmissinglookups": createmissinglookups, "checkduplicates": checkduplicates,
+        "lookups": {},
+        "fields": { 
+            "animal": additional.get_field_definitions(dbo, "animal"),
+            "person": additional.get_field_definitions(dbo, "person")
+        },
+        "defaults": {
+            "basecolour": str(configuration.default_colour(dbo)),
+            "species": str(configuration.default_species(dbo)),
+            "animaltype": str(configuration.default_type(dbo)),
+            "breed": str(configuration.default_breed(dbo)),
+            "size": str(configuration.default_size(dbo)),
+            "internallocation": str(configuration.default_location(dbo)),
+            "entryreason": str(configuration.default_entry_reason(dbo)),
+            "donationtype": str(configuration.default_donation_type(dbo))
+        }
+    }
+
+    async.set_task_name(dbo, i18n._("Import a CSV file", dbo.locale))
+    async.set_progress_max(dbo, rowcount)
+    async.set_progress_value(dbo, 0)
+    async.set_cancel(dbo, False)
     errors = []
-    rowno = 1
-    for row in data:
-
-        al.debug("import csv: row %d of %d" % (rowno, len(data)), "csvimport.csvimport", dbo)
-
-        # Do we have animal data to read?
-        animalid = 0
-        if hasanimal and gks(row, "ANIMALNAME") != "":
-            a = {}
-            a["animalname"] = gks(row, "ANIMALNAME")
-            a["sheltercode"] = gks(row, "ANIMALCODE")
-            a["shortcode"] = gks(row, "ANIMALCODE")
-            if gks(row, "ANIMALSEX") == "": 
-                a["sex"] = "2" # Default unknown if not set
-            else:
-                a["sex"] = gks(row, "ANIMALSEX").lower().startswith("m") and "1" or "0"
-            a["basecolour"] = gkl(dbo, row, "ANIMALCOLOR", "basecolour", "BaseColour", createmissinglookups)
-            if a["basecolour"] == "0":
-                a["basecolour"] = str(configuration.default_colour(dbo))
-            a["species"] = gkl(dbo, row, "ANIMALSPECIES", "species", "SpeciesName", createmissinglookups)
-            if a["species"] == "0":
-                a["species"] = str(configuration.default_species(dbo))
-            a["animaltype"] = gkl(dbo, row, "ANIMALTYPE", "animaltype", "AnimalType", createmissinglookups)
-            if a["animaltype"] == "0":
-                a["animaltype"] = str(configuration.default_type(dbo))
-            a["breed1"] = gkbr(dbo, row, "ANIMALBREED1", a["species"], createmissinglookups)
-            if a["breed1"] == "0":
-                a["breed1"] = str(configuration.default_breed(dbo))
-            a["breed2"] = gkbr(dbo, row, "ANIMALBREED2", a["species"], createmissinglookups)
-            if a["breed2"] != "0" and a["breed2"] != a["breed1"]:
-                a["crossbreed"] = "on"
-            a["size"] = str(configuration.default_size(dbo))
-            a["internallocation"] = gkl(dbo, row, "ANIMALLOCATION", "internallocation", "LocationName", createmissinglookups)
-            if a["internallocation"] == "0":
-                a["internallocation"] = str(configuration.default_location(dbo))
-            a["unit"] = gks(row, "ANIMALUNIT")
-            a["comments"] = gks(row, "ANIMALCOMMENTS")
-            a["markings"] = gks(row, "ANIMALMARKINGS")
-            a["hiddenanimaldetails"] = gks(row, "ANIMALHIDDENDETAILS")
-            a["healthproblems"] = gks(row, "ANIMALHEALTHPROBLEMS")
-            a["notforadoption"] = gkbi(row, "ANIMALNOTFORADOPTION")
-            a["housetrained"] = gkynu(row, "ANIMALHOUSETRAINED")
-            a["goodwithcats"] = gkynu(row, "ANIMALGOODWITHCATS")
-            a["goodwithdogs"] = gkynu(row, "ANIMALGOODWITHDOGS")
-            a["goodwithkids"] = gkynu(row, "ANIMALGOODWITHKIDS")
-            a["reasonforentry"] = gks(row, "ANIMALREASONFORENTRY")
-            a["estimatedage"] = gks(row, "ANIMALAGE")
-            a["dateofbirth"] = gkd(dbo, row, "ANIMALDOB", True)
-            if gks(row, "ANIMALDOB") == "" and a["estimatedage"] != "":
-                a["dateofbirth"] = "" # if we had an age and dob was blank, prefer the age
-            a["datebroughtin"] = gkd(dbo, row, "ANIMALENTRYDATE", True)
-            a["deceaseddate"] = gkd(dbo, row, "ANIMALDECEASEDDATE")
-            a["neutered"] = gkbc(row, "ANIMALNEUTERED")
-            a["neutereddate"] = gkd(dbo, row, "ANIMALNEUTEREDDATE")
-            if a["neutereddate"] != "": a["neutered"] = "on"
-            a["microchipnumber"] = gks(row, "ANIMALMICROCHIP")
-            if a["microchipnumber"] != "": a["microchipped"] = "on"
-            a["microchipdate"] = gkd(dbo, row, "ANIMALMICROCHIPDATE")
-            # If an original owner is specified, create a person record
-            # for them and attach it to the animal as original owner
-            if gks(row, "ORIGINALOWNERLASTNAME") != "":
-                p = {}
-                p["title"] = gks(row, "ORIGINALOWNERTITLE")
-                p["initials"] = gks(row, "ORIGINALOWNERINITIALS")
-                p["forenames"] = gks(row, "ORIGINALOWNERFIRSTNAME")
-                p["surname"] = gks(row, "ORIGINALOWNERLASTNAME")
-                p["address"] = gks(row, "ORIGINALOWNERADDRESS")
-                p["town"] = gks(row, "ORIGINALOWNERCITY")
-                p["county"] = gks(row, "ORIGINALOWNERSTATE")
-                p["postcode"] = gks(row, "ORIGINALOWNERZIPCODE")
-                p["hometelephone"] = gks(row, "ORIGINALOWNERHOMEPHONE")
-                p["worktelephone"] = gks(row, "ORIGINALOWNERWORKPHONE")
-                p["mobiletelephone"] = gks(row, "ORIGINALOWNERCELLPHONE")
-                p["emailaddress"] = gks(row, "ORIGINALOWNEREMAIL")
-                try:
-                    if checkduplicates:
-                        dups = person.get_person_similar(dbo, p["emailaddress"], p["surname"], p["forenames"], p["address"])
-                        if len(dups) > 0:
-                            a["originalowner"] = str(dups[0]["ID"])
-                    if not a.has_key("originalowner"):
-                        ooid = person.insert_person_from_form(dbo, utils.PostedData(p, dbo.locale), "import")
-                        a["originalowner"] = str(ooid)
-                        # Identify an ORIGINALOWNERADDITIONAL additional fields and create them
-                        create_additional_fields(dbo, row, errors, rowno, "ORIGINALOWNERADDITIONAL", "person", ooid)
-                except Exception,e:
-                    al.error("row %d (%s), originalowner: %s" % (rowno, str(row), str(e)), "csvimport.csvimport", dbo, sys.exc_info())
-                    errors.append( (rowno, str(row), "originalowner: " + str(e)) )
+    try:
+        rows = []
+        rowno = 1
+        for row in reader:
+            currow = {}
+            for i, col in enumerate(row):
+                if i >= len(cols): continue # skip if we run out of cols
+                currow[cols[i]] = col
+            rows.append( (rowno, currow) )
+            rowno += 1
+            if len(rows) == BATCH_SIZE:
+                import_rows(dbo, rows, errors, opts)
+                rows = []
+                async.set_progress_value(dbo, rowno - 1)
+                if async.get_cancel(dbo):
+                    errors.append( (rowno, "", "Import cancelled") )
+                    break
+        else:
+            if len(rows) > 0: import_rows(dbo, rows, errors, opts)
+    finally:
+        async.reset(dbo)
+
+    return errors
+
+def similar_keys(p):
+    """ Returns keys for person dictionary p that match the way
+        person.get_person_similar finds people with the same 
+        email address or name and address """
+    address = p["address"]
+    for c in ( " ", "\n", "," ):
+        if address.find(c) != -1: address = address[0:address.find(c)]
+    forenames = p["forenames"].lower().strip()
+    if forenames.find(" ") != -1: forenames = forenames[0:forenames.find(" ")]
+    email = p["emailaddress"].lower().strip()
+    keys = [ (p["surname"].lower().strip(), forenames, address.lower().strip()) ]
+    if email != "" and email.find("@") != -1 and email.find(".") != -1: keys.append(email)
+    return keys
+
+def import_person(dbo, batch, rowno, p, ownertype, similar, checkduplicates):
+    """ Returns the person to use for import dictionary p. If checkduplicates
+        is on and p is similar to someone in the database, their ID is returned
+        or if they are similar to someone earlier in this batch, that person's
+        batched record. Otherwise, p is added to the batch and its record
+        returned. The second element of the tuple is True for new records. """
+    if checkduplicates:
+        for k in similar_keys(p):
+            if similar.has_key(k): return (similar[k], False)
+        dups = person.get_person_similar(dbo, p["emailaddress"], p["surname"], p["forenames"], p["address"])
+        if len(dups) > 0: return (dups[0]["ID"], False)
+    r = batch_person(dbo, batch, p, ownertype, rowno)
+    for k in similar_keys(p): similar[k] = r
+    return (r, True)
+
+def import_rows(dbo, rows, errors, opts):
+    """ Imports a list of (rowno, row) tuples from the CSV file. 
+        People and donations are written in batches, the animals and 
+        movements that link to them are created one at a time so that
+        codes, validation and animal statuses are calculated in the same
+        way as the UI. """
+    batch = new_batch()
+    similar = {}
+    people = {}
+    fields = opts["fields"]
+
+    # People and original owners are written first so that
+    # animals and movements can be validated against them
+    for rowno, row in rows:
+        # If an original owner is specified, create a person record
+        # for them to attach to the animal as original owner
+        if opts["hasanimal"] and gks(row, "ANIMALNAME") != "" and gks(row, "ORIGINALOWNERLASTNAME") != "":
+            p = {}
+            p["title"] = gks(row, "ORIGINALOWNERTITLE")
+            p["initials"] = gks(row, "ORIGINALOWNERINITIALS")
+            p["forenames"] = gks(row, "ORIGINALOWNERFIRSTNAME")
+            p["surname"] = gks(row, "ORIGINALOWNERLASTNAME")
+            p["address"] = gks(row, "ORIGINALOWNERADDRESS")
+            p["town"] = gks(row, "ORIGINALOWNERCITY")
+            p["county"] = gks(row, "ORIGINALOWNERSTATE")
+            p["postcode"] = gks(row, "ORIGINALOWNERZIPCODE")
+            p["hometelephone"] = gks(row, "ORIGINALOWNERHOMEPHONE")
+            p["worktelephone"] = gks(row, "ORIGINALOWNERWORKPHONE")
+            p["mobiletelephone"] = gks(row, "ORIGINALOWNERCELLPHONE")
+            p["emailaddress"] = gks(row, "ORIGINALOWNEREMAIL")
             try:
-                if checkduplicates:
-                    dup = animal.get_animal_sheltercode(dbo, a["sheltercode"])
-                    if dup is not None:
-                        animalid = dup["ID"]
-                if animalid == 0:
-                    animalid, newcode = animal.insert_animal_from_form(dbo, utils.PostedData(a, dbo.locale), "import")
-                    # Identify an ANIMALADDITIONAL additional fields and create them
-                    create_additional_fields(dbo, row, errors, rowno, "ANIMALADDITIONAL", "animal", animalid)
+                oo, isnew = import_person(dbo, batch, rowno, p, 0, similar, opts["checkduplicates"])
+                people[(rowno, "originalowner")] = oo
+                # Identify any ORIGINALOWNERADDITIONAL additional fields and create them
+                if isnew:
+                    batch_additional_fields(batch, fields["person"], row, "ORIGINALOWNERADDITIONAL", oo, rowno)
             except Exception,e:
-                al.error("row %d (%s): %s" % (rowno, str(row), str(e)), "csvimport.csvimport", dbo, sys.exc_info())
-                errmsg = str(e)
-                if type(e) == utils.ASMValidationError: errmsg = e.getMsg()
-                errors.append( (rowno, str(row), errmsg) )
+                al.error("row %d (%s), originalowner: %s" % (rowno, str(row), str(e)), "csvimport.csvimport", dbo, sys.exc_info())
+                errors.append( (rowno, str(row), "originalowner: " + str(e)) )
 
         # Person data?
-        personid = 0
-        if hasperson and (gks(row, "PERSONLASTNAME") != "" or gks(row, "PERSONNAME") != ""):
+        if opts["hasperson"] and (gks(row, "PERSONLASTNAME") != "" or gks(row, "PERSONNAME") != ""):
             p = {}
-            p["ownertype"] = gks(row, "PERSONCLASS")
-            if p["ownertype"] != "1" and p["ownertype"] != "2": 
-                p["ownertype"] = "1"
+            ownertype = gks(row, "PERSONCLASS")
+            if ownertype != "1" and ownertype != "2": 
+                ownertype = "1"
             p["title"] = gks(row, "PERSONTITLE")
             p["initials"] = gks(row, "PERSONINITIALS")
             p["forenames"] = gks(row, "PERSONFIRSTNAME")
@@ -417,26 +588,39 @@ def csvimport(dbo, csvdata, createmissinglookups = False, cleartables = False, c
             p["comments"] = gks(row, "PERSONCOMMENTS")
             p["membershipexpires"] = gkd(dbo, row, "PERSONMEMBERSHIPEXPIRY")
             try:
-                if checkduplicates:
-                    dups = person.get_person_similar(dbo, p["emailaddress"], p["surname"], p["forenames"], p["address"])
-                    if len(dups) > 0:
-                        personid = dups[0]["ID"]
-                        # Merge flags and any extra details
-                        person.merge_flags(dbo, "import", personid, flags)
-                        person.merge_person_details(dbo, "import", personid, p)
-                if personid == 0:
-                    personid = person.insert_person_from_form(dbo, utils.PostedData(p, dbo.locale), "import")
+                pp, isnew = import_person(dbo, batch, rowno, p, int(ownertype), similar, opts["checkduplicates"])
+                people[(rowno, "person")] = pp
+                if isnew:
                     # Identify any PERSONADDITIONAL additional fields and create them
-                    create_additional_fields(dbo, row, errors, rowno, "PERSONADDITIONAL", "person", personid)
+                    batch_additional_fields(batch, fields["person"], row, "PERSONADDITIONAL", pp, rowno)
+                elif type(pp) != dict:
+                    # Merge flags and any extra details
+                    person.merge_flags(dbo, "import", pp, flags)
+                    person.merge_person_details(dbo, "import", pp, p)
             except Exception,e:
                 al.error("row %d (%s), person: %s" % (rowno, str(row), str(e)), "csvimport.csvimport", dbo, sys.exc_info())
                 errmsg = str(e)
                 if type(e) == utils.ASMValidationError: errmsg = e.getMsg()
                 errors.append( (rowno, str(row), "person: " + errmsg) )
 
+    # People that could not be written are left with an ID of 0
+    # so that nothing is linked to them
+    write_rows_batch(dbo, batch, rows, errors)
+
+    # Now the animals, movements and donations
+    donations = []
+    animalids = []
+    created = {}
+    for rowno, row in rows:
+        animalid, isnew = import_animal(dbo, batch, rowno, row, errors, opts, people)
+        if animalid != 0: animalids.append(animalid)
+
+        personid = people.get((rowno, "person"), 0)
+        if type(personid) == dict: personid = personid["ID"]
+
         # Movement to tie animal/person together?
         movementid = 0
-        if hasmovement and personid != 0 and animalid != 0 and gks(row, "MOVEMENTDATE") != "":
+        if opts["hasmovement"] and personid != 0 and animalid != 0 and gks(row, "MOVEMENTDATE") != "":
             m = {}
             m["person"] = str(personid)
             m["animal"] = str(animalid)
@@ -446,7 +630,7 @@ def csvimport(dbo, csvdata, createmissinglookups = False, cleartables = False, c
             m["movementdate"] = gkd(dbo, row, "MOVEMENTDATE", True)
             m["returndate"] = gkd(dbo, row, "MOVEMENTRETURNDATE")
             m["comments"] = gks(row, "MOVEMENTCOMMENTS")
-            m["returncategory"] = str(configuration.default_entry_reason(dbo))
+            m["returncategory"] = opts["defaults"]["entryreason"]
             try:
                 movementid = movement.insert_movement_from_form(dbo, "import", utils.PostedData(m, dbo.locale))
             except Exception,e:
@@ -456,30 +640,153 @@ def csvimport(dbo, csvdata, createmissinglookups = False, cleartables = False, c
                 errors.append( (rowno, str(row), "movement: " + errmsg) )
 
         # Donation?
-        if hasdonation and personid != 0 and gkc(row, "DONATIONAMOUNT") != 0:
+        if opts["hasdonation"] and personid != 0 and gkc(row, "DONATIONAMOUNT") != 0:
             d = {}
-            d["person"] = str(personid)
-            d["animal"] = str(animalid)
-            d["movement"] = str(movementid)
-            d["amount"] = str(gkc(row, "DONATIONAMOUNT"))
+            d["person"] = personid
+            d["animal"] = animalid
+            d["movement"] = movementid
+            d["amount"] = gkc(row, "DONATIONAMOUNT")
             d["comments"] = gks(row, "DONATIONCOMMENTS")
             d["received"] = gkd(dbo, row, "DONATIONDATE", True)
-            d["type"] = gkl(dbo, row, "DONATIONTYPE", "donationtype", "DonationName", createmissinglookups)
-            if d["type"] == "0":
-                d["type"] = str(configuration.default_donation_type(dbo))
-            d["payment"] = gkl(dbo, row, "DONATIONPAYMENT", "donationpayment", "PaymentName", createmissinglookups)
-            if d["payment"] == "0":
-                d["payment"] = "1"
+            d["type"] = int(gkl(dbo, row, "DONATIONTYPE", "donationtype", "DonationName", opts["createmissinglookups"], opts["lookups"]))
+            if d["type"] == 0:
+                d["type"] = int(opts["defaults"]["donationtype"])
+            d["payment"] = int(gkl(dbo, row, "DONATIONPAYMENT", "donationpayment", "PaymentName", opts["createmissinglookups"], opts["lookups"]))
+            if d["payment"] == 0:
+                d["payment"] = 1
+            donations.append(batch_donation(dbo, batch, d, rowno))
+
+        created[rowno] = (isnew and animalid or 0, movementid)
+
+    # The animals and movements for rows whose donations or additional 
+    # fields could not be written are removed again so that those rows
+    # aren't left half imported
+    hasadditional = len(batch["additional"]) > 0
+    for rowno in write_rows_batch(dbo, batch, rows, errors):
+        animalid, movementid = created.get(rowno, (0, 0))
+        try:
+            if movementid != 0: movement.delete_movement(dbo, "import", movementid)
+            if animalid != 0: animal.delete_animal(dbo, "import", animalid)
+        except Exception,e:
+            al.error("row %d: %s" % (rowno, str(e)), "csvimport.csvimport", dbo, sys.exc_info())
+        if animalid in animalids: animalids.remove(animalid)
+    donations = [ d for d in donations if d["ID"] != 0 ]
+    if hasadditional and len(animalids) > 0:
+        searchindex.update(dbo, searchindex.ANIMAL, animalids)
+
+    # Create matching transactions for the donations and update the
+    # donation totals on their movements
+    if configuration.create_donation_trx(dbo):
+        for d in donations:
             try:
-                financial.insert_donation_from_form(dbo, "import", utils.PostedData(d, dbo.locale))
+                financial.update_matching_donation_transaction(dbo, "import", d["ID"])
             except Exception,e:
-                al.error("row %d (%s), donation: %s" % (rowno, str(row), str(e)), "csvimport.csvimport", dbo, sys.exc_info())
+                al.error("donation %d: %s" % (d["ID"], str(e)), "csvimport.csvimport", dbo, sys.exc_info())
                 errmsg = str(e)
                 if type(e) == utils.ASMValidationError: errmsg = e.getMsg()
-                errors.append( (rowno, str(row), "donation: " + errmsg) )
-            if movementid != 0: movement.update_movement_donation(dbo, movementid)
-
-        rowno += 1
-
-    return errors
-
+                errors.append( (0, "", "donation: " + errmsg) )
+    for movementid in set([ d["MovementID"] for d in donations if d["MovementID"] != 0 ]):
+        movement.update_movement_donation(dbo, movementid)
+
+def write_rows_batch(dbo, batch, rows, errors):
+    """ Writes batch. If that fails, the records for each row of the CSV
+        file are written on their own so that the good rows are still
+        imported, and an error is recorded for each row that can't be.
+        The records of those rows are left with an ID of 0.
+        Returns the set of row numbers that could not be written. """
+    try:
+        write_batch(dbo, batch)
+        return set()
+    except Exception,e:
+        al.debug("rows %d-%d could not be written as a batch, writing each row: %s" % (rows[0][0], rows[-1][0], str(e)), "csvimport.csvimport", dbo)
+    rowtext = dict(rows)
+    failed = set()
+    for rowno, rowbatch in split_batch(batch):
+        try:
+            write_batch(dbo, rowbatch)
+        except Exception,e:
+            al.error("row %d (%s): %s" % (rowno, str(rowtext.get(rowno, "")), str(e)), "csvimport.csvimport", dbo, sys.exc_info())
+            errors.append( (rowno, str(rowtext.get(rowno, "")), str(e)) )
+            for r in rowbatch["owner"] + rowbatch["ownerdonation"]: r["ID"] = 0
+            failed.add(rowno)
+    batch.update(new_batch())
+    return failed
+
+def import_animal(dbo, batch, rowno, row, errors, opts, people):
+    """ Creates the animal from a row of the CSV file. Returns a tuple of
+        its ID (or 0 if the row doesn't have one) and whether it's new """
+    animalid = 0
+    isnew = False
+    if not opts["hasanimal"] or gks(row, "ANIMALNAME") == "": return (0, False)
+    createmissinglookups = opts["createmissinglookups"]
+    cache = opts["lookups"]
+    defaults = opts["defaults"]
+    a = {}
+    a["animalname"] = gks(row, "ANIMALNAME")
+    a["sheltercode"] = gks(row, "ANIMALCODE")
+    a["shortcode"] = gks(row, "ANIMALCODE")
+    if gks(row, "ANIMALSEX") == "": 
+        a["sex"] = "2" # Default unknown if not set
+    else:
+        a["sex"] = gks(row, "ANIMALSEX").lower().startswith("m") and "1" or "0"
+    a["basecolour"] = gkl(dbo, row, "ANIMALCOLOR", "basecolour", "BaseColour", createmissinglookups, cache)
+    if a["basecolour"] == "0":
+        a["basecolour"] = defaults["basecolour"]
+    a["species"] = gkl(dbo, row, "ANIMALSPECIES", "species", "SpeciesName", createmissinglookups, cache)
+    if a["species"] == "0":
+        a["species"] = defaults["species"]
+    a["animaltype"] = gkl(dbo, row, "ANIMALTYPE", "animaltype", "AnimalType", createmissinglookups, cache)
+    if a["animaltype"] == "0":
+        a["animaltype"] = defaults["animaltype"]
+    a["breed1"] = gkbr(dbo, row, "ANIMALBREED1", a["species"], createmissinglookups, cache)
+    if a["breed1"] == "0":
+        a["breed1"] = defaults["breed"]
+    a["breed2"] = gkbr(dbo, row, "ANIMALBREED2", a["species"], createmissinglookups, cache)
+    if a["breed2"] != "0" and a["breed2"] != a["breed1"]:
+        a["crossbreed"] = "on"
+    a["size"] = defaults["size"]
+    a["internallocation"] = gkl(dbo, row, "ANIMALLOCATION", "internallocation", "LocationName", createmissinglookups, cache)
+    if a["internallocation"] == "0":
+        a["internallocation"] = defaults["internallocation"]
+    a["unit"] = gks(row, "ANIMALUNIT")
+    a["comments"] = gks(row, "ANIMALCOMMENTS")
+    a["markings"] = gks(row, "ANIMALMARKINGS")
+    a["hiddenanimaldetails"] = gks(row, "ANIMALHIDDENDETAILS")
+    a["healthproblems"] = gks(row, "ANIMALHEALTHPROBLEMS")
+    a["notforadoption"] = gkbi(row, "ANIMALNOTFORADOPTION")
+    a["housetrained"] = gkynu(row, "ANIMALHOUSETRAINED")
+    a["goodwithcats"] = gkynu(row, "ANIMALGOODWITHCATS")
+    a["goodwithdogs"] = gkynu(row, "ANIMALGOODWITHDOGS")
+    a["goodwithkids"] = gkynu(row, "ANIMALGOODWITHKIDS")
+    a["reasonforentry"] = gks(row, "ANIMALREASONFORENTRY")
+    a["estimatedage"] = gks(row, "ANIMALAGE")
+    a["dateofbirth"] = gkd(dbo, row, "ANIMALDOB", True)
+    if gks(row, "ANIMALDOB") == "" and a["estimatedage"] != "":
+        a["dateofbirth"] = "" # if we had an age and dob was blank, prefer the age
+    a["datebroughtin"] = gkd(dbo, row, "ANIMALENTRYDATE", True)
+    a["deceaseddate"] = gkd(dbo, row, "ANIMALDECEASEDDATE")
+    a["neutered"] = gkbc(row, "ANIMALNEUTERED")
+    a["neutereddate"] = gkd(dbo, row, "ANIMALNEUTEREDDATE")
+    if a["neutereddate"] != "": a["neutered"] = "on"
+    a["microchipnumber"] = gks(row, "ANIMALMICROCHIP")
+    if a["microchipnumber"] != "": a["microchipped"] = "on"
+    a["microchipdate"] = gkd(dbo, row, "ANIMALMICROCHIPDATE")
+    ooid = people.get((rowno, "originalowner"), 0)
+    if type(ooid) == dict: ooid = ooid["ID"]
+    if ooid != 0: a["originalowner"] = str(ooid)
+    try:
+        if opts["checkduplicates"]:
+            dup = animal.get_animal_sheltercode(dbo, a["sheltercode"])
+            if dup is not None:
+                animalid = dup["ID"]
+        if animalid == 0:
+            animalid, newcode = animal.insert_animal_from_form(dbo, utils.PostedData(a, dbo.locale), "import")
+            isnew = True
+            # Identify any ANIMALADDITIONAL additional fields and create them
+            batch_additional_fields(batch, opts["fields"]["animal"], row, "ANIMALADDITIONAL", animalid, rowno)
+    except Exception,e:
+        al.error("row %d (%s): %s" % (rowno, str(row), str(e)), "csvimport.csvimport", dbo, sys.exc_info())
+        errmsg = str(e)
+        if type(e) == utils.ASMValidationError: errmsg = e.getMsg()
+        errors.append( (rowno, str(row), errmsg) )
+    return (animalid, isnew)
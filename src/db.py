@@ -5,9 +5,10 @@ import cachemem
 import datetime
 import i18n
 import sys
+import threading
 import time
 import utils
-from sitedefs import DB_TYPE, DB_HOST, DB_PORT, DB_USERNAME, DB_PASSWORD, DB_NAME, DB_HAS_ASM2_PK_TABLE, DB_PK_STRATEGY, DB_DECODE_HTML_ENTITIES, DB_EXEC_LOG, DB_EXPLAIN_QUERIES, DB_TIME_QUERIES, DB_TIME_LOG_OVER, DB_TIMEOUT, CACHE_COMMON_QUERIES, MULTIPLE_DATABASES_MAP
+from sitedefs import DB_TYPE, DB_HOST, DB_PORT, DB_USERNAME, DB_PASSWORD, DB_NAME, DB_HAS_ASM2_PK_TABLE, DB_PK_STRATEGY, DB_DECODE_HTML_ENTITIES, DB_EXEC_LOG, DB_EXPLAIN_QUERIES, DB_TIME_QUERIES, DB_TIME_LOG_OVER, DB_TIMEOUT, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_MAX_TOTAL, DB_POOL_MAX_IDLE, DB_POOL_CHECK_AFTER, CACHE_COMMON_QUERIES, MULTIPLE_DATABASES_MAP
 
 
 try:
@@ -68,43 +69,288 @@ def connection(dbo):
     except Exception,err:
         al.error(str(err), "db.connection", dbo, sys.exc_info())
 
+class ConnectionPool(object):
+    """
+    A thread safe pool of open connections to a single database.
+    Connections are checked out for the duration of a single
+    query/execute call and returned afterwards.
+    Up to DB_POOL_MAX_SIZE idle connections are kept open for each
+    database and no more than DB_POOL_MAX_TOTAL across all databases. 
+    If there's no room for a returned connection or every connection 
+    is busy, a temporary connection is opened and closed again when it 
+    is returned so that callers never block on each other.
+    Connections that have been idle for longer than DB_POOL_CHECK_AFTER
+    seconds are checked before being handed out and connections idle
+    for longer than DB_POOL_MAX_IDLE seconds are closed.
+    Each connection is kept in an entry with the time it was returned
+    and the session timeout last sent on it, so that the timeout is only 
+    sent again when it changes.
+    """
+    def __init__(self, dbo):
+        self.lock = threading.Lock()
+        self.idle = []      # entries for idle connections, oldest first
+        self.busy = {}      # id of checked out connection: its entry
+        for dummy in xrange(0, DB_POOL_MIN_SIZE):
+            if not reserve_idle(): break
+            c = connection(dbo)
+            if c is None:
+                release_idle()
+                break
+            self.idle.append({ "connection": c, "returned": time.time(), "timeout": None })
+
+    def get(self, dbo):
+        """
+        Checks out a working connection, opening a new one if
+        there are none idle.
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                if len(self.idle) == 0: break
+                e = self.idle.pop()
+                self.busy[id(e["connection"])] = e
+            finally:
+                self.lock.release()
+            release_idle()
+            if time.time() - e["returned"] < DB_POOL_CHECK_AFTER or self.is_alive(e["connection"]):
+                return e["connection"]
+            self.discard(e["connection"])
+        c = connection(dbo)
+        if c is None: raise Exception("Could not connect to database")
+        self.lock.acquire()
+        try:
+            # The entry holds a reference to the connection, so its id
+            # cannot be reused while it is checked out
+            self.busy[id(c)] = { "connection": c, "returned": 0, "timeout": None }
+        finally:
+            self.lock.release()
+        return c
+
+    def put(self, c):
+        """
+        Returns a connection to the pool. Connections that are not
+        checked out (eg: ones that have been discarded) are ignored.
+        """
+        self.lock.acquire()
+        try:
+            e = self.busy.pop(id(c), None)
+            if e is None: return
+            if len(self.idle) < DB_POOL_MAX_SIZE and reserve_idle():
+                e["returned"] = time.time()
+                self.idle.append(e)
+                return
+        finally:
+            self.lock.release()
+        try:
+            c.close()
+        except:
+            pass
+
+    def discard(self, c):
+        """
+        Closes a checked out connection without returning it to the pool.
+        """
+        self.lock.acquire()
+        try:
+            self.busy.pop(id(c), None)
+        finally:
+            self.lock.release()
+        try:
+            c.close()
+        except:
+            pass
+
+    def reap(self):
+        """
+        Closes connections that have been idle for longer than
+        DB_POOL_MAX_IDLE seconds.
+        """
+        cutoff = time.time() - DB_POOL_MAX_IDLE
+        self.lock.acquire()
+        try:
+            expired = [ e for e in self.idle if e["returned"] < cutoff ]
+            self.idle = [ e for e in self.idle if e["returned"] >= cutoff ]
+        finally:
+            self.lock.release()
+        for e in expired:
+            release_idle()
+            try:
+                e["connection"].close()
+            except:
+                pass
+
+    def is_alive(self, c):
+        """
+        Health check for a connection that has been idle for a while
+        """
+        try:
+            s = c.cursor()
+            s.execute("SELECT 1")
+            s.fetchall()
+            s.close()
+            c.commit()
+            return True
+        except:
+            return False
+
+    def set_timeout(self, dbo, c, s, ms):
+        """
+        Sets the session statement timeout on connection c to ms
+        if it isn't already set to that value.
+        """
+        e = self.busy.get(id(c))
+        if e is not None and e["timeout"] == ms: return
+        set_timeout(dbo, c, s, ms)
+        if e is not None: e["timeout"] = ms
+
+pools = {}
+pools_lock = threading.Lock()
+pools_idle = { "count": 0, "reaped": time.time() }
+pools_idle_lock = threading.Lock()
+
+def pool(dbo):
+    """
+    Returns the connection pool for dbo, creating it if necessary.
+    Returns None if pooling is disabled or not possible for this database.
+    """
+    if DB_POOL_MAX_SIZE == 0 or dbo.dbtype == "SQLITE": return None
+    key = "%s:%s:%s:%s:%s" % (dbo.dbtype, dbo.host, dbo.port, dbo.database, dbo.username)
+    p = pools.get(key)
+    if p is not None: return p
+    pools_lock.acquire()
+    try:
+        if not pools.has_key(key): pools[key] = ConnectionPool(dbo)
+        return pools[key]
+    finally:
+        pools_lock.release()
+
+def reserve_idle():
+    """
+    Reserves room for one more idle connection across all pools.
+    Returns False if there are already DB_POOL_MAX_TOTAL.
+    """
+    pools_idle_lock.acquire()
+    try:
+        if pools_idle["count"] >= DB_POOL_MAX_TOTAL: return False
+        pools_idle["count"] += 1
+        return True
+    finally:
+        pools_idle_lock.release()
+
+def release_idle():
+    """
+    Gives back the room reserved for an idle connection.
+    """
+    pools_idle_lock.acquire()
+    try:
+        pools_idle["count"] -= 1
+    finally:
+        pools_idle_lock.release()
+
+def reap_pools():
+    """
+    Closes connections that have been idle for too long in every 
+    pool, so that databases that are no longer being used do not hold
+    connections open. Only does anything every DB_POOL_CHECK_AFTER seconds.
+    """
+    pools_idle_lock.acquire()
+    try:
+        if time.time() - pools_idle["reaped"] < DB_POOL_CHECK_AFTER: return
+        pools_idle["reaped"] = time.time()
+    finally:
+        pools_idle_lock.release()
+    for p in pools.values():
+        p.reap()
+
+def set_timeout(dbo, c, s, ms):
+    """
+    Sends the statement timeout for the session to the database
+    """
+    if dbo.dbtype == "POSTGRESQL":
+        s.execute("SET statement_timeout=%d" % ms)
+        # Commit so that a rollback of a later failed statement
+        # does not undo the SET and invalidate our tracked state
+        c.commit()
+    elif dbo.dbtype == "MYSQL":
+        s.execute("SET SESSION max_execution_time=%d" % ms)
+
 def connect_cursor_open(dbo, timeout = False):
     """
     Returns a tuple containing an open connection and cursor.
     If the dbo object contains an active connection, we'll just use
-    that to get a cursor.
+    that to get a cursor, otherwise the connection is checked out
+    of the pool for the database.
     timeout: if set, applies DB_TIMEOUT timeout to the cursor
     """
+    p = None
     if dbo.connection is not None:
         c = dbo.connection
         s = dbo.connection.cursor()
     else:
-        c = connection(dbo)
-        s = c.cursor()
+        p = pool(dbo)
+        if p is not None:
+            c = p.get(dbo)
+        else:
+            c = connection(dbo)
+        try:
+            s = c.cursor()
+        except:
+            if p is not None: p.discard(c)
+            raise
     # Only issue any kind of timeout if DB_TIMEOUT is non-zero
-    if dbo.dbtype == "POSTGRESQL" and DB_TIMEOUT != 0:
-        if timeout: s.execute("SET statement_timeout=%d" % DB_TIMEOUT)
-        elif not timeout: s.execute("SET statement_timeout=0")
-    if dbo.dbtype == "MYSQL" and DB_TIMEOUT != 0:
-        if timeout: s.execute("SET SESSION max_execution_time=%d" % DB_TIMEOUT)
-        elif not timeout: s.execute("SET SESSION max_execution_time=0")
+    if DB_TIMEOUT != 0 and dbo.dbtype != "SQLITE":
+        ms = 0
+        if timeout: ms = DB_TIMEOUT
+        if p is not None: 
+            try:
+                p.set_timeout(dbo, c, s, ms)
+            except:
+                connect_cursor_discard(dbo, c, s)
+                raise
+        else:
+            set_timeout(dbo, c, s, ms)
     return c, s
 
 def connect_cursor_close(dbo, c, s):
     """
     Closes a connection and cursor pair. If dbo.connection exists, then
-    c must be it, so don't close it.
+    c must be it, so don't close it. Pooled connections are returned
+    to their pool instead of being closed, so this must only be
+    called once for each pair (once returned, the connection can be
+    checked out again by another thread).
     """
     try:
         s.close()
     except:
         pass
     if dbo.connection is None:
+        p = pool(dbo)
+        if p is not None:
+            p.put(c)
+            reap_pools()
+            return
         try:
             c.close()
         except:
             pass
 
+def connect_cursor_discard(dbo, c, s):
+    """
+    Closes a connection and cursor pair after an error. Pooled 
+    connections are closed and removed from their pool instead of
+    being returned as their state cannot be trusted.
+    """
+    p = None
+    if dbo.connection is None: p = pool(dbo)
+    if p is None: 
+        connect_cursor_close(dbo, c, s)
+        return
+    try:
+        s.close()
+    except:
+        pass
+    p.discard(c)
+
 def query(dbo, sql):
     """
         Runs the query given and returns the resultset
@@ -124,19 +370,11 @@ def query(dbo, sql):
         s.execute(sql)
         c.commit()
         d = s.fetchall()
-        l = []
         cols = []
         # Get the list of column names
         for i in s.description:
             cols.append(i[0].upper())
-        for row in d:
-            # Intialise a map for each row
-            rowmap = {}
-            for i in xrange(0, len(row)):
-                v = encode_str(dbo, row[i])
-                rowmap[cols[i]] = v
-            l.append(rowmap)
-        connect_cursor_close(dbo, c, s)
+        l = rows_to_dicts(dbo, cols, d)
         if DB_TIME_QUERIES:
             tt = time.time() - start
             if tt > DB_TIME_LOG_OVER:
@@ -144,6 +382,10 @@ def query(dbo, sql):
         return l
     except Exception,err:
         al.error(str(err), "db.query", dbo, sys.exc_info())
+        try:
+            connect_cursor_discard(dbo, c, s)
+        except:
+            pass
         raise err
     finally:
         try:
@@ -183,10 +425,13 @@ def query_columns(dbo, sql):
         cn = []
         for col in s.description:
             cn.append(col[0].upper())
-        connect_cursor_close(dbo, c, s)
         return cn
     except Exception,err:
         al.error(str(err), "db.query_columns", dbo, sys.exc_info())
+        try:
+            connect_cursor_discard(dbo, c, s)
+        except:
+            pass
         raise err
     finally:
         try:
@@ -200,6 +445,9 @@ def query_generator(dbo, sql):
         as a list of dictionaries. All fieldnames are
 	    uppercased when returned.
         generator function version that uses a forward cursor.
+        The database drivers still fetch the whole resultset when 
+        the query is run, this only saves building every row's 
+        dictionary before the first one is returned.
     """
     try:
         c, s = connect_cursor_open(dbo, timeout=True)
@@ -211,17 +459,18 @@ def query_generator(dbo, sql):
         for i in s.description:
             cols.append(i[0].upper())
         row = s.fetchone()
+        strcols = None
         while row:
-            # Intialise a map for each row
-            rowmap = {}
-            for i in xrange(0, len(row)):
-                v = encode_str(dbo, row[i])
-                rowmap[cols[i]] = v
-            yield rowmap
+            # Decide which columns need encoding from the first row
+            if strcols is None: strcols = string_columns(dbo, [row], len(cols))
+            yield row_to_dict(cols, strcols, row)
             row = s.fetchone()
-        connect_cursor_close(dbo, c, s)
     except Exception,err:
         al.error(str(err), "db.query", dbo, sys.exc_info())
+        try:
+            connect_cursor_discard(dbo, c, s)
+        except:
+            pass
         raise err
     finally:
         try:
@@ -277,10 +526,13 @@ def query_tuple(dbo, sql):
         s.execute(sql)
         d = s.fetchall()
         c.commit()
-        connect_cursor_close(dbo, c, s)
         return d
     except Exception,err:
         al.error(str(err), "db.query_tuple", dbo, sys.exc_info())
+        try:
+            connect_cursor_discard(dbo, c, s)
+        except:
+            pass
         raise err
     finally:
         try:
@@ -303,10 +555,13 @@ def query_tuple_columns(dbo, sql):
         cn = []
         for col in s.description:
             cn.append(col[0].upper())
-        connect_cursor_close(dbo, c, s)
         return (d, cn)
     except Exception,err:
         al.error(str(err), "db.query_tuple_columns", dbo, sys.exc_info())
+        try:
+            connect_cursor_discard(dbo, c, s)
+        except:
+            pass
         raise err
     finally:
         try:
@@ -334,7 +589,6 @@ def execute(dbo, sql, override_lock = False):
         s.execute(sql)
         rv = s.rowcount
         c.commit()
-        connect_cursor_close(dbo, c, s)
         if DB_EXEC_LOG != "":
             with open(DB_EXEC_LOG.replace("{database}", dbo.database), "a") as f:
                 f.write("-- %s\n%s;\n" % (nowsql(), sql))
@@ -347,6 +601,10 @@ def execute(dbo, sql, override_lock = False):
             c.rollback()
         except:
             pass
+        try:
+            connect_cursor_discard(dbo, c, s)
+        except:
+            pass
         raise err
     finally:
         try:
@@ -370,7 +628,6 @@ def execute_many(dbo, sql, params, override_lock = False):
         s.executemany(sql, params)
         rv = s.rowcount
         c.commit()
-        connect_cursor_close(dbo, c, s)
         return rv
     except Exception,err:
         al.error(str(err), "db.execute_many", dbo, sys.exc_info())
@@ -380,6 +637,44 @@ def execute_many(dbo, sql, params, override_lock = False):
             c.rollback()
         except:
             pass
+        try:
+            connect_cursor_discard(dbo, c, s)
+        except:
+            pass
+        raise err
+    finally:
+        try:
+            connect_cursor_close(dbo, c, s)
+        except:
+            pass
+
+def execute_transaction(dbo, statements, override_lock = False):
+    """
+        Runs a list of (sql, params) tuples with executemany in a single
+        transaction, so either all of them are written or, if any of them
+        fail, none of them are. Eg:
+        [ ( "INSERT INTO table (field1) VALUES (%s)", [ ( "val1", ), ( "val2", ) ] ), ... ]
+        Statements with an empty list of params are skipped.
+        override_lock: if this is set to False and dbo.locked = True,
+        we don't do anything. 
+    """
+    if not override_lock and dbo.locked: return
+    try:
+        c, s = connect_cursor_open(dbo)
+        for sql, params in statements:
+            if len(params) == 0: continue
+            s.executemany(sql, params)
+        c.commit()
+    except Exception,err:
+        al.error(str(err), "db.execute_transaction", dbo, sys.exc_info())
+        try:
+            c.rollback()
+        except:
+            pass
+        try:
+            connect_cursor_discard(dbo, c, s)
+        except:
+            pass
         raise err
     finally:
         try:
@@ -451,6 +746,32 @@ def get_id(dbo, table):
     al.debug("get_id: %s -> %d (%s)" % (table, nextid, strategy), "db.get_id", dbo)
     return nextid
 
+def get_ids(dbo, table, count):
+    """
+    Returns a list of count new IDs for a table, allocated in a single
+    block for bulk inserts, according to the same strategies as get_id.
+    """
+    if count <= 0: return []
+    strategy = ""
+    ids = []
+    if DB_PK_STRATEGY == "max" or dbo.has_asm2_pk_table:
+        firstid = _get_id_max(dbo, table)
+        ids = range(firstid, firstid + count)
+        strategy = "max"
+    elif DB_PK_STRATEGY == "cache":
+        ids = [ _get_id_cache(dbo, table) for i in xrange(0, count) ]
+        strategy = "cache"
+    elif DB_PK_STRATEGY == "pseq" and dbo.dbtype == "POSTGRESQL":
+        ids = sorted([ r[0] for r in query_tuple(dbo, "SELECT nextval('seq_%s') FROM generate_series(1, %d)" % (table, count)) ])
+        strategy = "pseq"
+    else:
+        raise Exception("No valid PK strategy found")
+    if dbo.has_asm2_pk_table: 
+        _get_id_set_asm2_primarykey(dbo, table, ids[-1] + 1)
+        strategy += " asm2pk"
+    al.debug("get_ids: %s -> %d-%d (%s)" % (table, ids[0], ids[-1], strategy), "db.get_ids", dbo)
+    return ids
+
 def get_multiple_database_info(alias):
     """
     Gets the database info for the alias from our configured map.
@@ -497,6 +818,10 @@ def query_date(dbo, sql):
     r = query_tuple(dbo, sql)
     try:
         v = r[0][0]
+        # SQLite loses the column type for aggregates (eg: MIN/MAX)
+        # and gives us back the stored string
+        if isinstance(v, basestring):
+            v = datetime.datetime.strptime(v[:19], len(v) > 10 and "%Y-%m-%d %H:%M:%S" or "%Y-%m-%d")
         return v
     except:
         return None
@@ -523,6 +848,64 @@ def encode_str(dbo, v):
         al.error(str(err), "db.encode_str", dbo, sys.exc_info())
         raise err
 
+def encode_value(v):
+    """
+    Fast version of encode_str for converting query result values
+    without the error handling wrapper.
+    """
+    if type(v) == unicode:
+        return v.replace("`", "'").encode("ascii", "xmlcharrefreplace")
+    elif type(v) == str:
+        return v.replace("`", "'").decode("ascii", "ignore").encode("ascii", "ignore")
+    return v
+
+def string_columns(dbo, rows, ncols, sample = 20):
+    """
+    Returns a list of the indexes of columns in a resultset that need
+    to be passed through encode_value, decided from the first sample rows.
+    Columns that only contain None in the sample are included as their type
+    is unknown. SQLite columns can hold values of any type, so all
+    columns are included for SQLite databases.
+    """
+    if dbo.dbtype == "SQLITE": return range(0, ncols)
+    nonstring = [False] * ncols
+    unknown = [True] * ncols
+    for row in rows[:sample]:
+        for i in xrange(0, ncols):
+            if unknown[i] and row[i] is not None:
+                unknown[i] = False
+                nonstring[i] = type(row[i]) != unicode and type(row[i]) != str
+        if True not in unknown: break
+    return [ i for i in xrange(0, ncols) if not nonstring[i] ]
+
+def row_to_dict(cols, strcols, row):
+    """
+    Converts a single result row to a dictionary of uppercased column name
+    to value, encoding the values of the columns in strcols.
+    """
+    rowmap = dict(zip(cols, row))
+    for i in strcols:
+        v = row[i]
+        if v is not None: rowmap[cols[i]] = encode_value(v)
+    return rowmap
+
+def rows_to_dicts(dbo, cols, rows):
+    """
+    Converts the rows of a resultset to a list of dictionaries of 
+    uppercased column name to value. The columns that need encoding are
+    decided once for the resultset rather than calling encode_str for
+    every value.
+    """
+    strcols = [ (i, cols[i]) for i in string_columns(dbo, rows, len(cols)) ]
+    l = []
+    for row in rows:
+        rowmap = dict(zip(cols, row))
+        for i, col in strcols:
+            v = row[i]
+            if v is not None: rowmap[col] = encode_value(v)
+        l.append(rowmap)
+    return l
+
 def split_queries(sql):
     """
     Splits semi-colon separated queries in a single
@@ -590,6 +973,21 @@ def ds(s, sanitise_xss = True):
         if sanitise_xss: s = escape_xss(s)  # XSS
         return u"'%s'" % s
 
+def ds_param(s, sanitise_xss = True):
+    """ Formats a string as a parameter for execute_many, encoding it in
+        the same way as ds but leaving the quoting to the database driver """
+    if s is None: 
+        return None
+    elif type(s) != str and type(s) != unicode:
+        return str(s)
+    elif not DB_DECODE_HTML_ENTITIES:
+        s = utils.encode_html(s)
+    else:
+        s = utils.decode_html(s)
+    s = s.replace("'", "`")
+    if sanitise_xss: s = escape_xss(s)
+    return s
+
 def df(f):
     """ Formats a value as a float for the database """
     if f is None: return "NULL"
@@ -2,7 +2,7 @@
 
 import al
 import animal, animalcontrol, financial, lostfound, medical, movement, onlineform, person, waitinglist
-import configuration, db, dbfs, utils
+import configuration, db, dbfs, lookups, utils
 import os, sys
 from i18n import _, BUILD
 from sitedefs import DB_PK_STRATEGY
@@ -21,28 +21,28 @@ VERSIONS = (
     33706, 33707, 33708, 33709, 33710, 33711, 33712, 33713, 33714, 33715, 33716,
     33717, 33718, 33800, 33801, 33802, 33803, 33900, 33901, 33902, 33903, 33904,
     33905, 33906, 33907, 33908, 33909, 33911, 33912, 33913, 33914, 33915, 33916,
-    34000
+    34000, 34001, 34002, 34003, 34004, 34005, 34006
 )
 
 LATEST_VERSION = VERSIONS[-1]
 
 # All ASM3 tables
-TABLES = ( "accounts", "accountsrole", "accountstrx", "additional", "additionalfield",
-    "adoption", "animal", "animalcontrol", "animalcontrolanimal", "animalcontrolrole", "animalcost", 
+TABLES = ( "accounts", "accountsbalance", "accountsrole", "accountstrx", "additional", "additionalfield",
+    "adoption", "alertcount", "animal", "animalcontrol", "animalcontrolanimal", "animalcontrolrole", "animalcost", 
     "animaldiet", "animalfigures", "animalfiguresannual", "animalfiguresasilomar", "animalfiguresmonthlyasilomar", 
     "animalfound", "animalcontrolanimal", "animallitter", "animallost", "animallostfoundmatch", 
     "animalmedical", "animalmedicaltreatment", "animalname", "animalpublished", 
     "animaltype", "animaltest", "animaltransport", "animalvaccination", "animalwaitinglist", "audittrail", 
-    "basecolour", "breed", "citationtype", "configuration", "costtype", "customreport", "customreportrole", "dbfs", 
+    "basecolour", "breed", "citationtype", "configuration", "costtype", "customreport", "customreportrole", "dailystats", "dbfs", 
     "deathreason", "diary", "diarytaskdetail", "diarytaskhead", "diet", "donationpayment", "donationtype", 
-    "entryreason", "incidentcompleted", "incidenttype", "internallocation", "licencetype", "lkanimalflags", "lkcoattype", 
+    "entryreason", "geocache", "incidentcompleted", "incidenttype", "internallocation", "licencetype", "lkanimalflags", "lkcoattype", 
     "lkownerflags", "lksaccounttype", "lksdiarylink", "lksdonationfreq", "lksex", "lksfieldlink", "lksfieldtype", 
     "lksize", "lksloglink", "lksmedialink", "lksmediatype", "lksmovementtype", "lksposneg", "lksrotatype", 
     "lksyesno", "lksynun", "lkurgency", "lkworktype", "log", "logtype", "media", "medicalprofile", "messages", "onlineform", 
     "onlineformfield", "onlineformincoming", "owner", "ownercitation", "ownerdonation", "ownerinvestigation", 
     "ownerlicence", "ownerlookingfor", "ownerrota", "ownertraploan", "ownervoucher", "pickuplocation", 
-    "reservationstatus", "role", "site", "species", "stocklevel", "stocklocation", "stockusage", "stockusagetype", 
-    "testtype", "testresult", "traptype", "userrole", "users", "vaccinationtype", "voucher" )
+    "reservationstatus", "role", "searchindex", "site", "species", "stocklevel", "stocklocation", "stockusage", "stockusagetype", 
+    "testtype", "testresult", "timeline", "traptype", "userrole", "users", "vaccinationtype", "voucher" )
 
 # ASM2_COMPATIBILITY This is used for dumping tables in ASM2/HSQLDB format. 
 # These are the tables present in ASM2. users is not included due to the
@@ -59,9 +59,9 @@ TABLES_ASM2 = ( "accounts", "accountstrx", "additional", "additionalfield",
     "species", "vaccinationtype", "voucher" )
 
 # Tables that don't have an ID column (we don't create PostgreSQL sequences for them for pseq pk)
-TABLES_NO_ID_COLUMN = ( "accountsrole", "additional", "audittrail", "animalcontrolanimal", 
-    "animalcontrolrole", "animallostfoundmatch", "animalpublished", "configuration", "customreportrole", 
-    "onlineformincoming", "ownerlookingfor", "userrole" )
+TABLES_NO_ID_COLUMN = ( "accountsbalance", "accountsrole", "additional", "alertcount", "audittrail", "animalcontrolanimal", 
+    "animalcontrolrole", "animallostfoundmatch", "animalpublished", "configuration", "customreportrole", "dailystats", "geocache", 
+    "onlineformincoming", "ownerlookingfor", "searchindex", "userrole" )
 
 VIEWS = ( "v_adoption", "v_animal", "v_animalcontrol", "v_animalfound", "v_animallost", 
     "v_animalmedicaltreatment", "v_animaltest", "v_animalvaccination", "v_animalwaitinglist", 
@@ -143,6 +143,14 @@ def sql_structure(dbo):
     sql += index("accounts_CostTypeID", "accounts", "CostTypeID")
     sql += index("accounts_DonationTypeID", "accounts", "DonationTypeID")
  
+    sql += table("accountsbalance", (
+        fint("AccountID"),
+        fint("PeriodMonth"),
+        fint("Total"),
+        fint("Reconciled") ), False)
+    sql += index("accountsbalance_AccountIDPeriodMonth", "accountsbalance", "AccountID,PeriodMonth", True)
+    sql += index("accountsbalance_PeriodMonth", "accountsbalance", "PeriodMonth")
+
     sql += table("accountsrole", (
         fint("AccountID"),
         fint("RoleID"),
@@ -225,6 +233,14 @@ def sql_structure(dbo):
     sql += index("adoption_ReturnedReasonID", "adoption", "ReturnedReasonID")
     sql += index("adoption_TrialEndDate", "adoption", "TrialEndDate")
 
+    sql += table("alertcount", (
+        field("AlertName", "VARCHAR(20)", False),
+        fint("AlertValue"),
+        fdate("CalcDate"),
+        fint("Version", True),
+        fint("CalcVersion", True) ), False)
+    sql += index("alertcount_AlertName", "alertcount", "AlertName", True)
+
     sql += table("animal", (
         fid(),
         fint("AnimalTypeID"),
@@ -830,6 +846,18 @@ def sql_structure(dbo):
         fint("CanView") ))
     sql += index("customreportrole_ReportIDRoleID", "customreportrole", "ReportID, RoleID")
 
+    sql += table("dailystats", (
+        fdate("StatDate"),
+        fint("Entered"),
+        fint("Adopted"),
+        fint("Reclaimed"),
+        fint("Transferred"),
+        fint("PTS"),
+        fint("Died"),
+        fint("Donations"),
+        fint("Costs") ), False)
+    sql += index("dailystats_StatDate", "dailystats", "StatDate", True)
+
     sql += table("dbfs", (
         fid(),
         fstr("Path"),
@@ -898,6 +926,13 @@ def sql_structure(dbo):
         fstr("ReasonDescription", True),
         fint("IsRetired", True) ), False)
 
+    sql += table("geocache", (
+        field("QueryHash", "VARCHAR(32)", False),
+        flongstr("Query"),
+        fstr("LatLong", True),
+        fdate("CreatedDate") ), False)
+    sql += index("geocache_QueryHash", "geocache", "QueryHash", True)
+
     sql += table("incidentcompleted", (
         fid(),
         fstr("CompletedName"),
@@ -1309,6 +1344,13 @@ def sql_structure(dbo):
         flongstr("SecurityMap")), False)
     sql += index("role_Rolename", "role", "Rolename")
 
+    sql += table("searchindex", (
+        fint("LinkType"),
+        fint("LinkID"),
+        field("Trigram", "VARCHAR(3)", False) ), False)
+    sql += index("searchindex_LinkTypeTrigramLinkID", "searchindex", "LinkType,Trigram,LinkID", True)
+    sql += index("searchindex_LinkTypeLinkID", "searchindex", "LinkType,LinkID")
+
     sql += table("site", (
         fid(),
         fstr("SiteName") ), False)
@@ -1378,6 +1420,19 @@ def sql_structure(dbo):
         fstr("ResultDescription", True),
         fint("IsRetired", True) ), False)
 
+    sql += table("timeline", (
+        fid(),
+        fstr("LinkTarget"),
+        fstr("Category"),
+        fdate("EventDate", True),
+        fint("LinkID"),
+        flongstr("Text1"),
+        flongstr("Text2"),
+        flongstr("Text3"),
+        fstr("LastChangedBy", True) ), False)
+    sql += index("timeline_EventDate", "timeline", "EventDate")
+    sql += index("timeline_LinkID", "timeline", "LinkID")
+
     sql += table("traptype", (
         fid(),
         fstr("TrapTypeName"),
@@ -2318,6 +2373,8 @@ def install_default_data(dbo, skip_config = False):
         if s.strip() != "":
             print s.strip()
             db.execute_dbupdate(dbo, s.strip())
+    configuration.invalidate(dbo)
+    lookups.invalidate(dbo)
 
 def reinstall_default_data(dbo):
     """
@@ -2638,13 +2695,13 @@ def reset_db(dbo):
     """
     Resets a database by removing all data from non-lookup tables.
     """
-    deltables = [ "accountstrx", "additional", "adoption", "animal", "animalcontrol", "animalcost",
+    deltables = [ "accountsbalance", "accountstrx", "additional", "adoption", "alertcount", "animal", "animalcontrol", "animalcost",
         "animaldiet", "animalfigures", "animalfiguresannual", "animalfiguresasilomar", "animalfiguresmonthlyasilomar",
         "animalfound", "animallitter", "animallost", "animalmedical", "animalmedicaltreatment", "animalname",
-        "animaltest", "animaltransport", "animalvaccination", "animalwaitinglist", "diary", "log",
+        "animaltest", "animaltransport", "animalvaccination", "animalwaitinglist", "dailystats", "diary", "log",
         "media", "messages", "onlineform", "onlineformfield", "onlineformincoming", "owner", "ownercitation",
         "ownerdonation", "ownerinvestigation", "ownerlicence", "ownertraploan", "ownervoucher", "stocklevel",
-        "stockusage" ]
+        "stockusage", "timeline" ]
     for t in deltables:
         db.execute_dbupdate(dbo, "DELETE FROM %s" % t)
     db.execute_dbupdate(dbo, "DELETE FROM dbfs WHERE Path LIKE '/animal%' OR Path LIKE '/owner%'")
@@ -2673,6 +2730,10 @@ def perform_updates(dbo):
                 configuration.dbv(dbo, str(v))
                 ver = v
         
+        # Updates can change configuration and lookup data directly
+        configuration.invalidate(dbo)
+        lookups.invalidate(dbo)
+
         # Return the new db version
         configuration.db_unlock(dbo)
         return configuration.dbv(dbo)
@@ -4550,3 +4611,75 @@ def update_34000(dbo):
     add_column(dbo, "animallostfoundmatch", "LostArea", shorttext(dbo))
     add_column(dbo, "animallostfoundmatch", "FoundArea", shorttext(dbo))
 
+def update_34001(dbo):
+    # Add the searchindex table
+    sql = "CREATE TABLE searchindex ( " \
+        "LinkType INTEGER NOT NULL, " \
+        "LinkID INTEGER NOT NULL, " \
+        "Trigram VARCHAR(3) NOT NULL)"
+    db.execute_dbupdate(dbo, sql)
+    add_index(dbo, "searchindex_LinkTypeTrigramLinkID", "searchindex", "LinkType,Trigram,LinkID", True)
+    add_index(dbo, "searchindex_LinkTypeLinkID", "searchindex", "LinkType,LinkID")
+
+def update_34002(dbo):
+    # Add the geocache table
+    sql = "CREATE TABLE geocache ( " \
+        "QueryHash VARCHAR(32) NOT NULL, " \
+        "Query %s NULL, " \
+        "LatLong %s NULL, " \
+        "CreatedDate %s NOT NULL)" % (longtext(dbo), shorttext(dbo), datetype(dbo))
+    db.execute_dbupdate(dbo, sql)
+    add_index(dbo, "geocache_QueryHash", "geocache", "QueryHash", True)
+
+def update_34003(dbo):
+    # Add the accountsbalance table, it will be built by the next daily batch
+    sql = "CREATE TABLE accountsbalance ( " \
+        "AccountID INTEGER NOT NULL, " \
+        "PeriodMonth INTEGER NOT NULL, " \
+        "Total INTEGER NOT NULL, " \
+        "Reconciled INTEGER NOT NULL)"
+    db.execute_dbupdate(dbo, sql)
+    add_index(dbo, "accountsbalance_AccountIDPeriodMonth", "accountsbalance", "AccountID,PeriodMonth", True)
+    add_index(dbo, "accountsbalance_PeriodMonth", "accountsbalance", "PeriodMonth")
+
+def update_34004(dbo):
+    # Add the alertcount table, it is filled the next time the alerts are read
+    sql = "CREATE TABLE alertcount ( " \
+        "AlertName VARCHAR(20) NOT NULL, " \
+        "AlertValue INTEGER NOT NULL, " \
+        "CalcDate %s NOT NULL, " \
+        "Version INTEGER, " \
+        "CalcVersion INTEGER)" % datetype(dbo)
+    db.execute_dbupdate(dbo, sql)
+    add_index(dbo, "alertcount_AlertName", "alertcount", "AlertName", True)
+
+def update_34005(dbo):
+    # Add the dailystats table, it will be built by the next daily batch
+    sql = "CREATE TABLE dailystats ( " \
+        "StatDate %s NOT NULL, " \
+        "Entered INTEGER NOT NULL, " \
+        "Adopted INTEGER NOT NULL, " \
+        "Reclaimed INTEGER NOT NULL, " \
+        "Transferred INTEGER NOT NULL, " \
+        "PTS INTEGER NOT NULL, " \
+        "Died INTEGER NOT NULL, " \
+        "Donations INTEGER NOT NULL, " \
+        "Costs INTEGER NOT NULL)" % datetype(dbo)
+    db.execute_dbupdate(dbo, sql)
+    add_index(dbo, "dailystats_StatDate", "dailystats", "StatDate", True)
+
+def update_34006(dbo):
+    # Add the timeline table, it will be built by the next daily batch
+    sql = "CREATE TABLE timeline (ID INTEGER NOT NULL PRIMARY KEY, " \
+        "LinkTarget %(short)s NOT NULL, " \
+        "Category %(short)s NOT NULL, " \
+        "EventDate %(date)s, " \
+        "LinkID INTEGER NOT NULL, " \
+        "Text1 %(long)s, " \
+        "Text2 %(long)s, " \
+        "Text3 %(long)s, " \
+        "LastChangedBy %(short)s)" % { "short": shorttext(dbo), "date": datetype(dbo), "long": longtext(dbo) }
+    db.execute_dbupdate(dbo, sql)
+    add_index(dbo, "timeline_EventDate", "timeline", "EventDate")
+    add_index(dbo, "timeline_LinkID", "timeline", "LinkID")
+
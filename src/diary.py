@@ -356,13 +356,17 @@ def execute_diary_task(dbo, username, tasktype, taskid, linkid, selecteddate):
     rollingdate = i18n.now(dbo.timezone) 
     dtd = db.query(dbo, "SELECT * FROM diarytaskdetail WHERE DiaryTaskHeadID = %d ORDER BY ID" % int(taskid))
     tags = {}
+    used = set()
+    for d in dtd:
+        used.update(wordprocessor.get_tags_used(fix(d["SUBJECT"])))
+        used.update(wordprocessor.get_tags_used(fix(d["NOTE"])))
     linktype = ANIMAL
     if tasktype == "ANIMAL": 
         linktype = ANIMAL
-        tags = wordprocessor.animal_tags(dbo, animal.get_animal(dbo, int(linkid)))
+        tags = wordprocessor.animal_tags(dbo, animal.get_animal(dbo, int(linkid)), used)
     elif tasktype == "PERSON": 
         linktype = PERSON
-        tags = wordprocessor.person_tags(dbo, person.get_person(dbo, int(linkid)))
+        tags = wordprocessor.person_tags(dbo, person.get_person(dbo, int(linkid)), used)
     for d in dtd:
         if d["DAYPIVOT"] == 9999: 
             rollingdate = selecteddate
@@ -1,11 +1,15 @@
 #!/usr/bin/python
 
 import al
+import alerts
 import audit
 import configuration
+import datetime
 import db
 import i18n
 import movement
+import searchindex
+import stats
 import utils
 import zipfile, sys
 from cStringIO import StringIO
@@ -152,50 +156,38 @@ def get_accounts(dbo, onlyactive = False):
     onlyactive: If set to true, only accounts with ARCHIVED == 0 are returned
     """
     l = dbo.locale
-    pfilter = ""
-    aperiod = configuration.accounting_period(dbo)
-    if aperiod != "":
-        pfilter = " AND TrxDate >= " + db.dd(i18n.display2python(l, aperiod))
     afilter = ""
     if onlyactive:
         afilter = "WHERE Archived = 0 "
     roles = db.query(dbo, "SELECT ar.*, r.RoleName FROM accountsrole ar INNER JOIN role r ON ar.RoleID = r.ID")
     accounts = db.query(dbo, "SELECT a.*, at.AccountType AS AccountTypeName, " \
-        "dt.DonationName, " \
-        "(SELECT SUM(Amount) FROM accountstrx WHERE DestinationAccountID = a.ID%s) AS dest," \
-        "(SELECT SUM(Amount) FROM accountstrx WHERE SourceAccountID = a.ID%s) AS src," \
-        "(SELECT SUM(Amount) FROM accountstrx WHERE Reconciled = 1 AND DestinationAccountID = a.ID%s) AS recdest," \
-        "(SELECT SUM(Amount) FROM accountstrx WHERE Reconciled = 1 AND SourceAccountID = a.ID%s) AS recsrc " \
+        "dt.DonationName " \
         "FROM accounts a " \
         "INNER JOIN lksaccounttype at ON at.ID = a.AccountType " \
         "LEFT OUTER JOIN donationtype dt ON dt.ID = a.DonationTypeID %s" \
-        "ORDER BY a.AccountType, a.Code" % (pfilter, pfilter, pfilter, pfilter, afilter))
+        "ORDER BY a.AccountType, a.Code" % afilter)
+    balances = get_balances_to_date(dbo)
+    aperiod = configuration.accounting_period(dbo)
+    if aperiod != "":
+        for aid, (balance, reconciled) in get_balances_to_date(dbo, i18n.display2python(l, aperiod)).iteritems():
+            b = balances.setdefault(aid, [0, 0])
+            b[0] -= balance
+            b[1] -= reconciled
+    accountroles = {}
+    for r in roles:
+        ar = accountroles.setdefault(r["ACCOUNTID"], ( [], [], [], [] ))
+        if r["CANVIEW"] == 1:
+            ar[0].append(str(r["ROLEID"]))
+            ar[1].append(str(r["ROLENAME"]))
+        if r["CANEDIT"] == 1:
+            ar[2].append(str(r["ROLEID"]))
+            ar[3].append(str(r["ROLENAME"]))
     for a in accounts:
-        dest = a["DEST"]
-        src = a["SRC"]
-        recdest = a["RECDEST"]
-        recsrc = a["RECSRC"]
-        if dest is None: dest = 0
-        if src is None: src = 0
-        if recdest is None: recdest = 0
-        if recsrc is None: recsrc = 0
-        
-        a["BALANCE"] = dest - src
-        a["RECONCILED"] = recdest - recsrc
+        a["BALANCE"], a["RECONCILED"] = balances.get(a["ID"], ( 0, 0 ))
         if a["ACCOUNTTYPE"] == INCOME or a["ACCOUNTTYPE"] == EXPENSE:
             a["BALANCE"] = abs(a["BALANCE"])
             a["RECONCILED"] = abs(a["RECONCILED"])
-        viewroleids = []
-        viewrolenames = []
-        editroleids = []
-        editrolenames = []
-        for r in roles:
-            if r["ACCOUNTID"] == a["ID"] and r["CANVIEW"] == 1:
-                viewroleids.append(str(r["ROLEID"]))
-                viewrolenames.append(str(r["ROLENAME"]))
-            if r["ACCOUNTID"] == a["ID"] and r["CANEDIT"] == 1:
-                editroleids.append(str(r["ROLEID"]))
-                editrolenames.append(str(r["ROLENAME"]))
+        viewroleids, viewrolenames, editroleids, editrolenames = accountroles.get(a["ID"], ( [], [], [], [] ))
         a["VIEWROLEIDS"] = "|".join(viewroleids)
         a["VIEWROLES"] = "|".join(viewrolenames)
         a["EDITROLEIDS"] = "|".join(editroleids)
@@ -207,44 +199,197 @@ def get_balance_to_date(dbo, accountid, todate):
     Returns the balance of accountid to todate.
     """
     aid = int(accountid)
-    rows = db.query(dbo, "SELECT a.AccountType, " \
-        "(SELECT SUM(Amount) FROM accountstrx WHERE SourceAccountID = a.ID AND TrxDate < %s) AS withdrawal," \
-        "(SELECT SUM(Amount) FROM accountstrx WHERE DestinationAccountID = a.ID AND TrxDate < %s) AS deposit " \
-        "FROM accounts a " \
-        "WHERE a.ID = %d" % ( db.dd(todate), db.dd(todate), aid ))
-    r = rows[0]
-    deposit = r["DEPOSIT"]
-    withdrawal = r["WITHDRAWAL"]
-    if deposit is None: deposit = 0
-    if withdrawal is None: withdrawal = 0
-    balance = deposit - withdrawal
-    #if r["ACCOUNTTYPE"] == INCOME or r["ACCOUNTTYPE"] == EXPENSE: balance = abs(balance)
-    return balance
+    return get_balances_to_date(dbo, todate, [ aid ]).get(aid, [ 0, 0 ])[0]
 
 def get_balance_fromto_date(dbo, accountid, fromdate, todate):
     """
     Returns the balance of accountid from fromdate to todate.
     """
-    aid = int(accountid)
-    rows = db.query(dbo, "SELECT a.AccountType, " \
-        "(SELECT SUM(Amount) FROM accountstrx WHERE SourceAccountID = a.ID AND TrxDate >= %s AND TrxDate < %s) AS withdrawal," \
-        "(SELECT SUM(Amount) FROM accountstrx WHERE DestinationAccountID = a.ID AND TrxDate >= %s AND TrxDate < %s) AS deposit " \
-        "FROM accounts a " \
-        "WHERE a.ID = %d" % ( db.dd(fromdate), db.dd(todate), db.dd(fromdate), db.dd(todate), aid ))
-    r = rows[0]
-    deposit = r["DEPOSIT"]
-    withdrawal = r["WITHDRAWAL"]
-    if deposit is None: deposit = 0
-    if withdrawal is None: withdrawal = 0
-    balance = deposit - withdrawal
-    #if r["ACCOUNTTYPE"] == INCOME or r["ACCOUNTTYPE"] == EXPENSE: balance = abs(balance)
-    return balance
+    return get_balance_to_date(dbo, accountid, todate) - get_balance_to_date(dbo, accountid, fromdate)
+
+def get_balances_to_date(dbo, todate = None, accountids = None):
+    """
+    Returns a dict of accountid: [ balance, reconciled balance ] for 
+    transactions before todate (or all transactions if todate is None).
+    accountids: A list of accounts to restrict to, or None for all.
+    Whole months are read from the accountsbalance ledger, so only
+    the transactions in the month of todate are summed.
+    """
+    if not account_balances_built(dbo):
+        where = "1=1"
+        if todate is not None: where = "TrxDate < %s" % db.dd(todate)
+        return _sum_trx(dbo, where, accountids)
+    where = ""
+    if todate is not None: 
+        where += " AND PeriodMonth < %d" % _period(todate)
+    if accountids is not None: 
+        where += " AND AccountID IN (%s)" % ",".join([ str(int(x)) for x in accountids ])
+    rows = db.query_tuple(dbo, "SELECT AccountID, SUM(Total), SUM(Reconciled) FROM accountsbalance " \
+        "WHERE 1=1%s GROUP BY AccountID" % where)
+    balances = {}
+    for aid, total, reconciled in rows:
+        balances[aid] = [ int(total or 0), int(reconciled or 0) ]
+    if todate is not None and todate.day != 1:
+        monthstart = _period_start(todate)
+        partial = _sum_trx(dbo, "TrxDate >= %s AND TrxDate < %s" % (db.dd(monthstart), db.dd(todate)), accountids)
+        for aid, (total, reconciled) in partial.iteritems():
+            b = balances.setdefault(aid, [0, 0])
+            b[0] += total
+            b[1] += reconciled
+    return balances
+
+def account_balances_built(dbo):
+    """
+    Returns True if the accountsbalance ledger has been built
+    """
+    return configuration.account_balances_updated(dbo) != ""
+
+def _period(d):
+    """ Returns the accountsbalance period (yyyymm) for a python date """
+    return d.year * 100 + d.month
+
+def _period_start(d):
+    """ Returns the first day of the month containing python date d """
+    return datetime.datetime(d.year, d.month, 1)
+
+def _next_period_start(d):
+    """ Returns the first day of the month after python date d """
+    if d.month == 12: return datetime.datetime(d.year + 1, 1, 1)
+    return datetime.datetime(d.year, d.month + 1, 1)
+
+def _sum_trx(dbo, where, accountids = None):
+    """
+    Returns a dict of accountid: [ balance, reconciled balance ] for 
+    the transactions matching where, restricted to accountids if given.
+    """
+    balances = {}
+    for col, sign in ( ("DestinationAccountID", 1), ("SourceAccountID", -1) ):
+        afilter = ""
+        if accountids is not None: 
+            afilter = " AND %s IN (%s)" % (col, ",".join([ str(int(x)) for x in accountids ]))
+        rows = db.query_tuple(dbo, "SELECT %s, Reconciled, SUM(Amount) FROM accountstrx " \
+            "WHERE %s%s GROUP BY %s, Reconciled" % (col, where, afilter, col))
+        for aid, reconciled, amount in rows:
+            b = balances.setdefault(aid, [0, 0])
+            amount = sign * int(amount or 0)
+            b[0] += amount
+            if reconciled == 1: b[1] += amount
+    return balances
+
+def get_balance_periods(dbo, where):
+    """
+    Returns the set of (accountid, period) accountsbalance entries that
+    the transactions matching where count towards. Call before and after 
+    changing transactions and pass the result to update_account_balances.
+    """
+    if not account_balances_built(dbo): return set()
+    periods = set()
+    for src, dest, trxdate in db.query_tuple(dbo, "SELECT SourceAccountID, DestinationAccountID, TrxDate " \
+        "FROM accountstrx WHERE %s" % where):
+        if trxdate is None: continue
+        periods.add((src, _period(trxdate)))
+        periods.add((dest, _period(trxdate)))
+    return periods
+
+def update_account_balances(dbo, periods):
+    """
+    Recalculates the accountsbalance entries for a set of 
+    (accountid, period) tuples from get_balance_periods. 
+    Errors are logged rather than raised so that a problem with
+    the ledger never stops a transaction being saved. Instead, the
+    ledger is marked as not built so that balances are calculated
+    from the transactions until the daily check rebuilds it.
+    """
+    if len(periods) == 0 or not account_balances_built(dbo): return
+    months = {}
+    for aid, period in periods:
+        months.setdefault(period, set()).add(aid)
+    try:
+        for period, accountids in months.iteritems():
+            monthstart = datetime.datetime(period / 100, period % 100, 1)
+            balances = _sum_trx(dbo, "TrxDate >= %s AND TrxDate < %s" % (db.dd(monthstart), db.dd(_next_period_start(monthstart))), accountids)
+            existing = set([ r[0] for r in db.query_tuple(dbo, "SELECT AccountID FROM accountsbalance WHERE PeriodMonth = %d AND AccountID IN (%s)" % \
+                (period, ",".join([ str(int(x)) for x in accountids ]))) ])
+            updates = []
+            inserts = []
+            for aid in accountids:
+                b = balances.get(aid, [0, 0])
+                if aid in existing:
+                    updates.append((b[0], b[1], aid, period))
+                elif b != [0, 0]:
+                    inserts.append((aid, period, b[0], b[1]))
+            db.execute_many(dbo, "UPDATE accountsbalance SET Total = %s, Reconciled = %s WHERE AccountID = %s AND PeriodMonth = %s", updates)
+            try:
+                db.execute_many(dbo, "INSERT INTO accountsbalance (AccountID, PeriodMonth, Total, Reconciled) VALUES (%s, %s, %s, %s)", inserts)
+            except:
+                # Another update inserted some of these periods since we looked
+                db.execute_many(dbo, "UPDATE accountsbalance SET Total = %s, Reconciled = %s WHERE AccountID = %s AND PeriodMonth = %s", 
+                    [ (t, r, aid, p) for aid, p, t, r in inserts ])
+    except Exception,err:
+        al.error("failed updating account balances for %s: %s" % (periods, err), "financial.update_account_balances", dbo)
+        configuration.set_account_balances_updated(dbo, False)
+
+def calculate_account_balances(dbo):
+    """
+    Calculates the accountsbalance ledger from the transactions,
+    returning a dict of (accountid, period): [ balance, reconciled balance ]
+    """
+    ledger = {}
+    first = db.query_date(dbo, "SELECT MIN(TrxDate) FROM accountstrx")
+    last = db.query_date(dbo, "SELECT MAX(TrxDate) FROM accountstrx")
+    if first is None or last is None: return ledger
+    monthstart = _period_start(first)
+    while monthstart <= last:
+        nextstart = _next_period_start(monthstart)
+        balances = _sum_trx(dbo, "TrxDate >= %s AND TrxDate < %s" % (db.dd(monthstart), db.dd(nextstart)))
+        for aid, b in balances.iteritems():
+            if b != [0, 0]: ledger[(aid, _period(monthstart))] = b
+        monthstart = nextstart
+    return ledger
+
+def rebuild_account_balances(dbo):
+    """
+    Rebuilds the accountsbalance ledger. Balances are calculated
+    from the transactions while it is being rebuilt.
+    """
+    configuration.set_account_balances_updated(dbo, False)
+    ledger = calculate_account_balances(dbo)
+    db.execute(dbo, "DELETE FROM accountsbalance")
+    db.execute_many(dbo, "INSERT INTO accountsbalance (AccountID, PeriodMonth, Total, Reconciled) VALUES (%s, %s, %s, %s)", 
+        [ (aid, period, b[0], b[1]) for (aid, period), b in ledger.iteritems() ])
+    configuration.set_account_balances_updated(dbo)
+    al.debug("rebuilt %d account balance periods" % len(ledger), "financial.rebuild_account_balances", dbo)
+
+def check_account_balances(dbo, rebuild = True):
+    """
+    Compares the accountsbalance ledger with the transactions and
+    logs any differences. Returns the number of periods that are wrong.
+    rebuild: Rebuild the ledger if it is wrong or hasn't been built yet
+    """
+    if not account_balances_built(dbo):
+        if rebuild: rebuild_account_balances(dbo)
+        return 0
+    expected = calculate_account_balances(dbo)
+    actual = {}
+    for aid, period, total, reconciled in db.query_tuple(dbo, "SELECT AccountID, PeriodMonth, Total, Reconciled FROM accountsbalance"):
+        actual[(aid, period)] = [ int(total), int(reconciled) ]
+    errors = 0
+    for aid, period in set(expected.keys()) | set(actual.keys()):
+        e = expected.get((aid, period), [0, 0])
+        a = actual.get((aid, period), [0, 0])
+        if e != a:
+            errors += 1
+            al.error("account %s period %s: ledger has %s, transactions have %s" % (aid, period, a, e), "financial.check_account_balances", dbo)
+    if errors > 0 and rebuild:
+        rebuild_account_balances(dbo)
+    return errors
 
 def mark_reconciled(dbo, trxid):
     """
     Marks a transaction reconciled.
     """
     db.execute(dbo, "UPDATE accountstrx SET Reconciled = 1 WHERE ID = %d" % int(trxid))
+    update_account_balances(dbo, get_balance_periods(dbo, "ID = %d" % int(trxid)))
 
 def get_transactions(dbo, accountid, datefrom, dateto, reconciled):
     """
@@ -504,8 +649,11 @@ def get_recent_licences(dbo):
         "ORDER BY ol.IssueDate DESC" % db.dd(i18n.subtract_days(i18n.now(dbo.timezone), 30)))
 
 def get_licence_find_simple(dbo, licnum, dummy = 0):
-    return db.query(dbo, get_licence_query(dbo) + \
-        "WHERE UPPER(ol.LicenceNumber) LIKE UPPER('%%%s%%')" % licnum.replace("'", "`"))
+    ids = searchindex.get_candidates(dbo, searchindex.LICENCE, licnum)
+    if ids is not None and len(ids) == 0: return []
+    sql = get_licence_query(dbo) + "WHERE UPPER(ol.LicenceNumber) LIKE UPPER('%%%s%%')" % licnum.replace("'", "`")
+    if ids is not None: sql += " AND ol.ID IN (%s)" % ",".join([ str(x) for x in ids ])
+    return db.query(dbo, sql)
 
 def get_licence(dbo, licenceid):
     """
@@ -611,6 +759,8 @@ def insert_donation_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "ownerdonation")
+    stats.update_days(dbo, stats.get_days(dbo, "ownerdonation", "ID = %d" % donationid))
     audit.create(dbo, username, "ownerdonation", donationid, audit.dump_row(dbo, "ownerdonation", donationid))
     if configuration.donation_trx_override(dbo):
         update_matching_donation_transaction(dbo, username, donationid, post.integer("destaccount"))
@@ -648,7 +798,10 @@ def update_donation_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     preaudit = db.query(dbo, "SELECT * FROM ownerdonation WHERE ID = %d" % donationid)
+    statdays = stats.get_days(dbo, "ownerdonation", "ID = %d" % donationid)
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "ownerdonation")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "ownerdonation", "ID = %d" % donationid))
     postaudit = db.query(dbo, "SELECT * FROM ownerdonation WHERE ID = %d" % donationid)
     audit.edit(dbo, username, "ownerdonation", donationid, audit.map_diff(preaudit, postaudit))
     if configuration.donation_trx_override(dbo):
@@ -664,9 +817,14 @@ def delete_donation(dbo, username, did):
     """
     audit.delete(dbo, username, "ownerdonation", did, audit.dump_row(dbo, "ownerdonation", did))
     movementid = db.query_int(dbo, "SELECT MovementID FROM ownerdonation WHERE ID = %d" % int(did))
+    statdays = stats.get_days(dbo, "ownerdonation", "ID = %d" % int(did))
     db.execute(dbo, "DELETE FROM ownerdonation WHERE ID = %d" % int(did))
+    alerts.invalidate(dbo, "ownerdonation")
+    stats.update_days(dbo, statdays)
     # Delete any existing transaction for this donation if there is one
+    periods = get_balance_periods(dbo, "OwnerDonationID = %d" % int(did))
     db.execute(dbo, "DELETE FROM accountstrx WHERE OwnerDonationID = %d" % int(did))
+    update_account_balances(dbo, periods)
     movement.update_movement_donation(dbo, movementid)
 
 def receive_donation(dbo, username, did):
@@ -674,7 +832,10 @@ def receive_donation(dbo, username, did):
     Marks a donation received
     """
     if id is None or did == "": return
+    statdays = stats.get_days(dbo, "ownerdonation", "ID = %d" % int(did))
     db.execute(dbo, "UPDATE ownerdonation SET Date = %s WHERE ID = %d" % ( db.dd(i18n.now(dbo.timezone)), int(did)))
+    alerts.invalidate(dbo, "ownerdonation")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "ownerdonation", "ID = %d" % int(did)))
     audit.edit(dbo, username, "ownerdonation", did, str(did) + ": received")
     update_matching_donation_transaction(dbo, username, int(did))
     check_create_next_donation(dbo, username, did)
@@ -731,6 +892,7 @@ def check_create_next_donation(dbo, username, odid):
             ( "Comments", db.ds(d["COMMENTS"]))
         ))
         db.execute(dbo, sql)
+        alerts.invalidate(dbo, "ownerdonation")
 
 def update_matching_cost_transaction(dbo, username, acid, destinationaccount = 0):
     """
@@ -758,6 +920,7 @@ def update_matching_cost_transaction(dbo, username, acid, destinationaccount = 0
     if trxid != 0:
         al.debug("Already have an existing transaction, updating amount to %d" % c["COSTAMOUNT"], "financial.update_matching_cost_transaction", dbo)
         db.execute(dbo, "UPDATE accountstrx SET Amount = %d WHERE ID = %d" % (c["COSTAMOUNT"], trxid))
+        update_account_balances(dbo, get_balance_periods(dbo, "ID = %d" % trxid))
         return
     # Get the target account for this type of cost, use the first expense account on file for that type
     target = db.query_int(dbo, "SELECT ID FROM accounts WHERE AccountType = %d AND CostTypeID = %d ORDER BY ID" % (EXPENSE, int(c["COSTTYPEID"])))
@@ -806,6 +969,7 @@ def update_matching_cost_transaction(dbo, username, acid, destinationaccount = 0
         ( "AnimalCostID", db.di(int(acid)))
         ))
     db.execute(dbo, sql)
+    update_account_balances(dbo, get_balance_periods(dbo, "ID = %d" % tid))
     al.debug("Trx created with ID %d" % int(tid), "financial.update_matching_cost_transaction", dbo)
 
 def update_matching_donation_transaction(dbo, username, odid, destinationaccount = 0):
@@ -834,6 +998,7 @@ def update_matching_donation_transaction(dbo, username, odid, destinationaccount
     if trxid != 0:
         al.debug("Already have an existing transaction, updating amount to %d" % d["DONATION"], "financial.update_matching_donation_transaction", dbo)
         db.execute(dbo, "UPDATE accountstrx SET Amount = %d WHERE ID = %d" % (d["DONATION"], trxid))
+        update_account_balances(dbo, get_balance_periods(dbo, "ID = %d" % trxid))
         return
     # Get the source account for this type of donation, use the first income account on file for that type
     source = db.query_int(dbo, "SELECT ID FROM accounts WHERE AccountType = %d AND DonationTypeID = %d ORDER BY ID" % (INCOME, int(d["DONATIONTYPEID"])))
@@ -881,6 +1046,7 @@ def update_matching_donation_transaction(dbo, username, odid, destinationaccount
         ( "OwnerDonationID", db.di(int(odid)))
         ))
     db.execute(dbo, sql)
+    update_account_balances(dbo, get_balance_periods(dbo, "ID = %d" % tid))
     al.debug("Trx created with ID %d" % int(tid), "financial.update_matching_cost_transaction", dbo)
 
 def insert_account_from_costtype(dbo, ctid, name, desc):
@@ -992,7 +1158,9 @@ def delete_account(dbo, username, aid):
     Deletes an account
     """
     audit.delete(dbo, username, "accounts", aid, audit.dump_row(dbo, "accounts", aid))
+    periods = get_balance_periods(dbo, "SourceAccountID = %d OR DestinationAccountID = %d" % ( int(aid), int(aid) ))
     db.execute(dbo, "DELETE FROM accountstrx WHERE SourceAccountID = %d OR DestinationAccountID = %d" % ( int(aid), int(aid) ))
+    update_account_balances(dbo, periods)
     db.execute(dbo, "DELETE FROM accountsrole WHERE AccountID = %d" % int(aid))
     db.execute(dbo, "DELETE FROM accounts WHERE ID = %d" % int(aid))
 
@@ -1030,6 +1198,7 @@ def insert_trx_from_form(dbo, username, post):
         ( "OwnerDonationID", db.di(0))
         ))
     db.execute(dbo, sql)
+    update_account_balances(dbo, get_balance_periods(dbo, "ID = %d" % tid))
     audit.create(dbo, username, "accountstrx", tid, audit.dump_row(dbo, "accountstrx", tid))
     return tid
 
@@ -1065,7 +1234,9 @@ def update_trx_from_form(dbo, username, post):
         ( "DestinationAccountID", db.di(target))
         ))
     preaudit = db.query(dbo, "SELECT * FROM accountstrx WHERE ID = %d" % trxid)
+    periods = get_balance_periods(dbo, "ID = %d" % trxid)
     db.execute(dbo, sql)
+    update_account_balances(dbo, periods | get_balance_periods(dbo, "ID = %d" % trxid))
     postaudit = db.query(dbo, "SELECT * FROM accountstrx WHERE ID = %d" % trxid)
     audit.edit(dbo, username, "accountstrx", trxid, audit.map_diff(preaudit, postaudit))
 
@@ -1074,7 +1245,9 @@ def delete_trx(dbo, username, tid):
     Deletes a transaction
     """
     audit.delete(dbo, username, "accountstrx", tid, audit.dump_row(dbo, "accountstrx", tid))
+    periods = get_balance_periods(dbo, "ID = %d" % int(tid))
     db.execute(dbo, "DELETE FROM accountstrx WHERE ID = %d" % int(tid))
+    update_account_balances(dbo, periods)
 
 def insert_voucher_from_form(dbo, username, post):
     """
@@ -1135,6 +1308,7 @@ def insert_citation_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "ownercitation")
     audit.create(dbo, username, "ownercitation", citationid, audit.dump_row(dbo, "ownercitation", citationid))
     return citationid
 
@@ -1153,6 +1327,7 @@ def update_citation_from_form(dbo, username, post):
     ))
     preaudit = db.query(dbo, "SELECT * FROM ownercitation WHERE ID = %d" % citationid)
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "ownercitation")
     postaudit = db.query(dbo, "SELECT * FROM ownercitation WHERE ID = %d" % citationid)
     audit.edit(dbo, username, "ownercitation", citationid, audit.map_diff(preaudit, postaudit))
 
@@ -1162,6 +1337,7 @@ def delete_citation(dbo, username, cid):
     """
     audit.delete(dbo, username, "ownercitation", cid, audit.dump_row(dbo, "ownercitation", cid))
     db.execute(dbo, "DELETE FROM ownercitation WHERE ID = %d" % int(cid))
+    alerts.invalidate(dbo, "ownercitation")
 
 def insert_licence_from_form(dbo, username, post):
     """
@@ -1183,6 +1359,7 @@ def insert_licence_from_form(dbo, username, post):
         ))
     db.execute(dbo, sql)
     audit.create(dbo, username, "ownerlicence", licenceid, audit.dump_row(dbo, "ownerlicence", licenceid))
+    searchindex.update(dbo, searchindex.LICENCE, licenceid)
     return licenceid
 
 def update_licence_from_form(dbo, username, post):
@@ -1206,6 +1383,7 @@ def update_licence_from_form(dbo, username, post):
     db.execute(dbo, sql)
     postaudit = db.query(dbo, "SELECT * FROM ownercitation WHERE ID = %d" % licenceid)
     audit.edit(dbo, username, "ownerlicence", licenceid, audit.map_diff(preaudit, postaudit))
+    searchindex.update(dbo, searchindex.LICENCE, licenceid)
 
 def delete_licence(dbo, username, lid):
     """
@@ -1213,6 +1391,7 @@ def delete_licence(dbo, username, lid):
     """
     audit.delete(dbo, username, "ownerlicence", lid, audit.dump_row(dbo, "ownerlicence", lid))
     db.execute(dbo, "DELETE FROM ownerlicence WHERE ID = %d" % int(lid))
+    searchindex.delete(dbo, searchindex.LICENCE, lid)
 
 def giftaid_spreadsheet(dbo, path, fromdate, todate):
     """
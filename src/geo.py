@@ -6,76 +6,221 @@
 
 import al
 import cachemem
+import db
+import i18n
 import json
+import Queue
 import threading
 import time
 import utils
 from lookups import LOCALE_COUNTRY_NAME_MAP
-from sitedefs import BULK_GEO_PROVIDER, BULK_GEO_NOMINATIM_URL, BULK_GEO_GOOGLE_URL, BULK_GEO_LOOKUP_TIMEOUT, BULK_GEO_SLEEP_AFTER
+from sitedefs import BULK_GEO_PROVIDER, BULK_GEO_NOMINATIM_URL, BULK_GEO_GOOGLE_URL, BULK_GEO_LOOKUP_TIMEOUT, BULK_GEO_SLEEP_AFTER, BULK_GEO_WORKERS, BULK_GEO_NOT_FOUND_DAYS
 
+class TokenBucket:
+    """
+    Rate limiter shared by the lookup workers. Holds up to capacity
+    tokens, refilled at rate tokens per second. A rate of 0 means
+    unlimited.
+    """
+    def __init__(self, rate, capacity = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self):
+        """
+        Takes a token from the bucket, sleeping until one is available
+        """
+        if self.rate <= 0: return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+lat_long_bucket = TokenBucket(BULK_GEO_SLEEP_AFTER > 0 and 1.0 / BULK_GEO_SLEEP_AFTER or 0)
+lat_long_queue = Queue.Queue()
+lat_long_pending = {}
 lat_long_lock = threading.Lock()
+lat_long_workers = []
 
-def get_lat_long(dbo, address, town, county, postcode, country = None):
+def get_lat_long(dbo, address, town, county, postcode, country = None, wait = True):
     """
     Looks up a latitude and longitude from an address using GEOCODE_URL
     and returns them as lat,long,(first 3 chars of address)
     Returns None if no results were found.
-    NB: dbo is only used for contextual reference in logging, no database
-        calls are made by any of this code.
+    Results are cached in the geocache table, so only addresses we have 
+    never seen before hit the geo provider. Addresses the provider 
+    couldn't find are cached for BULK_GEO_NOT_FOUND_DAYS.
+    Those are queued for the rate limited lookup workers and if wait is
+    False, None is returned immediately rather than waiting for them.
+    """
+    q, url = get_query(dbo, address, town, county, postcode, country)
+    if q is None:
+        return None
+    latlon = get_cached_lat_long(dbo, q)
+    if latlon is not None:
+        return latlon or None
+    req = queue_lat_long(dbo, q, url)
+    if not wait:
+        return None
+    return wait_lat_long(req)
+
+def get_query(dbo, address, town, county, postcode, country = None):
     """
+    Returns a tuple of the normalised query for an address and the
+    provider URL to look it up with, or (None, None) if the address
+    is blank or we have no provider.
+    """
+    if address is None or address.strip() == "":
+        return (None, None)
+    if country is None: 
+        country = LOCALE_COUNTRY_NAME_MAP[dbo.locale]
+    if BULK_GEO_PROVIDER == "nominatim":
+        q = normalise_nominatim(address, town, county, postcode, country)
+        return (q, BULK_GEO_NOMINATIM_URL.replace("{q}", q))
+    elif BULK_GEO_PROVIDER == "google":
+        q = normalise_google(address, town, county, postcode, country)
+        return (q, BULK_GEO_GOOGLE_URL.replace("{q}", q))
+    al.error("unrecognised geo provider: %s" % BULK_GEO_PROVIDER, "geo.get_query", dbo)
+    return (None, None)
+
+def _cache_key(q):
+    return "geo:" + utils.md5_hash(BULK_GEO_PROVIDER + ":" + q)
 
-    if address.strip() == "":
+def get_cached_lat_long(dbo, q):
+    """
+    Returns the cached geocode for normalised query q, an empty string
+    if we already know the provider can't find it or None if we have 
+    never looked it up (or it wasn't found more than BULK_GEO_NOT_FOUND_DAYS 
+    ago). Checks the memory cache before the geocache table.
+    """
+    key = _cache_key(q)
+    v = cachemem.get(key)
+    if v is not None:
+        al.debug("cache hit for address: %s = %s" % (q, v), "geo.get_cached_lat_long", dbo)
+        return v
+    try:
+        cutoff = i18n.subtract_days(i18n.now(dbo.timezone), BULK_GEO_NOT_FOUND_DAYS)
+        rows = db.query_tuple(dbo, "SELECT LatLong FROM geocache WHERE QueryHash = '%s' " \
+            "AND ((LatLong Is Not Null AND LatLong <> '') OR CreatedDate >= %s)" % (key[4:], db.ddt(cutoff)))
+    except Exception,err:
+        al.error(str(err), "geo.get_cached_lat_long", dbo)
+        return None
+    if len(rows) == 0:
         return None
+    v = rows[0][0] or ""
+    cachemem.put(key, v, 86400)
+    return v
 
+def put_cached_lat_long(dbo, q, latlon):
+    """
+    Stores the geocode for normalised query q in the memory cache and
+    geocache table. A latlon of None records that the provider
+    couldn't find the address.
+    """
+    key = _cache_key(q)
+    v = latlon or ""
+    cachemem.put(key, v, 86400)
     try:
-        # Synchronise this process to a single thread to prevent
-        # abusing our geo provider and concurrent requests for the
-        # same address when opening an animal with the same
-        # original/brought in by owner, etc.
-        lat_long_lock.acquire()
-
-        url = ""
-        if country is None: 
-            country = LOCALE_COUNTRY_NAME_MAP[dbo.locale]
-        if BULK_GEO_PROVIDER == "nominatim":
-            q = normalise_nominatim(address, town, county, postcode, country)
-            url = BULK_GEO_NOMINATIM_URL.replace("{q}", q)
-        elif BULK_GEO_PROVIDER == "google":
-            q = normalise_google(address, town, county, postcode, country)
-            url = BULK_GEO_GOOGLE_URL.replace("{q}", q)
-        else:
-            al.error("unrecognised geo provider: %s" % BULK_GEO_PROVIDER, "geo.get_lat_long", dbo)
-
-        al.debug("looking up geocode for address: %s" % q, "geo.get_lat_long", dbo)
-        
-        key = "nom:" + q
-        v = cachemem.get(key)
-        if v is not None:
-            al.debug("cache hit for address: %s = %s" % (q, v), "geo.get_lat_long", dbo)
-            return v
+        db.execute(dbo, "DELETE FROM geocache WHERE QueryHash = '%s'" % key[4:])
+        db.execute(dbo, db.make_insert_sql("geocache", (
+            ( "QueryHash", db.ds(key[4:]) ),
+            ( "Query", db.ds(q) ),
+            ( "LatLong", db.ds(v) ),
+            ( "CreatedDate", db.ddt(i18n.now(dbo.timezone)) )
+            )))
+    except Exception,err:
+        al.error(str(err), "geo.put_cached_lat_long", dbo)
 
+def queue_lat_long(dbo, q, url):
+    """
+    Queues a lookup of normalised query q for the worker pool and 
+    returns the request. Concurrent requests for the same query share
+    a single lookup.
+    """
+    key = _cache_key(q)
+    with lat_long_lock:
+        req = lat_long_pending.get(key)
+        if req is None:
+            req = { "dbo": dbo, "key": key, "q": q, "url": url, "latlon": None, "done": threading.Event() }
+            lat_long_pending[key] = req
+            lat_long_queue.put(req)
+        _start_workers()
+    return req
+
+def wait_lat_long(req, timeout = None):
+    """
+    Waits for a queued request to be completed by the worker pool
+    and returns its geocode or None if it couldn't be found.
+    """
+    if timeout is None: timeout = BULK_GEO_LOOKUP_TIMEOUT + lat_long_queue.qsize() * max(BULK_GEO_SLEEP_AFTER, 1) + 60
+    req["done"].wait(timeout)
+    return req["latlon"]
+
+def _start_workers():
+    """
+    Starts the lookup worker threads if they aren't running. 
+    Must be called with lat_long_lock held.
+    """
+    lat_long_workers[:] = [ t for t in lat_long_workers if t.is_alive() ]
+    while len(lat_long_workers) < max(BULK_GEO_WORKERS, 1):
+        t = threading.Thread(target=_worker)
+        t.daemon = True
+        t.start()
+        lat_long_workers.append(t)
+
+def _worker():
+    """
+    Takes requests off the queue and looks them up with the geo provider,
+    sharing a token bucket so that we don't abuse it.
+    """
+    while True:
+        req = lat_long_queue.get()
+        try:
+            lat_long_bucket.consume()
+            req["latlon"] = _lookup(req["dbo"], req["q"], req["url"])
+        except:
+            pass
+        finally:
+            with lat_long_lock:
+                lat_long_pending.pop(req["key"], None)
+            req["done"].set()
+            lat_long_queue.task_done()
+
+def _lookup(dbo, q, url):
+    """
+    Contacts the geo provider for normalised query q. Successful
+    responses and addresses the provider says it can't find are cached. 
+    Transport errors, rate limiting and other provider errors are not 
+    so that they will be retried next time.
+    """
+    try:
+        al.debug("looking up geocode for address: %s" % q, "geo._lookup", dbo)
         jr = utils.get_url(url, timeout = BULK_GEO_LOOKUP_TIMEOUT)["response"]
         j = json.loads(jr)
-
         latlon = None
+        notfound = False
         if BULK_GEO_PROVIDER == "nominatim":
             latlon = parse_nominatim(dbo, jr, j, q)
+            notfound = isinstance(j, list) and len(j) == 0
         elif BULK_GEO_PROVIDER == "google":
             latlon = parse_google(dbo, jr, j, q)
-
-        if BULK_GEO_SLEEP_AFTER > 0:
-            time.sleep(BULK_GEO_SLEEP_AFTER)
-
-        cachemem.put(key, latlon, 86400)
+            notfound = isinstance(j, dict) and j.get("status") == "ZERO_RESULTS"
+        if latlon is not None or notfound:
+            put_cached_lat_long(dbo, q, latlon)
         return latlon
-
     except Exception,err:
-        al.error(str(err), "geo.get_lat_long", dbo)
+        al.error(str(err), "geo._lookup", dbo)
         return None
 
-    finally:
-        lat_long_lock.release()
-
 def parse_nominatim(dbo, jr, j, q):
     if len(j) == 0:
         al.debug("no response from nominatim for %s (response %s)" % (q, str(jr)), "geo.parse_nominatim", dbo)
@@ -1,11 +1,16 @@
 #!/usr/bin/python
 
+import cachemem
 import configuration
 import db
 import financial
 import re
+import searchindex
+import threading
+import time
 import utils
 from i18n import _, add_days, now
+from sitedefs import CACHE_LOOKUPS, CACHE_VERSION_CHECK
 
 # Look up tables map
 # tablename : ( tablelabel, namefield, namelabel, descfield, hasspecies, haspfspecies, haspfbreed, hasapcolour, hasdefaultcost, hasunits, hassite, canadd, candelete, canretire,(foreignkeys) )
@@ -906,6 +911,109 @@ ADOPTAPET_COLOURS = (
     "Albino or Red-Eyed White"
 )
 
+# In-process cache of lookup data for each database, keyed by database.
+# Each entry is a dict containing the version token it was loaded under,
+# the time it was loaded, the time the token was last checked, the rows 
+# returned by each lookup query and ID to name maps for each lookup 
+# table/name field.
+lookup_snapshots = {}
+lookup_lock = threading.Lock()
+
+def _snapshot_key(dbo):
+    return "%s:%s:%s:%s" % (dbo.host, dbo.port, dbo.database, dbo.alias)
+
+def _version_key(dbo):
+    return "lookups:ver:%s" % _snapshot_key(dbo)
+
+def _version(dbo):
+    """
+    Returns the current lookup version token for dbo. The token is
+    held in cachemem so that it is shared between processes when 
+    memcached is in use. If there isn't one, a new token is issued.
+    """
+    v = cachemem.get(_version_key(dbo))
+    if v is None:
+        v = "%0.6f" % time.time()
+        cachemem.put(_version_key(dbo), v, 86400)
+    return v
+
+def _current(dbo, snap):
+    """
+    Returns True if snap can still be used. The version token is only
+    read from the cache once every CACHE_VERSION_CHECK seconds.
+    """
+    if snap is None or time.time() - snap["loaded"] >= CACHE_LOOKUPS: return False
+    if time.time() - snap["checked"] < CACHE_VERSION_CHECK: return True
+    if snap["version"] != _version(dbo): return False
+    snap["checked"] = time.time()
+    return True
+
+def _snapshot(dbo):
+    """
+    Returns the lookup cache for dbo, starting a new empty one if we 
+    don't have one or the one we have has been invalidated or is older 
+    than CACHE_LOOKUPS seconds.
+    """
+    key = _snapshot_key(dbo)
+    snap = lookup_snapshots.get(key)
+    if _current(dbo, snap): return snap
+    lookup_lock.acquire()
+    try:
+        snap = lookup_snapshots.get(key)
+        if not _current(dbo, snap):
+            snap = { "version": _version(dbo), "loaded": time.time(), "checked": time.time(), "queries": {}, "names": {} }
+            lookup_snapshots[key] = snap
+        return snap
+    finally:
+        lookup_lock.release()
+
+def invalidate(dbo):
+    """
+    Discards the lookup cache for dbo in this process and issues a new
+    version token so that any other process sharing the cache reloads
+    its lookups on next read. Should be called after any change to
+    a lookup table.
+    """
+    lookup_lock.acquire()
+    try:
+        lookup_snapshots.pop(_snapshot_key(dbo), None)
+        cachemem.put(_version_key(dbo), "%0.6f" % time.time(), 86400)
+    finally:
+        lookup_lock.release()
+
+def _query(dbo, sql):
+    """
+    Returns the rows for a lookup query, reading them from the database 
+    the first time and the cache after that. Callers get their own copies 
+    of the rows so that they are free to modify them.
+    """
+    if CACHE_LOOKUPS <= 0: return db.query(dbo, sql)
+    queries = _snapshot(dbo)["queries"]
+    rows = queries.get(sql)
+    if rows is None:
+        rows = db.query(dbo, sql)
+        queries[sql] = rows
+    return [ dict(r) for r in rows ]
+
+def _name(dbo, table, namefield, iid):
+    """
+    Returns the value of namefield for the row of a lookup table with
+    ID iid, or an empty string if there isn't one. The whole table is 
+    read the first time a name is asked for and held as an ID indexed
+    map after that.
+    """
+    if iid is None: return ""
+    if CACHE_LOOKUPS <= 0: 
+        return db.query_string(dbo, "SELECT %s FROM %s WHERE ID = %d" % (namefield, table, int(iid)))
+    names = _snapshot(dbo)["names"]
+    m = names.get((table, namefield))
+    if m is None:
+        m = {}
+        for r in db.query(dbo, "SELECT ID, %s AS Name FROM %s" % (namefield, table)):
+            m[r["ID"]] = r["NAME"] or ""
+        names[(table, namefield)] = m
+    return m.get(int(iid), "")
+
 def add_message(dbo, createdby, email, message, forname = "*", priority = 0, expires = None, added = None):
     if added is None: added = now(dbo.timezone)
     if expires is None: expires = add_days(added, 7)
@@ -928,91 +1036,84 @@ def delete_message(dbo, mid):
     db.execute(dbo, "DELETE FROM messages WHERE ID = %d" % int(mid))
 
 def get_account_types(dbo):
-    return db.query(dbo, "SELECT * FROM lksaccounttype ORDER BY AccountType")
+    return _query(dbo, "SELECT * FROM lksaccounttype ORDER BY AccountType")
 
 def get_additionalfield_links(dbo):
-    return db.query(dbo, "SELECT * FROM lksfieldlink ORDER BY LinkType")
+    return _query(dbo, "SELECT * FROM lksfieldlink ORDER BY LinkType")
 
 def get_additionalfield_types(dbo):
-    return db.query(dbo, "SELECT * FROM lksfieldtype ORDER BY FieldType")
+    return _query(dbo, "SELECT * FROM lksfieldtype ORDER BY FieldType")
 
 def get_animal_flags(dbo):
-    return db.query(dbo, "SELECT * FROM lkanimalflags ORDER BY Flag")
+    return _query(dbo, "SELECT * FROM lkanimalflags ORDER BY Flag")
 
 def get_animal_types(dbo):
-    return db.query(dbo, "SELECT * FROM animaltype ORDER BY AnimalType")
+    return _query(dbo, "SELECT * FROM animaltype ORDER BY AnimalType")
 
 def get_animaltype_name(dbo, aid):
-    if id is None: return ""
-    return db.query_string(dbo, "SELECT AnimalType FROM animaltype WHERE ID = %d" % aid)
+    return _name(dbo, "animaltype", "AnimalType", aid)
 
 def get_basecolours(dbo):
-    return db.query(dbo, "SELECT * FROM basecolour ORDER BY BaseColour")
+    return _query(dbo, "SELECT * FROM basecolour ORDER BY BaseColour")
 
 def get_basecolour_name(dbo, cid):
-    if id is None: return ""
-    return db.query_string(dbo, "SELECT BaseColour FROM basecolour WHERE ID = %d" % cid)
+    return _name(dbo, "basecolour", "BaseColour", cid)
 
 def get_breeds(dbo):
-    return db.query(dbo, "SELECT * FROM breed ORDER BY BreedName")
+    return _query(dbo, "SELECT * FROM breed ORDER BY BreedName")
 
 def get_breeds_by_species(dbo):
-    return db.query(dbo, "SELECT breed.*, species.SpeciesName FROM breed " \
+    return _query(dbo, "SELECT breed.*, species.SpeciesName FROM breed " \
         "LEFT OUTER JOIN species ON breed.SpeciesID = species.ID " \
         "ORDER BY species.SpeciesName, breed.BreedName");
 
 def get_breed_name(dbo, bid):
-    if id is None: return ""
-    return db.query_string(dbo, "SELECT BreedName FROM breed WHERE ID = %d" % bid)
+    return _name(dbo, "breed", "BreedName", bid)
 
 def get_citation_types(dbo):
-    return db.query(dbo, "SELECT * FROM citationtype ORDER BY CitationName")
+    return _query(dbo, "SELECT * FROM citationtype ORDER BY CitationName")
 
 def get_coattypes(dbo):
-    return db.query(dbo, "SELECT * FROM lkcoattype ORDER BY CoatType")
+    return _query(dbo, "SELECT * FROM lkcoattype ORDER BY CoatType")
 
 def get_costtypes(dbo):
-    return db.query(dbo, "SELECT * FROM costtype ORDER BY CostTypeName")
+    return _query(dbo, "SELECT * FROM costtype ORDER BY CostTypeName")
 
 def get_coattype_name(dbo, cid):
-    if id is None: return ""
-    return db.query_string(dbo, "SELECT CoatTypeName FROM lkcoattype WHERE ID = %d" % cid)
+    return _name(dbo, "lkcoattype", "CoatType", cid)
 
 def get_deathreasons(dbo):
-    return db.query(dbo, "SELECT * FROM deathreason ORDER BY ReasonName")
+    return _query(dbo, "SELECT * FROM deathreason ORDER BY ReasonName")
 
 def get_deathreason_name(dbo, rid):
-    if id is None: return ""
-    return db.query_string(dbo, "SELECT ReasonName FROM deathreason WHERE ID = %d" % rid)
+    return _name(dbo, "deathreason", "ReasonName", rid)
 
 def get_diets(dbo):
-    return db.query(dbo, "SELECT * FROM diet ORDER BY DietName")
+    return _query(dbo, "SELECT * FROM diet ORDER BY DietName")
 
 def get_donation_default(dbo, donationtypeid):
     return db.query_int(dbo, "SELECT DefaultCost FROM donationtype WHERE ID = %d" % int(donationtypeid))
 
 def get_donation_frequencies(dbo):
-    return db.query(dbo, "SELECT * FROM lksdonationfreq ORDER BY ID")
+    return _query(dbo, "SELECT * FROM lksdonationfreq ORDER BY ID")
 
 def get_donation_types(dbo):
-    return db.query(dbo, "SELECT * FROM donationtype ORDER BY DonationName")
+    return _query(dbo, "SELECT * FROM donationtype ORDER BY DonationName")
 
 def get_donationtype_name(dbo, did):
-    if did is None: return ""
-    return db.query_string(dbo, "SELECT DonationName FROM donationtype WHERE ID = %d" % did)
+    return _name(dbo, "donationtype", "DonationName", did)
 
 def get_entryreasons(dbo):
-    return db.query(dbo, "SELECT * FROM entryreason ORDER BY ReasonName")
+    return _query(dbo, "SELECT * FROM entryreason ORDER BY ReasonName")
 
 def get_entryreason_name(dbo, rid):
-    if rid is None: return ""
-    return db.query_string(dbo, "SELECT ReasonName FROM entryreason WHERE ID = %d" % rid)
+    return _name(dbo, "entryreason", "ReasonName", rid)
 
 def get_incident_completed_types(dbo):
-    return db.query(dbo, "SELECT * FROM incidentcompleted ORDER BY CompletedName")
+    return _query(dbo, "SELECT * FROM incidentcompleted ORDER BY CompletedName")
 
 def get_incident_types(dbo):
-    return db.query(dbo, "SELECT * FROM incidenttype ORDER BY IncidentName")
+    return _query(dbo, "SELECT * FROM incidenttype ORDER BY IncidentName")
 
 def get_internal_locations(dbo, locationfilter = "", siteid = 0):
     clauses = []
@@ -1020,14 +1121,13 @@ def get_internal_locations(dbo, locationfilter = "", siteid = 0):
     if siteid != 0: clauses.append("SiteID = %s" % siteid)
     c = " AND ".join(clauses)
     if c != "": c = "WHERE %s" % c
-    return db.query(dbo, "SELECT * FROM internallocation %s ORDER BY LocationName" % c)
+    return _query(dbo, "SELECT * FROM internallocation %s ORDER BY LocationName" % c)
 
 def get_internallocation_name(dbo, lid):
-    if lid is None: return ""
-    return db.query_string(dbo, "SELECT LocationName FROM internallocation WHERE ID = %d" % lid)
+    return _name(dbo, "internallocation", "LocationName", lid)
 
 def get_licence_types(dbo):
-    return db.query(dbo, "SELECT * FROM licencetype ORDER BY LicenceTypeName")
+    return _query(dbo, "SELECT * FROM licencetype ORDER BY LicenceTypeName")
 
 def get_messages(dbo, user, roles, superuser):
     """
@@ -1054,16 +1154,15 @@ def get_messages(dbo, user, roles, superuser):
     return rv
 
 def get_log_types(dbo):
-    return db.query(dbo, "SELECT * FROM logtype ORDER BY LogTypeName")
+    return _query(dbo, "SELECT * FROM logtype ORDER BY LogTypeName")
 
 def get_logtype_name(dbo, tid):
-    if tid is None: return ""
-    return db.query_string(dbo, "SELECT LogTypeName FROM logtype WHERE ID = %d" % tid)
+    return _name(dbo, "logtype", "LogTypeName", tid)
 
 def get_lookup(dbo, tablename, namefield):
     if tablename == "breed":
-        return db.query(dbo, "SELECT b.*, s.SpeciesName FROM breed b LEFT OUTER JOIN species s ON s.ID = b.SpeciesID ORDER BY b.BreedName")
-    return db.query(dbo, "SELECT * FROM %s ORDER BY %s" % ( tablename, namefield ))
+        return _query(dbo, "SELECT b.*, s.SpeciesName FROM breed b LEFT OUTER JOIN species s ON s.ID = b.SpeciesID ORDER BY b.BreedName")
+    return _query(dbo, "SELECT * FROM %s ORDER BY %s" % ( tablename, namefield ))
 
 def insert_lookup(dbo, lookup, name, desc="", speciesid=0, pfbreed="", pfspecies="", apcolour="", units="", site=1, defaultcost=0, retired=0):
     t = LOOKUP_TABLES[lookup]
@@ -1121,6 +1220,7 @@ def insert_lookup(dbo, lookup, name, desc="", speciesid=0, pfbreed="", pfspecies
             sql = "INSERT INTO %s (ID, %s, %s) VALUES (%s, %s, %s)" % (
                 lookup, t[LOOKUP_NAMEFIELD], t[LOOKUP_DESCFIELD], db.di(nid), db.ds(name), db.ds(desc))
     db.execute(dbo, sql)
+    invalidate(dbo)
     return nid
 
 def update_lookup(dbo, iid, lookup, name, desc="", speciesid=0, pfbreed="", pfspecies="", apcolour="", units="", site=1, defaultcost=0, retired=0):
@@ -1163,11 +1263,17 @@ def update_lookup(dbo, iid, lookup, name, desc="", speciesid=0, pfbreed="", pfsp
         else:
             sql = "UPDATE %s SET %s=%s, %s=%s WHERE ID=%s" % (
                 lookup, t[LOOKUP_NAMEFIELD], db.ds(name), t[LOOKUP_DESCFIELD], db.ds(desc), db.di(iid))
+    oldname = db.query_string(dbo, "SELECT %s FROM %s WHERE ID = %d" % (t[LOOKUP_NAMEFIELD], lookup, int(iid)))
     db.execute(dbo, sql)
+    invalidate(dbo)
+    # Records showing a renamed lookup need their search index updating
+    if oldname != db.query_string(dbo, "SELECT %s FROM %s WHERE ID = %d" % (t[LOOKUP_NAMEFIELD], lookup, int(iid))):
+        searchindex.update_links(dbo, searchindex.get_lookup_links(dbo, lookup, iid))
 
 def update_lookup_retired(dbo, lookup, iid, retired):
     """ Updates lookup item with ID=iid, setting IsRetired=retired """
     db.execute(dbo, "UPDATE %s SET IsRetired=%d WHERE ID=%d" % (lookup, retired, iid))
+    invalidate(dbo)
 
 def delete_lookup(dbo, lookup, iid):
     l = dbo.locale
@@ -1177,6 +1283,7 @@ def delete_lookup(dbo, lookup, iid):
         if 0 < db.query_int(dbo, "SELECT COUNT(*) FROM %s WHERE %s = %s" % (table, field, str(iid))):
             raise utils.ASMValidationError(_("This item is referred to in the database ({0}) and cannot be deleted until it is no longer in use.", l).format(fv))
     db.execute(dbo, "DELETE FROM %s WHERE ID = %s" % (lookup, str(iid)))
+    invalidate(dbo)
 
 def get_microchip_manufacturer(l, chipno):
     """
@@ -1198,97 +1305,90 @@ def get_microchip_manufacturer(l, chipno):
     return mf
 
 def get_movementtype_name(dbo, mid):
-    if mid is None: return ""
-    return db.query_string(dbo, "SELECT MovementType FROM lksmovementtype WHERE ID = %d" % int(mid))
+    return _name(dbo, "lksmovementtype", "MovementType", mid)
 
 def get_movement_types(dbo):
-    return db.query(dbo, "SELECT * FROM lksmovementtype ORDER BY ID")
+    return _query(dbo, "SELECT * FROM lksmovementtype ORDER BY ID")
 
 def get_payment_types(dbo):
-    return db.query(dbo, "SELECT * FROM donationpayment ORDER BY PaymentName")
+    return _query(dbo, "SELECT * FROM donationpayment ORDER BY PaymentName")
 
 def get_person_flags(dbo):
-    return db.query(dbo, "SELECT * FROM lkownerflags ORDER BY Flag")
+    return _query(dbo, "SELECT * FROM lkownerflags ORDER BY Flag")
 
 def get_pickup_locations(dbo):
-    return db.query(dbo, "SELECT * FROM pickuplocation ORDER BY LocationName")
+    return _query(dbo, "SELECT * FROM pickuplocation ORDER BY LocationName")
 
 def get_posneg(dbo):
-    return db.query(dbo, "SELECT * FROM lksposneg ORDER BY Name")
+    return _query(dbo, "SELECT * FROM lksposneg ORDER BY Name")
 
 def get_reservation_statuses(dbo):
-    return db.query(dbo, "SELECT * FROM reservationstatus ORDER BY StatusName")
+    return _query(dbo, "SELECT * FROM reservationstatus ORDER BY StatusName")
 
 def get_rota_types(dbo):
-    return db.query(dbo, "SELECT * FROM lksrotatype ORDER BY ID")
+    return _query(dbo, "SELECT * FROM lksrotatype ORDER BY ID")
 
 def get_sex_name(dbo, sid):
-    if id is None: return ""
-    return db.query_string(dbo, "SELECT Sex FROM lksex WHERE ID = %d" % sid)
+    return _name(dbo, "lksex", "Sex", sid)
 
 def get_sexes(dbo):
-    return db.query(dbo, "SELECT * FROM lksex ORDER BY Sex")
+    return _query(dbo, "SELECT * FROM lksex ORDER BY Sex")
 
 def get_sites(dbo):
-    return db.query(dbo, "SELECT * FROM site ORDER BY SiteName")
+    return _query(dbo, "SELECT * FROM site ORDER BY SiteName")
 
 def get_site_name(dbo, sid):
-    if sid is None: return ""
-    return db.query_string(dbo, "SELECT SiteName FROM site WHERE ID = %d" % sid)
+    return _name(dbo, "site", "SiteName", sid)
 
 def get_size_name(dbo, sid):
-    if sid is None: return ""
-    return db.query_string(dbo, "SELECT Size FROM lksize WHERE ID = %d" % sid)
+    return _name(dbo, "lksize", "Size", sid)
 
 def get_species(dbo):
-    return db.query(dbo, "SELECT * FROM species ORDER BY SpeciesName")
+    return _query(dbo, "SELECT * FROM species ORDER BY SpeciesName")
 
 def get_species_name(dbo, sid):
-    if id is None: return ""
-    return db.query_string(dbo, "SELECT SpeciesName FROM species WHERE ID = %d" % sid)
+    return _name(dbo, "species", "SpeciesName", sid)
 
 def get_sizes(dbo):
-    return db.query(dbo, "SELECT * FROM lksize ORDER BY Size")
+    return _query(dbo, "SELECT * FROM lksize ORDER BY Size")
 
 def get_stock_locations(dbo):
-    return db.query(dbo, "SELECT * FROM stocklocation ORDER BY LocationName")
+    return _query(dbo, "SELECT * FROM stocklocation ORDER BY LocationName")
 
 def get_stock_location_name(dbo, slid):
-    if slid is None: return ""
-    return db.query_string(dbo, "SELECT LocationName FROM stocklocation WHERE ID = %d" % slid)
+    return _name(dbo, "stocklocation", "LocationName", slid)
 
 def get_stock_usage_types(dbo):
-    return db.query(dbo, "SELECT * FROM stockusagetype ORDER BY UsageTypeName")
+    return _query(dbo, "SELECT * FROM stockusagetype ORDER BY UsageTypeName")
 
 def get_trap_types(dbo):
-    return db.query(dbo, "SELECT * FROM traptype ORDER BY TrapTypeName")
+    return _query(dbo, "SELECT * FROM traptype ORDER BY TrapTypeName")
 
 def get_urgencies(dbo):
-    return db.query(dbo, "SELECT * FROM lkurgency ORDER BY ID")
+    return _query(dbo, "SELECT * FROM lkurgency ORDER BY ID")
 
 def get_urgency_name(dbo, uid):
-    if id is None: return ""
-    return db.query_string(dbo, "SELECT Urgency FROM lkurgency WHERE ID = %d" % uid)
+    return _name(dbo, "lkurgency", "Urgency", uid)
 
 def get_test_types(dbo):
-    return db.query(dbo, "SELECT * FROM testtype ORDER BY TestName")
+    return _query(dbo, "SELECT * FROM testtype ORDER BY TestName")
 
 def get_test_results(dbo):
-    return db.query(dbo, "SELECT * FROM testresult ORDER BY ResultName")
+    return _query(dbo, "SELECT * FROM testresult ORDER BY ResultName")
 
 def get_vaccination_types(dbo):
-    return db.query(dbo, "SELECT * FROM vaccinationtype ORDER BY VaccinationType")
+    return _query(dbo, "SELECT * FROM vaccinationtype ORDER BY VaccinationType")
 
 def get_voucher_types(dbo):
-    return db.query(dbo, "SELECT * FROM voucher ORDER BY VoucherName")
+    return _query(dbo, "SELECT * FROM voucher ORDER BY VoucherName")
 
 def get_work_types(dbo):
-    return db.query(dbo, "SELECT * FROM lkworktype ORDER BY ID")
+    return _query(dbo, "SELECT * FROM lkworktype ORDER BY ID")
 
 def get_yesno(dbo):
-    return db.query(dbo, "SELECT * FROM lksyesno ORDER BY Name")
+    return _query(dbo, "SELECT * FROM lksyesno ORDER BY Name")
 
 def get_ynun(dbo):
-    return db.query(dbo, "SELECT * FROM lksynun ORDER BY Name")
+    return _query(dbo, "SELECT * FROM lksynun ORDER BY Name")
 
 
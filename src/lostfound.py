@@ -5,12 +5,15 @@ import al
 import animal
 import audit
 import configuration
+import datetime
 import db
 import dbfs
 import diary
 import log
 import media
 import reports
+import searchindex
+import timeline
 import utils
 import waitinglist
 from i18n import _, date_diff_days, now, subtract_days, subtract_years, python2display, display2python
@@ -53,36 +56,22 @@ class LostFoundMatch:
     matchpoints = 0
     def __init__(self, dbo):
         self.dbo = dbo
-    def toDB(self):
-        """ Writes a lostfoundmatch record from this object """
-        sql = db.make_insert_sql("animallostfoundmatch", (
-            ( "AnimalLostID", db.di(self.lid) ),
-            ( "AnimalFoundID", db.di(self.fid) ),
-            ( "AnimalID", db.di(self.fanimalid) ),
-            ( "LostContactName", db.ds(self.lcontactname) ),
-            ( "LostContactNumber", db.ds(self.lcontactnumber) ),
-            ( "LostArea", db.ds(self.larealost) ),
-            ( "LostPostcode", db.ds(self.lareapostcode) ),
-            ( "LostAgeGroup", db.ds(self.lagegroup) ),
-            ( "LostSex", db.di(self.lsexid) ),
-            ( "LostSpeciesID", db.di(self.lspeciesid) ),
-            ( "LostBreedID", db.di(self.lbreedid) ),
-            ( "LostFeatures", db.ds(self.ldistinguishingfeatures) ),
-            ( "LostBaseColourID", db.di(self.lbasecolourid) ),
-            ( "LostDate", db.dd(self.ldatelost) ),
-            ( "FoundContactName", db.ds(self.fcontactname) ),
-            ( "FoundContactNumber", db.ds(self.fcontactnumber) ),
-            ( "FoundArea", db.ds(self.fareafound) ),
-            ( "FoundPostcode", db.ds(self.fareapostcode) ),
-            ( "FoundAgeGroup", db.ds(self.fagegroup) ),
-            ( "FoundSex", db.di(self.fsexid) ),
-            ( "FoundSpeciesID", db.di(self.fspeciesid) ),
-            ( "FoundBreedID", db.di(self.fbreedid) ),
-            ( "FoundFeatures", db.ds(self.fdistinguishingfeatures) ),
-            ( "FoundBaseColourID", db.di(self.fbasecolourid) ),
-            ( "FoundDate", db.dd(self.fdatefound) ),
-            ( "MatchPoints", db.di(self.matchpoints) ) ))
-        db.execute(self.dbo, sql)
+    def toParams(self):
+        """ Returns the values for an animallostfoundmatch record in MATCH_COLUMNS order """
+        return ( self.lid, self.fid, self.fanimalid, self.lcontactname, self.lcontactnumber,
+            self.larealost, self.lareapostcode, self.lagegroup, self.lsexid, self.lspeciesid,
+            self.lbreedid, self.ldistinguishingfeatures, self.lbasecolourid, self.ldatelost,
+            self.fcontactname, self.fcontactnumber, self.fareafound, self.fareapostcode, self.fagegroup,
+            self.fsexid, self.fspeciesid, self.fbreedid, self.fdistinguishingfeatures, self.fbasecolourid,
+            self.fdatefound, self.matchpoints )
+
+# The animallostfoundmatch columns, in the order LostFoundMatch.toParams returns them
+MATCH_COLUMNS = ( "AnimalLostID", "AnimalFoundID", "AnimalID", "LostContactName", "LostContactNumber",
+    "LostArea", "LostPostcode", "LostAgeGroup", "LostSex", "LostSpeciesID",
+    "LostBreedID", "LostFeatures", "LostBaseColourID", "LostDate",
+    "FoundContactName", "FoundContactNumber", "FoundArea", "FoundPostcode", "FoundAgeGroup",
+    "FoundSex", "FoundSpeciesID", "FoundBreedID", "FoundFeatures", "FoundBaseColourID",
+    "FoundDate", "MatchPoints" )
 
 def get_foundanimal_query(dbo):
     dummy = dbo
@@ -144,6 +133,9 @@ def get_lostanimal_find_simple(dbo, query = "", limit = 0):
     if query == "":
         ors.append("a.DateLost > %s AND a.DateFound Is Null" % db.dd(subtract_days(now(dbo.timezone), 30)))
     else:
+        # Narrow the search to candidates from the search index if we can
+        ids = searchindex.get_candidates(dbo, searchindex.LOSTANIMAL, query)
+        if ids is not None and len(ids) == 0: return []
         if utils.is_numeric(query):
             ors.append("a.ID = " + str(utils.cint(query)))
         ors.append(add("o.OwnerName"))
@@ -152,7 +144,7 @@ def get_lostanimal_find_simple(dbo, query = "", limit = 0):
         ors.append(u"EXISTS(SELECT ad.Value FROM additional ad " \
             "INNER JOIN additionalfield af ON af.ID = ad.AdditionalFieldID AND af.Searchable = 1 " \
             "WHERE ad.LinkID=a.ID AND ad.LinkType IN (%s) AND LOWER(ad.Value) LIKE '%%%s%%')" % (additional.LOSTANIMAL_IN, query.lower()))
-        if not dbo.is_large_db:
+        if not dbo.is_large_db or ids is not None:
             ors.append(add("x.Sex"))
             ors.append(add("b.BreedName"))
             ors.append(add("c.BaseColour"))
@@ -160,6 +152,8 @@ def get_lostanimal_find_simple(dbo, query = "", limit = 0):
             ors.append(add("a.AgeGroup"))
             ors.append(add("a.DistFeat"))
             ors.append(add("a.Comments"))
+        if ids is not None:
+            ors = [ "a.ID IN (%s) AND (%s)" % (",".join([ str(x) for x in ids ]), " OR ".join(ors)) ]
     sql = get_lostanimal_query(dbo) + " WHERE " + " OR ".join(ors)
     if limit > 0: sql += " LIMIT " + str(limit)
     return db.query(dbo, sql)
@@ -184,6 +178,9 @@ def get_foundanimal_find_simple(dbo, query = "", limit = 0):
     if query == "":
         ors.append("a.DateFound > %s AND a.ReturnToOwnerDate Is Null" % db.dd(subtract_days(now(dbo.timezone), 30)))
     else:
+        # Narrow the search to candidates from the search index if we can
+        ids = searchindex.get_candidates(dbo, searchindex.FOUNDANIMAL, query)
+        if ids is not None and len(ids) == 0: return []
         if utils.is_numeric(query):
             ors.append("a.ID = " + str(utils.cint(query)))
         ors.append(add("o.OwnerName"))
@@ -192,7 +189,7 @@ def get_foundanimal_find_simple(dbo, query = "", limit = 0):
         ors.append(u"EXISTS(SELECT ad.Value FROM additional ad " \
             "INNER JOIN additionalfield af ON af.ID = ad.AdditionalFieldID AND af.Searchable = 1 " \
             "WHERE ad.LinkID=a.ID AND ad.LinkType IN (%s) AND LOWER(ad.Value) LIKE '%%%s%%')" % (additional.FOUNDANIMAL_IN, query.lower()))
-        if not dbo.is_large_db:
+        if not dbo.is_large_db or ids is not None:
             ors.append(add("x.Sex"))
             ors.append(add("b.BreedName"))
             ors.append(add("c.BaseColour"))
@@ -200,6 +197,8 @@ def get_foundanimal_find_simple(dbo, query = "", limit = 0):
             ors.append(add("a.AgeGroup"))
             ors.append(add("a.DistFeat"))
             ors.append(add("a.Comments"))
+        if ids is not None:
+            ors = [ "a.ID IN (%s) AND (%s)" % (",".join([ str(x) for x in ids ]), " OR ".join(ors)) ]
     sql = get_foundanimal_query(dbo) + " WHERE " + " OR ".join(ors)
     if limit > 0: sql += " LIMIT " + str(limit)
     return db.query(dbo, sql)
@@ -395,6 +394,246 @@ def words(str1, str2, maxpoints):
             matches += 1
     return int((float(matches) / float(len(s1words))) * float(maxpoints))
 
+def word_keys(s):
+    """
+    Returns the words in s split the same way as words(). Two strings
+    only score points from words() if they share at least one of these.
+    """
+    if s is None: s = ""
+    return set(s.replace(",", " ").replace("\n", " ").lower().strip().split(" "))
+
+def get_match_settings(dbo):
+    """
+    Returns the points for each match criteria as a dict, along with
+    the maximum possible, the point floor and whether shelter animals
+    are included.
+    """
+    ms = {
+        "species": configuration.match_species(dbo),
+        "breed": configuration.match_breed(dbo),
+        "age": configuration.match_age(dbo),
+        "sex": configuration.match_sex(dbo),
+        "area": configuration.match_area_lost(dbo),
+        "features": configuration.match_features(dbo),
+        "postcode": configuration.match_postcode(dbo),
+        "colour": configuration.match_colour(dbo),
+        "date": configuration.match_within2weeks(dbo),
+        "floor": configuration.match_point_floor(dbo),
+        "shelter": configuration.match_include_shelter(dbo)
+    }
+    ms["max"] = ms["species"] + ms["breed"] + ms["age"] + ms["sex"] + ms["area"] + \
+        ms["features"] + ms["postcode"] + ms["colour"] + ms["date"]
+    return ms
+
+# The blocking keys for comparing lost animals with found animals. Each key:
+# the criteria points it scores, a function returning the key values
+# for a lost animal and a function returning them for a found animal.
+# A found animal only scores for a key if they share at least one value.
+FOUND_KEYS = (
+    ( "species", lambda la: [ la["ANIMALTYPEID"] ], lambda fa: [ fa["ANIMALTYPEID"] ] ),
+    ( "breed", lambda la: [ la["BREEDID"] ], lambda fa: [ fa["BREEDID"] ] ),
+    ( "age", lambda la: [ la["AGEGROUP"] ], lambda fa: [ fa["AGEGROUP"] ] ),
+    ( "sex", lambda la: [ la["SEX"] ], lambda fa: [ fa["SEX"] ] ),
+    ( "area", lambda la: word_keys(la["AREALOST"]), lambda fa: word_keys(fa["AREAFOUND"]) ),
+    ( "features", lambda la: word_keys(la["DISTFEAT"]), lambda fa: word_keys(fa["DISTFEAT"]) ),
+    ( "postcode", lambda la: [ la["AREAPOSTCODE"] ], lambda fa: [ fa["AREAPOSTCODE"] ] ),
+    ( "colour", lambda la: [ la["BASECOLOURID"] ], lambda fa: [ fa["BASECOLOURID"] ] )
+)
+
+# The same for shelter animals. The postcode is matched within the
+# original owner postcode so it isn't used as a key.
+SHELTER_KEYS = (
+    ( "species", lambda la: [ la["ANIMALTYPEID"] ], lambda a: [ a["SPECIESID"] ] ),
+    ( "breed", lambda la: [ la["BREEDID"] ], lambda a: [ a["BREEDID"], a["BREED2ID"] ] ),
+    ( "colour", lambda la: [ la["BASECOLOURID"] ], lambda a: [ a["BASECOLOURID"] ] ),
+    ( "age", lambda la: [ la["AGEGROUP"] ], lambda a: [ a["AGEGROUP"] ] ),
+    ( "sex", lambda la: [ la["SEX"] ], lambda a: [ a["SEX"] ] ),
+    ( "area", lambda la: word_keys(la["AREALOST"]), lambda a: word_keys(a["ORIGINALOWNERADDRESS"]) ),
+    ( "features", lambda la: word_keys(la["DISTFEAT"]), lambda a: word_keys(a["MARKINGS"]) )
+)
+
+def build_match_index(rows, keys):
+    """
+    Builds a blocking index of rows for the keys given (FOUND_KEYS or
+    SHELTER_KEYS). Returns a dict of key name: { value: set of row positions }
+    """
+    index = {}
+    for name, lostvalues, rowvalues in keys:
+        buckets = index[name] = {}
+        for i, r in enumerate(rows):
+            for v in rowvalues(r):
+                buckets.setdefault(v, set()).add(i)
+    return index
+
+def get_match_candidates(la, index, keys, ms, rowcount, unkeyed):
+    """
+    Returns the positions of the rows in index that could score at least
+    the point floor against lost animal la, in order.
+    unkeyed: The points for criteria that aren't blocking keys.
+    A row that shares no values with la for a set of keys can only score
+    the points for the other keys and unkeyed, so the largest buckets
+    are skipped while that stays below the floor.
+    """
+    if unkeyed >= ms["floor"]: return range(0, rowcount)
+    probes = []
+    for name, lostvalues, rowvalues in keys:
+        buckets = index[name]
+        matched = [ buckets[v] for v in lostvalues(la) if buckets.has_key(v) ]
+        probes.append(( sum([ len(x) for x in matched ]), ms[name], matched ))
+    probes.sort(key = lambda x: x[0], reverse = True)
+    skipped = unkeyed
+    candidates = set()
+    for size, points, matched in probes:
+        if skipped + points < ms["floor"]:
+            skipped += points
+            continue
+        for x in matched:
+            candidates |= x
+    return sorted(candidates)
+
+def match_animals(dbo, lostanimals, foundanimals, shelteranimals):
+    """
+    Compares lostanimals against foundanimals and shelteranimals
+    (None to skip them), returning a list of LostFoundMatch objects
+    for the pairs that score at least the point floor. Only the pairs
+    that share enough blocking keys to reach the floor are scored.
+    """
+    l = dbo.locale
+    ms = get_match_settings(dbo)
+    matchmax = ms["max"]
+    matchpointfloor = ms["floor"]
+    matches = []
+    if foundanimals is None: foundanimals = []
+    if shelteranimals is None: shelteranimals = []
+    foundindex = build_match_index(foundanimals, FOUND_KEYS)
+    shelterindex = build_match_index(shelteranimals, SHELTER_KEYS)
+
+    for la in lostanimals:
+        # Found animals
+        for i in get_match_candidates(la, foundindex, FOUND_KEYS, ms, len(foundanimals), ms["date"]):
+            fa = foundanimals[i]
+            matchpoints = 0
+            if la["ANIMALTYPEID"] == fa["ANIMALTYPEID"]: matchpoints += ms["species"]
+            if la["BREEDID"] == fa["BREEDID"]: matchpoints += ms["breed"]
+            if la["AGEGROUP"] == fa["AGEGROUP"]: matchpoints += ms["age"]
+            if la["SEX"] == fa["SEX"]: matchpoints += ms["sex"]
+            matchpoints += words(la["AREALOST"], fa["AREAFOUND"], ms["area"])
+            matchpoints += words(la["DISTFEAT"], fa["DISTFEAT"], ms["features"])
+            if la["AREAPOSTCODE"] == fa["AREAPOSTCODE"]: matchpoints += ms["postcode"]
+            if la["BASECOLOURID"] == fa["BASECOLOURID"]: matchpoints += ms["colour"]
+            if date_diff_days(la["DATELOST"], fa["DATEFOUND"]) <= 14: matchpoints += ms["date"]
+            if matchpoints > matchmax: matchpoints = matchmax
+            if matchpoints >= matchpointfloor:
+                m = LostFoundMatch(dbo)
+                m.lid = la["ID"]
+                m.lcontactname = la["OWNERNAME"]
+                m.lcontactnumber = la["HOMETELEPHONE"]
+                m.larealost = la["AREALOST"]
+                m.lareapostcode = la["AREAPOSTCODE"]
+                m.lagegroup = la["AGEGROUP"]
+                m.lsexid = la["SEX"]
+                m.lsexname = la["SEXNAME"]
+                m.lspeciesid = la["ANIMALTYPEID"]
+                m.lspeciesname = la["SPECIESNAME"]
+                m.lbreedid = la["BREEDID"]
+                m.lbreedname = la["BREEDNAME"]
+                m.ldistinguishingfeatures = la["DISTFEAT"]
+                m.lbasecolourid = la["BASECOLOURID"]
+                m.lbasecolourname = la["BASECOLOURNAME"]
+                m.ldatelost = la["DATELOST"]
+                m.fid = fa["ID"]
+                m.fanimalid = 0
+                m.fcontactname = fa["OWNERNAME"]
+                m.fcontactnumber = fa["HOMETELEPHONE"]
+                m.fareafound = fa["AREAFOUND"]
+                m.fareapostcode = fa["AREAPOSTCODE"]
+                m.fagegroup = fa["AGEGROUP"]
+                m.fsexid = fa["SEX"]
+                m.fsexname = fa["SEXNAME"]
+                m.fspeciesid = fa["ANIMALTYPEID"]
+                m.fspeciesname = fa["SPECIESNAME"]
+                m.fbreedid = fa["BREEDID"]
+                m.fbreedname = fa["BREEDNAME"]
+                m.fdistinguishingfeatures = fa["DISTFEAT"]
+                m.fbasecolourid = fa["BASECOLOURID"]
+                m.fbasecolourname = fa["BASECOLOURNAME"]
+                m.fdatefound = fa["DATEFOUND"]
+                m.matchpoints = int((float(matchpoints) / float(matchmax)) * 100.0)
+                matches.append(m)
+
+        # Shelter animals
+        for i in get_match_candidates(la, shelterindex, SHELTER_KEYS, ms, len(shelteranimals), ms["postcode"] + ms["date"]):
+            a = shelteranimals[i]
+            matchpoints = 0
+            if la["ANIMALTYPEID"] == a["SPECIESID"]: matchpoints += ms["species"]
+            if la["BREEDID"] == a["BREEDID"] or la["BREEDID"] == a["BREED2ID"]: matchpoints += ms["breed"]
+            if la["BASECOLOURID"] == a["BASECOLOURID"]: matchpoints += ms["colour"]
+            if la["AGEGROUP"] == a["AGEGROUP"]: matchpoints += ms["age"]
+            if la["SEX"] == a["SEX"]: matchpoints += ms["sex"]
+            matchpoints += words(la["AREALOST"], a["ORIGINALOWNERADDRESS"], ms["area"])
+            matchpoints += words(la["DISTFEAT"], a["MARKINGS"], ms["features"])
+            if utils.nulltostr(a["ORIGINALOWNERPOSTCODE"]).find(la["AREAPOSTCODE"]) != -1: matchpoints += ms["postcode"]
+            if date_diff_days(la["DATELOST"], a["DATEBROUGHTIN"]) <= 14: matchpoints += ms["date"]
+            if matchpoints > matchmax: matchpoints = matchmax
+            if matchpoints >= matchpointfloor:
+                m = LostFoundMatch(dbo)
+                m.lid = la["ID"]
+                m.lcontactname = la["OWNERNAME"]
+                m.lcontactnumber = la["HOMETELEPHONE"]
+                m.larealost = la["AREALOST"]
+                m.lareapostcode = la["AREAPOSTCODE"]
+                m.lagegroup = la["AGEGROUP"]
+                m.lsexid = la["SEX"]
+                m.lsexname = la["SEXNAME"]
+                m.lspeciesid = la["ANIMALTYPEID"]
+                m.lspeciesname = la["SPECIESNAME"]
+                m.lbreedid = la["BREEDID"]
+                m.lbreedname = la["BREEDNAME"]
+                m.ldistinguishingfeatures = la["DISTFEAT"]
+                m.lbasecolourid = la["BASECOLOURID"]
+                m.lbasecolourname = la["BASECOLOURNAME"]
+                m.ldatelost = la["DATELOST"]
+                m.fid = 0
+                m.fanimalid = a["ID"]
+                m.fcontactname = _("Shelter animal {0} '{1}'", l).format(a["CODE"], a["ANIMALNAME"])
+                m.fcontactnumber = a["SPECIESNAME"]
+                m.fareafound = _("On Shelter", l)
+                m.fareapostcode = a["ORIGINALOWNERPOSTCODE"]
+                m.fagegroup = a["AGEGROUP"]
+                m.fsexid = a["SEX"]
+                m.fsexname = a["SEXNAME"]
+                m.fspeciesid = a["SPECIESID"]
+                m.fspeciesname = a["SPECIESNAME"]
+                m.fbreedid = a["BREEDID"]
+                m.fbreedname = a["BREEDNAME"]
+                m.fdistinguishingfeatures = a["MARKINGS"]
+                m.fbasecolourid = a["BASECOLOURID"]
+                m.fbasecolourname = a["BASECOLOURNAME"]
+                m.fdatefound = a["DATEBROUGHTIN"]
+                m.matchpoints = int((float(matchpoints) / float(matchmax)) * 100.0)
+                matches.append(m)
+
+    return matches
+
+def get_match_giveup(dbo):
+    """
+    Returns the date lost animals have to be reported after to be matched.
+    Older records are ignored to keep things useful.
+    """
+    return subtract_days(now(dbo.timezone), 180)
+
+def get_lost_match_clause(dbo):
+    """ Returns the clause for the lost animals to match """
+    return "a.DateFound Is Null AND a.DateLost > %s" % db.dd(get_match_giveup(dbo))
+
+def get_found_match_clause(dbo, oldestdate):
+    """ Returns the clause for the found animals to compare with lost animals lost from oldestdate """
+    return "a.ReturnToOwnerDate Is Null AND a.DateFound >= %s" % db.dd(oldestdate)
+
+def get_shelter_match_clause(dbo, oldestdate):
+    """ Returns the clause for the shelter animals to compare with lost animals lost from oldestdate """
+    return "a.Archived = 0 AND a.DateBroughtIn > %s" % db.dd(oldestdate)
+
 def match(dbo, lostanimalid = 0, foundanimalid = 0, animalid = 0):
     """
     Performs a lost and found match by going through all lost animals
@@ -402,45 +641,31 @@ def match(dbo, lostanimalid = 0, foundanimalid = 0, animalid = 0):
     foundanimalid:  Compare all lost animals against this found animal
     animalid:       Compare all lost animals against this shelter animal
     returns a list of LostFoundMatch objects
+    If no IDs are given, all the stored matches are replaced with the result.
     """
-    l = dbo.locale
-    matches = []
-    matchspecies = configuration.match_species(dbo)
-    matchbreed = configuration.match_breed(dbo)
-    matchage = configuration.match_age(dbo)
-    matchsex = configuration.match_sex(dbo)
-    matcharealost = configuration.match_area_lost(dbo)
-    matchfeatures = configuration.match_features(dbo)
-    matchpostcode = configuration.match_postcode(dbo)
-    matchcolour = configuration.match_colour(dbo)
-    matchdatewithin2weeks = configuration.match_within2weeks(dbo)
-    matchmax = matchspecies + matchbreed + matchage + matchsex + \
-        matcharealost + matchfeatures + matchpostcode + matchcolour + \
-        matchdatewithin2weeks
-    matchpointfloor = configuration.match_point_floor(dbo)
     includeshelter = configuration.match_include_shelter(dbo)
-    # Ignore records older than 6 months to keep things useful
-    giveup = subtract_days(now(dbo.timezone), 180)
 
     # Get our set of lost animals
     lostanimals = None
     if lostanimalid == 0:
         lostanimals = db.query(dbo, get_lostanimal_query(dbo) + \
-            " WHERE a.DateFound Is Null AND a.DateLost > %s ORDER BY a.DateLost" % db.dd(giveup))
+            " WHERE %s ORDER BY a.DateLost" % get_lost_match_clause(dbo))
     else:
         lostanimals = db.query(dbo, get_lostanimal_query(dbo) + \
             " WHERE a.ID = %d" % lostanimalid)
 
-    oldestdate = giveup
+    oldestdate = get_match_giveup(dbo)
     if len(lostanimals) > 0:
         oldestdate = lostanimals[0]["DATELOST"]
 
-    # Get the set of found animals for comparison
+    # Get the set of found animals for comparison (if an animal id
+    # has been given don't check found animals)
     foundanimals = None
-    if foundanimalid == 0:
+    if animalid != 0:
+        foundanimals = None
+    elif foundanimalid == 0:
         foundanimals = db.query(dbo, get_foundanimal_query(dbo) + \
-            " WHERE a.ReturnToOwnerDate Is Null" \
-            " AND a.DateFound >= %s " % db.dd(oldestdate))
+            " WHERE %s" % get_found_match_clause(dbo, oldestdate))
     else:
         foundanimals = db.query(dbo, get_foundanimal_query(dbo) + " WHERE a.ID = %d" % foundanimalid)
 
@@ -448,125 +673,168 @@ def match(dbo, lostanimalid = 0, foundanimalid = 0, animalid = 0):
     shelteranimals = None
     if includeshelter:
         if animalid == 0:
-            shelteranimals = db.query(dbo, animal.get_animal_query(dbo) + " WHERE " + \
-                "a.Archived = 0 AND a.DateBroughtIn > %s" % db.dd(oldestdate))
+            shelteranimals = db.query(dbo, animal.get_animal_query(dbo) + \
+                " WHERE %s" % get_shelter_match_clause(dbo, oldestdate))
         else:
             shelteranimals = db.query(dbo, animal.get_animal_query(dbo) + " WHERE a.ID = %d" % animalid)
 
-    # We're doing a full match, clear down the lostfoundmatch table
+    matches = match_animals(dbo, lostanimals, foundanimals, shelteranimals)
+
+    # We're doing a full match, replace the stored matches
     if animalid == 0 and lostanimalid == 0 and foundanimalid == 0:
         db.execute(dbo, "DELETE FROM animallostfoundmatch")
+        insert_matches(dbo, matches)
+    return matches
 
-    for la in lostanimals:
-        # Found animals (if an animal id has been given don't
-        # check found animals)
-        if animalid == 0:
-            for fa in foundanimals:
-                matchpoints = 0
-                if la["ANIMALTYPEID"] == fa["ANIMALTYPEID"]: matchpoints += matchspecies
-                if la["BREEDID"] == fa["BREEDID"]: matchpoints += matchbreed
-                if la["AGEGROUP"] == fa["AGEGROUP"]: matchpoints += matchage
-                if la["SEX"] == fa["SEX"]: matchpoints += matchsex
-                matchpoints += words(la["AREALOST"], fa["AREAFOUND"], matcharealost)
-                matchpoints += words(la["DISTFEAT"], fa["DISTFEAT"], matchfeatures)
-                if la["AREAPOSTCODE"] == fa["AREAPOSTCODE"]: matchpoints += matchpostcode
-                if la["BASECOLOURID"] == fa["BASECOLOURID"]: matchpoints += matchcolour
-                if date_diff_days(la["DATELOST"], fa["DATEFOUND"]) <= 14: matchpoints += matchdatewithin2weeks
-                if matchpoints > matchmax: matchpoints = matchmax
-                if matchpoints >= matchpointfloor:
-                    m = LostFoundMatch(dbo)
-                    m.lid = la["ID"]
-                    m.lcontactname = la["OWNERNAME"]
-                    m.lcontactnumber = la["HOMETELEPHONE"]
-                    m.larealost = la["AREALOST"]
-                    m.lareapostcode = la["AREAPOSTCODE"]
-                    m.lagegroup = la["AGEGROUP"]
-                    m.lsexid = la["SEX"]
-                    m.lsexname = la["SEXNAME"]
-                    m.lspeciesid = la["ANIMALTYPEID"]
-                    m.lspeciesname = la["SPECIESNAME"]
-                    m.lbreedid = la["BREEDID"]
-                    m.lbreedname = la["BREEDNAME"]
-                    m.ldistinguishingfeatures = la["DISTFEAT"]
-                    m.lbasecolourid = la["BASECOLOURID"]
-                    m.lbasecolourname = la["BASECOLOURNAME"]
-                    m.ldatelost = la["DATELOST"]
-                    m.fid = fa["ID"]
-                    m.fanimalid = 0
-                    m.fcontactname = fa["OWNERNAME"]
-                    m.fcontactnumber = fa["HOMETELEPHONE"]
-                    m.fareafound = fa["AREAFOUND"]
-                    m.fareapostcode = fa["AREAPOSTCODE"]
-                    m.fagegroup = fa["AGEGROUP"]
-                    m.fsexid = fa["SEX"]
-                    m.fsexname = fa["SEXNAME"]
-                    m.fspeciesid = fa["ANIMALTYPEID"]
-                    m.fspeciesname = fa["SPECIESNAME"]
-                    m.fbreedid = fa["BREEDID"]
-                    m.fbreedname = fa["BREEDNAME"]
-                    m.fdistinguishingfeatures = fa["DISTFEAT"]
-                    m.fbasecolourid = fa["BASECOLOURID"]
-                    m.fbasecolourname = fa["BASECOLOURNAME"]
-                    m.fdatefound = fa["DATEFOUND"]
-                    m.matchpoints = int((float(matchpoints) / float(matchmax)) * 100.0)
-                    matches.append(m)
-                    if animalid == 0 and lostanimalid == 0 and foundanimalid == 0:
-                        m.toDB()
+def insert_matches(dbo, matches):
+    """
+    Writes a list of LostFoundMatch objects to the animallostfoundmatch table
+    """
+    if len(matches) == 0: return
+    db.execute_many(dbo, "INSERT INTO animallostfoundmatch (%s) VALUES (%s)" % \
+        (", ".join(MATCH_COLUMNS), ", ".join([ "%s" ] * len(MATCH_COLUMNS))),
+        [ m.toParams() for m in matches ])
 
-        # Shelter animals
-        if includeshelter:
-            for a in shelteranimals:
-                matchpoints = 0
-                if la["ANIMALTYPEID"] == a["SPECIESID"]: matchpoints += matchspecies
-                if la["BREEDID"] == a["BREEDID"] or la["BREEDID"] == a["BREED2ID"]: matchpoints += matchbreed
-                if la["BASECOLOURID"] == a["BASECOLOURID"]: matchpoints += matchcolour
-                if la["AGEGROUP"] == a["AGEGROUP"]: matchpoints += matchage
-                if la["SEX"] == a["SEX"]: matchpoints += matchsex
-                matchpoints += words(la["AREALOST"], a["ORIGINALOWNERADDRESS"], matcharealost)
-                matchpoints += words(la["DISTFEAT"], a["MARKINGS"], matchfeatures)
-                if utils.nulltostr(a["ORIGINALOWNERPOSTCODE"]).find(la["AREAPOSTCODE"]) != -1: matchpoints += matchpostcode
-                if date_diff_days(la["DATELOST"], a["DATEBROUGHTIN"]) <= 14: matchpoints += matchdatewithin2weeks
-                if matchpoints > matchmax: matchpoints = matchmax
-                if matchpoints >= matchpointfloor:
-                    m = LostFoundMatch(dbo)
-                    m.lid = la["ID"]
-                    m.lcontactname = la["OWNERNAME"]
-                    m.lcontactnumber = la["HOMETELEPHONE"]
-                    m.larealost = la["AREALOST"]
-                    m.lareapostcode = la["AREAPOSTCODE"]
-                    m.lagegroup = la["AGEGROUP"]
-                    m.lsexid = la["SEX"]
-                    m.lsexname = la["SEXNAME"]
-                    m.lspeciesid = la["ANIMALTYPEID"]
-                    m.lspeciesname = la["SPECIESNAME"]
-                    m.lbreedid = la["BREEDID"]
-                    m.lbreedname = la["BREEDNAME"]
-                    m.ldistinguishingfeatures = la["DISTFEAT"]
-                    m.lbasecolourid = la["BASECOLOURID"]
-                    m.lbasecolourname = la["BASECOLOURNAME"]
-                    m.ldatelost = la["DATELOST"]
-                    m.fid = 0
-                    m.fanimalid = a["ID"]
-                    m.fcontactname = _("Shelter animal {0} '{1}'", l).format(a["CODE"], a["ANIMALNAME"])
-                    m.fcontactnumber = a["SPECIESNAME"]
-                    m.fareafound = _("On Shelter", l)
-                    m.fareapostcode = a["ORIGINALOWNERPOSTCODE"]
-                    m.fagegroup = a["AGEGROUP"]
-                    m.fsexid = a["SEX"]
-                    m.fsexname = a["SEXNAME"]
-                    m.fspeciesid = a["SPECIESID"]
-                    m.fspeciesname = a["SPECIESNAME"]
-                    m.fbreedid = a["BREEDID"]
-                    m.fbreedname = a["BREEDNAME"]
-                    m.fdistinguishingfeatures = a["MARKINGS"]
-                    m.fbasecolourid = a["BASECOLOURID"]
-                    m.fbasecolourname = a["BASECOLOURNAME"]
-                    m.fdatefound = a["DATEBROUGHTIN"]
-                    m.matchpoints = int((float(matchpoints) / float(matchmax)) * 100.0)
-                    matches.append(m)
-                    if animalid == 0 and lostanimalid == 0 and foundanimalid == 0:
-                        m.toDB()
+def get_match_settings_key(dbo):
+    """
+    Returns the match settings as a string so we can tell when they change
+    """
+    ms = get_match_settings(dbo)
+    return ",".join([ "%s=%s" % (k, ms[k]) for k in sorted(ms.keys()) ])
+
+def update_matches(dbo):
+    """
+    Brings the stored matches up to date. Only lost, found and shelter
+    animals that have changed since the last run are matched again and
+    matches for animals that no longer qualify are removed.
+    Everything is matched again if the settings have changed, a changed
+    lost animal is older than the others (which brings older found and
+    shelter animals in) or the last full match was over a week ago (to
+    pick up changes to people, lookups, etc. that don't touch the animals).
+    Returns the number of stored matches.
+    """
+    runtime = now(dbo.timezone)
+    settings = get_match_settings_key(dbo)
+    lastrun = configuration.lostfound_match_updated(dbo)
+    lastfull = configuration.lostfound_match_full(dbo)
+    full = lastrun == "" or lastfull == "" or configuration.lostfound_match_settings(dbo) != settings
+    if not full:
+        full = datetime.datetime.strptime(lastfull, "%Y%m%d%H%M%S") < subtract_days(runtime, 7)
+    if not full:
+        since = datetime.datetime.strptime(lastrun, "%Y%m%d%H%M%S")
+        lostanimals = db.query(dbo, get_lostanimal_query(dbo) + \
+            " WHERE %s ORDER BY a.DateLost" % get_lost_match_clause(dbo))
+        changedlost = [ x for x in lostanimals if x["LASTCHANGEDDATE"] is None or x["LASTCHANGEDDATE"] >= since ]
+        unchangedlost = [ x for x in lostanimals if not (x["LASTCHANGEDDATE"] is None or x["LASTCHANGEDDATE"] >= since) ]
+        if len(unchangedlost) == 0 or lostanimals[0]["ID"] != unchangedlost[0]["ID"]:
+            full = True
+
+    if full:
+        al.debug("matching all lost animals", "lostfound.update_matches", dbo)
+        match(dbo)
+        configuration.set_lostfound_match_full(dbo, runtime)
+        configuration.set_lostfound_match_settings(dbo, settings)
+        configuration.set_lostfound_match_updated(dbo, runtime)
+        return lostfound_last_match_count(dbo)
 
+    oldestdate = lostanimals[0]["DATELOST"]
+    foundclause = get_found_match_clause(dbo, oldestdate)
+    shelterclause = get_shelter_match_clause(dbo, oldestdate)
+    foundanimals = db.query(dbo, get_foundanimal_query(dbo) + " WHERE %s" % foundclause)
+    changedfound = [ x for x in foundanimals if x["LASTCHANGEDDATE"] is None or x["LASTCHANGEDDATE"] >= since ]
+    shelteranimals = []
+    changedshelter = []
+    if configuration.match_include_shelter(dbo):
+        shelteranimals = db.query(dbo, animal.get_animal_query(dbo) + " WHERE %s" % shelterclause)
+        # Shelter animals come and go through movements without their own record changing
+        changedids = set([ x[0] for x in db.query_tuple(dbo, "SELECT a.ID FROM animal a WHERE %s AND (a.LastChangedDate >= %s " \
+            "OR EXISTS(SELECT ad.ID FROM adoption ad WHERE ad.AnimalID = a.ID AND ad.LastChangedDate >= %s))" % \
+            (shelterclause, db.ddt(since), db.ddt(since))) ])
+        changedshelter = [ x for x in shelteranimals if x["ID"] in changedids ]
+    al.debug("matching %d changed lost animals, %d changed found animals and %d changed shelter animals" % \
+        (len(changedlost), len(changedfound), len(changedshelter)), "lostfound.update_matches", dbo)
+
+    # Remove the matches for animals that no longer qualify or have changed
+    def ids(rows):
+        return ",".join([ str(x["ID"]) for x in rows ])
+    db.execute(dbo, "DELETE FROM animallostfoundmatch WHERE AnimalLostID NOT IN " \
+        "(SELECT a.ID FROM animallost a WHERE %s)" % get_lost_match_clause(dbo))
+    db.execute(dbo, "DELETE FROM animallostfoundmatch WHERE AnimalFoundID > 0 AND AnimalFoundID NOT IN " \
+        "(SELECT a.ID FROM animalfound a WHERE %s)" % foundclause)
+    db.execute(dbo, "DELETE FROM animallostfoundmatch WHERE AnimalID > 0 AND AnimalID NOT IN " \
+        "(SELECT a.ID FROM animal a WHERE %s)" % shelterclause)
+    if len(changedlost) > 0:
+        db.execute(dbo, "DELETE FROM animallostfoundmatch WHERE AnimalLostID IN (%s)" % ids(changedlost))
+    if len(changedfound) > 0:
+        db.execute(dbo, "DELETE FROM animallostfoundmatch WHERE AnimalFoundID IN (%s)" % ids(changedfound))
+    if len(changedshelter) > 0:
+        db.execute(dbo, "DELETE FROM animallostfoundmatch WHERE AnimalID IN (%s)" % ids(changedshelter))
+
+    # Changed lost animals against everything, the rest against changed found and shelter animals
+    matches = match_animals(dbo, changedlost, foundanimals, shelteranimals)
+    if len(changedfound) > 0 or len(changedshelter) > 0:
+        matches += match_animals(dbo, unchangedlost, changedfound, changedshelter)
+    insert_matches(dbo, matches)
+    configuration.set_lostfound_match_updated(dbo, runtime)
+    return lostfound_last_match_count(dbo)
+
+def get_matches(dbo):
+    """
+    Returns the stored matches as a list of LostFoundMatch objects, in
+    the same order match produces them.
+    """
+    rows = db.query(dbo, "SELECT m.*, lx.Sex AS LostSexName, ls.SpeciesName AS LostSpeciesName, " \
+        "lb.BreedName AS LostBreedName, lc.BaseColour AS LostBaseColourName, " \
+        "fx.Sex AS FoundSexName, fs.SpeciesName AS FoundSpeciesName, " \
+        "fb.BreedName AS FoundBreedName, fc.BaseColour AS FoundBaseColourName " \
+        "FROM animallostfoundmatch m " \
+        "LEFT OUTER JOIN lksex lx ON lx.ID = m.LostSex " \
+        "LEFT OUTER JOIN species ls ON ls.ID = m.LostSpeciesID " \
+        "LEFT OUTER JOIN breed lb ON lb.ID = m.LostBreedID " \
+        "LEFT OUTER JOIN basecolour lc ON lc.ID = m.LostBaseColourID " \
+        "LEFT OUTER JOIN lksex fx ON fx.ID = m.FoundSex " \
+        "LEFT OUTER JOIN species fs ON fs.ID = m.FoundSpeciesID " \
+        "LEFT OUTER JOIN breed fb ON fb.ID = m.FoundBreedID " \
+        "LEFT OUTER JOIN basecolour fc ON fc.ID = m.FoundBaseColourID " \
+        "ORDER BY m.LostDate, m.AnimalLostID, m.AnimalID, m.AnimalFoundID")
+    matches = []
+    for r in rows:
+        m = LostFoundMatch(dbo)
+        m.lid = r["ANIMALLOSTID"]
+        m.lcontactname = r["LOSTCONTACTNAME"]
+        m.lcontactnumber = r["LOSTCONTACTNUMBER"]
+        m.larealost = r["LOSTAREA"]
+        m.lareapostcode = r["LOSTPOSTCODE"]
+        m.lagegroup = r["LOSTAGEGROUP"]
+        m.lsexid = r["LOSTSEX"]
+        m.lsexname = r["LOSTSEXNAME"]
+        m.lspeciesid = r["LOSTSPECIESID"]
+        m.lspeciesname = r["LOSTSPECIESNAME"]
+        m.lbreedid = r["LOSTBREEDID"]
+        m.lbreedname = r["LOSTBREEDNAME"]
+        m.ldistinguishingfeatures = r["LOSTFEATURES"]
+        m.lbasecolourid = r["LOSTBASECOLOURID"]
+        m.lbasecolourname = r["LOSTBASECOLOURNAME"]
+        m.ldatelost = r["LOSTDATE"]
+        m.fid = r["ANIMALFOUNDID"]
+        m.fanimalid = r["ANIMALID"]
+        m.fcontactname = r["FOUNDCONTACTNAME"]
+        m.fcontactnumber = r["FOUNDCONTACTNUMBER"]
+        m.fareafound = r["FOUNDAREA"]
+        m.fareapostcode = r["FOUNDPOSTCODE"]
+        m.fagegroup = r["FOUNDAGEGROUP"]
+        m.fsexid = r["FOUNDSEX"]
+        m.fsexname = r["FOUNDSEXNAME"]
+        m.fspeciesid = r["FOUNDSPECIESID"]
+        m.fspeciesname = r["FOUNDSPECIESNAME"]
+        m.fbreedid = r["FOUNDBREEDID"]
+        m.fbreedname = r["FOUNDBREEDNAME"]
+        m.fdistinguishingfeatures = r["FOUNDFEATURES"]
+        m.fbasecolourid = r["FOUNDBASECOLOURID"]
+        m.fbasecolourname = r["FOUNDBASECOLOURNAME"]
+        m.fdatefound = r["FOUNDDATE"]
+        m.matchpoints = r["MATCHPOINTS"]
+        matches.append(m)
     return matches
 
 def match_report(dbo, username = "system", lostanimalid = 0, foundanimalid = 0, animalid = 0):
@@ -581,7 +849,11 @@ def match_report(dbo, username = "system", lostanimalid = 0, foundanimalid = 0,
     def td(s): return "<td>%s</td>" % s
     def hr(): return "<hr />"
     lastid = 0
-    matches = match(dbo, lostanimalid, foundanimalid, animalid)
+    if lostanimalid == 0 and foundanimalid == 0 and animalid == 0:
+        update_matches(dbo)
+        matches = get_matches(dbo)
+    else:
+        matches = match(dbo, lostanimalid, foundanimalid, animalid)
     if len(matches) > 0:
         for m in matches:
             if lastid != m.lid:
@@ -682,6 +954,8 @@ def update_lostanimal_from_form(dbo, post, username):
         ( "Comments", post.db_string("comments"))
         )))
     additional.save_values_for_link(dbo, post, lfid, "lostanimal")
+    searchindex.update(dbo, searchindex.LOSTANIMAL, lfid)
+    timeline.update(dbo, timeline.LOST, lfid)
     postaudit = db.query(dbo, "SELECT * FROM animallost WHERE ID = %d" % lfid)
     audit.edit(dbo, username, "animallost", lfid, audit.map_diff(preaudit, postaudit))
 
@@ -719,6 +993,8 @@ def insert_lostanimal_from_form(dbo, post, username):
 
     # Save any additional field values given
     additional.save_values_for_link(dbo, post, nid, "lostanimal")
+    searchindex.update(dbo, searchindex.LOSTANIMAL, nid)
+    timeline.update(dbo, timeline.LOST, nid)
 
     return nid
 
@@ -757,6 +1033,8 @@ def update_foundanimal_from_form(dbo, post, username):
         ( "Comments", post.db_string("comments"))
         )))
     additional.save_values_for_link(dbo, post, lfid, "foundanimal")
+    searchindex.update(dbo, searchindex.FOUNDANIMAL, lfid)
+    timeline.update(dbo, timeline.FOUND, lfid)
     postaudit = db.query(dbo, "SELECT * FROM animalfound WHERE ID = %d" % lfid)
     audit.edit(dbo, username, "animalfound", lfid, audit.map_diff(preaudit, postaudit))
 
@@ -794,6 +1072,8 @@ def insert_foundanimal_from_form(dbo, post, username):
 
     # Save any additional field values given
     additional.save_values_for_link(dbo, post, nid, "foundanimal")
+    searchindex.update(dbo, searchindex.FOUNDANIMAL, nid)
+    timeline.update(dbo, timeline.FOUND, nid)
 
     return nid
 
@@ -857,6 +1137,8 @@ def delete_lostanimal(dbo, username, aid):
     db.execute(dbo, "DELETE FROM diary WHERE LinkID = %d AND LinkType = %d" % (aid, diary.LOSTANIMAL))
     db.execute(dbo, "DELETE FROM log WHERE LinkID = %d AND LinkType = %d" % (aid, log.LOSTANIMAL))
     db.execute(dbo, "DELETE FROM additional WHERE LinkID = %d AND LinkType IN (%s)" % (aid, additional.LOSTANIMAL_IN))
+    searchindex.delete(dbo, searchindex.LOSTANIMAL, aid)
+    timeline.update(dbo, timeline.LOST, aid)
 
 def delete_foundanimal(dbo, username, aid):
     """
@@ -868,5 +1150,7 @@ def delete_foundanimal(dbo, username, aid):
     db.execute(dbo, "DELETE FROM diary WHERE LinkID = %d AND LinkType = %d" % (aid, diary.FOUNDANIMAL))
     db.execute(dbo, "DELETE FROM log WHERE LinkID = %d AND LinkType = %d" % (aid, log.FOUNDANIMAL))
     db.execute(dbo, "DELETE FROM additional WHERE LinkID = %d AND LinkType IN (%s)" % (aid, additional.FOUNDANIMAL_IN))
+    searchindex.delete(dbo, searchindex.FOUNDANIMAL, aid)
+    timeline.update(dbo, timeline.FOUND, aid)
 
 
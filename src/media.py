@@ -4,6 +4,7 @@ import al
 import animal
 import audit
 import base64
+import cachedisk
 import configuration
 import datetime
 import db
@@ -12,10 +13,11 @@ import i18n
 from PIL import ExifTags, Image
 import os
 import tempfile
+import time
 import utils
 import zipfile
 from cStringIO import StringIO
-from sitedefs import SCALE_PDF_DURING_ATTACH, SCALE_PDF_CMD
+from sitedefs import CACHE_SCALED_IMAGES, SCALE_PDF_DURING_ATTACH, SCALE_PDF_CMD
 
 ANIMAL = 0
 LOSTANIMAL = 1
@@ -28,6 +30,13 @@ MEDIATYPE_FILE = 0
 MEDIATYPE_DOCUMENT_LINK = 1
 MEDIATYPE_VIDEO_LINK = 2
 
+# Named sizes that images can be requested at
+IMAGE_SIZES = {
+    "thumbnail":    "70x70",
+    "small":        "150x150",
+    "medium":       "300x300"
+}
+
 def mime_type(filename):
     """
     Returns the mime type for a file with the given name
@@ -136,7 +145,56 @@ def get_media_file_data(dbo, mid):
     mm = get_media_by_id(dbo, mid)[0]
     return mm["DATE"], mm["MEDIANAME"], mime_type(mm["MEDIANAME"]), dbfs.get_string(dbo, mm["MEDIANAME"])
 
-def get_image_file_data(dbo, mode, iid, seq = -1, justdate = False):
+def get_image_file_media(dbo, mode, iid, seq = -1):
+    """
+    Returns the media record for the image served by get_image_file_data
+    for mode, iid and seq as a single element list. An empty list is 
+    returned if there is no image or the mode does not use a media record.
+    """
+    if mode == "media":
+        return get_media_by_id(dbo, int(iid))
+    linktype = -1
+    if mode == "animal" or mode == "animalthumb":
+        linktype = ANIMAL
+    elif mode == "person" or mode == "personthumb":
+        linktype = PERSON
+    if linktype == -1:
+        return []
+    if seq == -1 or mode.endswith("thumb"):
+        return get_web_preferred(dbo, linktype, int(iid))
+    if seq > get_total_seq(dbo, linktype, int(iid)):
+        return []
+    return get_media_by_seq(dbo, linktype, int(iid), seq)
+
+def get_image_size(mode, size = ""):
+    """
+    Returns the named size that get_image_file_data will scale an image
+    to for mode and size, or an empty string for the original image.
+    """
+    if mode.endswith("thumb"): return "thumbnail"
+    if IMAGE_SIZES.has_key(size): return size
+    return ""
+
+def get_image_etag(dbo, mediarow, size = ""):
+    """
+    Returns an ETag for a media record image at a named size. 
+    It changes whenever the image is replaced or rotated (which 
+    updates the media record's date).
+    """
+    return "%s-%d-%s-%s" % (dbo.database, mediarow["ID"], _datestamp(mediarow["DATE"]), size)
+
+def get_image_last_modified(dbo, mediarow):
+    """
+    Returns the date of a media record in UTC for an HTTP Last-Modified
+    header, or None if it doesn't have one. Media dates are stored in
+    server local time with the database's timezone offset applied.
+    """
+    d = mediarow["DATE"]
+    if d is None: return None
+    d = d - datetime.timedelta(hours = dbo.timezone)
+    return datetime.datetime.utcfromtimestamp(time.mktime(d.timetuple()))
+
+def get_image_file_data(dbo, mode, iid, seq = -1, justdate = False, size = "", mm = None):
     """
     Gets an image
     mode: animal | media | animalthumb | person | personthumb | dbfs
@@ -144,85 +202,70 @@ def get_image_file_data(dbo, mode, iid, seq = -1, justdate = False):
         or a template path for dbfs mode
     seq: If the mode is animal or person, returns image X for that person/animal
          The first image is always the preferred photo.
+    size: One of the IMAGE_SIZES to scale the image to. The thumb modes
+         are always the thumbnail size.
+    mm: The result of get_image_file_media for mode, iid and seq if the 
+         caller has already read it.
     if justdate is True, returns the last modified date
     if justdate is False, returns a tuple containing the last modified date and image data
     """
-    def nopic():
-        NOPIC_DATE = datetime.datetime(2011, 01, 01)
-        if justdate: 
-            return NOPIC_DATE
+    if mode == "dbfs":
+        if justdate:
+            return datetime.datetime.today()
         else:
-            return (NOPIC_DATE, "NOPIC")
-    def thumb_nopic():
+            return (datetime.datetime.today(), dbfs.get_string_filepath(dbo, str(iid)))
+    if mm is None: mm = get_image_file_media(dbo, mode, iid, seq)
+    if len(mm) == 0:
         NOPIC_DATE = datetime.datetime(2011, 01, 01)
         if justdate:
             return NOPIC_DATE
         else:
             return (NOPIC_DATE, "NOPIC")
-    def mrec(mm):
-        if justdate:
-            return mm[0]["DATE"]
-        else:
-            return (mm[0]["DATE"], dbfs.get_string(dbo, mm[0]["MEDIANAME"]))
-    def thumb_mrec(mm):
-        if justdate:
-            return mm[0]["DATE"]
-        else:
-            return (mm[0]["DATE"], scale_thumbnail(dbfs.get_string(dbo, mm[0]["MEDIANAME"])))
-
-    if mode == "animal":
-        if seq == -1:
-            mm = get_web_preferred(dbo, ANIMAL, int(iid))
-            if len(mm) == 0:
-                return nopic()
-            else:
-                return mrec(mm)
-        else:
-            tseq = get_total_seq(dbo, ANIMAL, int(iid))
-            if seq > tseq:
-                return nopic()
-            else:
-                mm = get_media_by_seq(dbo, ANIMAL, int(iid), seq)
-                return mrec(mm)
-    elif mode == "person":
-        if seq == -1:
-            mm = get_web_preferred(dbo, PERSON, int(iid))
-            if len(mm) == 0:
-                return nopic()
-            else:
-                return mrec(mm)
-        else:
-            tseq = get_total_seq(dbo, PERSON, int(iid))
-            if seq > tseq:
-                return nopic()
-            else:
-                mm = get_media_by_seq(dbo, PERSON, int(iid), seq)
-                return mrec(mm)
-    elif mode == "animalthumb":
-        mm = get_web_preferred(dbo, ANIMAL, int(iid))
-        if len(mm) == 0:
-            return thumb_nopic()
-        else:
-            return thumb_mrec(mm)
-    elif mode == "personthumb":
-        mm = get_web_preferred(dbo, PERSON, int(iid))
-        if len(mm) == 0:
-            return thumb_nopic()
-        else:
-            return thumb_mrec(mm)
-    elif mode == "media":
-        mm = get_media_by_id(dbo, int(iid))
-        if len(mm) == 0:
-            return nopic()
-        else:
-            return mrec(mm)
-    elif mode == "dbfs":
-        if justdate:
-            return datetime.datetime.today()
-        else:
-            return (datetime.datetime.today(), dbfs.get_string_filepath(dbo, str(iid)))
-    else:
-        return nopic()
+    m = mm[0]
+    if justdate:
+        return m["DATE"]
+    size = get_image_size(mode, size)
+    if size != "":
+        return (m["DATE"], get_scaled_image(dbo, m, size))
+    return (m["DATE"], dbfs.get_string(dbo, m["MEDIANAME"]))
+
+def _datestamp(d):
+    if d is None: return "0"
+    return d.strftime("%Y%m%d%H%M%S")
+
+def _scaled_image_key(dbo, mediaid, mediadate, size):
+    return "scaledimage:%s:%d:%s:%s" % (dbo.database, mediaid, _datestamp(mediadate), size)
+
+def get_scaled_image(dbo, mediarow, size):
+    """
+    Returns the image for a media record scaled to one of the IMAGE_SIZES.
+    Scaled images are kept in the disk cache, keyed by the media ID and
+    date so that a replaced or rotated image is never served from it.
+    """
+    key = _scaled_image_key(dbo, mediarow["ID"], mediarow["DATE"], size)
+    if CACHE_SCALED_IMAGES > 0:
+        imagedata = cachedisk.get(key)
+        if imagedata is not None: return imagedata
+    imagedata = scale_image(dbfs.get_string(dbo, mediarow["MEDIANAME"]), IMAGE_SIZES[size])
+    if CACHE_SCALED_IMAGES > 0:
+        cachedisk.put(key, imagedata, CACHE_SCALED_IMAGES)
+    return imagedata
+
+def cache_scaled_images(dbo, mediaid, mediadate, imagedata):
+    """
+    Populates the disk cache with the thumbnail for a new or changed image, 
+    the size that the find screens and shelter view ask for.
+    """
+    if CACHE_SCALED_IMAGES > 0:
+        cachedisk.put(_scaled_image_key(dbo, mediaid, mediadate, "thumbnail"), scale_thumbnail(imagedata), CACHE_SCALED_IMAGES)
+
+def delete_scaled_images(dbo, mediaid, mediadate):
+    """
+    Removes all the scaled versions of an image from the disk cache.
+    """
+    if CACHE_SCALED_IMAGES > 0:
+        for size in IMAGE_SIZES.iterkeys():
+            cachedisk.delete(_scaled_image_key(dbo, mediaid, mediadate, size))
 
 def get_dbfs_path(linkid, linktype):
     path = "/animal/%d" % int(linkid)
@@ -324,6 +367,7 @@ def attach_file_from_form(dbo, username, linktype, linkid, post):
         comments = utils.filename_only(filename)
     
     # Create the media record
+    mediadate = i18n.now(dbo.timezone).replace(microsecond = 0)
     sql = db.make_insert_sql("media", (
         ( "ID", db.di(mediaid) ),
         ( "MediaName", db.ds(medianame) ),
@@ -339,11 +383,14 @@ def attach_file_from_form(dbo, username, linktype, linkid, post):
         # ASM2_COMPATIBILITY
         ( "LinkID", db.di(linkid) ),
         ( "LinkTypeID", db.di(linktype) ),
-        ( "Date", db.dd(i18n.now(dbo.timezone)))
+        ( "Date", db.ddt(mediadate))
         ))
     db.execute(dbo, sql)
     audit.create(dbo, username, "media", mediaid, str(mediaid) + ": for " + str(linkid) + "/" + str(linktype))
 
+    if ispicture:
+        cache_scaled_images(dbo, mediaid, mediadate, filedata)
+
     if ispicture and checkpref:
         check_default_web_doc_pic(dbo, mediaid, linkid, linktype)
 
@@ -537,6 +584,7 @@ def delete_media(dbo, username, mid):
     audit.delete(dbo, username, "media", mid, str(mr))
     dbfs.delete(dbo, mn)
     db.execute(dbo, "DELETE FROM media WHERE ID = %d" % int(mid))
+    delete_scaled_images(dbo, mr["ID"], mr["DATE"])
     # Was it the web or doc preferred? If so, make the first image for the link
     # the web or doc preferred instead
     if mr["WEBSITEPHOTO"] == 1:
@@ -570,8 +618,12 @@ def rotate_media(dbo, username, mid, clockwise = True):
     imagedata = rotate_image(imagedata, clockwise)
     # Store it back in the dbfs and add an entry to the audit trail
     dbfs.put_string(dbo, mn, path, imagedata)
-    # Update the date stamp on the media record
-    db.execute(dbo, "UPDATE media SET Date = %s WHERE ID = %d" % (db.nowsql(), mid))
+    # Update the date stamp on the media record and replace any scaled
+    # versions of the old image
+    mediadate = i18n.now(dbo.timezone).replace(microsecond = 0)
+    db.execute(dbo, "UPDATE media SET Date = %s WHERE ID = %d" % (db.ddt(mediadate), mid))
+    delete_scaled_images(dbo, mr["ID"], mr["DATE"])
+    cache_scaled_images(dbo, mr["ID"], mediadate, imagedata)
     audit.edit(dbo, username, "media", mid, "media id %d rotated, clockwise=%s" % (mid, str(clockwise)))
 
 def scale_image(imagedata, resizespec):
@@ -815,8 +867,10 @@ def scale_animal_images(dbo):
         f.close()
         os.unlink(inputfile.name)
         os.unlink(outputfile.name)
-        # Update the image file data
+        # Update the image file data and the media date so that
+        # cached copies of the old image aren't used
         dbfs.put_string(dbo, name, filepath, data)
+        db.execute(dbo, "UPDATE media SET Date = %s WHERE MediaName = %s" % (db.ddt(i18n.now(dbo.timezone).replace(microsecond = 0)), db.ds(name)))
     al.debug("scaled %d images" % len(mp), "media.scale_animal_images", dbo)
 
 def scale_all_odt(dbo):
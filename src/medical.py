@@ -1,11 +1,14 @@
 #!/usr/bin/python
 
 import al
+import alerts
 import animal
 import audit
 import configuration
 import datetime
 import db
+import stats
+import timeline
 import utils
 from i18n import _, now, add_days, subtract_days
 
@@ -529,22 +532,30 @@ def update_test_today(dbo, username, testid, resultid):
     """
     Marks a test record as performed today. 
     """
+    statdays = stats.get_days(dbo, "animaltest", "ID = %d" % testid)
     db.execute(dbo, db.make_update_user_sql(dbo, "animaltest", username, "ID = %d" % testid, (
         ( "DateOfTest", db.dd(now(dbo.timezone)) ), 
         ( "TestResultID", db.di(resultid) )
         )))
+    alerts.invalidate(dbo, "animaltest")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "animaltest", "ID = %d" % testid))
     audit.edit(dbo, username, "animaltest", testid, str(testid) + " => given " + str(db.dd(now(dbo.timezone))))
     # ASM2_COMPATIBILITY
     update_asm2_tests(dbo, testid)
+    timeline.update(dbo, timeline.ANIMAL, db.query_int(dbo, "SELECT AnimalID FROM animaltest WHERE ID = %d" % testid), [ "animal", "animaltest" ])
 
 def update_vaccination_today(dbo, username, vaccid):
     """
     Marks a vaccination record as given today. 
     """
+    statdays = stats.get_days(dbo, "animalvaccination", "ID = %d" % vaccid)
     db.execute(dbo, db.make_update_user_sql(dbo, "animalvaccination", username, "ID = %d" % vaccid, (
         ( "DateOfVaccination", db.dd(now(dbo.timezone)) ),
         )))
+    alerts.invalidate(dbo, "animalvaccination")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "animalvaccination", "ID = %d" % vaccid))
     audit.edit(dbo, username, "animalvaccination", vaccid, str(vaccid) + " => given " + str(db.dd(now(dbo.timezone))))
+    timeline.update(dbo, timeline.ANIMAL, db.query_int(dbo, "SELECT AnimalID FROM animalvaccination WHERE ID = %d" % vaccid), [ "animalvaccination" ])
 
 def calculate_given_remaining(dbo, amid):
     """
@@ -560,21 +571,29 @@ def complete_vaccination(dbo, username, vaccinationid, newdate, vetid = 0):
     """
     Marks a vaccination completed on newdate
     """
+    statdays = stats.get_days(dbo, "animalvaccination", "ID = %d" % vaccinationid)
     db.execute(dbo, "UPDATE animalvaccination SET DateOfVaccination = %s, AdministeringVetID = %s, " \
         "LastChangedBy = %s, LastChangedDate = %s WHERE ID = %d" % \
         ( db.dd(newdate), db.di(vetid), db.ds(username), db.ddt(now(dbo.timezone)), vaccinationid))
+    alerts.invalidate(dbo, "animalvaccination")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "animalvaccination", "ID = %d" % vaccinationid))
     audit.edit(dbo, username, "animalvaccination", vaccinationid, str(vaccinationid) + " => given " + str(newdate))
+    timeline.update(dbo, timeline.ANIMAL, db.query_int(dbo, "SELECT AnimalID FROM animalvaccination WHERE ID = %d" % vaccinationid), [ "animalvaccination" ])
 
 def complete_test(dbo, username, testid, newdate, testresult, vetid = 0):
     """
     Marks a test performed on newdate with testresult
     """
+    statdays = stats.get_days(dbo, "animaltest", "ID = %d" % testid)
     db.execute(dbo, "UPDATE animaltest SET DateOfTest = %s, AdministeringVetID = %s, " \
         "LastChangedBy = %s, LastChangedDate = %s, TestResultID = %d WHERE ID = %d" % \
         ( db.dd(newdate), db.di(vetid), db.ds(username), db.ddt(now(dbo.timezone)), testresult, testid))
+    alerts.invalidate(dbo, "animaltest")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "animaltest", "ID = %d" % testid))
     audit.edit(dbo, username, "animaltest", testid, "%d => performed on %s (result: %d)" % (testid, str(newdate), testresult))
     # ASM2_COMPATIBILITY
     update_asm2_tests(dbo, testid)
+    timeline.update(dbo, timeline.ANIMAL, db.query_int(dbo, "SELECT AnimalID FROM animaltest WHERE ID = %d" % testid), [ "animal", "animaltest" ])
 
 def reschedule_vaccination(dbo, username, vaccinationid, newdate, comments):
     """
@@ -596,6 +615,7 @@ def reschedule_vaccination(dbo, username, vaccinationid, newdate, comments):
         ( "Cost", db.di(av["COST"])),
         ( "CostPaidDate", db.dd(None)),
         ( "Comments", db.ds(comments)))))
+    alerts.invalidate(dbo, "animalvaccination")
 
     audit.create(dbo, username, "animalvaccination", nvaccid, audit.dump_row(dbo, "animalvaccination", nvaccid))
 
@@ -778,6 +798,9 @@ def insert_regimen_from_form(dbo, username, post):
     elif post.integer("status") == 1:
         db.execute(dbo, "UPDATE animalmedical SET Status = 1 WHERE ID = %d" % nregid)
 
+    alerts.invalidate(dbo, "animalmedical", "animalmedicaltreatment")
+    stats.update_days(dbo, stats.get_days(dbo, "animalmedical", "ID = %d" % nregid))
+    timeline.update(dbo, timeline.ANIMAL, post.integer("animal"), [ "animalmedical" ])
     return nregid
 
 def update_regimen_from_form(dbo, username, post):
@@ -801,10 +824,14 @@ def update_regimen_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     preaudit = db.query(dbo, "SELECT * FROM animalmedical WHERE ID=%d" % regimenid)
+    statdays = stats.get_days(dbo, "animalmedical", "ID = %d" % regimenid)
     db.execute(dbo, sql)
     postaudit = db.query(dbo, "SELECT * FROM animalmedical WHERE ID=%d" % regimenid)
     audit.edit(dbo, username, "animalmedical", regimenid, audit.map_diff(preaudit, postaudit, [ "TREATMENTNAME", "DOSAGE" ]))
     update_medical_treatments(dbo, username, post.integer("regimenid"))
+    alerts.invalidate(dbo, "animalmedical", "animalmedicaltreatment")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "animalmedical", "ID = %d" % regimenid))
+    timeline.update(dbo, timeline.ANIMAL, [ r["ANIMALID"] for r in postaudit ], [ "animalmedical" ])
 
 def insert_vaccination_from_form(dbo, username, post):
     """
@@ -833,7 +860,10 @@ def insert_vaccination_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "animalvaccination")
+    stats.update_days(dbo, stats.get_days(dbo, "animalvaccination", "ID = %d" % nvaccid))
     audit.create(dbo, username, "animalvaccination", nvaccid, audit.dump_row(dbo, "animalvaccination", nvaccid))
+    timeline.update(dbo, timeline.ANIMAL, post.integer("animal"), [ "animalvaccination" ])
     return nvaccid
 
 def update_vaccination_from_form(dbo, username, post):
@@ -859,9 +889,13 @@ def update_vaccination_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     preaudit = db.query(dbo, "SELECT * FROM animalvaccination WHERE ID = %d" % vaccid)
+    statdays = stats.get_days(dbo, "animalvaccination", "ID = %d" % vaccid)
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "animalvaccination")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "animalvaccination", "ID = %d" % vaccid))
     postaudit = db.query(dbo, "SELECT * FROM animalvaccination WHERE ID = %d" % vaccid)
     audit.edit(dbo, username, "animalvaccination", vaccid, audit.map_diff(preaudit, postaudit))
+    timeline.update(dbo, timeline.ANIMAL, [ r["ANIMALID"] for r in preaudit + postaudit ], [ "animalvaccination" ])
 
 def update_vaccination_batch_stock(dbo, username, vid, slid):
     """
@@ -901,9 +935,12 @@ def insert_test_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "animaltest")
+    stats.update_days(dbo, stats.get_days(dbo, "animaltest", "ID = %d" % ntestid))
     audit.create(dbo, username, "animaltest", ntestid, audit.dump_row(dbo, "animaltest", ntestid))
     # ASM2_COMPATIBILITY
     update_asm2_tests(dbo, ntestid, "insert")
+    timeline.update(dbo, timeline.ANIMAL, post.integer("animal"), [ "animal", "animaltest" ])
     return ntestid
 
 def update_test_from_form(dbo, username, post):
@@ -927,11 +964,15 @@ def update_test_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     preaudit = db.query(dbo, "SELECT * FROM animaltest WHERE ID = %d" % testid)
+    statdays = stats.get_days(dbo, "animaltest", "ID = %d" % testid)
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "animaltest")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "animaltest", "ID = %d" % testid))
     postaudit = db.query(dbo, "SELECT * FROM animaltest WHERE ID = %d" % testid)
     audit.edit(dbo, username, "animaltest", testid, audit.map_diff(preaudit, postaudit))
     # ASM2_COMPATIBILITY
     update_asm2_tests(dbo, testid, "update")
+    timeline.update(dbo, timeline.ANIMAL, [ r["ANIMALID"] for r in preaudit + postaudit ], [ "animal", "animaltest" ])
 
 def update_asm2_tests(dbo, testid, action = "insert"):
     """
@@ -983,8 +1024,13 @@ def delete_regimen(dbo, username, amid):
     Deletes a regimen
     """
     audit.delete(dbo, username, "animalmedical", amid, audit.dump_row(dbo, "animalmedical", amid))
+    animalid = db.query_int(dbo, "SELECT AnimalID FROM animalmedical WHERE ID = %d" % amid)
     db.execute(dbo, "DELETE FROM animalmedicaltreatment WHERE AnimalMedicalID = %d" % amid)
+    statdays = stats.get_days(dbo, "animalmedical", "ID = %d" % amid)
     db.execute(dbo, "DELETE FROM animalmedical WHERE ID = %d" % amid)
+    alerts.invalidate(dbo, "animalmedical", "animalmedicaltreatment")
+    stats.update_days(dbo, statdays)
+    timeline.update(dbo, timeline.ANIMAL, animalid, [ "animalmedical" ])
 
 def delete_treatment(dbo, username, amtid):
     """
@@ -992,7 +1038,10 @@ def delete_treatment(dbo, username, amtid):
     """
     audit.delete(dbo, username, "animalmedicaltreatment", amtid, audit.dump_row(dbo, "animalmedicaltreatment", amtid))
     amid = db.query_int(dbo, "SELECT AnimalMedicalID FROM animalmedicaltreatment WHERE ID = %d" % int(amtid))
+    animalid = db.query_int(dbo, "SELECT AnimalID FROM animalmedicaltreatment WHERE ID = %d" % int(amtid))
     db.execute(dbo, "DELETE FROM animalmedicaltreatment WHERE ID = %d" % amtid)
+    alerts.invalidate(dbo, "animalmedical", "animalmedicaltreatment")
+    timeline.update(dbo, timeline.ANIMAL, animalid, [ "animalmedicaltreatment" ])
     # Was that the last treatment for the regimen? If so, remove the regimen as well
     if 0 == db.query_int(dbo, "SELECT COUNT(*) FROM animalmedicaltreatment WHERE AnimalMedicalID = %d" % amid):
         delete_regimen(dbo, username, amid)
@@ -1007,14 +1056,24 @@ def delete_test(dbo, username, testid):
     audit.delete(dbo, username, "animaltest", testid, audit.dump_row(dbo, "animaltest", testid))
     # ASM2_COMPATIBILITY
     update_asm2_tests(dbo, testid, "delete")
+    animalid = db.query_int(dbo, "SELECT AnimalID FROM animaltest WHERE ID = %d" % testid)
+    statdays = stats.get_days(dbo, "animaltest", "ID = %d" % testid)
     db.execute(dbo, "DELETE FROM animaltest WHERE ID = %d" % testid)
+    alerts.invalidate(dbo, "animaltest")
+    stats.update_days(dbo, statdays)
+    timeline.update(dbo, timeline.ANIMAL, animalid, [ "animal", "animaltest" ])
 
 def delete_vaccination(dbo, username, vaccinationid):
     """
     Deletes a vaccination record
     """
     audit.delete(dbo, username, "animalvaccination", vaccinationid, audit.dump_row(dbo, "animalvaccination", vaccinationid))
+    animalid = db.query_int(dbo, "SELECT AnimalID FROM animalvaccination WHERE ID = %d" % vaccinationid)
+    statdays = stats.get_days(dbo, "animalvaccination", "ID = %d" % vaccinationid)
     db.execute(dbo, "DELETE FROM animalvaccination WHERE ID = %d" % vaccinationid)
+    alerts.invalidate(dbo, "animalvaccination")
+    stats.update_days(dbo, statdays)
+    timeline.update(dbo, timeline.ANIMAL, animalid, [ "animalvaccination" ])
 
 def insert_profile_from_form(dbo, username, post):
     """
@@ -1124,6 +1183,8 @@ def update_treatment_today(dbo, username, amtid):
     # Generate next treatments in sequence or complete the
     # medical record appropriately
     update_medical_treatments(dbo, username, amid)
+    alerts.invalidate(dbo, "animalmedicaltreatment")
+    timeline.update(dbo, timeline.ANIMAL, db.query_int(dbo, "SELECT AnimalID FROM animalmedicaltreatment WHERE ID = %d" % amtid), [ "animalmedicaltreatment" ])
 
 def update_treatment_given(dbo, username, amtid, newdate, by = "", vetid = 0, comments = ""):
     """
@@ -1145,6 +1206,8 @@ def update_treatment_given(dbo, username, amtid, newdate, by = "", vetid = 0, co
     # Generate next treatments in sequence or complete the
     # medical record appropriately
     update_medical_treatments(dbo, username, amid)
+    alerts.invalidate(dbo, "animalmedicaltreatment")
+    timeline.update(dbo, timeline.ANIMAL, db.query_int(dbo, "SELECT AnimalID FROM animalmedicaltreatment WHERE ID = %d" % amtid), [ "animalmedicaltreatment" ])
 
 def update_treatment_required(dbo, username, amtid, newdate):
     """
@@ -1152,6 +1215,7 @@ def update_treatment_required(dbo, username, amtid, newdate):
     that newdate is valid.
     """
     db.execute(dbo, "UPDATE animalmedicaltreatment SET DateRequired = %s WHERE ID = %d" % (db.dd(newdate), amtid))
+    alerts.invalidate(dbo, "animalmedicaltreatment")
     audit.edit(dbo, username, "animalmedicaltreatment", amtid, "%d required => %s" % (amtid, str(newdate)))
 
 def update_vaccination_required(dbo, username, vaccid, newdate):
@@ -1162,5 +1226,6 @@ def update_vaccination_required(dbo, username, vaccid, newdate):
     db.execute(dbo, db.make_update_user_sql(dbo, "animalvaccination", username, "ID = %d" % vaccid, (
         ( "DateRequired", db.dd(newdate) ), 
         )))
+    alerts.invalidate(dbo, "animalvaccination")
     audit.edit(dbo, username, "animalvaccination", vaccid, "%d required => %s" % (vaccid, str(newdate)))
 
@@ -1,12 +1,16 @@
 #!/usr/bin/python
 
 import al
+import alerts
 import animal
 import audit
 import configuration
 import db
 import financial
 import i18n
+import searchindex
+import stats
+import timeline
 import utils
 
 NO_MOVEMENT = 0
@@ -382,10 +386,14 @@ def insert_movement_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "adoption")
+    stats.update_days(dbo, stats.get_days(dbo, "adoption", "ID = %d" % movementid))
     audit.create(dbo, username, "adoption", movementid, audit.dump_row(dbo, "adoption", movementid))
     animal.update_animal_status(dbo, animalid)
     animal.update_variable_animal_data(dbo, animalid)
     update_movement_donation(dbo, movementid)
+    searchindex.update(dbo, searchindex.ANIMAL, animalid)
+    timeline.update(dbo, timeline.ANIMAL, animalid, [ "animal", "adoption" ])
     return movementid
 
 def update_movement_from_form(dbo, username, post):
@@ -416,12 +424,17 @@ def update_movement_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     preaudit = db.query(dbo, "SELECT * FROM adoption WHERE ID = %d" % movementid)
+    statdays = stats.get_days(dbo, "adoption", "ID = %d" % movementid)
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "adoption")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "adoption", "ID = %d" % movementid))
     postaudit = db.query(dbo, "SELECT * FROM adoption WHERE ID = %d" % movementid)
     audit.edit(dbo, username, "adoption", movementid, audit.map_diff(preaudit, postaudit))
     animal.update_animal_status(dbo, post.integer("animal"))
     animal.update_variable_animal_data(dbo, post.integer("animal"))
     update_movement_donation(dbo, movementid)
+    searchindex.update(dbo, searchindex.ANIMAL, post.integer("animal"))
+    timeline.update(dbo, timeline.ANIMAL, [ r["ANIMALID"] for r in preaudit + postaudit ], [ "animal", "adoption" ])
 
 def delete_movement(dbo, username, mid):
     """
@@ -432,9 +445,14 @@ def delete_movement(dbo, username, mid):
         raise utils.ASMError("Trying to delete a movement that does not exist")
     db.execute(dbo, "UPDATE ownerdonation SET MovementID = 0 WHERE MovementID = %d" % int(mid))
     audit.delete(dbo, username, "adoption", mid, audit.dump_row(dbo, "adoption", mid))
+    statdays = stats.get_days(dbo, "adoption", "ID = %d" % int(mid))
     db.execute(dbo, "DELETE FROM adoption WHERE ID = %d" % int(mid))
+    alerts.invalidate(dbo, "adoption")
+    stats.update_days(dbo, statdays)
     animal.update_animal_status(dbo, animalid)
     animal.update_variable_animal_data(dbo, animalid)
+    searchindex.update(dbo, searchindex.ANIMAL, animalid)
+    timeline.update(dbo, timeline.ANIMAL, animalid, [ "animal", "adoption" ])
 
 def return_movement(dbo, movementid, animalid = 0, returndate = None):
     """
@@ -445,7 +463,10 @@ def return_movement(dbo, movementid, animalid = 0, returndate = None):
     if returndate is None: returndate = i18n.now(dbo.timezone)
     if animalid == 0: animalid = db.query_int(dbo, "SELECT AnimalID FROM adoption WHERE ID = %d" % int(movementid))
     db.execute(dbo, "UPDATE adoption SET ReturnDate = %s WHERE ID = %d" % (db.dd(returndate), int(movementid)))
+    alerts.invalidate(dbo, "adoption")
     animal.update_animal_status(dbo, int(animalid))
+    searchindex.update(dbo, searchindex.ANIMAL, animalid)
+    timeline.update(dbo, timeline.ANIMAL, animalid, [ "animal", "adoption" ])
 
 def insert_adoption_from_form(dbo, username, post, creating = [], create_payments = True):
     """
@@ -808,6 +829,8 @@ def insert_transport_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "animaltransport")
+    stats.update_days(dbo, stats.get_days(dbo, "animaltransport", "ID = %d" % transportid))
     audit.create(dbo, username, "animaltransport", transportid, audit.dump_row(dbo, "animaltransport", transportid))
     return transportid
 
@@ -838,7 +861,10 @@ def update_transport_from_form(dbo, username, post):
         ( "Comments", post.db_string("comments"))
         ))
     preaudit = db.query(dbo, "SELECT * FROM animaltransport WHERE ID = %d" % transportid)
+    statdays = stats.get_days(dbo, "animaltransport", "ID = %d" % transportid)
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "animaltransport")
+    stats.update_days(dbo, statdays | stats.get_days(dbo, "animaltransport", "ID = %d" % transportid))
     postaudit = db.query(dbo, "SELECT * FROM animaltransport WHERE ID = %d" % transportid)
     audit.edit(dbo, username, "animaltransport", transportid, audit.map_diff(preaudit, postaudit))
 
@@ -850,7 +876,10 @@ def delete_transport(dbo, username, tid):
     if animalid == 0:
         raise utils.ASMError("Trying to delete a transport that does not exist")
     audit.delete(dbo, username, "animaltransport", tid, audit.dump_row(dbo, "animaltransport", tid))
+    statdays = stats.get_days(dbo, "animaltransport", "ID = %d" % int(tid))
     db.execute(dbo, "DELETE FROM animaltransport WHERE ID = %d" % int(tid))
+    alerts.invalidate(dbo, "animaltransport")
+    stats.update_days(dbo, statdays)
 
 def generate_insurance_number(dbo):
     """
@@ -875,6 +904,7 @@ def auto_cancel_reservations(dbo):
         "WHERE MovementDate Is Null AND ReservationCancelledDate Is Null AND " \
         "MovementType = 0 AND ReservationDate < %s" % ( db.dd(i18n.now(dbo.timezone)), db.dd(cancelcutoff))
     count = db.execute(dbo, sql)
+    alerts.invalidate(dbo, "adoption")
     al.debug("cancelled %d reservations older than %d days" % (count, int(cancelafter)), "movement.auto_cancel_reservations", dbo)
 
     
@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import al
+import alerts
 import animal
 import animalcontrol
 import audit
@@ -665,6 +666,7 @@ def insert_onlineformincoming_from_form(dbo, post, remoteip):
             fieldssofar += 1
             preview.append( fld["LABEL"] + ": " + fld["VALUE"] )
     db.execute(dbo, "UPDATE onlineformincoming SET Preview = %s WHERE CollationID = %s" % ( db.ds(", ".join(preview)), db.di(collationid) ))
+    alerts.invalidate(dbo, "onlineformincoming")
     # Do we have a valid emailaddress for the submitter and EmailSubmitter is set? 
     # If so, send them a copy of their submission
     emailsubmitter = db.query_int(dbo, "SELECT o.EmailSubmitter FROM onlineform o " \
@@ -697,6 +699,7 @@ def delete_onlineformincoming(dbo, username, collationid):
     """
     audit.delete(dbo, username, "onlineformincoming", collationid, str(db.query(dbo, "SELECT * FROM onlineformincoming WHERE CollationID=%d" % int(collationid))))
     db.execute(dbo, "DELETE FROM onlineformincoming WHERE CollationID = %d" % int(collationid))
+    alerts.invalidate(dbo, "onlineformincoming")
 
 def guess_agegroup(dbo, s):
     """ Guesses an agegroup, returns the default if no match is found """
@@ -987,5 +990,6 @@ def auto_remove_old_incoming_forms(dbo):
     al.debug("remove date: incoming forms < %s" % db.dd(removecutoff), "onlineform.auto_remove_old_incoming_forms", dbo)
     sql = "DELETE FROM onlineformincoming WHERE PostedDate < %s" % db.dd(removecutoff)
     count = db.execute(dbo, sql)
+    alerts.invalidate(dbo, "onlineformincoming")
     al.debug("removed %d incoming forms older than %d days" % (count, int(removeafter)), "onlineform.auto_remove_old_incoming_forms", dbo)
 
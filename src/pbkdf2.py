@@ -49,6 +49,10 @@ from itertools import izip, starmap
 
 _pack_int = Struct('>I').pack
 
+# Python 2.7.8+ has a native implementation in hashlib, which is 
+# used when it's available as it's much faster
+_pbkdf2_hmac = getattr(hashlib, 'pbkdf2_hmac', None)
+
 
 def pbkdf2_hex(data, salt, iterations=1000, keylen=24, hashfunc=None):
     """Like :func:`pbkdf2_bin` but returns a hex encoded string."""
@@ -62,6 +66,13 @@ def pbkdf2_bin(data, salt, iterations=1000, keylen=24, hashfunc=None):
     a different hashlib `hashfunc` can be provided.
     """
     hashfunc = hashfunc or hashlib.sha1
+    if _pbkdf2_hmac is not None:
+        try:
+            return _pbkdf2_hmac(hashfunc().name, data, salt, iterations, keylen)
+        except (AttributeError, TypeError, ValueError, UnicodeError):
+            # Not a hashlib hash or data the native version can't 
+            # take, use the pure python version
+            pass
     mac = hmac.new(data, None, hashfunc)
     def _pseudorandom(x, mac=mac):
         h = mac.copy()
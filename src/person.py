@@ -2,6 +2,7 @@
 
 import additional
 import al
+import alerts
 import animal
 import audit
 import configuration
@@ -13,10 +14,13 @@ import geo
 import log
 import media
 import reports
+import searchindex
+import stats
+import timeline
 import users
 import utils
 from i18n import _, add_days, date_diff_days, format_time, python2display, subtract_years, now
-from sitedefs import BULK_GEO_BATCH
+from sitedefs import BULK_GEO_BATCH, BULK_GEO_BATCH_LIMIT
 
 ASCENDING = 0
 DESCENDING = 1
@@ -345,6 +349,9 @@ def get_person_find_simple(dbo, query, username="", classfilter="all", includeSt
     """
     ors = []
     query = query.replace("'", "`")
+    # Narrow the search to candidates from the search index if we can
+    ids = searchindex.get_candidates(dbo, searchindex.PERSON, query)
+    if ids is not None and len(ids) == 0: return []
     words = query.split(" ")
     def add(field):
         return utils.where_text_filter(dbo, field, query)
@@ -402,6 +409,8 @@ def get_person_find_simple(dbo, query, username="", classfilter="all", includeSt
         cf = " AND o.IsStaff = 0"
     if not includeVolunteers:
         cf = " AND o.IsVolunteer = 0"
+    if ids is not None:
+        cf += " AND o.ID IN (%s)" % ",".join([ str(x) for x in ids ])
     sql = unicode(get_person_query(dbo)) + " WHERE (" + u" OR ".join(ors) + ")" + cf + " ORDER BY o.OwnerName"
     if limit > 0: sql += " LIMIT " + str(limit)
     return reduce_find_results(dbo, username, db.query(dbo, sql))
@@ -689,12 +698,18 @@ def update_person_from_form(dbo, post, username):
     ))
     preaudit = db.query(dbo, "SELECT * FROM owner WHERE ID=%d" % pid)
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "owner")
     postaudit = db.query(dbo, "SELECT * FROM owner WHERE ID=%d" % pid)
     audit.edit(dbo, username, "owner", pid, audit.map_diff(preaudit, postaudit, [ "OWNERNAME", ]))
 
     # Save any additional field values given
     additional.save_values_for_link(dbo, post, pid, "person")
 
+    # Update the search index for the person and any animals that show their details
+    searchindex.update(dbo, searchindex.PERSON, pid)
+    searchindex.update_animals_for_person(dbo, pid)
+    timeline.update_animals_for_person(dbo, pid)
+
 def update_flags(dbo, username, personid, flags):
     """
     Updates the flags on a person record from a list of flags
@@ -737,6 +752,7 @@ def update_flags(dbo, username, personid, flags):
         ( "AdditionalFlags", db.ds(flagstr))
     ))
     db.execute(dbo, sql)
+    alerts.invalidate(dbo, "owner")
 
 def insert_person_from_form(dbo, post, username):
     """
@@ -838,6 +854,7 @@ def insert_person_from_form(dbo, post, username):
     # Save any additional field values given
     additional.save_values_for_link(dbo, post, pid, "person")
 
+    searchindex.update(dbo, searchindex.PERSON, pid)
     return pid
 
 def merge_person_details(dbo, username, personid, d):
@@ -946,6 +963,10 @@ def merge_person(dbo, username, personid, mergepersonid):
     reparent("log", "LinkID", "LinkType", log.PERSON)
     audit.delete(dbo, username, "owner", mergepersonid, audit.dump_row(dbo, "owner", mergepersonid))
     db.execute(dbo, "DELETE FROM owner WHERE ID = %d" % mergepersonid)
+    searchindex.update(dbo, searchindex.PERSON, [ personid, mergepersonid ])
+    searchindex.update_animals_for_person(dbo, personid)
+    timeline.update_animals_for_person(dbo, personid)
+    alerts.invalidate(dbo, "owner", "ownerdonation")
 
 def merge_duplicate_people(dbo, username):
     """
@@ -1024,16 +1045,22 @@ def delete_person(dbo, username, personid):
     db.execute(dbo, "DELETE FROM diary WHERE LinkID = %d AND LinkType = %d" % (personid, 2))
     db.execute(dbo, "DELETE FROM log WHERE LinkID = %d AND LinkType = %d" % (personid, 1))
     db.execute(dbo, "DELETE FROM additional WHERE LinkID = %d AND LinkType IN (%s)" % (personid, additional.PERSON_IN))
+    statdays = stats.get_days(dbo, "adoption", "OwnerID = %d" % personid) | stats.get_days(dbo, "ownerdonation", "OwnerID = %d" % personid)
     db.execute(dbo, "DELETE FROM adoption WHERE OwnerID = %d" % personid)
     db.execute(dbo, "DELETE FROM ownerdonation WHERE OwnerID = %d" % personid)
     db.execute(dbo, "DELETE FROM ownervoucher WHERE OwnerID = %d" % personid)
     dbfs.delete_path(dbo, "/owner/%d" % personid)
     db.execute(dbo, "DELETE FROM owner WHERE ID = %d" % personid)
+    searchindex.delete(dbo, searchindex.PERSON, personid)
+    alerts.invalidate(dbo, "owner", "adoption", "ownerdonation")
+    stats.update_days(dbo, statdays)
     # Now that we've removed the person, update any animals that were previously
     # attached to it so that they return to the shelter.
     for a in animals:
         animal.update_animal_status(dbo, int(a["ANIMALID"]))
         animal.update_variable_animal_data(dbo, int(a["ANIMALID"]))
+    searchindex.update(dbo, searchindex.ANIMAL, [ a["ANIMALID"] for a in animals ])
+    timeline.update(dbo, timeline.ANIMAL, [ a["ANIMALID"] for a in animals ], [ "animal", "adoption" ])
 
 def insert_rota_from_form(dbo, username, post):
     """
@@ -1144,6 +1171,34 @@ def send_email_from_form(dbo, username, post):
         log.add_log(dbo, username, log.PERSON, post.integer("personid"), logtype, utils.html_email_to_plain(body))
     return rv
 
+def get_lookingfor_predicates(dbo, p):
+    """
+    Returns a list of functions for person p's looking for criteria.
+    Each takes an animal row and returns True if it meets the criteria.
+    """
+    preds = []
+    def eq(field, v): return lambda a: a[field] == v
+    if p["MATCHANIMALTYPE"] > 0: preds.append(eq("ANIMALTYPEID", p["MATCHANIMALTYPE"]))
+    if p["MATCHSPECIES"] > 0: preds.append(eq("SPECIESID", p["MATCHSPECIES"]))
+    if p["MATCHBREED"] > 0: preds.append(lambda a, v=p["MATCHBREED"]: a["BREEDID"] == v or a["BREED2ID"] == v)
+    if p["MATCHSEX"] > -1: preds.append(eq("SEX", p["MATCHSEX"]))
+    if p["MATCHSIZE"] > -1: preds.append(eq("SIZE", p["MATCHSIZE"]))
+    if p["MATCHCOLOUR"] > -1: preds.append(eq("BASECOLOURID", p["MATCHCOLOUR"]))
+    if p["MATCHGOODWITHCHILDREN"] == 0: preds.append(eq("ISGOODWITHCHILDREN", 0))
+    if p["MATCHGOODWITHCATS"] == 0: preds.append(eq("ISGOODWITHCATS", 0))
+    if p["MATCHGOODWITHDOGS"] == 0: preds.append(eq("ISGOODWITHDOGS", 0))
+    if p["MATCHHOUSETRAINED"] == 0: preds.append(eq("ISHOUSETRAINED", 0))
+    if p["MATCHAGEFROM"] >= 0 and p["MATCHAGETO"] > 0:
+        # Born between the two dates, compared at midnight as the database would
+        def midnight(d): return datetime.datetime(d.year, d.month, d.day)
+        born1 = midnight(subtract_years(now(dbo.timezone), p["MATCHAGETO"]))
+        born2 = midnight(subtract_years(now(dbo.timezone), p["MATCHAGEFROM"]))
+        preds.append(lambda a: a["DATEOFBIRTH"] is not None and born1 <= a["DATEOFBIRTH"] <= born2)
+    if p["MATCHCOMMENTSCONTAIN"] is not None and p["MATCHCOMMENTSCONTAIN"] != "":
+        for w in p["MATCHCOMMENTSCONTAIN"].split(" "):
+            preds.append(lambda a, w=w.lower(): a["ANIMALCOMMENTS"] is not None and a["ANIMALCOMMENTS"].lower().find(w) != -1)
+    return preds
+
 def lookingfor_report(dbo, username = "system", personid = 0):
     """
     Generates the person looking for report
@@ -1193,26 +1248,20 @@ def lookingfor_report(dbo, username = "system", personid = 0):
     ah.append( "<th>%s</th>" % _("Comments", l))
     ah.append( "</tr>")
 
+    # Load the adoptable animals once and index them by species,
+    # each person's criteria are then checked against them in memory
+    adoptable = db.query(dbo, animal.get_animal_query(dbo) + " WHERE a.Archived=0 AND a.IsNotAvailableForAdoption=0 AND a.HasActiveReserve=0 AND a.CrueltyCase=0 AND a.DeceasedDate Is Null")
+    speciesindex = {}
+    for a in adoptable:
+        speciesindex.setdefault(a["SPECIESID"], []).append(a)
+
     totalmatches = 0
+    matchrows = []
     for p in people:
-        sql = []
-        if p["MATCHANIMALTYPE"] > 0: sql.append(" AND a.AnimalTypeID = %d" % int(p["MATCHANIMALTYPE"]))
-        if p["MATCHSPECIES"] > 0: sql.append(" AND a.SpeciesID = %d" % int(p["MATCHSPECIES"]))
-        if p["MATCHBREED"] > 0: sql.append(" AND (a.BreedID = %d OR a.Breed2ID = %d)" % (int(p["MATCHBREED"]), int(p["MATCHBREED"])))
-        if p["MATCHSEX"] > -1: sql.append(" AND a.Sex = %d" % int(p["MATCHSEX"]))
-        if p["MATCHSIZE"] > -1: sql.append(" AND a.Size = %d" % int(p["MATCHSIZE"]))
-        if p["MATCHCOLOUR"] > -1: sql.append(" AND a.BaseColourID = %d" % int(p["MATCHCOLOUR"]))
-        if p["MATCHGOODWITHCHILDREN"] == 0: sql.append(" AND a.IsGoodWithChildren = 0")
-        if p["MATCHGOODWITHCATS"] == 0: sql.append(" AND a.IsGoodWithCats = 0")
-        if p["MATCHGOODWITHDOGS"] == 0: sql.append(" AND a.IsGoodWithDogs = 0")
-        if p["MATCHHOUSETRAINED"] == 0: sql.append(" AND a.IsHouseTrained = 0")
-        if p["MATCHAGEFROM"] >= 0 and p["MATCHAGETO"] > 0: 
-            sql.append(" AND a.DateOfBirth BETWEEN %s AND %s" % (db.dd(subtract_years(now(dbo.timezone), p["MATCHAGETO"])), \
-                db.dd(subtract_years(now(dbo.timezone), p["MATCHAGEFROM"]))))
-        if p["MATCHCOMMENTSCONTAIN"] is not None and p["MATCHCOMMENTSCONTAIN"] != "":
-            for w in str(p["MATCHCOMMENTSCONTAIN"]).split(" "):
-                sql.append(" AND a.AnimalComments Like '%%%s%%'" % w.replace("'", "`"))
-        animals = db.query(dbo, animal.get_animal_query(dbo) + " WHERE a.Archived=0 AND a.IsNotAvailableForAdoption=0 AND a.HasActiveReserve=0 AND a.CrueltyCase=0 AND a.DeceasedDate Is Null" + "".join(sql))
+        predicates = get_lookingfor_predicates(dbo, p)
+        candidates = adoptable
+        if p["MATCHSPECIES"] > 0: candidates = speciesindex.get(p["MATCHSPECIES"], [])
+        animals = [ a for a in candidates if all(f(a) for f in predicates) ]
 
         h.append("<h2>%s (%s) %s %s</h2>" % (p["OWNERNAME"], p["OWNERADDRESS"], p["HOMETELEPHONE"], p["MOBILETELEPHONE"]))
         c = []
@@ -1258,16 +1307,15 @@ def lookingfor_report(dbo, username = "system", personid = 0):
 
             # Add an entry to ownerlookingfor for other reports
             if personid == 0:
-                sql = db.make_insert_sql("ownerlookingfor", (
-                    ( "AnimalID", db.di(a["ID"]) ),
-                    ( "OwnerID", db.di(p["ID"]) ),
-                    ( "MatchSummary", db.ds(summary) ) ))
-                db.execute(dbo, sql)
+                matchrows.append(( a["ID"], p["ID"], summary ))
 
         if outputheader:
             h.append( "</table>")
         h.append( hr())
 
+    if personid == 0:
+        db.execute_many(dbo, "INSERT INTO ownerlookingfor (AnimalID, OwnerID, MatchSummary) VALUES (%s, %s, %s)", matchrows)
+
     if len(people) == 0:
         h.append( p(_("No matches found.", l)))
 
@@ -1284,23 +1332,34 @@ def update_missing_geocodes(dbo):
     """
     Goes through all people records without geocodes and completes
     the missing ones, using our configured bulk geocoding service.
-    We limit this to LIMIT geocode requests per call so that databases with
-    a lot of historical data don't end up tying up the daily
-    batch for a long time, they'll just slowly complete over time.
+    Addresses we have looked up before are completed from the geocode
+    cache. We limit this to BULK_GEO_BATCH_LIMIT people (most recently
+    changed first) per call so that databases with a lot of historical 
+    data don't end up tying up the daily batch for a long time, they'll 
+    just slowly complete over time.
     """
     if not BULK_GEO_BATCH:
         al.warn("BULK_GEO_BATCH is False, skipping", "update_missing_geocodes", dbo)
         return
-    LIMIT = 50
     people = db.query(dbo, "SELECT ID, OwnerAddress, OwnerTown, OwnerCounty, OwnerPostcode " \
-        "FROM owner WHERE LatLong Is Null OR LatLong = '' LIMIT %d" % LIMIT)
+        "FROM owner WHERE LatLong Is Null OR LatLong = '' ORDER BY LastChangedDate DESC LIMIT %d" % BULK_GEO_BATCH_LIMIT)
     batch = []
+    queued = []
     for p in people:
-        latlong = geo.get_lat_long(dbo, p["OWNERADDRESS"], p["OWNERTOWN"], p["OWNERCOUNTY"], p["OWNERPOSTCODE"])
-        if latlong is not None:
+        q, url = geo.get_query(dbo, p["OWNERADDRESS"], p["OWNERTOWN"], p["OWNERCOUNTY"], p["OWNERPOSTCODE"])
+        if q is None: continue
+        latlong = geo.get_cached_lat_long(dbo, q)
+        if latlong is None:
+            queued.append((geo.queue_lat_long(dbo, q, url), p["ID"]))
+        elif latlong != "":
             batch.append((latlong, p["ID"]))
+    cached = len(batch)
+    for req, pid in queued:
+        latlong = geo.wait_lat_long(req)
+        if latlong is not None:
+            batch.append((latlong, pid))
     db.execute_many(dbo, "UPDATE owner SET LatLong = %s WHERE ID = %s", batch)
-    al.debug("updated %d person geocodes" % len(batch), "person.update_missing_geocodes", dbo)
+    al.debug("updated %d person geocodes (%d from cache, %d lookups)" % (len(batch), cached, len(queued)), "person.update_missing_geocodes", dbo)
 
 def update_lookingfor_report(dbo):
     """
@@ -23,6 +23,7 @@ import medical
 import movement
 import onlineform
 import os, glob
+import Queue
 import re
 import shutil
 import smcom
@@ -179,6 +180,16 @@ class PublishCriteria:
         if self.publishDirectory is not None: s += " publishdirectory=" + self.publishDirectory
         return s.strip()
 
+# The number of FTP connections FTP publishers upload images over
+FTP_UPLOAD_WORKERS = 4
+
+# How many times an image upload is attempted before giving up
+FTP_UPLOAD_RETRIES = 3
+
+# Files that have not been published for this many days are dropped
+# from the upload manifest
+FTP_UPLOAD_MANIFEST_DAYS = 30
+
 def quietcallback(x):
     """ ftplib callback that does nothing instead of dumping to stdout """
     pass
@@ -203,9 +214,9 @@ def get_animal_data(dbo, pc, include_additional_fields = False):
             r["WEBSITEMEDIANOTES"] = r["ANIMALCOMMENTS"]
     # Embellish additional fields if requested
     if include_additional_fields:
+        add = additional.get_additional_fields_many(dbo, [ r["ID"] for r in rows ], "animal")
         for r in rows:
-            add = additional.get_additional_fields(dbo, int(r["ID"]), "animal")
-            for af in add:
+            for af in add[r["ID"]]:
                 if af["FIELDNAME"].find("&") != -1:
                     # We've got unicode chars for the tag name - not allowed
                     r["ADD" + str(af["ID"])] = af["VALUE"]
@@ -213,24 +224,30 @@ def get_animal_data(dbo, pc, include_additional_fields = False):
                     r[af["FIELDNAME"]] = af["VALUE"]
     # If bondedAsSingle is on, go through the the set of animals and merge
     # the bonded animals into a single record
-    def merge_animal(a, animalid):
-        """
-        Find the animal in rows with animalid, merge it into a and
-        then remove it from the set.
-        """
-        for r in rows:
-            if r["ID"] == animalid:
-                a["ANIMALNAME"] = "%s, %s" % (a["ANIMALNAME"], r["ANIMALNAME"])
-                rows.remove(r)
-                break
     if pc.bondedAsSingle:
-        for r in rows:
-            if r["BONDEDANIMALID"] is not None and r["BONDEDANIMALID"] != 0:
-                merge_animal(r, r["BONDEDANIMALID"])
-            if r["BONDEDANIMAL2ID"] is not None and r["BONDEDANIMAL2ID"] != 0:
-                merge_animal(r, r["BONDEDANIMAL2ID"])
+        rows = merge_bonded_animals(rows)
     return rows
 
+def merge_bonded_animals(rows):
+    """
+    Returns rows with each animal's bonded animals merged into its 
+    record (their names are appended) and removed from the set.
+    """
+    byid = {}
+    for r in rows:
+        byid[r["ID"]] = r
+    merged = set()
+    results = []
+    for r in rows:
+        if r["ID"] in merged: continue
+        for bid in ( r["BONDEDANIMALID"], r["BONDEDANIMAL2ID"] ):
+            if bid is not None and bid != 0 and byid.has_key(bid) and bid not in merged and bid != r["ID"]:
+                r["ANIMALNAME"] = "%s, %s" % (r["ANIMALNAME"], byid[bid]["ANIMALNAME"])
+                merged.add(bid)
+        merged.add(r["ID"])
+        results.append(r)
+    return results
+
 def get_animal_data_query(dbo, pc, animalid = 0):
     """
     Generate the adoptable animal query. If animalid is supplied, only runs the
@@ -436,7 +453,7 @@ def get_animal_view(dbo, animalid):
     if foot == "":
         foot = "</body>\n</html>"
     s = head + body + foot
-    tags = wordprocessor.animal_tags(dbo, a)
+    tags = wordprocessor.animal_tags(dbo, a, wordprocessor.get_tags_used(s, True, "$$", "$$"))
     tags = wordprocessor.append_tags(tags, wordprocessor.org_tags(dbo, "system"))
     # Add extra publishing text, preserving the line endings
     notes = utils.nulltostr(a["WEBSITEMEDIANOTES"])
@@ -470,6 +487,75 @@ def is_adoptable(dbo, animalid):
     rows = db.query(dbo, sql)
     return len(rows) > 0
 
+class PublishSnapshot:
+    """
+    A snapshot of the adoptable animals and their images that can be
+    shared by several publishers running in one pass. Animal data is
+    held for each distinct query the criteria produce, images are
+    retrieved from the dbfs and scaled once into a temporary folder.
+    Call cleanup when all the publishers have finished.
+    """
+    dbo = None
+    animals = None
+    images = None
+    imageDir = ""
+    lock = None
+
+    def __init__(self, dbo):
+        self.dbo = dbo
+        self.animals = {}
+        self.images = {}
+        self.imageDir = tempfile.mkdtemp()
+        self.lock = threading.RLock()
+
+    def getAnimalData(self, pc, include_additional_fields = False):
+        """
+        Returns a copy of the animal data for criteria pc, only querying
+        the first time those criteria are seen.
+        """
+        key = ( get_animal_data_query(self.dbo, pc), include_additional_fields, pc.bondedAsSingle )
+        self.lock.acquire()
+        try:
+            if not self.animals.has_key(key):
+                self.animals[key] = get_animal_data(self.dbo, pc, include_additional_fields)
+            rows = self.animals[key]
+        finally:
+            self.lock.release()
+        # Publishers change the rows they are given, so each gets its own copy
+        return [ dict(r) for r in rows ]
+
+    def getImage(self, medianame, *sizespecs):
+        """
+        Returns the path to a copy of the dbfs image medianame in the
+        snapshot folder, scaled to each of the sizespecs in turn (eg: 
+        "640x480", "70x70" for a thumbnail of the scaled image). 
+        If scaling fails, the unscaled image is used.
+        """
+        key = ( medianame, ) + sizespecs
+        self.lock.acquire()
+        try:
+            if not self.images.has_key(key):
+                path = os.path.join(self.imageDir, "%d.jpg" % len(self.images))
+                if len(sizespecs) == 0:
+                    dbfs.get_file(self.dbo, medianame, "", path)
+                else:
+                    source = self.getImage(medianame, *sizespecs[:-1])
+                    try:
+                        media.scale_image_file(source, path, sizespecs[-1])
+                    except Exception,err:
+                        al.error("failed scaling %s to %s: %s" % (medianame, sizespecs[-1], err), "publish.PublishSnapshot.getImage", self.dbo)
+                        path = source
+                self.images[key] = path
+            return self.images[key]
+        finally:
+            self.lock.release()
+
+    def cleanup(self):
+        """
+        Removes the snapshot image folder
+        """
+        shutil.rmtree(self.imageDir, True)
+
 class AbstractPublisher(threading.Thread):
     """
     Base class for all publishers
@@ -484,13 +570,22 @@ class AbstractPublisher(threading.Thread):
     locale = "en"
     lastError = ""
     logBuffer = ""
+    logLock = None
     logName = ""
+    tagsUsed = None
+    tagCache = None
+    snapshot = None # A PublishSnapshot shared with other publishers
+    matchingAnimalIds = None
 
     def __init__(self, dbo, publishCriteria):
         threading.Thread.__init__(self)
         self.dbo = dbo
         self.locale = configuration.locale(dbo)
         self.pc = publishCriteria
+        self.tagsUsed = {}
+        self.tagCache = {}
+        self.matchingAnimalIds = []
+        self.logLock = threading.Lock()
         self.makePublishDirectory()
 
     def checkMappedSpecies(self):
@@ -572,11 +667,24 @@ class AbstractPublisher(threading.Thread):
         s = s.replace("{username}", dbo.username)
         return s
 
+    def getAnimalTags(self, a, searchin):
+        """
+        Returns the tags for animal a that are used by the $$Tag$$ 
+        template searchin. Templates are only scanned once and the
+        tags that need queries are memoised for the run.
+        """
+        if not self.tagsUsed.has_key(searchin):
+            self.tagsUsed[searchin] = wordprocessor.get_tags_used(searchin, True, "$$", "$$")
+        if wordprocessor.additional_tags_needed(self.dbo, self.tagsUsed[searchin], "animal", self.tagCache):
+            # Retrieve the additional fields for all the matching animals at once
+            wordprocessor.cache_additional_tags(self.dbo, self.tagCache, self.matchingAnimalIds + [ a["ID"] ], "animal")
+        return wordprocessor.animal_tags(self.dbo, a, self.tagsUsed[searchin], self.tagCache)
+
     def replaceAnimalTags(self, a, s):
         """
         Replace any $$Tag$$ tags in s, using animal a
         """
-        tags = wordprocessor.animal_tags(self.dbo, a)
+        tags = self.getAnimalTags(a, s)
         return wordprocessor.substitute_tags(s, tags, True, "$$", "$$")
 
     def resetPublisherProgress(self):
@@ -770,7 +878,11 @@ class AbstractPublisher(threading.Thread):
         db.execute_many(self.dbo, "INSERT INTO animalpublished (AnimalID, PublishedTo, SentDate, Extra) VALUES (%s, %s, %s, %s)", batch)
 
     def getMatchingAnimals(self):
-        a = get_animal_data(self.dbo, self.pc)
+        if self.snapshot is not None:
+            a = self.snapshot.getAnimalData(self.pc)
+        else:
+            a = get_animal_data(self.dbo, self.pc)
+        self.matchingAnimalIds = [ x["ID"] for x in a ]
         self.log("Got %d matching animals for publishing." % len(a))
         return a
 
@@ -785,9 +897,13 @@ class AbstractPublisher(threading.Thread):
 
     def log(self, msg):
         """
-        Logs a message
+        Logs a message. FTP upload workers log from their own threads.
         """
-        self.logBuffer += msg + "\n"
+        self.logLock.acquire()
+        try:
+            self.logBuffer += msg + "\n"
+        finally:
+            self.logLock.release()
         al.debug(utils.truncate(msg, 1023), self.publisherName, self.dbo)
 
     def logError(self, msg, ie=None):
@@ -839,12 +955,26 @@ class AbstractPublisher(threading.Thread):
         except Exception,err:
             self.logError("Failed scaling thumbnail: %s" % err, sys.exc_info())
 
-    def scaleImage(self, image, scalesize):
+    def getImageData(self, medianame):
         """
-        Scales an image. scalesize is the scaleImage publish criteria and
-        can either be a resize spec, or it can be one of our old ASM2
-        fixed numbers.
-        image: The image file
+        Returns the contents of the dbfs image medianame, from the 
+        snapshot if there is one.
+        """
+        if self.snapshot is None:
+            return dbfs.get_string(self.dbo, medianame)
+        path = self.snapshot.getImage(medianame)
+        if not os.path.exists(path): return ""
+        f = open(path, "rb")
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def getScaleSpec(self, scalesize):
+        """
+        Returns the resize spec for scalesize, the scaleImage publish 
+        criteria. It can either be a resize spec, or it can be one of 
+        our old ASM2 fixed numbers.
         Empty string = No scaling
         1 = No scaling
         2 = 320x200
@@ -853,22 +983,256 @@ class AbstractPublisher(threading.Thread):
         5 = 1024x768
         6 = 300x300
         7 = 95x95
+        Returns an empty string for no scaling.
+        """
+        if scalesize == "" or scalesize == "1": return ""
+        elif scalesize == "2": return "320x200"
+        elif scalesize == "3": return "640x400"
+        elif scalesize == "4": return "800x600"
+        elif scalesize == "5": return "1024x768"
+        elif scalesize == "6": return "300x300"
+        elif scalesize == "7": return "95x95"
+        return scalesize
+
+    def scaleImage(self, image, scalesize):
+        """
+        Scales an image. scalesize is the scaleImage publish criteria,
+        see getScaleSpec.
+        image: The image file
         """
-        sizespec = ""
-        if scalesize == "" or scalesize == "1": return image
-        elif scalesize == "2": sizespec = "320x200"
-        elif scalesize == "3": sizespec = "640x400"
-        elif scalesize == "4": sizespec = "800x600"
-        elif scalesize == "5": sizespec = "1024x768"
-        elif scalesize == "6": sizespec = "300x300"
-        elif scalesize == "7": sizespec = "95x95"
-        else: sizespec = scalesize
+        sizespec = self.getScaleSpec(scalesize)
+        if sizespec == "": return image
         self.log("scaling %s to %s" % ( image, scalesize ))
         try:
             return media.scale_image_file(image, image, sizespec)
         except Exception,err:
             self.logError("Failed scaling image: %s" % err, sys.exc_info())
 
+class FTPUploadPool:
+    """
+    Uploads files for an FTPPublisher over a bounded pool of FTP
+    connections, so that the publisher can carry on retrieving and
+    scaling images while earlier ones are being sent.
+    A manifest of the content hash of every file uploaded is kept in 
+    the dbfs, files that are unchanged and still present on the 
+    remote server are skipped. Entries for files that have not been
+    published for FTP_UPLOAD_MANIFEST_DAYS are dropped from the manifest.
+    """
+    publisher = None
+    queue = None
+    workers = None
+    maxWorkers = FTP_UPLOAD_WORKERS
+    manifest = None
+    manifestName = ""
+    lastPublished = None
+    today = ""
+    listings = None
+    pending = None
+    lock = None
+
+    def __init__(self, publisher, maxWorkers = FTP_UPLOAD_WORKERS):
+        self.publisher = publisher
+        self.maxWorkers = maxWorkers
+        self.queue = Queue.Queue(maxWorkers * 4)
+        self.workers = []
+        self.listings = {}
+        self.pending = {}
+        self.lock = threading.RLock()
+        self.manifestName = "%s_%s.manifest" % (publisher.publisherKey, publisher.ftphost)
+        self.manifest = {}
+        self.lastPublished = {}
+        self.today = datetime.date.today().strftime("%Y-%m-%d")
+        try:
+            for l in dbfs.get_string(publisher.dbo, self.manifestName, "/publish").split("\n"):
+                fields = l.split("\t")
+                if len(fields) >= 2:
+                    path = fields[0]
+                    self.manifest[path] = fields[1]
+                    self.lastPublished[path] = len(fields) > 2 and fields[2] or self.today
+        except Exception,err:
+            publisher.log("No upload manifest %s (%s)" % (self.manifestName, err))
+
+    def remotePath(self, remotedir, filename):
+        if remotedir == "": return filename
+        return "%s/%s" % (remotedir, filename)
+
+    def put(self, filepath, remotedir):
+        """
+        Queues the local file filepath for upload to remotedir
+        (relative to the FTP root). Blocks if the queue is full.
+        """
+        self.lock.acquire()
+        try:
+            if len(self.workers) < self.maxWorkers:
+                t = threading.Thread(target=self.work)
+                t.daemon = True
+                t.start()
+                self.workers.append(t)
+            key = self.remotePath(remotedir, os.path.basename(filepath))
+            self.pending[key] = self.pending.get(key, 0) + 1
+            self.lastPublished[key] = self.today
+        finally:
+            self.lock.release()
+        self.queue.put(( filepath, remotedir ))
+
+    def wait(self):
+        """
+        Waits for all the queued uploads to finish
+        """
+        self.queue.join()
+
+    def waitFor(self, remotedir, filename):
+        """
+        Waits for the queued uploads to finish if filename is one of them,
+        so that it can be safely overwritten or deleted.
+        """
+        if self.pending.get(self.remotePath(remotedir, filename), 0) > 0:
+            self.wait()
+
+    def close(self):
+        """
+        Waits for the queued uploads, stops the workers and saves the manifest
+        """
+        self.wait()
+        for t in self.workers:
+            self.queue.put(None)
+        for t in self.workers:
+            t.join()
+        self.workers = []
+        try:
+            cutoff = (datetime.date.today() - datetime.timedelta(days = FTP_UPLOAD_MANIFEST_DAYS)).strftime("%Y-%m-%d")
+            lines = []
+            for k, v in sorted(self.manifest.iteritems()):
+                published = self.lastPublished.get(k, self.today)
+                if published >= cutoff:
+                    lines.append("%s\t%s\t%s" % (k, v, published))
+            dbfs.put_string(self.publisher.dbo, self.manifestName, "/publish", "\n".join(lines))
+        except Exception,err:
+            self.publisher.logError("Failed saving upload manifest %s: %s" % (self.manifestName, err), sys.exc_info())
+
+    def forget(self, remotedir, filename):
+        """
+        Removes a file deleted from the remote server from the manifest
+        """
+        self.lock.acquire()
+        try:
+            path = self.remotePath(remotedir, filename)
+            if self.manifest.has_key(path): del self.manifest[path]
+            if self.lastPublished.has_key(path): del self.lastPublished[path]
+            if self.listings.has_key(remotedir) and filename in self.listings[remotedir]:
+                self.listings[remotedir].remove(filename)
+        finally:
+            self.lock.release()
+
+    def connect(self, remotedir):
+        """
+        Opens a new FTP connection and changes to remotedir
+        (relative to the FTP root)
+        """
+        p = self.publisher
+        socket = ftplib.FTP(host=p.ftphost, timeout=15)
+        socket.login(p.ftpuser, p.ftppassword)
+        socket.set_pasv(p.passive)
+        if p.ftproot is not None and p.ftproot != "":
+            socket.cwd(p.ftproot)
+        if remotedir != "":
+            socket.cwd(remotedir)
+        return socket
+
+    def closeSocket(self, socket):
+        if socket is None: return
+        try:
+            socket.quit()
+        except:
+            pass
+
+    def isUnchanged(self, socket, remotedir, filename, md5):
+        """
+        Returns True if the manifest says filename was uploaded with the
+        same content and it is still on the remote server.
+        """
+        if self.publisher.pc.forceReupload: return False
+        self.lock.acquire()
+        try:
+            if self.manifest.get(self.remotePath(remotedir, filename)) != md5: return False
+            listing = self.listings.get(remotedir)
+        finally:
+            self.lock.release()
+        if listing is None:
+            # List the folder without holding the lock so that the other
+            # workers can carry on uploading
+            try:
+                listing = set(socket.nlst())
+            except ftplib.error_perm:
+                # Some servers treat listing an empty folder as an error
+                listing = set()
+            self.lock.acquire()
+            try:
+                listing = self.listings.setdefault(remotedir, listing)
+            finally:
+                self.lock.release()
+        return filename in listing
+
+    def work(self):
+        """
+        Worker thread, uploads queued files over its own connection,
+        reconnecting and retrying if an upload fails.
+        """
+        p = self.publisher
+        socket = None
+        socketdir = ""
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            filepath, remotedir = job
+            filename = os.path.basename(filepath)
+            try:
+                f = open(filepath, "rb")
+                data = f.read()
+                f.close()
+                md5 = utils.md5_hash(data)
+                for attempt in xrange(1, FTP_UPLOAD_RETRIES + 1):
+                    try:
+                        if socket is None or socketdir != remotedir:
+                            self.closeSocket(socket)
+                            socket = None
+                            socket = self.connect(remotedir)
+                            socketdir = remotedir
+                        if self.isUnchanged(socket, remotedir, filename, md5):
+                            p.log("%s: skipping, unchanged on server" % filename)
+                            break
+                        p.log("Uploading: %s" % filename)
+                        f = open(filepath, "rb")
+                        try:
+                            socket.storbinary("STOR %s" % filename, f, callback=quietcallback)
+                        finally:
+                            f.close()
+                        self.lock.acquire()
+                        try:
+                            self.manifest[self.remotePath(remotedir, filename)] = md5
+                        finally:
+                            self.lock.release()
+                        break
+                    except Exception,err:
+                        if attempt == FTP_UPLOAD_RETRIES:
+                            p.logError("Failed uploading %s: %s" % (filename, err), sys.exc_info())
+                        else:
+                            p.log("Failed uploading %s (%s), reconnecting and retrying" % (filename, err))
+                            self.closeSocket(socket)
+                            socket = None
+            except Exception,err:
+                p.logError("Failed uploading %s: %s" % (filename, err), sys.exc_info())
+            finally:
+                self.lock.acquire()
+                try:
+                    self.pending[self.remotePath(remotedir, filename)] -= 1
+                finally:
+                    self.lock.release()
+                self.queue.task_done()
+        self.closeSocket(socket)
+
 class FTPPublisher(AbstractPublisher):
     """
     Base class for publishers that rely on FTP
@@ -882,6 +1246,8 @@ class FTPPublisher(AbstractPublisher):
     currentDir = ""
     passive = True
     existingImageList = None
+    uploadPool = None
+    uploadWorkers = FTP_UPLOAD_WORKERS
 
     def __init__(self, dbo, publishCriteria, ftphost, ftpuser, ftppassword, ftpport = 21, ftproot = "", passive = True):
         AbstractPublisher.__init__(self, dbo, publishCriteria)
@@ -892,6 +1258,23 @@ class FTPPublisher(AbstractPublisher):
         self.ftproot = ftproot
         self.passive = passive
 
+    def run(self):
+        """
+        Runs the publisher. Subclasses implement publish, the upload pool 
+        is always closed afterwards (stopping its workers and saving the 
+        manifest), even if publish raises.
+        """
+        try:
+            self.publish()
+        finally:
+            self.closeUploadPool()
+
+    def publish(self):
+        """
+        Does the publishing, implemented by subclasses
+        """
+        pass
+
     def unxssPass(self, s):
         """
         Passwords stored in the config table are subject to XSS escaping, so
@@ -924,14 +1307,22 @@ class FTPPublisher(AbstractPublisher):
                 if MULTIPLE_DATABASES_PUBLISH_FTP is not None:
                     self.mkdir(self.ftproot)
                 self.chdir(self.ftproot)
+                # currentDir is relative to the root folder
+                self.currentDir = ""
 
             return True
         except Exception,err:
             self.logError("Failed opening FTP socket (%s->%s): %s" % (self.dbo.database, self.ftphost, err), sys.exc_info())
             return False
 
+    def closeUploadPool(self):
+        if self.uploadPool is not None:
+            self.uploadPool.close()
+            self.uploadPool = None
+
     def closeFTPSocket(self):
         if not self.pc.uploadDirectly: return
+        self.closeUploadPool()
         try:
             self.socket.quit()
         except:
@@ -969,6 +1360,8 @@ class FTPPublisher(AbstractPublisher):
         if filename.find(os.sep) != -1: filename = filename[filename.rfind(os.sep) + 1:]
         if not self.pc.uploadDirectly: return
         if not os.path.exists(os.path.join(self.publishDir, filename)): return
+        # Make sure any images the file refers to have been sent first
+        if self.uploadPool is not None: self.uploadPool.wait()
         self.log("Uploading: %s" % filename)
         try:
             if self.pc.checkSocket: self.checkFTPSocket()
@@ -981,6 +1374,19 @@ class FTPPublisher(AbstractPublisher):
             self.log("reconnecting FTP socket to reset state")
             self.reconnectFTPSocket()
 
+    def queueUpload(self, filename):
+        """
+        Queues a file in the publish directory for upload to the current
+        FTP directory by the pool of upload connections. 
+        Files that are unchanged since they were last uploaded are skipped.
+        """
+        if filename.find(os.sep) != -1: filename = filename[filename.rfind(os.sep) + 1:]
+        if not self.pc.uploadDirectly: return
+        if not os.path.exists(os.path.join(self.publishDir, filename)): return
+        if self.uploadPool is None: 
+            self.uploadPool = FTPUploadPool(self, self.uploadWorkers)
+        self.uploadPool.put(os.path.join(self.publishDir, filename), self.currentDir)
+
     def lsdir(self):
         if not self.pc.uploadDirectly: return []
         try:
@@ -1010,6 +1416,9 @@ class FTPPublisher(AbstractPublisher):
 
     def delete(self, filename):
         try:
+            if self.uploadPool is not None: 
+                self.uploadPool.waitFor(self.currentDir, filename)
+                self.uploadPool.forget(self.currentDir, filename)
             self.socket.delete(filename)
         except Exception,err:
             self.log("delete %s: %s" % (filename, err))
@@ -1039,7 +1448,7 @@ class FTPPublisher(AbstractPublisher):
         if not self.pc.uploadDirectly: return
         try:
             for f in self.socket.nlst("*.jpg"):
-                self.socket.delete(f)
+                self.delete(f)
         except Exception, err:
             self.logError("warning: failed deleting from FTP server: %s" % err, sys.exc_info())
 
@@ -1069,19 +1478,34 @@ class FTPPublisher(AbstractPublisher):
                     return
             imagefile = os.path.join(self.publishDir, imagename)
             thumbnail = os.path.join(self.publishDir, "tn_" + imagename)
-            dbfs.get_file(self.dbo, medianame, "", imagefile)
-            self.log("Retrieved image: %d::%s::%s" % ( a["ID"], medianame, imagename ))
-            # If scaling is on, do it
-            if self.pc.scaleImages > 1:
-                self.scaleImage(imagefile, self.pc.scaleImages)
-            # If thumbnails are on, do it
-            if self.pc.thumbnails:
-                self.generateThumbnail(imagefile, thumbnail)
+            # Don't overwrite the files while they are still waiting to upload
+            if self.uploadPool is not None: 
+                self.uploadPool.waitFor(self.currentDir, imagename)
+                self.uploadPool.waitFor(self.currentDir, "tn_" + imagename)
+            if self.snapshot is not None:
+                # Copy the image and thumbnail from the snapshot, which
+                # only retrieves and scales each image once
+                sizespecs = ()
+                if self.pc.scaleImages > 1 and self.getScaleSpec(self.pc.scaleImages) != "":
+                    sizespecs = ( self.getScaleSpec(self.pc.scaleImages), )
+                shutil.copyfile(self.snapshot.getImage(medianame, *sizespecs), imagefile)
+                self.log("Retrieved image from snapshot: %d::%s::%s" % ( a["ID"], medianame, imagename ))
+                if self.pc.thumbnails:
+                    shutil.copyfile(self.snapshot.getImage(medianame, *(sizespecs + ( self.pc.thumbnailSize, ))), thumbnail)
+            else:
+                dbfs.get_file(self.dbo, medianame, "", imagefile)
+                self.log("Retrieved image: %d::%s::%s" % ( a["ID"], medianame, imagename ))
+                # If scaling is on, do it
+                if self.pc.scaleImages > 1:
+                    self.scaleImage(imagefile, self.pc.scaleImages)
+                # If thumbnails are on, do it
+                if self.pc.thumbnails:
+                    self.generateThumbnail(imagefile, thumbnail)
             # Upload
             if self.pc.uploadDirectly:
-                self.upload(imagefile)
+                self.queueUpload(imagefile)
                 if self.pc.thumbnails:
-                    self.upload(thumbnail)
+                    self.queueUpload(thumbnail)
         except Exception, err:
             self.logError("Failed uploading image %s: %s" % (medianame, err), sys.exc_info())
             return 0
@@ -1492,7 +1916,7 @@ class AdoptAPetPublisher(FTPPublisher):
             return ""
         return "https://www.youtube.com/watch?v=%s" % watch
 
-    def run(self):
+    def publish(self):
         
         self.log("AdoptAPetPublisher starting...")
 
@@ -1873,7 +2297,7 @@ class FoundAnimalsPublisher(FTPPublisher):
         self.publisherName = "FoundAnimals Publisher"
         self.setLogName("foundanimals")
 
-    def run(self):
+    def publish(self):
         
         if self.isPublisherExecuting(): return
         self.updatePublisherProgress(0)
@@ -2033,7 +2457,7 @@ class HelpingLostPetsPublisher(FTPPublisher):
         else:
             return "\"No\""
 
-    def run(self):
+    def publish(self):
         
         if self.isPublisherExecuting(): return
         self.updatePublisherProgress(0)
@@ -2345,7 +2769,7 @@ class HTMLPublisher(FTPPublisher):
         """
         Substitutes any tags in the body for animal data
         """
-        tags = wordprocessor.animal_tags(self.dbo, a)
+        tags = self.getAnimalTags(a, searchin)
         tags["TotalAnimals"] = str(self.totalAnimals)
         tags["IMAGE"] = str(a["WEBSITEMEDIANAME"])
         # Note: WEBSITEMEDIANOTES becomes ANIMALCOMMENTS in get_animal_data when publisher_use_comments is on
@@ -2375,7 +2799,7 @@ class HTMLPublisher(FTPPublisher):
             self.upload("db.js")
             self.log("Uploaded javascript database.")
 
-    def run(self):
+    def publish(self):
         self.setLastError("")
         if self.isPublisherExecuting(): return
         self.updatePublisherProgress(0)
@@ -3163,7 +3587,7 @@ class MeetAPetPublisher(AbstractPublisher):
                 }
 
                 files = {
-                    "pet_image": ( an["WEBSITEMEDIANAME"], dbfs.get_string(self.dbo, an["WEBSITEMEDIANAME"]), "image/jpeg")
+                    "pet_image": ( an["WEBSITEMEDIANAME"], self.getImageData(an["WEBSITEMEDIANAME"]), "image/jpeg")
                 }
 
                 # Do we need to create or update this record?
@@ -3241,7 +3665,7 @@ class PetFinderPublisher(FTPPublisher):
         else:
             return "\"\""
 
-    def run(self):
+    def publish(self):
 
         self.log("PetFinderPublisher starting...")
 
@@ -3701,7 +4125,7 @@ class PetRescuePublisher(FTPPublisher):
         elif v == 1: return "No"
         else: return ""
 
-    def run(self):
+    def publish(self):
         
         self.log("PetRescuePublisher starting...")
 
@@ -4095,7 +4519,7 @@ class PetsLocatedUKPublisher(FTPPublisher):
         if speciesmap.has_key(ps): return speciesmap[ps]
         return "Cat"
 
-    def run(self):
+    def publish(self):
         
         if self.isPublisherExecuting(): return
         self.updatePublisherProgress(0)
@@ -4656,7 +5080,7 @@ class RescueGroupsPublisher(FTPPublisher):
         elif v == 1: return "No"
         else: return ""
 
-    def run(self):
+    def publish(self):
         
         self.log("RescueGroupsPublisher starting...")
 
@@ -4857,7 +5281,7 @@ class SmartTagPublisher(FTPPublisher):
         else:
             return "\"N\""
 
-    def run(self):
+    def publish(self):
         
         if self.isPublisherExecuting(): return
         self.updatePublisherProgress(0)
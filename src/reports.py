@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+import al
 import animal
 import audit
 import configuration
@@ -8,8 +9,10 @@ import db
 import dbfs
 import dbupdate
 import i18n
+import itertools
 import lookups
 import html
+import re
 import person
 import users
 import utils
@@ -18,6 +21,28 @@ from sitedefs import BASE_URL, QR_IMG_SRC, URL_REPORTS
 HEADER = 0
 FOOTER = 1
 
+# The number of rows rendered between each chunk of output when
+# streaming reports that don't have groups
+STREAM_CHUNK_ROWS = 500
+
+# Tokens substituted in report header/footer blocks that don't
+# need the report resultset
+TEMPLATE_TOKENS = ( "$$TITLE$$", "$$CATEGORY$$", "$$DATE$$", "$$TIME$$", "$$DATETIME$$", "$$VERSION$$", "$$USER$$", "$$REGISTEREDTO$$" )
+
+# Calculation keys in report header/footer blocks that are worked
+# out from the report resultset
+RESULTSET_KEYS = ( "sum", "count", "avg", "pct", "min", "max", "first", "last", "subreport" )
+
+# The maximum number of parent keys sent in one query when
+# fetching the rows for a subreport in a batch
+SUBREPORT_BATCH_SIZE = 500
+
+# Matches {SUBREPORT.title.field} tokens in a report body
+SUBREPORT_TOKEN = re.compile(r"\{(subreport\.[^}]+)\}", re.IGNORECASE)
+
+# Matches a subreport criteria of the form "expr = $PARENTKEY$"
+PARENTKEY_CRITERIA = re.compile(r"([\w\.]+)\s*=\s*\$PARENTKEY\$")
+
 DEFAULT_REPORT_HEADER = """
 <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">
 <html>
@@ -50,6 +75,42 @@ on $$DATE$$ by $$USER$$
 </html>
 """
 
+def get_parentkey_criteria(sql):
+    """
+    Returns the PARENTKEY_CRITERIA match in sql if the criteria is a
+    top level condition of the WHERE clause that is ANDed with any
+    others, so that it can be swapped for an IN clause without
+    changing the results. Returns None if there is no such criteria
+    or it is in brackets, an OR, a NOT or a JOIN ON clause.
+    """
+    m = PARENTKEY_CRITERIA.search(sql)
+    if m is None: return None
+    # Blank out quoted strings so that brackets and keywords in them are ignored
+    lsql = re.sub(r"'[^']*'", lambda x: " " * len(x.group(0)), sql.lower())
+    w = re.search(r"\bwhere\b", lsql)
+    if w is None or w.end() > m.start(): return None
+    end = len(lsql)
+    ob = re.search(r"\border\s+by\b", lsql[w.end():])
+    if ob is not None: end = w.end() + ob.start()
+    if m.end() > end: return None
+    # Blank out anything in brackets to leave the top level of the WHERE clause
+    depth = 0
+    top = []
+    for i in xrange(w.end(), end):
+        ch = lsql[i]
+        if ch == "(": depth += 1
+        if depth == 0: top.append(ch)
+        else: top.append(" ")
+        if ch == ")": depth -= 1
+        if depth < 0: return None
+    top = "".join(top)
+    start = m.start() - w.end()
+    if top[start:m.end() - w.end()] != lsql[m.start():m.end()]: return None
+    if re.search(r"\bor\b", top) is not None: return None
+    if re.search(r"(^|\band)\s*$", top[:start]) is None: return None
+    if re.match(r"\s*($|and\b)", top[m.end() - w.end():]) is None: return None
+    return m
+
 def get_all_report_titles(dbo):
     """
     Returns a list of titles for every report on the system, does not
@@ -567,6 +628,15 @@ def execute(dbo, customreportid, username = "system", params = None):
     r = Report(dbo)
     return r.Execute(customreportid, username, params)
 
+def execute_stream(dbo, customreportid, username = "system", params = None):
+    """
+    Executes a custom report by its ID as execute does, but returns a
+    generator that yields the report HTML in chunks as it is rendered
+    rather than a single string.
+    """
+    r = Report(dbo)
+    return r.ExecuteStream(customreportid, username, params)
+
 def execute_query(dbo, customreportid, username = "system", params = None):
     """
     Executes a custom report query by its ID. 'params' is a tuple of 
@@ -608,6 +678,60 @@ class GroupDescriptor:
     lastGroupStartPosition = 0
     lastGroupEndPosition = 0
 
+class ReportTemplate:
+    """
+    A report block compiled for a set of columns into a list of literal
+    text and field slots, so that it can be rendered for a row with a
+    single join instead of a replace over the block for every column.
+    """
+    # Characters that denote a field token has ended
+    VALID_END = (" ", "\n", "\r", ",", "<", ">", "&" , "[", "]", "{", "}", ".", "$", "*", ":", ";", "!", "%", "^", "(", ")", "@", "~", "/", "\\", "'", "\"", "|")
+
+    def __init__(self, text, cols):
+        """
+        Compiles text for the column names in cols. Field tokens are a 
+        $ followed by a column name (case insensitive) and one of the
+        VALID_END characters.
+        """
+        self.segments = []
+        self.fields = []
+        names = sorted(cols, key=len, reverse=True)
+        lc = text.lower()
+        start = 0
+        tok = lc.find("$")
+        while tok != -1:
+            found = None
+            for k in names:
+                aftertok = lc[tok+1+len(k):tok+1+len(k)+1]
+                if lc[tok+1:tok+1+len(k)] == k.lower() and aftertok in self.VALID_END:
+                    found = k
+                    break
+            if found is not None:
+                self.segments.append(text[start:tok])
+                self.fields.append(found)
+                start = tok + 1 + len(found)
+                tok = lc.find("$", start)
+            else:
+                tok = lc.find("$", tok+1)
+        self.segments.append(text[start:])
+
+    def render(self, row, displayvalue):
+        """
+        Returns the block with the fields substituted from row.
+        displayvalue is a function taking the fieldname and value and
+        returning the text to output. Curly braces and dollars are
+        escaped as HTML entities as they can blow up the parser after
+        substitution.
+        """
+        if len(self.fields) == 0: return self.segments[0]
+        out = []
+        for i, k in enumerate(self.fields):
+            out.append(self.segments[i])
+            v = displayvalue(k, row[k])
+            out.append(v.replace("{", "&#123;").replace("}", "&#125;").replace("$", "&#36;"))
+        out.append(self.segments[-1])
+        return "".join(out)
+
 class Report:
     dbo = None
     user = ""
@@ -622,10 +746,14 @@ class Report:
     omitCriteria = False
     omitHeaderFooter = False
     isSubReport = False
-    output = ""
+    output = []
     
     def __init__(self, dbo):
         self.dbo = dbo
+        self.presetRows = None
+        self.subreports = {}
+        self.subreportRows = {}
+        self.templates = {}
 
     def _ReadReport(self, reportId):
         """
@@ -638,7 +766,12 @@ class Report:
         # Can't do anything if the ID was invalid
         if len(rs) == 0: return
 
-        r = rs[0]
+        self._SetReport(rs[0])
+
+    def _SetReport(self, r):
+        """
+        Populates our local class variables from a customreport row
+        """
         self.title = r["TITLE"]
         self.category = r["CATEGORY"]
         self.html = r["HTMLBODY"]
@@ -647,6 +780,142 @@ class Report:
         self.omitHeaderFooter = r["OMITHEADERFOOTER"] > 0
         self.isSubReport = self.sql.find("PARENTKEY") != -1 or self.sql.find("PARENTARG") != -1
 
+    def _GetSubReport(self, title):
+        """
+        Returns the customreport row for the subreport with title, or 
+        None if it doesn't exist. Definitions are read once and shared
+        by any subreports run from this report.
+        """
+        title = title.lower()
+        if not self.subreports.has_key(title):
+            rs = db.query(self.dbo, "SELECT ID, Title, Category, HTMLBody, SQLCommand, OmitCriteria, " \
+                "OmitHeaderFooter FROM customreport WHERE LOWER(Title) LIKE %s" % db.ds(title))
+            self.subreports[title] = None
+            if len(rs) > 0: self.subreports[title] = rs[0]
+        return self.subreports[title]
+
+    def _NewSubReport(self, d):
+        """
+        Returns a new Report for the subreport definition d
+        """
+        r = Report(self.dbo)
+        r._SetReport(d)
+        r.user = self.user
+        r.subreports = self.subreports
+        return r
+
+    def _ExecuteSubReport(self, title, fieldnames, row):
+        """
+        Runs the subreport with title for a row of this report, passing
+        the values of fieldnames from row as PARENTKEY/PARENTARGX.
+        Uses the rows fetched by _PrefetchSubReports if there are some.
+        """
+        d = self._GetSubReport(title)
+        if d is None:
+            self._p("Custom report '" + title + "' doesn't exist.")
+            return None
+
+        # Create our list of parameters from the fields passed
+        # to the subreport key. They are accessed as PARENTARGX
+        # The first one is also passed as PARENTKEY for compatibility
+        # with older reports.
+        subparams = []
+        valid = True
+        for x, f in enumerate(fieldnames):
+            fieldname = f.upper()
+            fieldvalue = ""
+            if not row.has_key(fieldname):
+                self._p("Subreport field '" + f + "' doesn't exist.")
+                valid = False
+            else:
+                fieldvalue = str(row[fieldname])
+            if x == 0:
+                subparams.append(("PARENTKEY", "No question parentkey", fieldvalue, fieldvalue))
+            subparams.append(("PARENTARG%d" % (x+1), "No question parentarg", fieldvalue, fieldvalue ))
+
+        # Get the content from it
+        r = self._NewSubReport(d)
+        prefetched = self.subreportRows.get((title, tuple(fieldnames)))
+        if prefetched is not None and len(subparams) > 0:
+            r.presetRows = prefetched.get(subparams[0][2], [])
+        value = r.Execute(0, self.user, subparams)
+        if not valid: return None
+        return value
+
+    def _PrefetchSubReports(self, cbody, rs):
+        """
+        Finds the {SUBREPORT.title.field} tokens in cbody and, where the 
+        subreport's SQL selects on "expr = $PARENTKEY$", fetches the
+        subreport rows for every row in rs with IN queries instead of
+        running the subreport query once per row.
+        """
+        self.subreportRows = {}
+        for key in set(SUBREPORT_TOKEN.findall(cbody)):
+            fields = key.lower().split(".")
+            if len(fields) != 3: continue
+            d = self._GetSubReport(fields[1])
+            if d is None: continue
+            fieldname = fields[2].upper()
+            keys = []
+            seen = set()
+            for r in rs:
+                if not r.has_key(fieldname): break
+                v = str(r[fieldname])
+                if v not in seen:
+                    seen.add(v)
+                    keys.append(v)
+            rows = self._QuerySubReportRows(d, keys)
+            if rows is not None:
+                self.subreportRows[(fields[1], (fields[2],))] = rows
+
+    def _QuerySubReportRows(self, d, keys):
+        """
+        Runs the query for subreport definition d for all parent keys,
+        returning a dictionary of key: [rows]. Returns None if the
+        subreport's query cannot be safely run for a set of keys, 
+        in which case it should be run for each parent row.
+        """
+        if len(keys) == 0: return None
+        for k in keys:
+            if not k.isdigit(): return None
+        body = d["HTMLBODY"].upper()
+        if body.startswith("GRAPH") or body.startswith("MAP"): return None
+        r = self._NewSubReport(d)
+        r._SubstituteSQLParameters(None)
+        sql = r.sql
+        lsql = sql.lower()
+        # Only simple queries with a single $PARENTKEY$ criteria ANDed
+        # into the WHERE clause and no other tokens, aggregates, grouping
+        # or limits can be batched
+        m = get_parentkey_criteria(sql)
+        if m is None or sql.count("$") != 2: return None
+        if lsql.count("select") != 1 or lsql.find(" union ") != -1 or lsql.find("group by") != -1 or lsql.find(" limit ") != -1: return None
+        if re.search(r"\b(count|sum|min|max|avg)\s*\(", lsql) is not None: return None
+        ob = re.search(r"order\s+by\s+(.*)$", lsql, re.DOTALL)
+        if ob is not None:
+            for term in ob.group(1).split(","):
+                if term.strip().split(" ")[0].isdigit(): return None
+        # Add the parent key to the selected columns
+        sm = re.search(r"select\s+(distinct\s+)?(\*\s*)?", lsql)
+        if sm.group(2) is not None:
+            prefix = sql[:sm.end()] + ", %s AS ASM_PARENTKEY " % m.group(1) + sql[sm.end():m.start()]
+        else:
+            prefix = sql[:sm.end()] + "%s AS ASM_PARENTKEY, " % m.group(1) + sql[sm.end():m.start()]
+        suffix = sql[m.end():]
+        out = {}
+        try:
+            for i in xrange(0, len(keys), SUBREPORT_BATCH_SIZE):
+                batch = keys[i:i+SUBREPORT_BATCH_SIZE]
+                for row in db.query(self.dbo, "%s%s IN (%s)%s" % (prefix, m.group(1), ",".join(batch), suffix)):
+                    k = str(row["ASM_PARENTKEY"])
+                    del row["ASM_PARENTKEY"]
+                    if not out.has_key(k): out[k] = []
+                    out[k].append(row)
+        except Exception,err:
+            al.debug("could not batch subreport '%s': %s" % (d["TITLE"], err), "reports._QuerySubReportRows", self.dbo)
+            return None
+        return out
+
     def _ReadHeader(self):
         """
         Reads the report header from the DBFS. If the omitHeaderFooter
@@ -684,8 +953,16 @@ class Report:
             return s
 
     def _Append(self, s):
-        self.output += str(s)
-        return self.output
+        self.output.append(str(s))
+
+    def _Flush(self):
+        """
+        Returns everything output since the last flush and clears
+        the output buffer.
+        """
+        s = "".join(self.output)
+        self.output = []
+        return s
 
     def _p(self, s):
         self._Append("<p>%s</p>" % s)
@@ -693,27 +970,18 @@ class Report:
     def _hr(self):
         self._Append("<hr />")
 
-    def _ReplaceFields(self, s, k, v):
+    def _ReplaceFields(self, s, row):
         """
-        Replaces field tokens in HTML for real fields. 
-        Escapes curly braces and dollars for HTML entities as they can blow 
-        up the parser after substitution.
-        s is the html string, k is the fieldname, v is the value
+        Replaces field tokens in HTML for real fields from row. 
+        The HTML is compiled into a ReportTemplate the first time it
+        is seen for a set of columns.
         """
-        # Characters that denote a field token has ended
-        validend = (" ", "\n", "\r", ",", "<", ">", "&" , "[", "]", "{", "}", ".", "$", "*", ":", ";", "!", "%", "^", "(", ")", "@", "~", "/", "\\", "'", "\"", "|")
-        lc = s.lower()
-        tok = lc.find("$")
-        while tok != -1:
-            aftertok = lc[tok+1+len(k):tok+1+len(k)+1]
-            if lc[tok+1:tok+1+len(k)] == k.lower() and aftertok in validend:
-                foundtok = s[tok+1:tok+1+len(k)]
-                v = v.replace("{", "&#123;").replace("}", "&#125;")
-                v = v.replace("$", "&#36;")
-                s = s.replace("$" + foundtok + aftertok, v + aftertok)
-                lc = s.lower()
-            tok = lc.find("$", tok+1) 
-        return s
+        key = (s, tuple(sorted(row.iterkeys())))
+        t = self.templates.get(key)
+        if t is None:
+            t = ReportTemplate(s, key[1])
+            self.templates[key] = t
+        return t.render(row, self._DisplayValue)
         
     def _DisplayValue(self, k, v):
         """
@@ -755,8 +1023,7 @@ class Report:
 
         # Replace any fields in the block based on the last row
         # in the group
-        for k, v in rs[gd.lastGroupEndPosition].iteritems():
-            out = self._ReplaceFields(out, k, self._DisplayValue(k, v))
+        out = self._ReplaceFields(out, rs[gd.lastGroupEndPosition])
 
         # Replace any of our special header/footer tokens
         out = self._SubstituteTemplateHeaderFooter(out)
@@ -984,32 +1251,9 @@ class Report:
                     startkey = out.find("{", startkey+1)
                     continue
 
-                # Get custom report ID from title
-                crid = db.query_int(self.dbo, "SELECT ID FROM customreport WHERE LOWER(Title) LIKE '" + fields[1] + "'");
-                if crid == 0:
-                    self._p("Custom report '" + fields[1] + "' doesn't exist.")
-                    valid = False
-
-                # Create our list of parameters from the fields passed
-                # to the subreport key. They are accessed as PARENTARGX
-                # The first one is also passed as PARENTKEY for compatibility
-                # with older reports.
-                subparams = []
-                for x in xrange(2, len(fields)):
-                    fieldname = fields[x].upper()
-                    fieldvalue = ""
-                    if not rs[row].has_key(fieldname):
-                        self._p("Subreport field '" + fields[x] + "' doesn't exist.")
-                        valid = False
-                    else:
-                        fieldvalue = str(rs[row][fieldname])
-                    if x == 2:
-                        subparams.append(("PARENTKEY", "No question parentkey", fieldvalue, fieldvalue))
-                    subparams.append(("PARENTARG%d" % (x-1), "No question parentarg", fieldvalue, fieldvalue ))
-                    
                 # Get the content from it
-                r = Report(self.dbo)
-                value = r.Execute(crid, self.user, subparams)
+                value = self._ExecuteSubReport(fields[1], fields[2:], rs[row])
+                if value is None: valid = False
 
             # Modify our block with the token value
             if valid:
@@ -1230,10 +1474,20 @@ class Report:
         They should all be strings and will be literally replaced.
         Return value is the HTML output of the report.
         """
+        return "".join(self.ExecuteStream(reportId, username, params))
+
+    def ExecuteStream(self, reportId = 0, username = "system", params = None):
+        """
+        Executes a report as Execute does, but returns an iterator that
+        yields the HTML output of the report in chunks as it is rendered.
+        The report is read and validated, its query run and its header
+        output before this returns, so that any errors with those are
+        raised to the caller rather than from the iterator.
+        """
         self.user = username
         if reportId != 0: self._ReadReport(reportId)
         self.params = params
-        self.output = ""
+        self.output = []
 
         # Substitute our parameters in the SQL
         self._SubstituteSQLParameters(params)
@@ -1243,13 +1497,29 @@ class Report:
             raise utils.ASMValidationError("Reports must be based on a SELECT query.")
 
         if self.html.upper().startswith("GRAPH"):
-            return self._GenerateGraph()
+            self._GenerateGraph()
+            return iter([ self._Flush() ])
         elif self.html.upper().startswith("MAP"):
-            return self._GenerateMap()
-        else:
-            self._GenerateReport()
+            self._GenerateMap()
+            return iter([ self._Flush() ])
 
-        return self.output
+        # Render up to the first chunk, which is after the query 
+        # has been run and the report header output
+        chunks = self._GenerateReport()
+        try:
+            chunks.next()
+        except StopIteration:
+            pass
+        return itertools.chain([ self._Flush() ], self._FlushChunks(chunks))
+
+    def _FlushChunks(self, chunks):
+        """
+        Generator that yields the output after each chunk of the
+        report in chunks has been rendered.
+        """
+        for dummy in chunks:
+            yield self._Flush()
+        yield self._Flush()
 
     def ExecuteQuery(self, reportId = 0, username = "system", params = None):
         """
@@ -1259,7 +1529,7 @@ class Report:
         self.user = username
         if reportId != 0: self._ReadReport(reportId)
         self.params = params
-        self.output = ""
+        self.output = []
 
         # Substitute our parameters in the SQL
         self._SubstituteSQLParameters(params)
@@ -1300,7 +1570,7 @@ class Report:
         except Exception,e:
             self._p(e)
             self._Append("</body></html>")
-            return self.output
+            return "".join(self.output)
 
         # Output any criteria given at the top of the chart
         self.OutputCriteria()
@@ -1309,7 +1579,7 @@ class Report:
         if len(rs) == 0:
             self._p(i18n._("No data.", l))
             self._Append("</body></html>")
-            return self.output
+            return "".join(self.output)
 
         self._Append("""<script type="text/javascript">
             $(function() {
@@ -1382,7 +1652,7 @@ class Report:
                 self._Append("{ label: '%s', \n" % label(k))
                 self._Append("data: [%s], \n%s\n },\n" % (",".join(v), mode))
             # Remove trailing comma
-            self.output = self.output[0:len(self.output)-1]
+            if len(self.output) > 0: self.output[-1] = self.output[-1][0:-1]
             self._Append("""\n], {
                 xaxis: {
                     tickDecimals: 0 
@@ -1402,7 +1672,7 @@ class Report:
             </script>
             </body>
             </html>""")
-        return self.output
+        return "".join(self.output)
 
     def _GenerateMap(self):
         """
@@ -1420,7 +1690,7 @@ class Report:
         except Exception,e:
             self._p(e)
             self._Append("</body></html>")
-            return self.output
+            return "".join(self.output)
 
         # Output any criteria given at the top of the chart
         self.OutputCriteria()
@@ -1429,13 +1699,13 @@ class Report:
         if len(rs) == 0:
             self._p(i18n._("No data.", l))
             self._Append("</body></html>")
-            return self.output
+            return "".join(self.output)
 
         # Check we have two columns
         if len(rs[0]) != 2:
             self._p("Map query should have two columns.")
             self._Append("</body></html>")
-            return self.output
+            return "".join(self.output)
 
         self._Append('<div id="embeddedmap" style="width: 100%%; height: 600px; color: #000" />\n')
         self._Append("<script type='text/javascript'>\n" \
@@ -1455,11 +1725,13 @@ class Report:
             </script>
             </body>
             </html>""")
-        return self.output
+        return "".join(self.output)
 
     def _GenerateReport(self):
         """
-        Does the work of generating the report content
+        Does the work of generating the report content. This is a 
+        generator that yields each time a chunk of the report has been
+        appended to the output so that it can be flushed.
         """
 
         # String indexes within report html string to where 
@@ -1473,7 +1745,6 @@ class Report:
         groupstart = 0
         groupend = 0
 
-        tempbody = ""
         cheader = ""
         cbody = ""
         cfooter = ""
@@ -1583,18 +1854,35 @@ class Report:
         # Output any criteria given at the top of the report
         self.OutputCriteria()
 
-        # Run the query
+        # Run the query. If the header and footer don't use the resultset,
+        # rows are turned into dictionaries as they are rendered instead
+        # of all at once before we start (the database driver still
+        # fetches the whole resultset when the query is run).
         rs = None
+        firstrow = None
+        lastrow = None
+        streaming = not self._UsesResultset(cheader) and not self._UsesResultset(cfooter) and self.dbo.dbtype != "SQLITE" \
+            and self.presetRows is None
         try:
-            rs = db.query(self.dbo, self.sql)
+            if self.presetRows is not None:
+                rs = self.presetRows
+                if len(rs) > 0: firstrow = rs[0]
+            elif streaming:
+                rs = db.query_generator(self.dbo, self.sql)
+                try:
+                    firstrow = rs.next()
+                except StopIteration:
+                    rs = None
+            else:
+                rs = db.query(self.dbo, self.sql)
+                if len(rs) > 0: firstrow = rs[0]
         except Exception,e:
             self._p(e)
-
-        first_record = True
+            rs = None
 
         # If there are no records, show a message to say so
         # but only if it's not a subreport
-        if rs is None or len(rs) == 0:
+        if rs is None or firstrow is None:
             if not self.isSubReport:
                 if nodata == "":
                     self._p(i18n._("No data to show on the report.", l))
@@ -1605,7 +1893,80 @@ class Report:
             return
 
         # Add the header to the report
-        self._SubstituteHeaderFooter(HEADER, cheader, rs)
+        if streaming:
+            self._SubstituteHeaderFooter(HEADER, cheader, [firstrow])
+        else:
+            self._SubstituteHeaderFooter(HEADER, cheader, rs)
+        yield
+
+        # Construct our report in chunks, splitting at changes of the 
+        # outermost group so that each group is complete in its chunk
+        # and yielding after each one so the output can be sent
+        rows = rs
+        if streaming: rows = itertools.chain([firstrow], rs)
+        for chunk in self._ChunkRows(rows, groups):
+            lastrow = chunk[-1]
+            if not self._GenerateRows(chunk, groups, cbody): 
+                return
+            yield
+
+        # And the report footer
+        if streaming:
+            self._SubstituteHeaderFooter(FOOTER, cfooter, [lastrow])
+        else:
+            self._SubstituteHeaderFooter(FOOTER, cfooter, rs)
+
+        # HTML footer to finish 
+        self._Append(htmlfooter)
+
+    def _UsesResultset(self, block):
+        """
+        Returns True if a header or footer block contains field or
+        calculation tokens that need the report resultset.
+        """
+        for t in TEMPLATE_TOKENS:
+            block = block.replace(t, "")
+        if block.find("$") != -1: return True
+        startkey = block.find("{")
+        while startkey != -1:
+            if block[startkey+1:].lower().startswith(RESULTSET_KEYS): return True
+            startkey = block.find("{", startkey+1)
+        return False
+
+    def _ChunkRows(self, rows, groups):
+        """
+        Generator that splits rows into lists for rendering. If the 
+        report has groups, each list contains one value of the outermost 
+        group, otherwise each list is STREAM_CHUNK_ROWS long.
+        """
+        chunk = []
+        lastvalue = None
+        for r in rows:
+            if len(groups) > 0:
+                value = r.get(groups[0].fieldName)
+                if len(chunk) > 0 and value != lastvalue:
+                    yield chunk
+                    chunk = []
+                lastvalue = value
+            elif len(chunk) == STREAM_CHUNK_ROWS:
+                yield chunk
+                chunk = []
+            chunk.append(r)
+        if len(chunk) > 0:
+            yield chunk
+
+    def _GenerateRows(self, rs, groups, cbody):
+        """
+        Outputs the group and body blocks for the rows in rs, finishing
+        with the footers for any groups. Returns False if the rows could
+        not be output.
+        """
+        self._PrefetchSubReports(cbody, rs)
+
+        # Compile the body block for the columns in our rows
+        body = ReportTemplate(cbody, rs[0].keys())
+
+        first_record = True
 
         # Construct our report
         for row in range(0, len(rs)):
@@ -1624,7 +1985,7 @@ class Report:
                     # Check the group field exists
                     if not rs[row].has_key(gd.fieldName):
                         self._p("Cannot construct group, field '%s' does not exist" % gd.fieldName)
-                        return
+                        return False
                     if cascade or not gd.lastFieldValue == rs[row][gd.fieldName]:
                         # Mark this one for update
                         gd.forceFinish = True
@@ -1653,11 +2014,8 @@ class Report:
 
             first_record = False
 
-            # Make a temp string to hold the body block 
-            # while we substitute fields for tags
-            tempbody = cbody
-            for k, v in rs[row].iteritems():
-                tempbody = self._ReplaceFields(tempbody, k, self._DisplayValue(k, v))
+            # Render the body block with the fields for this row
+            tempbody = body.render(rs[row], self._DisplayValue)
 
             # Update the last value for each group
             for gd in groups:
@@ -1745,32 +2103,9 @@ class Report:
                         startkey = tempbody.find("{", startkey+1)
                         continue
                     
-                    # Get custom report ID from title
-                    crid = db.query_int(self.dbo, "SELECT ID FROM customreport WHERE LOWER(Title) LIKE '" + fields[1] + "'");
-                    if crid == 0:
-                        self._p("Custom report '" + fields[1] + "' doesn't exist.")
-                        valid = False
-
-                    # Create our list of parameters from the fields passed
-                    # to the subreport key. They are accessed as PARENTARGX
-                    # The first one is also passed as PARENTKEY for compatibility
-                    # with older reports.
-                    subparams = []
-                    for x in xrange(2, len(fields)):
-                        fieldname = fields[x].upper()
-                        fieldvalue = ""
-                        if not rs[row].has_key(fieldname):
-                            self._p("Subreport field '" + fields[x] + "' doesn't exist.")
-                            valid = False
-                        else:
-                            fieldvalue = str(rs[row][fieldname])
-                        if x == 2:
-                            subparams.append(("PARENTKEY", "No question parentkey", fieldvalue, fieldvalue))
-                        subparams.append(("PARENTARG%d" % (x-1), "No question parentarg", fieldvalue, fieldvalue ))
-
                     # Get the content from it
-                    r = Report(self.dbo)
-                    value = r.Execute(crid, self.user, subparams)
+                    value = self._ExecuteSubReport(fields[1], fields[2:], rs[row])
+                    if value is None: valid = False
 
                 if valid:
                     tempbody = tempbody[0:startkey] + value + tempbody[endkey+1:]
@@ -1787,9 +2122,4 @@ class Report:
             gd.lastGroupEndPosition = row
             self._OutputGroupBlock(gd, FOOTER, rs)
 
-        # And the report footer
-        self._SubstituteHeaderFooter(FOOTER, cfooter, rs)
-
-        # HTML footer to finish 
-        self._Append(htmlfooter)
-
+        return True
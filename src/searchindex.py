@@ -0,0 +1,314 @@
+#!/usr/bin/python
+
+"""
+Maintains the searchindex table, which holds the distinct trigrams
+(three character sequences) found in the words of the text that the
+simple search looks at for each searchable record.
+
+The simple find functions use it to narrow the records they need to
+look at to those containing every trigram in the search term, before
+applying their normal criteria to those records only.
+
+The record save functions, lookup renames and changes to additional
+fields keep the index current. Changes made any other way (eg: directly
+in the database) are only picked up when the index is rebuilt during 
+the daily batch, and until then the simple search can miss records
+that those changes made match.
+"""
+
+import additional
+import al
+import configuration
+import db
+import utils
+
+ANIMAL = 0
+PERSON = 1
+ANIMALCONTROL = 2
+WAITINGLIST = 3
+LOSTANIMAL = 4
+FOUNDANIMAL = 5
+LICENCE = 6
+
+# Record types that are also matched by their ID when searching for
+# a number, which the index can't help with
+ID_SEARCHABLE = ( ANIMALCONTROL, WAITINGLIST, LOSTANIMAL, FOUNDANIMAL )
+
+# The most candidates get_candidates will return. Terms common enough to
+# match more records than this are searched without the index rather
+# than with a very long IN clause.
+MAX_CANDIDATES = 1000
+
+# For each record type, a query to read the text it is searched on,
+# the qualified ID column to restrict it with and the additional
+# field link type (as for additional.clause_for_linktype) that is
+# also searched.
+DOCUMENTS = {
+    ANIMAL: ("SELECT a.ID, a.AnimalName, a.ShelterCode, a.ShortCode, a.AcceptanceNumber, a.BreedName, " \
+        "a.IdentichipNumber, a.TattooNumber, a.RabiesTag, il.LocationName, a.ShelterLocationUnit, " \
+        "a.PickupAddress, a.Markings, a.HiddenAnimalDetails, a.AnimalComments, a.ReasonNO, " \
+        "a.HealthProblems, a.PTSReason, " \
+        "oo.OwnerName AS OOName, oo.OwnerAddress AS OOAddress, oo.HomeTelephone AS OOHome, " \
+        "oo.WorkTelephone AS OOWork, oo.MobileTelephone AS OOMobile, " \
+        "co.OwnerName AS COName, co.OwnerAddress AS COAddress, co.HomeTelephone AS COHome, " \
+        "co.WorkTelephone AS COWork, co.MobileTelephone AS COMobile, " \
+        "bo.OwnerName AS BOName, bo.OwnerAddress AS BOAddress, bo.HomeTelephone AS BOHome, " \
+        "bo.WorkTelephone AS BOWork, bo.MobileTelephone AS BOMobile, " \
+        "ro.OwnerName AS ROName, ro.OwnerAddress AS ROAddress, ro.HomeTelephone AS ROHome, " \
+        "ro.WorkTelephone AS ROWork, ro.MobileTelephone AS ROMobile, " \
+        "cv.OwnerName AS CVName, cv.OwnerAddress AS CVAddress, cv.WorkTelephone AS CVWork, " \
+        "at.AnimalType, sp.SpeciesName, sx.Sex, sz.Size, bc.BaseColour, ct.CoatType " \
+        "FROM animal a " \
+        "LEFT OUTER JOIN animaltype at ON at.ID = a.AnimalTypeID " \
+        "LEFT OUTER JOIN basecolour bc ON bc.ID = a.BaseColourID " \
+        "LEFT OUTER JOIN species sp ON sp.ID = a.SpeciesID " \
+        "LEFT OUTER JOIN lksex sx ON sx.ID = a.Sex " \
+        "LEFT OUTER JOIN lksize sz ON sz.ID = a.Size " \
+        "LEFT OUTER JOIN lkcoattype ct ON ct.ID = a.CoatType " \
+        "LEFT OUTER JOIN internallocation il ON il.ID = a.ShelterLocation " \
+        "LEFT OUTER JOIN owner cv ON cv.ID = a.CurrentVetID " \
+        "LEFT OUTER JOIN owner oo ON oo.ID = a.OriginalOwnerID " \
+        "LEFT OUTER JOIN owner bo ON bo.ID = a.BroughtInByOwnerID " \
+        "LEFT OUTER JOIN adoption am ON am.ID = a.ActiveMovementID " \
+        "LEFT OUTER JOIN owner co ON co.ID = am.OwnerID " \
+        "LEFT OUTER JOIN adoption ar ON ar.AnimalID = a.ID AND ar.MovementType = 0 AND ar.MovementDate Is Null AND ar.ReservationDate Is Not Null AND ar.ReservationCancelledDate Is Null " \
+        "LEFT OUTER JOIN owner ro ON ro.ID = ar.OwnerID", "a.ID", "animal"),
+    PERSON: ("SELECT o.ID, o.OwnerName, o.OwnerCode, o.OwnerAddress, o.OwnerTown, o.OwnerCounty, " \
+        "o.OwnerPostcode, o.EmailAddress, o.HomeTelephone, o.WorkTelephone, o.MobileTelephone, " \
+        "o.MembershipNumber FROM owner o", "o.ID", "person"),
+    ANIMALCONTROL: ("SELECT ac.ID, co.OwnerName AS CallerName, ti.IncidentName, ac.DispatchAddress, " \
+        "ac.DispatchPostcode, o1.OwnerName AS Owner1Name, o2.OwnerName AS Owner2Name, " \
+        "o3.OwnerName AS Owner3Name, vo.OwnerName AS VictimName, ac.CallNotes, ac.AnimalDescription " \
+        "FROM animalcontrol ac " \
+        "LEFT OUTER JOIN owner co ON co.ID = ac.CallerID " \
+        "LEFT OUTER JOIN owner o1 ON o1.ID = ac.OwnerID " \
+        "LEFT OUTER JOIN owner o2 ON o2.ID = ac.Owner2ID " \
+        "LEFT OUTER JOIN owner o3 ON o3.ID = ac.Owner3ID " \
+        "LEFT OUTER JOIN owner vo ON vo.ID = ac.VictimID " \
+        "LEFT OUTER JOIN incidenttype ti ON ti.ID = ac.IncidentTypeID", "ac.ID", "incident"),
+    WAITINGLIST: ("SELECT a.ID, o.OwnerName, a.AnimalDescription, a.ReasonForWantingToPart, a.ReasonForRemoval " \
+        "FROM animalwaitinglist a " \
+        "LEFT OUTER JOIN owner o ON o.ID = a.OwnerID", "a.ID", "waitinglist"),
+    LOSTANIMAL: ("SELECT a.ID, o.OwnerName, a.AreaLost AS Area, a.AreaPostcode, x.Sex, b.BreedName, " \
+        "c.BaseColour, s.SpeciesName, a.AgeGroup, a.DistFeat, a.Comments " \
+        "FROM animallost a " \
+        "LEFT OUTER JOIN breed b ON a.BreedID = b.ID " \
+        "LEFT OUTER JOIN species s ON a.AnimalTypeID = s.ID " \
+        "LEFT OUTER JOIN basecolour c ON a.BaseColourID = c.ID " \
+        "LEFT OUTER JOIN lksex x ON a.Sex = x.ID " \
+        "LEFT OUTER JOIN owner o ON a.OwnerID = o.ID", "a.ID", "lostanimal"),
+    FOUNDANIMAL: ("SELECT a.ID, o.OwnerName, a.AreaFound AS Area, a.AreaPostcode, x.Sex, b.BreedName, " \
+        "c.BaseColour, s.SpeciesName, a.AgeGroup, a.DistFeat, a.Comments " \
+        "FROM animalfound a " \
+        "LEFT OUTER JOIN breed b ON a.BreedID = b.ID " \
+        "LEFT OUTER JOIN species s ON a.AnimalTypeID = s.ID " \
+        "LEFT OUTER JOIN basecolour c ON a.BaseColourID = c.ID " \
+        "LEFT OUTER JOIN lksex x ON a.Sex = x.ID " \
+        "LEFT OUTER JOIN owner o ON a.OwnerID = o.ID", "a.ID", "foundanimal"),
+    LICENCE: ("SELECT ol.ID, ol.LicenceNumber FROM ownerlicence ol", "ol.ID", "")
+}
+
+# For each lookup table whose names are part of the indexed text, the 
+# record types that show them and a query for the IDs of the records
+# using a row of the lookup (substituted with the lookup row ID)
+LOOKUPS = {
+    "animaltype": ( (ANIMAL, "SELECT ID FROM animal WHERE AnimalTypeID = %d"), ),
+    "basecolour": ( (ANIMAL, "SELECT ID FROM animal WHERE BaseColourID = %d"), 
+        (LOSTANIMAL, "SELECT ID FROM animallost WHERE BaseColourID = %d"),
+        (FOUNDANIMAL, "SELECT ID FROM animalfound WHERE BaseColourID = %d") ),
+    "breed": ( (LOSTANIMAL, "SELECT ID FROM animallost WHERE BreedID = %d"),
+        (FOUNDANIMAL, "SELECT ID FROM animalfound WHERE BreedID = %d") ),
+    "incidenttype": ( (ANIMALCONTROL, "SELECT ID FROM animalcontrol WHERE IncidentTypeID = %d"), ),
+    "internallocation": ( (ANIMAL, "SELECT ID FROM animal WHERE ShelterLocation = %d"), ),
+    "lkcoattype": ( (ANIMAL, "SELECT ID FROM animal WHERE CoatType = %d"), ),
+    "lksize": ( (ANIMAL, "SELECT ID FROM animal WHERE Size = %d"), ),
+    "species": ( (ANIMAL, "SELECT ID FROM animal WHERE SpeciesID = %d"), 
+        (LOSTANIMAL, "SELECT ID FROM animallost WHERE AnimalTypeID = %d"),
+        (FOUNDANIMAL, "SELECT ID FROM animalfound WHERE AnimalTypeID = %d") )
+}
+
+def get_trigrams(s):
+    """
+    Returns the set of distinct lower case trigrams in the words of s.
+    Non-ASCII characters are replaced with ? as they can't be lowercased
+    the same way as the database does. Apostrophes are stored as
+    backticks, the same as in the database and escaped search terms.
+    """
+    t = set()
+    if s is None: return t
+    if type(s) == str: s = s.decode("ascii", "replace")
+    elif type(s) != unicode: s = unicode(s)
+    for w in s.encode("ascii", "replace").replace("'", "`").lower().split():
+        for i in xrange(0, len(w) - 2):
+            t.add(w[i:i+3])
+    return t
+
+def is_built(dbo):
+    """
+    Returns True if the index has been built for this database
+    """
+    return configuration.search_index_updated(dbo) != ""
+
+def get_candidates(dbo, linktype, query):
+    """
+    Returns a list of IDs for records of linktype that contain every
+    trigram of every word in query. This is a superset of the records
+    that the simple search for query matches.
+    Returns None if the index can't be used for this query, because it
+    hasn't been built, the term has no words of three or more
+    characters, contains non-ASCII characters or HTML entities, is a
+    number for a record type that is also searched by ID or matches
+    more than MAX_CANDIDATES records. The caller should search without
+    the index in that case.
+    """
+    if not is_built(dbo): return None
+    if linktype in ID_SEARCHABLE and utils.is_numeric(query): return None
+    try:
+        query = str(query)
+    except UnicodeEncodeError:
+        return None
+    if utils.decode_html(query) != query: return None
+    trigrams = get_trigrams(query)
+    if len(trigrams) == 0: return None
+    rows = db.query(dbo, "SELECT LinkID FROM searchindex WHERE LinkType = %d AND Trigram IN (%s) " \
+        "GROUP BY LinkID HAVING COUNT(*) = %d LIMIT %d" % (linktype, ",".join([ "'%s'" % db.escape(x) for x in sorted(trigrams) ]),
+        len(trigrams), MAX_CANDIDATES + 1))
+    if len(rows) > MAX_CANDIDATES: return None
+    return [ r["LINKID"] for r in rows ]
+
+def get_documents(dbo, linktype, where):
+    """
+    Returns a dictionary of record ID: set of trigrams for records of
+    linktype matching the where clause given. {0} in the where clause 
+    is replaced with the ID column.
+    """
+    sql, idcol, addin = DOCUMENTS[linktype]
+    docs = {}
+    for r in db.query(dbo, "%s WHERE %s" % (sql, where.format(idcol))):
+        if not docs.has_key(r["ID"]): docs[r["ID"]] = set()
+        for k, v in r.iteritems():
+            if k != "ID": docs[r["ID"]] |= get_trigrams(v)
+    if addin != "" and len(docs) > 0:
+        for r in db.query(dbo, "SELECT ad.LinkID, ad.Value FROM additional ad " \
+            "INNER JOIN additionalfield af ON af.ID = ad.AdditionalFieldID AND af.Searchable = 1 " \
+            "WHERE ad.LinkType IN (%s) AND %s" % (additional.clause_for_linktype(addin), where.format("ad.LinkID"))):
+            if docs.has_key(r["LINKID"]): docs[r["LINKID"]] |= get_trigrams(r["VALUE"])
+    return docs
+
+def write_documents(dbo, linktype, docs, where):
+    """
+    Brings the index entries for records of linktype matching the where
+    clause ({0} is replaced with the LinkID column) in line with docs
+    (as returned by get_documents for the same where clause).
+    Only missing trigrams are added and stale ones removed, so searches
+    never see a partly written entry for a record.
+    """
+    existing = {}
+    for r in db.query(dbo, "SELECT LinkID, Trigram FROM searchindex WHERE LinkType = %d AND %s" % (linktype, where.format("LinkID"))):
+        if not existing.has_key(r["LINKID"]): existing[r["LINKID"]] = set()
+        # Backticks are turned back into apostrophes when read
+        existing[r["LINKID"]].add(r["TRIGRAM"].replace("'", "`"))
+    missing = []
+    stale = []
+    for linkid, trigrams in docs.iteritems():
+        for t in trigrams - existing.get(linkid, set()):
+            missing.append(( linktype, linkid, t ))
+    for linkid, trigrams in existing.iteritems():
+        for t in trigrams - docs.get(linkid, set()):
+            stale.append(( linktype, linkid, t ))
+    db.execute_many(dbo, "INSERT INTO searchindex (LinkType, LinkID, Trigram) VALUES (%s, %s, %s)", missing)
+    db.execute_many(dbo, "DELETE FROM searchindex WHERE LinkType = %s AND LinkID = %s AND Trigram = %s", stale)
+
+def update(dbo, linktype, linkids):
+    """
+    Updates the index for one or a list of record IDs of linktype.
+    Should be called after a searchable record or its additional fields
+    have been saved. Errors are logged rather than raised so that a
+    problem with the index never stops a record being saved.
+    """
+    if type(linkids) != list: linkids = [ linkids ]
+    linkids = [ int(x) for x in linkids if x is not None and int(x) > 0 ]
+    if len(linkids) == 0: return
+    try:
+        where = "{0} IN (%s)" % ",".join([ str(x) for x in linkids ])
+        write_documents(dbo, linktype, get_documents(dbo, linktype, where), where)
+    except Exception,err:
+        al.error("failed updating search index for %d %s: %s" % (linktype, linkids, err), "searchindex.update", dbo)
+
+def update_animals_for_person(dbo, personid):
+    """
+    Updates the index for the animals whose documents include details
+    of person personid (original owner, brought in by, current vet or
+    the current/reserving owner).
+    """
+    rows = db.query(dbo, "SELECT ID FROM animal WHERE OriginalOwnerID = %d OR BroughtInByOwnerID = %d OR CurrentVetID = %d " \
+        "UNION SELECT AnimalID AS ID FROM adoption WHERE OwnerID = %d AND ReturnDate Is Null" % (personid, personid, personid, personid))
+    if len(rows) > 0: update(dbo, ANIMAL, [ r["ID"] for r in rows ])
+
+def update_links(dbo, links, chunksize = 1000):
+    """
+    Updates the index for a dictionary of linktype: list of record IDs
+    (as returned by get_field_links and get_lookup_links), chunksize
+    records at a time.
+    """
+    for linktype, linkids in links.iteritems():
+        for i in xrange(0, len(linkids), chunksize):
+            update(dbo, linktype, linkids[i:i+chunksize])
+
+def get_field_links(dbo, fieldid):
+    """
+    Returns a dictionary of linktype: list of record IDs for the 
+    records holding a value for additional field fieldid.
+    """
+    links = {}
+    for linktype, (sql, idcol, addin) in DOCUMENTS.iteritems():
+        if addin == "": continue
+        rows = db.query(dbo, "SELECT DISTINCT LinkID FROM additional WHERE AdditionalFieldID = %d AND LinkType IN (%s)" % \
+            (fieldid, additional.clause_for_linktype(addin)))
+        if len(rows) > 0: links[linktype] = [ r["LINKID"] for r in rows ]
+    return links
+
+def get_lookup_links(dbo, lookup, iid):
+    """
+    Returns a dictionary of linktype: list of record IDs for the 
+    records showing the name of row iid of lookup table lookup.
+    """
+    links = {}
+    for linktype, sql in LOOKUPS.get(lookup, ()):
+        rows = db.query(dbo, sql % int(iid))
+        if len(rows) > 0: links[linktype] = links.get(linktype, []) + [ r["ID"] for r in rows ]
+    return links
+
+def delete(dbo, linktype, linkids):
+    """
+    Removes the index entries for one or a list of record IDs
+    """
+    if type(linkids) != list: linkids = [ linkids ]
+    if len(linkids) == 0: return
+    db.execute(dbo, "DELETE FROM searchindex WHERE LinkType = %d AND LinkID IN (%s)" % (linktype, ",".join([ str(int(x)) for x in linkids ])))
+
+def rebuild(dbo, chunksize = 1000):
+    """
+    Rebuilds the whole index. Records are read in ID order, chunksize
+    at a time, and the entries for each chunk are brought up to date
+    in place so that searches can carry on using the index while it
+    is being rebuilt.
+    """
+    for linktype, (sql, idcol, addin) in DOCUMENTS.iteritems():
+        table = sql[sql.find(" FROM ")+6:].split(" ")[0]
+        lastid = 0
+        total = 0
+        while True:
+            ids = db.query(dbo, "SELECT ID FROM %s WHERE ID > %d ORDER BY ID LIMIT %d" % (table, lastid, chunksize))
+            if len(ids) == 0: break
+            # The first chunk also covers entries for deleted records before it
+            where = "{0} > %d AND {0} <= %d" % (lastid, ids[-1]["ID"])
+            lastid = ids[-1]["ID"]
+            docs = get_documents(dbo, linktype, where)
+            write_documents(dbo, linktype, docs, where)
+            total += len(docs)
+            if len(ids) < chunksize: break
+        # Remove entries for deleted records after the last one
+        db.execute(dbo, "DELETE FROM searchindex WHERE LinkType = %d AND LinkID > %d" % (linktype, lastid))
+        al.debug("indexed %d %s records" % (total, table), "searchindex.rebuild", dbo)
+    configuration.set_search_index_updated(dbo)
@@ -72,6 +72,23 @@ DB_TIME_LOG_OVER = 0
 # Time out queries that take longer than this (ms) to run
 DB_TIMEOUT = 0
 
+# Connection pooling. Connections to each database are kept open
+# and reused between queries instead of connecting for every query.
+# DB_POOL_MIN_SIZE connections are opened when the pool is first used and
+# up to DB_POOL_MAX_SIZE idle connections are kept open for each database
+# (if all are busy, extra connections are opened and closed after use).
+# No more than DB_POOL_MAX_TOTAL idle connections are kept open across
+# all databases (eg: with MULTIPLE_DATABASES) and connections that are 
+# idle for more than DB_POOL_MAX_IDLE seconds are closed.
+# Connections idle for more than DB_POOL_CHECK_AFTER seconds are
+# checked before they are reused. Set DB_POOL_MAX_SIZE to 0 to disable
+# pooling (SQLite databases are never pooled).
+DB_POOL_MIN_SIZE = 0
+DB_POOL_MAX_SIZE = 2
+DB_POOL_MAX_TOTAL = 20
+DB_POOL_MAX_IDLE = 120
+DB_POOL_CHECK_AFTER = 30
+
 # URLs for ASM services
 URL_NEWS = "http://sheltermanager.com/repo/asm_news.html"
 URL_REPORTS = "http://sheltermanager.com/repo/reports.txt"
@@ -104,6 +121,35 @@ DISK_CACHE = "/tmp/asm_disk_cache"
 # These queries include shelterview animals and main screen links) 
 CACHE_COMMON_QUERIES = False
 
+# Keep a snapshot of each database's configuration table in memory so
+# that reading a configuration item is a dictionary lookup instead of a
+# query. Snapshots are reloaded after any configuration change (shared
+# between processes if memcached is used) or when they are older than
+# this many seconds. Set to 0 to query the database for every item.
+CACHE_CONFIGURATION = 60
+
+# Keep the rows of each lookup table (species, breeds, locations, etc)
+# in memory rather than querying them every time a screen needs them.
+# They are reloaded after a change to a lookup (shared between processes 
+# if memcached is used) or when they are older than this many seconds.
+# Set to 0 to query the database every time.
+CACHE_LOOKUPS = 300
+
+# How often (in seconds) the configuration and lookup snapshots above
+# check whether another process has changed them. Changes made in this
+# process are always seen straight away.
+CACHE_VERSION_CHECK = 5
+
+# Keep thumbnails and other scaled images in the disk cache for
+# this many seconds, rather than scaling the full image from the 
+# database for every request. Set to 0 to disable.
+CACHE_SCALED_IMAGES = 604800
+
+# Remember a successful username/password check for this many seconds
+# so that repeated service calls from the same account do not have to
+# hash the password every time. Set to 0 to check every time.
+CACHE_VERIFIED_CREDENTIALS = 300
+
 # Cache service call responses on the server side according
 # to their max-age headers in the disk cache
 CACHE_SERVICE_RESPONSES = False
@@ -178,6 +224,18 @@ BULK_GEO_LOOKUP_TIMEOUT = 10
 # (nominatim has a no more than 1 request/s limit)
 BULK_GEO_SLEEP_AFTER = 1
 
+# Number of worker threads making server side geocode requests. They
+# share a rate limit of one request per BULK_GEO_SLEEP_AFTER seconds
+BULK_GEO_WORKERS = 2
+
+# The maximum number of people with blank geocodes the daily batch
+# will try to complete per run
+BULK_GEO_BATCH_LIMIT = 1000
+
+# Addresses the geocoding provider could not find are not looked
+# up again until this many days have passed
+BULK_GEO_NOT_FOUND_DAYS = 30
+
 # Enable the database field on login and allow login to multiple databases
 MULTIPLE_DATABASES = False
 MULTIPLE_DATABASES_TYPE = "map"
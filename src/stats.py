@@ -0,0 +1,218 @@
+#!/usr/bin/python
+
+"""
+    Module for the daily statistics shown on the main screen.
+
+    The dailystats table holds one row for each day that something
+    happened, with the number of animals entered, adopted, reclaimed,
+    transferred, put to sleep and died that day and the total of the
+    donations received and costs incurred. The figures for any period
+    are a sum of the rows for the days in it.
+
+    Functions that change the records counted call get_days before
+    and after the change and pass the days to update_days. The daily
+    batch checks the table against the records and rebuilds it if
+    they differ or it hasn't been built yet.
+"""
+
+import al
+import configuration
+import datetime
+import db
+import movement
+
+# The dailystats figures, in the order they are held in lists
+COLUMNS = ( "Entered", "Adopted", "Reclaimed", "Transferred", "PTS", "Died", "Donations", "Costs" )
+
+# Each source for a figure: the figure it adds to, the table and date column
+# it comes from, the column to total (None to count rows) and a filter.
+# Movement types are substituted when the filter is used.
+SOURCES = (
+    ( "Entered", "animal", "DateBroughtIn", None, "NonShelterAnimal = 0" ),
+    ( "Adopted", "adoption", "MovementDate", None, "MovementType = %(adoption)d" ),
+    ( "Reclaimed", "adoption", "MovementDate", None, "MovementType = %(reclaimed)d" ),
+    ( "Transferred", "adoption", "MovementDate", None, "MovementType = %(transfer)d" ),
+    ( "PTS", "animal", "DeceasedDate", None, "NonShelterAnimal = 0 AND PutToSleep = 1" ),
+    ( "Died", "animal", "DeceasedDate", None, "NonShelterAnimal = 0 AND PutToSleep = 0" ),
+    ( "Donations", "ownerdonation", "Date", "Donation", "" ),
+    ( "Costs", "animalcost", "CostDate", "CostAmount", "" ),
+    ( "Costs", "animalvaccination", "DateOfVaccination", "Cost", "" ),
+    ( "Costs", "animaltest", "DateOfTest", "Cost", "" ),
+    ( "Costs", "animalmedical", "StartDate", "Cost", "" ),
+    ( "Costs", "animaltransport", "PickupDateTime", "Cost", "" )
+)
+
+def daily_stats_built(dbo):
+    """
+    Returns True if the dailystats table has been built
+    """
+    return configuration.daily_stats_updated(dbo) != ""
+
+def _day(d):
+    """ Returns midnight on the day of python date d """
+    return datetime.datetime(d.year, d.month, d.day)
+
+def _calculate(dbo, fromdate = None, todate = None, columns = COLUMNS):
+    """
+    Calculates the figures in columns from the records dated from fromdate
+    up to todate (all records if they aren't given).
+    Returns a dict of day: [ figures in COLUMNS order ]
+    """
+    mtypes = { "adoption": movement.ADOPTION, "reclaimed": movement.RECLAIMED, "transfer": movement.TRANSFER }
+    days = {}
+    for column, table, datecol, totalcol, where in SOURCES:
+        if column not in columns: continue
+        clauses = [ "%s Is Not Null" % datecol ]
+        if where != "": clauses.append(where % mtypes)
+        if fromdate is not None: clauses.append("%s >= %s" % (datecol, db.dd(fromdate)))
+        if todate is not None: clauses.append("%s < %s" % (datecol, db.dd(todate)))
+        i = COLUMNS.index(column)
+        rows = db.query_tuple(dbo, "SELECT %s, %s FROM %s WHERE %s" % (datecol, totalcol or "1", table, " AND ".join(clauses)))
+        for d, v in rows:
+            figures = days.setdefault(_day(d), [0] * len(COLUMNS))
+            figures[i] += int(v or 0)
+    return days
+
+def get_days(dbo, table, where):
+    """
+    Returns the set of (table, day) that the rows in table matching
+    where count towards. Call before and after changing rows and 
+    pass the result to update_days.
+    """
+    if not daily_stats_built(dbo): return set()
+    datecols = []
+    for column, t, datecol, totalcol, w in SOURCES:
+        if t == table and datecol not in datecols: datecols.append(datecol)
+    if len(datecols) == 0: return set()
+    days = set()
+    for row in db.query_tuple(dbo, "SELECT %s FROM %s WHERE %s" % (", ".join(datecols), table, where)):
+        for d in row:
+            if d is not None: days.add((table, _day(d)))
+    return days
+
+def get_animal_days(dbo, animalid):
+    """
+    Returns the set of (table, day) that an animal and the records
+    linked to it count towards, for update_days.
+    """
+    days = get_days(dbo, "animal", "ID = %d" % int(animalid))
+    for table in ( "adoption", "ownerdonation", "animalcost", "animalvaccination", "animaltest", "animalmedical", "animaltransport" ):
+        days |= get_days(dbo, table, "AnimalID = %d" % int(animalid))
+    return days
+
+def update_days(dbo, days):
+    """
+    Recalculates the dailystats figures for a set of (table, day)
+    from get_days, only the figures that the tables count towards
+    are recalculated.
+    Errors are logged rather than raised so that a problem with
+    the stats never stops a record being saved. Instead, the table
+    is marked as not built so that the stats are calculated from the
+    records until the daily check rebuilds it.
+    """
+    if len(days) == 0 or not daily_stats_built(dbo): return
+    tables = {}
+    for table, day in days:
+        tables.setdefault(day, set()).add(table)
+    try:
+        for day, daytables in tables.iteritems():
+            columns = [ x[0] for x in SOURCES if x[1] in daytables ]
+            figures = _calculate(dbo, day, day + datetime.timedelta(days = 1), columns).get(day, [0] * len(COLUMNS))
+            _write_day(dbo, day, figures, columns)
+    except Exception,err:
+        al.error("failed updating daily stats for %s: %s" % (days, err), "stats.update_days", dbo)
+        configuration.set_daily_stats_updated(dbo, False)
+
+def _write_day(dbo, day, figures, columns):
+    """
+    Stores the figures in columns for day, updating the existing row
+    if there is one. The other figures in an existing row are left alone.
+    """
+    values = [ figures[COLUMNS.index(x)] for x in COLUMNS if x in columns ]
+    updatesql = "UPDATE dailystats SET %s WHERE StatDate = %%s" % ", ".join([ "%s = %%s" % x for x in COLUMNS if x in columns ])
+    if db.query_int(dbo, "SELECT COUNT(*) FROM dailystats WHERE StatDate = %s" % db.dd(day)) > 0:
+        db.execute_many(dbo, updatesql, [ values + [ day ] ])
+    elif figures != [0] * len(COLUMNS):
+        try:
+            db.execute_many(dbo, "INSERT INTO dailystats (StatDate, %s) VALUES (%%s, %s)" % (", ".join(COLUMNS), ", ".join([ "%s" ] * len(COLUMNS))),
+                [ [ day ] + figures ])
+        except:
+            # Another update inserted the day since we looked
+            db.execute_many(dbo, updatesql, [ values + [ day ] ])
+
+def get_totals(dbo, fromdate):
+    """
+    Returns the totals of each figure from python date fromdate onwards
+    as a single row, with the column names in upper case.
+    """
+    rows = db.query_tuple(dbo, "SELECT %s FROM dailystats WHERE StatDate >= %s" % \
+        (", ".join([ "SUM(%s)" % x for x in COLUMNS ]), db.dd(fromdate)))
+    totals = {}
+    for i, column in enumerate(COLUMNS):
+        totals[column.upper()] = int(rows[0][i] or 0)
+    return [ totals ]
+
+def calculate_daily_stats(dbo):
+    """
+    Calculates the dailystats table from the records,
+    returning a dict of day: [ figures in COLUMNS order ]
+    """
+    return _calculate(dbo)
+
+def check_daily_stats(dbo, rebuild = True):
+    """
+    Compares the dailystats table with the records and logs any
+    differences. Returns the number of days that are wrong.
+    rebuild: Rebuild the table if it is wrong or hasn't been built yet
+    """
+    if not daily_stats_built(dbo):
+        if rebuild: rebuild_daily_stats(dbo)
+        return 0
+    wrong = _wrong_days(dbo, calculate_daily_stats(dbo))
+    if len(wrong) > 0 and rebuild:
+        _correct_days(dbo, wrong)
+    return len(wrong)
+
+def _wrong_days(dbo, expected):
+    """
+    Compares the dailystats table with the expected figures from
+    calculate_daily_stats, logging and returning the days that differ.
+    """
+    actual = {}
+    for row in db.query_tuple(dbo, "SELECT StatDate, %s FROM dailystats" % ", ".join(COLUMNS)):
+        actual[_day(row[0])] = [ int(x) for x in row[1:] ]
+    wrong = []
+    for day in set(expected.keys()) | set(actual.keys()):
+        e = expected.get(day, [0] * len(COLUMNS))
+        a = actual.get(day, [0] * len(COLUMNS))
+        if e != a:
+            wrong.append(day)
+            al.error("day %s: stats have %s, records have %s" % (day, a, e), "stats._wrong_days", dbo)
+    return wrong
+
+def _correct_days(dbo, days):
+    """
+    Recalculates every figure for days from the records. The table is
+    corrected in place, so changes saved while we do it still update it.
+    """
+    tables = set([ x[1] for x in SOURCES ])
+    update_days(dbo, set([ (t, d) for t in tables for d in days ]))
+
+def rebuild_daily_stats(dbo):
+    """
+    Rebuilds the dailystats table. The first time, the stats are 
+    calculated from the records while it is being built. After that, 
+    only the days that are wrong are corrected and the table stays 
+    in use, so changes saved during the rebuild are not lost.
+    """
+    if daily_stats_built(dbo):
+        wrong = _wrong_days(dbo, calculate_daily_stats(dbo))
+        _correct_days(dbo, wrong)
+        al.debug("rebuilt %d days of stats" % len(wrong), "stats.rebuild_daily_stats", dbo)
+        return
+    days = calculate_daily_stats(dbo)
+    db.execute(dbo, "DELETE FROM dailystats")
+    db.execute_many(dbo, "INSERT INTO dailystats (StatDate, %s) VALUES (%%s, %s)" % (", ".join(COLUMNS), ", ".join([ "%s" ] * len(COLUMNS))),
+        [ [ day ] + figures for day, figures in days.iteritems() ])
+    configuration.set_daily_stats_updated(dbo)
+    al.debug("built %d days of stats" % len(days), "stats.rebuild_daily_stats", dbo)
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+import alerts
 import audit
 import db
 import utils
@@ -105,6 +106,7 @@ def update_stocklevel_from_form(dbo, post, username):
         ( "Cost", post.db_integer("cost") ),
         ( "UnitPrice", post.db_integer("unitprice") )
     )))
+    alerts.invalidate(dbo, "stocklevel")
     postaudit = db.query(dbo, "SELECT * FROM stocklevel WHERE ID = %d" % slid)
     diff = postaudit[0]["BALANCE"] - preaudit[0]["BALANCE"]
     if diff != 0: insert_stockusage(dbo, username, slid, diff, post.date("usagedate"), post.integer("usagetype"), post["comments"])
@@ -138,6 +140,7 @@ def insert_stocklevel_from_form(dbo, post, username):
         ( "UnitPrice", post.db_integer("unitprice") ),
         ( "CreatedDate", db.todaysql() )
     )))
+    alerts.invalidate(dbo, "stocklevel")
     insert_stockusage(dbo, username, slid, post.floating("balance"), post.date("usagedate"), post.integer("usagetype"), post["comments"])
     audit.create(dbo, username, "stocklevel", nid, audit.dump_row(dbo, "stocklevel", nid))
     return nid
@@ -149,6 +152,7 @@ def delete_stocklevel(dbo, username, slid):
     audit.delete(dbo, username, "stocklevel", slid, audit.dump_row(dbo, "stocklevel", slid))
     db.execute(dbo, "DELETE FROM stockusage WHERE StockLevelID = %d" % slid)
     db.execute(dbo, "DELETE FROM stocklevel WHERE ID = %d" % slid)
+    alerts.invalidate(dbo, "stocklevel")
 
 def insert_stockusage(dbo, username, slid, diff, usagedate, usagetype, comments):
     """
@@ -179,6 +183,7 @@ def deduct_stocklevel_from_form(dbo, username, post):
     curq = db.query_float(dbo, "SELECT Balance FROM stocklevel WHERE ID = %d" % item)
     newq = curq - quantity
     db.execute(dbo, "UPDATE stocklevel SET Balance = %f WHERE ID = %d" % (newq, item))
+    alerts.invalidate(dbo, "stocklevel")
     insert_stockusage(dbo, username, item, quantity, usagedate, usagetype, comments)
 
 def stock_take_from_mobile_form(dbo, username, post):
@@ -187,6 +192,7 @@ def stock_take_from_mobile_form(dbo, username, post):
     """
     if post.integer("usagetype") == 0:
         raise utils.ASMValidationError("No usage type passed")
+    changed = False
     for k in post.data.iterkeys():
         if k.startswith("sl"):
             slid = utils.cint(k.replace("sl", ""))
@@ -197,6 +203,8 @@ def stock_take_from_mobile_form(dbo, username, post):
             if slb == sln: continue
             # Update the level
             db.execute(dbo, "UPDATE stocklevel SET Balance = %f WHERE ID = %d" % ( sln, slid ))
+            changed = True
             # Write a stock usage record for the difference
             insert_stockusage(dbo, username, slid, sln - slb, now(dbo.timezone), post.integer("usagetype"), "")
+    if changed: alerts.invalidate(dbo, "stocklevel")
 
@@ -0,0 +1,329 @@
+#!/usr/bin/python
+
+"""
+    Module for the shelter timeline of recent events.
+
+    The events are stored in the timeline table, one row for each
+    event with the record it links to. Functions that change the
+    records an event comes from call update with the record IDs and
+    the tables they wrote to, and the events for those records are
+    recalculated so that changed or deleted records don't leave
+    stale events behind. The timeline is then a single range read
+    on the event date. The daily batch builds the table the first 
+    time to backfill it, after that it checks the table against the
+    records and corrects the events changed outside of the normal
+    screens (lookup renames, batch updates). The maint_timeline cron 
+    mode rebuilds it.
+"""
+
+import al
+import configuration
+import datetime
+import db
+import sys
+from i18n import now
+
+# The kinds of record that events link to
+ANIMAL = "animal"
+INCIDENT = "incident"
+LOST = "lost"
+FOUND = "found"
+WAITINGLIST = "waitinglist"
+
+# Each event: the kind of record it links to, its category, the tables it is
+# calculated from, the event date and record ID columns and the query for it
+EVENTS = (
+    ( ANIMAL, "ENTERED", ( "animal", ), "DateBroughtIn", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'ENTERED' AS Category, DateBroughtIn AS EventDate, ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
+        "WHERE NonShelterAnimal = 0" ),
+    ( ANIMAL, "MICROCHIP", ( "animal", ), "IdentichipDate", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'MICROCHIP' AS Category, IdentichipDate AS EventDate, ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
+        "WHERE NonShelterAnimal = 0 AND IdentichipDate Is Not Null" ),
+    ( ANIMAL, "NEUTERED", ( "animal", ), "NeuteredDate", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'NEUTERED' AS Category, NeuteredDate AS EventDate, ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
+        "WHERE NonShelterAnimal = 0 AND NeuteredDate Is Not Null" ),
+    ( ANIMAL, "RESERVED", ( "animal", "adoption", "owner" ), "ReservationDate", "animal.ID",
+        "SELECT 'animal_movements' AS LinkTarget, 'RESERVED' AS Category, ReservationDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
+        "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
+        "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
+        "WHERE NonShelterAnimal = 0 AND MovementDate Is Null AND ReservationDate Is Not Null" ),
+    ( ANIMAL, "ADOPTED", ( "animal", "adoption", "owner" ), "MovementDate", "animal.ID",
+        "SELECT 'animal_movements' AS LinkTarget, 'ADOPTED' AS Category, MovementDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
+        "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
+        "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
+        "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 1" ),
+    ( ANIMAL, "FOSTERED", ( "animal", "adoption", "owner" ), "MovementDate", "animal.ID",
+        "SELECT 'animal_movements' AS LinkTarget, 'FOSTERED' AS Category, MovementDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
+        "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
+        "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
+        "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 2" ),
+    ( ANIMAL, "TRANSFER", ( "animal", "adoption", "owner" ), "MovementDate", "animal.ID",
+        "SELECT 'animal_movements' AS LinkTarget, 'TRANSFER' AS Category, MovementDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
+        "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
+        "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
+        "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 3" ),
+    ( ANIMAL, "ESCAPED", ( "animal", "adoption" ), "MovementDate", "animal.ID",
+        "SELECT 'animal_movements' AS LinkTarget, 'ESCAPED' AS Category, MovementDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, adoption.LastChangedBy FROM animal " \
+        "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
+        "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 4" ),
+    ( ANIMAL, "RECLAIMED", ( "animal", "adoption", "owner" ), "MovementDate", "animal.ID",
+        "SELECT 'animal_movements' AS LinkTarget, 'RECLAIMED' AS Category, MovementDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
+        "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
+        "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
+        "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 5" ),
+    ( ANIMAL, "STOLEN", ( "animal", "adoption" ), "MovementDate", "animal.ID",
+        "SELECT 'animal_movements' AS LinkTarget, 'STOLEN' AS Category, MovementDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, adoption.LastChangedBy FROM animal " \
+        "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
+        "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 6" ),
+    ( ANIMAL, "RELEASED", ( "animal", "adoption" ), "MovementDate", "animal.ID",
+        "SELECT 'animal_movements' AS LinkTarget, 'RELEASED' AS Category, MovementDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, adoption.LastChangedBy FROM animal " \
+        "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
+        "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 7" ),
+    ( ANIMAL, "RETAILER", ( "animal", "adoption", "owner" ), "MovementDate", "animal.ID",
+        "SELECT 'animal_movements' AS LinkTarget, 'RETAILER' AS Category, MovementDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
+        "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
+        "INNER JOIN owner ON adoption.OwnerID = owner.ID " \
+        "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND MovementType = 8" ),
+    ( ANIMAL, "RETURNED", ( "animal", "adoption", "owner" ), "ReturnDate", "animal.ID",
+        "SELECT 'animal_movements' AS LinkTarget, 'RETURNED' AS Category, ReturnDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, owner.OwnerName AS Text3, adoption.LastChangedBy FROM animal " \
+        "INNER JOIN adoption ON adoption.AnimalID = animal.ID " \
+        "LEFT OUTER JOIN owner ON adoption.OwnerID = owner.ID " \
+        "WHERE NonShelterAnimal = 0 AND MovementDate Is Not Null AND ReturnDate Is Not Null" ),
+    ( ANIMAL, "DIED", ( "animal", ), "DeceasedDate", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'DIED' AS Category, DeceasedDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, ReasonName AS Text3, animal.LastChangedBy FROM animal " \
+        "INNER JOIN deathreason ON animal.PTSReasonID = deathreason.ID " \
+        "WHERE NonShelterAnimal = 0 AND DiedOffShelter = 0 AND PutToSleep = 0 AND DeceasedDate Is Not Null" ),
+    ( ANIMAL, "EUTHANISED", ( "animal", ), "DeceasedDate", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'EUTHANISED' AS Category, DeceasedDate AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, ReasonName AS Text3, animal.LastChangedBy FROM animal " \
+        "INNER JOIN deathreason ON animal.PTSReasonID = deathreason.ID " \
+        "WHERE NonShelterAnimal = 0 AND DiedOffShelter = 0 AND PutToSleep = 1 AND DeceasedDate Is Not Null" ),
+    ( ANIMAL, "FIVP", ( "animal", ), "CombiTestDate", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'FIVP' AS Category, CombiTestDate AS EventDate, ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
+        "WHERE NonShelterAnimal = 0 AND CombiTested = 1 AND CombiTestDate Is Not Null AND CombiTestResult = 2" ),
+    ( ANIMAL, "FLVP", ( "animal", ), "CombiTestDate", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'FLVP' AS Category, CombiTestDate AS EventDate, ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
+        "WHERE NonShelterAnimal = 0 AND CombiTested = 1 AND CombiTestDate Is Not Null AND FLVResult = 2" ),
+    ( ANIMAL, "HWP", ( "animal", ), "HeartwormTestDate", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'HWP' AS Category, CombiTestDate AS EventDate, ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
+        "WHERE NonShelterAnimal = 0 AND HeartwormTested = 1 AND HeartwormTestDate Is Not Null AND HeartwormTestResult = 2" ),
+    ( ANIMAL, "QUARANTINE", ( "animal", ), "LastChangedDate", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'QUARANTINE' AS Category, LastChangedDate AS EventDate, ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
+        "WHERE NonShelterAnimal = 0 AND IsQuarantine = 1" ),
+    ( ANIMAL, "HOLD", ( "animal", ), "DateBroughtIn", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'HOLD' AS Category, DateBroughtIn AS EventDate, ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
+        "WHERE NonShelterAnimal = 0 AND IsHold = 1" ),
+    ( ANIMAL, "NOTADOPT", ( "animal", ), "DateBroughtIn", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'NOTADOPT' AS Category, DateBroughtIn AS EventDate, ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
+        "WHERE NonShelterAnimal = 0 AND IsNotAvailableForAdoption = 1" ),
+    ( ANIMAL, "AVAILABLE", ( "animal", ), "ActiveMovementReturn", "animal.ID",
+        "SELECT 'animal' AS LinkTarget, 'AVAILABLE' AS Category, ActiveMovementReturn AS EventDate, ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, '' AS Text3, LastChangedBy FROM animal " \
+        "WHERE NonShelterAnimal = 0 AND ActiveMovementReturn Is Not Null AND IsNotAvailableForAdoption = 0" ),
+    ( ANIMAL, "VACC", ( "animal", "animalvaccination" ), "DateOfVaccination", "animal.ID",
+        "SELECT 'animal_vaccination' AS LinkTarget, 'VACC' AS Category, DateOfVaccination AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, VaccinationType AS Text3, animalvaccination.LastChangedBy FROM animal " \
+        "INNER JOIN animalvaccination ON animalvaccination.AnimalID = animal.ID " \
+        "INNER JOIN vaccinationtype ON vaccinationtype.ID = animalvaccination.VaccinationID " \
+        "WHERE NonShelterAnimal = 0 AND DateOfVaccination Is Not Null" ),
+    ( ANIMAL, "TEST", ( "animal", "animaltest" ), "DateOfTest", "animal.ID",
+        "SELECT 'animal_test' AS LinkTarget, 'TEST' AS Category, DateOfTest AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, TestName AS Text3, animaltest.LastChangedBy FROM animal " \
+        "INNER JOIN animaltest ON animaltest.AnimalID = animal.ID " \
+        "INNER JOIN testtype ON testtype.ID = animaltest.TestTypeID " \
+        "WHERE NonShelterAnimal = 0 AND DateOfTest Is Not Null" ),
+    ( ANIMAL, "MEDICAL", ( "animal", "animalmedical", "animalmedicaltreatment" ), "DateGiven", "animal.ID",
+        "SELECT 'animal_medical' AS LinkTarget, 'MEDICAL' AS Category, DateGiven AS EventDate, animal.ID, " \
+        "ShelterCode AS Text1, AnimalName AS Text2, TreatmentName AS Text3, animalmedicaltreatment.LastChangedBy FROM animal " \
+        "INNER JOIN animalmedicaltreatment ON animalmedicaltreatment.AnimalID = animal.ID " \
+        "INNER JOIN animalmedical ON animalmedicaltreatment.AnimalMedicalID = animalmedical.ID " \
+        "WHERE NonShelterAnimal = 0 AND DateGiven Is Not Null" ),
+    ( INCIDENT, "INCIDENTOPEN", ( "animalcontrol", ), "IncidentDateTime", "animalcontrol.ID",
+        "SELECT 'incident' AS LinkTarget, 'INCIDENTOPEN' AS Category, IncidentDateTime AS EventDate, animalcontrol.ID, " \
+        "IncidentName AS Text1, DispatchAddress AS Text2, '' AS Text3, LastChangedBy FROM animalcontrol " \
+        "INNER JOIN incidenttype ON incidenttype.ID = animalcontrol.IncidentTypeID " \
+        "WHERE IncidentDateTime Is Not Null" ),
+    ( INCIDENT, "INCIDENTCLOSE", ( "animalcontrol", ), "CompletedDate", "animalcontrol.ID",
+        "SELECT 'incident' AS LinkTarget, 'INCIDENTCLOSE' AS Category, CompletedDate AS EventDate, animalcontrol.ID, " \
+        "IncidentName AS Text1, DispatchAddress AS Text2, CompletedName AS Text3, LastChangedBy FROM animalcontrol " \
+        "INNER JOIN incidenttype ON incidenttype.ID = animalcontrol.IncidentTypeID " \
+        "INNER JOIN incidentcompleted ON incidentcompleted.ID = animalcontrol.IncidentCompletedID " \
+        "WHERE CompletedDate Is Not Null" ),
+    ( LOST, "LOST", ( "animallost", ), "DateLost", "animallost.ID",
+        "SELECT 'lostanimal' AS LinkTarget, 'LOST' AS Category, DateLost AS EventDate, animallost.ID, " \
+        "DistFeat AS Text1, AreaLost AS Text2, SpeciesName AS Text3, LastChangedBy FROM animallost " \
+        "INNER JOIN species ON animallost.AnimalTypeID = species.ID " \
+        "WHERE DateLost Is Not Null" ),
+    ( FOUND, "FOUND", ( "animalfound", ), "DateFound", "animalfound.ID",
+        "SELECT 'foundanimal' AS LinkTarget, 'FOUND' AS Category, DateFound AS EventDate, animalfound.ID, " \
+        "DistFeat AS Text1, AreaFound AS Text2, SpeciesName AS Text3, LastChangedBy FROM animalfound " \
+        "INNER JOIN species ON animalfound.AnimalTypeID = species.ID " \
+        "WHERE DateFound Is Not Null" ),
+    ( WAITINGLIST, "WAITINGLIST", ( "animalwaitinglist", ), "DatePutOnList", "animalwaitinglist.ID",
+        "SELECT 'waitinglist' AS LinkTarget, 'WAITINGLIST' AS Category, DatePutOnList AS EventDate, animalwaitinglist.ID, " \
+        "AnimalDescription AS Text1, lkurgency.Urgency AS Text2, '' AS Text3, LastChangedBy FROM animalwaitinglist " \
+        "INNER JOIN lkurgency ON lkurgency.ID = animalwaitinglist.Urgency " \
+        "WHERE DatePutOnList Is Not Null" )
+)
+
+COLUMNS = "LinkTarget, Category, EventDate, LinkID, Text1, Text2, Text3, LastChangedBy"
+
+def timeline_built(dbo):
+    """
+    Returns True if the timeline table has been built
+    """
+    return configuration.timeline_updated(dbo) != ""
+
+def get_timeline(dbo, limit = 500, beforedate = None, beforeid = 0):
+    """
+    Returns up to limit events from the timeline table, most recent
+    first. To page back through older events, pass the EVENTDATE
+    and EVENTID of the last event returned as beforedate and beforeid.
+    """
+    where = ""
+    if beforedate is not None:
+        where = "AND (EventDate < %s OR (EventDate = %s AND ID < %d)) " % (db.ddt(beforedate), db.ddt(beforedate), int(beforeid))
+    return db.query(dbo, "SELECT LinkTarget, Category, EventDate, LinkID AS ID, Text1, Text2, Text3, LastChangedBy, ID AS EventID " \
+        "FROM timeline WHERE EventDate <= %s %s" \
+        "ORDER BY EventDate DESC, ID DESC LIMIT %d" % (db.ddt(now(dbo.timezone)), where, int(limit)))
+
+def get_timeline_query(dbo, limit = 500):
+    """
+    Returns the query that calculates the most recent limit events
+    from the records, used until the timeline table has been built.
+    """
+    sql = " UNION ALL ".join([ "(%s ORDER BY %s DESC, %s LIMIT %d)" % (sql, datecol, keycol, int(limit)) \
+        for kind, category, tables, datecol, keycol, sql in EVENTS ])
+    return "SELECT * FROM (%s) dummy WHERE EventDate <= %s ORDER BY EventDate DESC, ID LIMIT %d" % \
+        (sql, db.ddt(now(dbo.timezone)), int(limit))
+
+def _insert_statement(dbo, rows):
+    """
+    Returns the (sql, params) statement for db.execute_transaction
+    that inserts event rows calculated from the EVENTS queries
+    """
+    ids = db.get_ids(dbo, "timeline", len(rows))
+    return ( "INSERT INTO timeline (ID, %s) VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s)" % COLUMNS,
+        [ [ ids[i] ] + list(r) for i, r in enumerate(rows) ] )
+
+def _insert(dbo, rows):
+    """
+    Inserts event rows calculated from the EVENTS queries
+    """
+    if len(rows) == 0: return
+    sql, params = _insert_statement(dbo, rows)
+    db.execute_many(dbo, sql, params)
+
+def update(dbo, kind, linkids, tables = None):
+    """
+    Recalculates the events for one or a list of record IDs of kind,
+    after they or the records linked to them have been changed.
+    tables: The tables changed, only the events calculated from
+            them are recalculated. None for all events.
+    The old events are replaced in a single transaction. Errors are 
+    logged rather than raised so that a problem with the timeline never 
+    stops a record being saved. Instead, the timeline is marked as not 
+    built so that it is calculated from the records until the daily 
+    batch rebuilds it.
+    """
+    if type(linkids) != list: linkids = [ linkids ]
+    linkids = [ int(x) for x in linkids if x is not None and int(x) > 0 ]
+    if len(linkids) == 0 or not timeline_built(dbo): return
+    events = [ e for e in EVENTS if e[0] == kind and (tables is None or len(set(tables).intersection(e[2])) > 0) ]
+    if len(events) == 0: return
+    idlist = ",".join([ str(x) for x in linkids ])
+    try:
+        rows = db.query_tuple(dbo, " UNION ALL ".join([ "%s AND %s IN (%s)" % (sql, keycol, idlist) \
+            for ekind, category, t, datecol, keycol, sql in events ]))
+        db.execute_transaction(dbo, [
+            ( "DELETE FROM timeline WHERE LinkID = %%s AND Category IN (%s)" % ",".join([ "'%s'" % e[1] for e in events ]),
+                [ ( x, ) for x in linkids ] ),
+            _insert_statement(dbo, rows) ])
+    except Exception,err:
+        al.error("failed updating timeline for %s %s: %s" % (kind, linkids, err), "timeline.update", dbo, sys.exc_info())
+        configuration.set_timeline_updated(dbo, False)
+
+def update_animals_for_person(dbo, personid):
+    """
+    Recalculates the events for the animals whose events show
+    the name of person personid (movements to them).
+    """
+    rows = db.query(dbo, "SELECT DISTINCT AnimalID FROM adoption WHERE OwnerID = %d" % int(personid))
+    if len(rows) > 0: update(dbo, ANIMAL, [ r["ANIMALID"] for r in rows ], [ "owner" ])
+
+def rebuild(dbo):
+    """
+    Rebuilds the timeline table from the records. The timeline is
+    calculated from the records while it is being rebuilt.
+    """
+    configuration.set_timeline_updated(dbo, False)
+    db.execute(dbo, "DELETE FROM timeline")
+    total = 0
+    for kind, category, tables, datecol, keycol, sql in EVENTS:
+        rows = db.query_tuple(dbo, sql)
+        _insert(dbo, rows)
+        total += len(rows)
+    configuration.set_timeline_updated(dbo)
+    al.debug("rebuilt timeline with %d events" % total, "timeline.rebuild", dbo)
+
+def _event_key(row):
+    """
+    Returns a tuple of the COLUMNS values of an event row that can
+    be compared between the EVENTS queries and the timeline table
+    """
+    key = []
+    for x in row:
+        if isinstance(x, datetime.datetime): x = x.replace(microsecond = 0)
+        elif isinstance(x, datetime.date): x = datetime.datetime(x.year, x.month, x.day)
+        elif isinstance(x, (int, long, float)): x = str(x)
+        key.append(x)
+    return tuple(key)
+
+def check_timeline(dbo, correct = True):
+    """
+    Compares the timeline table with the events calculated from
+    the records and logs any differences. Returns the number of 
+    events that are missing or stale.
+    correct: Correct the table if it is wrong or build it if it 
+             hasn't been built yet
+    """
+    if not timeline_built(dbo):
+        if correct: rebuild(dbo)
+        return 0
+    actual = {}
+    for r in db.query_tuple(dbo, "SELECT ID, %s FROM timeline" % COLUMNS):
+        actual.setdefault(_event_key(r[1:]), []).append(r[0])
+    missing = []
+    for kind, category, tables, datecol, keycol, sql in EVENTS:
+        for r in db.query_tuple(dbo, sql):
+            ids = actual.get(_event_key(r))
+            if ids: ids.pop()
+            else: missing.append(r)
+    stale = [ ( x, ) for ids in actual.itervalues() for x in ids ]
+    if len(missing) > 0 or len(stale) > 0:
+        al.error("timeline has %d stale events and is missing %d" % (len(stale), len(missing)), "timeline.check_timeline", dbo)
+        if correct:
+            db.execute_transaction(dbo, [
+                ( "DELETE FROM timeline WHERE ID = %s", stale ),
+                _insert_statement(dbo, missing) ])
+    return len(missing) + len(stale)
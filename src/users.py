@@ -11,10 +11,13 @@ import hashlib
 import i18n
 import os
 import pbkdf2
+import re
 import smcom
 import sys
+import threading
+import time
 import utils
-from sitedefs import MULTIPLE_DATABASES, MULTIPLE_DATABASES_TYPE
+from sitedefs import CACHE_VERIFIED_CREDENTIALS, MULTIPLE_DATABASES, MULTIPLE_DATABASES_TYPE
 
 # Security flags
 ADD_ANIMAL                      = "aa"
@@ -238,19 +241,92 @@ def add_security_flag(securitymap, flag):
         securitymap += flag + " *"
     return securitymap
 
+# Usernames made of these characters are safe to look up directly
+USERNAME_LOOKUP = re.compile(r"^[A-Za-z0-9_\.\-@ ]+$")
+
+# Recently verified credentials, so that repeated service calls from the
+# same account don't have to run the password hash every time. Keyed
+# by database and user ID, each entry holds a token derived from the
+# stored hash and the password (see _credential_token) and when it was
+# verified. Entries are kept for CACHE_VERIFIED_CREDENTIALS seconds and 
+# there are never more than VERIFIED_CREDENTIALS_MAX of them.
+verified_credentials = {}
+verified_credentials_lock = threading.Lock()
+VERIFIED_CREDENTIALS_MAX = 1000
+VERIFIED_CREDENTIALS_SECRET = os.urandom(16)
+
+def _credential_key(dbo, userid):
+    return "%s:%s:%s:%s:%d" % (dbo.host, dbo.port, dbo.database, dbo.alias, int(userid))
+
+def _credential_token(dbpassword, password):
+    """
+    Returns a token for a stored password hash and a plaintext password.
+    As the stored hash is part of it, a token stops matching as soon as 
+    the password is changed by any process.
+    """
+    if type(password) == unicode: password = password.encode("utf-8")
+    return hashlib.sha256("%s%s\0%s" % (VERIFIED_CREDENTIALS_SECRET, dbpassword, password)).hexdigest()
+
+def _credential_verified(key, token):
+    """
+    Returns True if token was verified for key within the last
+    CACHE_VERIFIED_CREDENTIALS seconds.
+    """
+    if CACHE_VERIFIED_CREDENTIALS <= 0: return False
+    v = verified_credentials.get(key)
+    return v is not None and v[0] == token and time.time() - v[1] < CACHE_VERIFIED_CREDENTIALS
+
+def _credential_put(key, token):
+    """
+    Remembers that token was verified for key. If the cache is full,
+    expired entries are removed, followed by the oldest if it is still full.
+    """
+    if CACHE_VERIFIED_CREDENTIALS <= 0: return
+    verified_credentials_lock.acquire()
+    try:
+        if len(verified_credentials) >= VERIFIED_CREDENTIALS_MAX:
+            now = time.time()
+            for k, v in verified_credentials.items():
+                if now - v[1] >= CACHE_VERIFIED_CREDENTIALS: del verified_credentials[k]
+            if len(verified_credentials) >= VERIFIED_CREDENTIALS_MAX:
+                oldest = min(verified_credentials.iterkeys(), key=lambda k: verified_credentials[k][1])
+                del verified_credentials[oldest]
+        verified_credentials[key] = ( token, time.time() )
+    finally:
+        verified_credentials_lock.release()
+
+def invalidate_credentials(dbo, userid):
+    """
+    Forgets any verified credentials for a user. 
+    """
+    verified_credentials_lock.acquire()
+    try:
+        verified_credentials.pop(_credential_key(dbo, userid), None)
+    finally:
+        verified_credentials_lock.release()
+
 def authenticate(dbo, username, password):
     """
     Authenticates whether a username and password are valid.
     Returns None if authentication failed, or a user row
     """
     username = username.upper()
-    # Do not use any login inputs directly in database queries
-    for u in db.query(dbo, "SELECT ID, UserName, Password FROM users"):
+    # Only look up usernames made of safe characters directly, do not
+    # use any other login inputs in database queries
+    if USERNAME_LOOKUP.match(username):
+        rows = db.query(dbo, "SELECT * FROM users WHERE UPPER(UserName) = '%s'" % username)
+    else:
+        rows = db.query(dbo, "SELECT * FROM users")
+    for u in rows:
         if username == u["USERNAME"].upper():
             dbpassword = u["PASSWORD"].strip()
+            key = _credential_key(dbo, u["ID"])
+            token = _credential_token(dbpassword, password)
+            if _credential_verified(key, token):
+                return u
             if verify_password(password, dbpassword):
-                u = db.query(dbo, "SELECT * FROM users WHERE ID=%d" % u["ID"])
-                if len(u) == 1: return u[0]
+                _credential_put(key, token)
+                return u
     return None
 
 def authenticate_ip(user, remoteip):
@@ -337,9 +413,11 @@ def change_password(dbo, username, oldpassword, newpassword):
     Changes the password for a user
     """
     l = dbo.locale
-    if None == authenticate(dbo, username, oldpassword):
+    user = authenticate(dbo, username, oldpassword)
+    if user is None:
         raise utils.ASMValidationError(i18n._("Password is incorrect.", l))
     db.execute(dbo, "UPDATE users SET Password = '%s' WHERE UserName Like '%s'" % (hash_password(newpassword), username))
+    invalidate_credentials(dbo, user["ID"])
 
 def get_locale_override(dbo, username):
     """
@@ -627,6 +705,7 @@ def reset_password(dbo, userid, password):
     Resets the password for the given user to "password"
     """
     db.execute(dbo, "UPDATE users SET Password = '%s' WHERE ID = %d" % ( hash_password(password), int(userid)))
+    invalidate_credentials(dbo, userid)
 
 def update_session(session):
     """
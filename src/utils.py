@@ -47,6 +47,12 @@ websession = None
 # Global reference to the current code path
 PATH = os.path.dirname(os.path.abspath(__file__)) + os.sep
 
+# Templates compiled by compile_tags, keyed by a hash of their
+# content and tag markers, so an edited template is compiled again. 
+# Cleared when it reaches COMPILED_TAGS_MAX entries.
+compiled_tags = {}
+COMPILED_TAGS_MAX = 200
+
 class PostedData(object):
     """
     Helper class for reading fields from the web.py web.input object
@@ -619,6 +625,54 @@ def fix_relative_document_uris(s, baseurl, account = "" ):
     s = s.replace("image?" + dbp + "mode=dbfs&amp;id=/animal/", baseurl + "/service?method=dbfs_image" + accountp + "&title=/animal/")
     return s
 
+def compile_tags(searchin, opener, closer):
+    """
+    Splits searchin into a list of alternating literal text and
+    (upper case) tag names found between opener and closer, starting
+    and ending with literal text. Compiled templates are cached.
+    """
+    key = searchin
+    if type(key) == unicode: key = key.encode("utf-8")
+    key = hashlib.md5("%s|%s|%s" % (opener, closer, key)).hexdigest()
+    parts = compiled_tags.get(key)
+    if parts is not None:
+        return parts
+    parts = []
+    pos = 0
+    sp = searchin.find(opener)
+    while sp != -1:
+        ep = searchin.find(closer, sp + len(opener))
+        if ep == -1:
+            # No end marker for this tag, stop processing
+            break
+        parts.append(searchin[pos:sp])
+        parts.append(searchin[sp + len(opener):ep].upper())
+        pos = ep + len(closer)
+        sp = searchin.find(opener, pos)
+    parts.append(searchin[pos:])
+    if len(compiled_tags) >= COMPILED_TAGS_MAX: 
+        compiled_tags.clear()
+    compiled_tags[key] = parts
+    return parts
+
+def render_tags(parts, tags, escape = None):
+    """
+    Renders a template compiled by compile_tags with the dictionary
+    of tags. Tags that are not in the dictionary are output as an
+    empty string. escape is an optional function to apply to the 
+    string value of each tag.
+    """
+    out = list(parts)
+    for i in xrange(1, len(out), 2):
+        newval = ""
+        if tags.has_key(out[i]):
+            newval = tags[out[i]]
+            if newval is not None:
+                newval = str(newval)
+                if escape is not None: newval = escape(newval)
+        out[i] = str(newval)
+    return "".join(out)
+
 def substitute_tags(searchin, tags, use_xml_escaping = True, opener = "&lt;&lt;", closer = "&gt;&gt;"):
     """
     Substitutes the dictionary of tags in "tags" for any found
@@ -626,31 +680,15 @@ def substitute_tags(searchin, tags, use_xml_escaping = True, opener = "&lt;&lt;"
     if use_xml_escaping is set to true, then tags are XML escaped when
     output and opener/closer are escaped.
     """
+    def xml_escape(newval):
+        if newval.lower().startswith("<img"): return newval
+        return newval.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    escape = xml_escape
     if not use_xml_escaping:
         opener = opener.replace("&lt;", "<").replace("&gt;", ">")
         closer = closer.replace("&lt;", "<").replace("&gt;", ">")
-
-    s = searchin
-    sp = s.find(opener)
-    while sp != -1:
-        ep = s.find(closer, sp + len(opener))
-        if ep != -1:
-            matchtag = s[sp + len(opener):ep].upper()
-            newval = ""
-            if tags.has_key(matchtag):
-                newval = tags[matchtag]
-                if newval is not None:
-                    newval = str(newval)
-                    if use_xml_escaping and not newval.lower().startswith("<img"):
-                        newval = newval.replace("&", "&amp;")
-                        newval = newval.replace("<", "&lt;")
-                        newval = newval.replace(">", "&gt;")
-            s = s[0:sp] + str(newval) + s[ep + len(closer):]
-            sp = s.find(opener, sp)
-        else:
-            # No end marker for this tag, stop processing
-            break
-    return s
+        escape = None
+    return render_tags(compile_tags(searchin, opener, closer), tags, escape)
 
 def check_locked_db(session):
     if session.dbo.locked: 
@@ -2,6 +2,7 @@
 
 import additional
 import al
+import alerts
 import animal
 import audit
 import configuration
@@ -10,6 +11,8 @@ import dbfs
 import diary
 import log
 import media
+import searchindex
+import timeline
 import utils
 from i18n import _, after, now, python2display, subtract_years, add_days, date_diff
 
@@ -131,6 +134,10 @@ def get_waitinglist_find_simple(dbo, query = "", limit = 0):
     if query == "":
         return get_waitinglist(dbo)
 
+    # Narrow the search to candidates from the search index if we can
+    ids = searchindex.get_candidates(dbo, searchindex.WAITINGLIST, query)
+    if ids is not None and len(ids) == 0: return []
+
     ors = []
     add = lambda f: "LOWER(%s) LIKE '%%%s%%'" % (f, query.lower())
     if utils.is_numeric(query):
@@ -140,9 +147,11 @@ def get_waitinglist_find_simple(dbo, query = "", limit = 0):
     ors.append(u"EXISTS(SELECT ad.Value FROM additional ad " \
         "INNER JOIN additionalfield af ON af.ID = ad.AdditionalFieldID AND af.Searchable = 1 " \
         "WHERE ad.LinkID=a.ID AND ad.LinkType IN (%s) AND LOWER(ad.Value) LIKE '%%%s%%')" % (additional.WAITINGLIST_IN, query.lower()))
-    if not dbo.is_large_db:
+    if not dbo.is_large_db or ids is not None:
         ors.append(add("a.ReasonForWantingToPart"))
         ors.append(add("a.ReasonForRemoval"))
+    if ids is not None:
+        ors = [ "a.ID IN (%s) AND (%s)" % (",".join([ str(x) for x in ids ]), " OR ".join(ors)) ]
     sql = get_waitinglist_query(dbo) + " WHERE " + " OR ".join(ors)
     if limit > 0: sql += " LIMIT " + str(limit)
     return db.query(dbo, sql)
@@ -166,10 +175,13 @@ def delete_waitinglist(dbo, username, wid):
     """
     audit.delete(dbo, username, "animalwaitinglist", wid, audit.dump_row(dbo, "animalwaitinglist", wid))
     db.execute(dbo, "DELETE FROM animalwaitinglist WHERE ID = %d" % wid)
+    alerts.invalidate(dbo, "animalwaitinglist")
     db.execute(dbo, "DELETE FROM media WHERE LinkID = %d AND LinkTypeID = %d" % (wid, media.WAITINGLIST))
     db.execute(dbo, "DELETE FROM diary WHERE LinkID = %d AND LinkType = %d" % (wid, diary.WAITINGLIST))
     db.execute(dbo, "DELETE FROM log WHERE LinkID = %d AND LinkType = %d" % (wid, log.WAITINGLIST))
     db.execute(dbo, "DELETE FROM additional WHERE LinkID = %d AND LinkType IN (%s)" % (wid, additional.WAITINGLIST_IN))
+    searchindex.delete(dbo, searchindex.WAITINGLIST, wid)
+    timeline.update(dbo, timeline.WAITINGLIST, wid)
 
 def send_email_from_form(dbo, username, post):
     """
@@ -194,6 +206,7 @@ def update_waitinglist_remove(dbo, username, wid):
     Marks a waiting list record as removed
     """
     db.execute(dbo, "UPDATE animalwaitinglist SET DateRemovedFromList = %s WHERE ID = %d" % ( db.dd(now(dbo.timezone)), int(wid) ))
+    alerts.invalidate(dbo, "animalwaitinglist")
     audit.edit(dbo, username, "animalwaitinglist", wid, "%s: DateRemovedFromList ==> %s" % ( str(wid), python2display(dbo.locale, now(dbo.timezone))))
 
 def update_waitinglist_highlight(dbo, wlid, himode):
@@ -243,6 +256,7 @@ def auto_remove_waitinglist(dbo):
     if len(updates) > 0:
         db.execute_many(dbo, "UPDATE animalwaitinglist SET DateRemovedFromList = %s, " \
             "ReasonForRemoval=%s WHERE ID=%s", updates)
+        alerts.invalidate(dbo, "animalwaitinglist")
         
 def auto_update_urgencies(dbo):
     """
@@ -267,6 +281,8 @@ def auto_update_urgencies(dbo):
             "UrgencyUpdateDate=%s, " \
             "Urgency=%s " \
             "WHERE ID=%s ", updates)
+        alerts.invalidate(dbo, "animalwaitinglist")
+        timeline.update(dbo, timeline.WAITINGLIST, [ r["ID"] for r in rows ])
             
 def update_waitinglist_from_form(dbo, post, username):
     """
@@ -302,7 +318,10 @@ def update_waitinglist_from_form(dbo, post, username):
         ( "ReasonForRemoval", post.db_string("reasonforremoval")),
         ( "Comments", post.db_string("comments"))
         )))
+    alerts.invalidate(dbo, "animalwaitinglist")
     additional.save_values_for_link(dbo, post, wlid, "waitinglist")
+    searchindex.update(dbo, searchindex.WAITINGLIST, wlid)
+    timeline.update(dbo, timeline.WAITINGLIST, wlid)
     postaudit = db.query(dbo, "SELECT * FROM animalwaitinglist WHERE ID = %d" % wlid)
     audit.edit(dbo, username, "animalwaitinglist", wlid, audit.map_diff(preaudit, postaudit))
 
@@ -337,10 +356,13 @@ def insert_waitinglist_from_form(dbo, post, username):
         ( "UrgencyLastUpdatedDate", db.dd(now(dbo.timezone))),
         ( "UrgencyUpdateDate", db.dd(add_days(now(dbo.timezone), configuration.waiting_list_urgency_update_period(dbo))))
         )))
+    alerts.invalidate(dbo, "animalwaitinglist")
     audit.create(dbo, username, "animalwaitinglist", nwlid, audit.dump_row(dbo, "animalwaitinglist", nwlid))
 
     # Save any additional field values given
     additional.save_values_for_link(dbo, post, nwlid, "waitinglist")
+    searchindex.update(dbo, searchindex.WAITINGLIST, nwlid)
+    timeline.update(dbo, timeline.WAITINGLIST, nwlid)
 
     return nwlid
 
@@ -382,6 +404,7 @@ def create_animal(dbo, username, wlid):
         db.dd(now(dbo.timezone)), 
         db.ds(_("Moved to animal record {0}", l).format(code)),
         wlid))
+    alerts.invalidate(dbo, "animalwaitinglist")
     # If there were any logs and media entries on the waiting list, create them
     # on the animal
     # Media
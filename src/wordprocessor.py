@@ -76,10 +76,80 @@ def fw(s):
     if s.find(" ") == -1: return s
     return s.split(" ")[0]
 
-def animal_tags(dbo, a):
+def tags_needed(used, names):
+    """
+    Returns True if any of the tags in the set used start with
+    one of the tag names in names. If used is None, all tags
+    are wanted and True is returned.
+    """
+    if used is None: return True
+    for t in used:
+        for n in names:
+            if t.startswith(n): return True
+    return False
+
+def cached_tags(cache, key, fn):
+    """
+    Returns the result of calling fn, memoised in the dictionary
+    cache under key. If cache is None, fn is always called.
+    """
+    if cache is None: return fn()
+    if not cache.has_key(key):
+        cache[key] = fn()
+    return cache[key]
+
+def additional_tags(dbo, linkid, linktype, add = None):
+    """
+    Generates tags from the additional fields for a record
+    add: The additional fields for the record if they have already
+         been retrieved (see additional.get_additional_fields_many)
+    """
+    l = dbo.locale
+    tags = {}
+    if add is None: add = additional.get_additional_fields(dbo, linkid, linktype)
+    for af in add:
+        val = af["VALUE"]
+        if val is None: val = ""
+        if af["FIELDTYPE"] == additional.YESNO:
+            val = additional_yesno(l, af)
+        if af["FIELDTYPE"] == additional.MONEY:
+            val = format_currency_no_symbol(l, af["VALUE"])
+        tags[af["FIELDNAME"].upper()] = val
+    return tags
+
+def cache_additional_tags(dbo, cache, linkids, linktype):
+    """
+    Generates the additional field tags for every one of linkids that 
+    isn't already in cache with two queries, so that animal_tags and 
+    person_tags can build tags for many records without querying 
+    additional fields for each one.
+    """
+    linkids = [ x for x in linkids if not cache.has_key((linktype, x, "additional")) ]
+    if len(linkids) == 0: return
+    add = additional.get_additional_fields_many(dbo, linkids, linktype)
+    for linkid in linkids:
+        cache[(linktype, linkid, "additional")] = additional_tags(dbo, linkid, linktype, add[linkid])
+
+def additional_tags_needed(dbo, used, linktype, cache = None):
+    """
+    Returns True if the set of tags used references any of the
+    additional fields for linktype.
+    """
+    if used is None: return True
+    fields = cached_tags(cache, ("fields", linktype), 
+        lambda: [ f["FIELDNAME"].upper() for f in additional.get_field_definitions(dbo, linktype) ])
+    for f in fields:
+        if f in used: return True
+    return False
+
+def animal_tags(dbo, a, used = None, cache = None):
     """
     Generates a list of tags from an animal result (the deep type from
     calling animal.get_animal)
+    used: The set of tags a template references (see get_tags_used). If
+          supplied, only the tags that need extra queries and are
+          referenced will be generated.
+    cache: A dictionary for memoising the queried tags across calls
     """
     l = dbo.locale
     qr = QR_IMG_SRC % { "url": BASE_URL + "/animal?id=%d" % a["ID"], "size": "150x150" }
@@ -300,14 +370,19 @@ def animal_tags(dbo, a):
         "ANIMALONFOSTER"        : yes_no(l, a["ACTIVEMOVEMENTTYPE"] == movement.FOSTER),
         "ANIMALPERMANENTFOSTER" : yes_no(l, a["HASPERMANENTFOSTER"] == 1),
         "ANIMALATRETAILER"      : yes_no(l, a["ACTIVEMOVEMENTTYPE"] == movement.RETAILER),
-        "ANIMALISADOPTABLE"     : utils.iif(publish.is_adoptable(dbo, a["ID"]), _("Yes", l), _("No", l)),
         "ANIMALISRESERVED"      : yes_no(l, a["HASACTIVERESERVE"] == 1),
-        "ADOPTIONSTATUS"        : publish.get_adoption_status(dbo, a),
         "ADOPTIONID"            : a["ACTIVEMOVEMENTADOPTIONNUMBER"],
         "OUTCOMEDATE"           : utils.iif(a["DECEASEDDATE"] is None, python2display(l, a["ACTIVEMOVEMENTDATE"]), python2display(l, a["DECEASEDDATE"])),
         "OUTCOMETYPE"           : utils.iif(a["ARCHIVED"] == 1, a["DISPLAYLOCATIONNAME"], "")
     }
 
+    if tags_needed(used, [ "ANIMALISADOPTABLE" ]):
+        tags["ANIMALISADOPTABLE"] = cached_tags(cache, ("animal", a["ID"], "adoptable"), 
+            lambda: utils.iif(publish.is_adoptable(dbo, a["ID"]), _("Yes", l), _("No", l)))
+    if tags_needed(used, [ "ADOPTIONSTATUS" ]):
+        tags["ADOPTIONSTATUS"] = cached_tags(cache, ("animal", a["ID"], "adoptionstatus"), 
+            lambda: publish.get_adoption_status(dbo, a))
+
     # Set original owner to be current owner on non-shelter animals
     if a["NONSHELTERANIMAL"] == 1 and a["ORIGINALOWNERNAME"] is not None and a["ORIGINALOWNERNAME"] != "":
         tags["CURRENTOWNERNAME"] = a["ORIGINALOWNERNAME"]
@@ -328,36 +403,31 @@ def animal_tags(dbo, a):
     # If the animal doesn't have a current owner, but does have an open
     # movement with a future date on it, look up the owner and use that 
     # instead so that we can still generate paperwork for future adoptions.
-    if a["CURRENTOWNERID"] is None or a["CURRENTOWNERID"] == 0:
-        latest = animal.get_latest_movement(dbo, a["ID"])
-        if latest is not None:
-            p = person.get_person(dbo, latest["OWNERID"])
-            if p is not None:
-                tags["CURRENTOWNERNAME"] = p["OWNERNAME"]
-                tags["CURRENTOWNERADDRESS"] = p["OWNERADDRESS"]
-                tags["CURRENTOWNERTOWN"] = p["OWNERTOWN"]
-                tags["CURRENTOWNERCOUNTY"] = p["OWNERCOUNTY"]
-                tags["CURRENTOWNERPOSTCODE"] = p["OWNERPOSTCODE"]
-                tags["CURRENTOWNERCITY"] = p["OWNERTOWN"]
-                tags["CURRENTOWNERSTATE"] = p["OWNERCOUNTY"]
-                tags["CURRENTOWNERZIPCODE"] = p["OWNERPOSTCODE"]
-                tags["CURRENTOWNERHOMEPHONE"] = p["HOMETELEPHONE"]
-                tags["CURRENTOWNERPHONE"] = p["HOMETELEPHONE"]
-                tags["CURRENTOWNERWORKPHONE"] = p["WORKTELEPHONE"]
-                tags["CURRENTOWNERMOBILEPHONE"] = p["MOBILETELEPHONE"]
-                tags["CURRENTOWNERCELLPHONE"] = p["MOBILETELEPHONE"]
-                tags["CURRENTOWNEREMAIL"] = p["EMAILADDRESS"]
+    if (a["CURRENTOWNERID"] is None or a["CURRENTOWNERID"] == 0) and tags_needed(used, [ "CURRENTOWNER" ]):
+        def latest_owner():
+            latest = animal.get_latest_movement(dbo, a["ID"])
+            if latest is None: return None
+            return person.get_person(dbo, latest["OWNERID"])
+        p = cached_tags(cache, ("animal", a["ID"], "latestowner"), latest_owner)
+        if p is not None:
+            tags["CURRENTOWNERNAME"] = p["OWNERNAME"]
+            tags["CURRENTOWNERADDRESS"] = p["OWNERADDRESS"]
+            tags["CURRENTOWNERTOWN"] = p["OWNERTOWN"]
+            tags["CURRENTOWNERCOUNTY"] = p["OWNERCOUNTY"]
+            tags["CURRENTOWNERPOSTCODE"] = p["OWNERPOSTCODE"]
+            tags["CURRENTOWNERCITY"] = p["OWNERTOWN"]
+            tags["CURRENTOWNERSTATE"] = p["OWNERCOUNTY"]
+            tags["CURRENTOWNERZIPCODE"] = p["OWNERPOSTCODE"]
+            tags["CURRENTOWNERHOMEPHONE"] = p["HOMETELEPHONE"]
+            tags["CURRENTOWNERPHONE"] = p["HOMETELEPHONE"]
+            tags["CURRENTOWNERWORKPHONE"] = p["WORKTELEPHONE"]
+            tags["CURRENTOWNERMOBILEPHONE"] = p["MOBILETELEPHONE"]
+            tags["CURRENTOWNERCELLPHONE"] = p["MOBILETELEPHONE"]
+            tags["CURRENTOWNEREMAIL"] = p["EMAILADDRESS"]
 
     # Additional fields
-    add = additional.get_additional_fields(dbo, a["ID"], "animal")
-    for af in add:
-        val = af["VALUE"]
-        if val is None: val = ""
-        if af["FIELDTYPE"] == additional.YESNO:
-            val = additional_yesno(l, af)
-        if af["FIELDTYPE"] == additional.MONEY:
-            val = format_currency_no_symbol(l, af["VALUE"])
-        tags[af["FIELDNAME"].upper()] = val
+    if additional_tags_needed(dbo, used, "animal", cache):
+        tags.update(cached_tags(cache, ("animal", a["ID"], "additional"), lambda: additional_tags(dbo, a["ID"], "animal")))
 
     include_incomplete_vacc = configuration.include_incomplete_vacc_doc(dbo)
     include_incomplete_medical = configuration.include_incomplete_medical_doc(dbo)
@@ -375,8 +445,12 @@ def animal_tags(dbo, a):
         "VACCINATIONADMINISTERINGVET": "ADMINISTERINGVETNAME",
         "VACCINATIONDESCRIPTION":   "VACCINATIONDESCRIPTION"
     }
-    tags.update(table_tags(dbo, d, medical.get_vaccinations(dbo, a["ID"], not include_incomplete_vacc), "VACCINATIONTYPE", "DATEOFVACCINATION"))
-    tags["ANIMALISVACCINATED"] = utils.iif(medical.get_vaccinated(dbo, a["ID"]), _("Yes", l), _("No", l))
+    if tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("animal", a["ID"], "vaccinations"), lambda: table_tags(dbo, d, 
+            medical.get_vaccinations(dbo, a["ID"], not include_incomplete_vacc), "VACCINATIONTYPE", "DATEOFVACCINATION")))
+    if tags_needed(used, [ "ANIMALISVACCINATED" ]):
+        tags["ANIMALISVACCINATED"] = cached_tags(cache, ("animal", a["ID"], "vaccinated"), 
+            lambda: utils.iif(medical.get_vaccinated(dbo, a["ID"]), _("Yes", l), _("No", l)))
 
     # Tests
     d = {
@@ -389,7 +463,9 @@ def animal_tags(dbo, a):
         "TESTADMINISTERINGVET":     "ADMINISTERINGVETNAME",
         "TESTDESCRIPTION":          "TESTDESCRIPTION"
     }
-    tags.update(table_tags(dbo, d, medical.get_tests(dbo, a["ID"], not include_incomplete_vacc), "TESTNAME", "DATEOFTEST"))
+    if tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("animal", a["ID"], "tests"), lambda: table_tags(dbo, d, 
+            medical.get_tests(dbo, a["ID"], not include_incomplete_vacc), "TESTNAME", "DATEOFTEST")))
 
     # Medical
     d = {
@@ -406,7 +482,9 @@ def animal_tags(dbo, a):
         "MEDICALLASTTREATMENTGIVEN": "d:LASTTREATMENTGIVEN",
         "MEDICALCOST":              "c:COST"
     }
-    tags.update(table_tags(dbo, d, medical.get_regimens(dbo, a["ID"], not include_incomplete_medical), "TREATMENTNAME", "STATUS"))
+    if tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("animal", a["ID"], "medical"), lambda: table_tags(dbo, d, 
+            medical.get_regimens(dbo, a["ID"], not include_incomplete_medical), "TREATMENTNAME", "STATUS")))
 
     # Diet
     d = {
@@ -415,7 +493,9 @@ def animal_tags(dbo, a):
         "DIETDATESTARTED":          "d:DATESTARTED",
         "DIETCOMMENTS":             "COMMENTS"
     }
-    tags.update(table_tags(dbo, d, animal.get_diets(dbo, a["ID"]), "DIETNAME", "DATESTARTED"))
+    if tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("animal", a["ID"], "diets"), lambda: table_tags(dbo, d, 
+            animal.get_diets(dbo, a["ID"]), "DIETNAME", "DATESTARTED")))
 
     # Donations (only add if this animal doesn't have an active movement)
     d = {
@@ -441,8 +521,9 @@ def animal_tags(dbo, a):
         "PAYMENTVATAMOUNT":         "c:VATAMOUNT",
         "PAYMENTTAXAMOUNT":         "c:VATAMOUNT"
     }
-    if a["ACTIVEMOVEMENTID"] is None or a["ACTIVEMOVEMENTID"] == 0:
-        tags.update(table_tags(dbo, d, financial.get_animal_donations(dbo, a["ID"]), "DONATIONNAME", "DATE"))
+    if (a["ACTIVEMOVEMENTID"] is None or a["ACTIVEMOVEMENTID"] == 0) and tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("animal", a["ID"], "donations"), lambda: table_tags(dbo, d, 
+            financial.get_animal_donations(dbo, a["ID"]), "DONATIONNAME", "DATE")))
 
     # Costs
     d = {
@@ -452,7 +533,9 @@ def animal_tags(dbo, a):
         "COSTAMOUNT":               "c:COSTAMOUNT",
         "COSTDESCRIPTION":          "DESCRIPTION"
     }
-    tags.update(table_tags(dbo, d, animal.get_costs(dbo, a["ID"]), "COSTTYPENAME", "COSTPAIDDATE"))
+    if tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("animal", a["ID"], "costs"), lambda: table_tags(dbo, d, 
+            animal.get_costs(dbo, a["ID"]), "COSTTYPENAME", "COSTPAIDDATE")))
 
     # Logs
     d = {
@@ -461,14 +544,17 @@ def animal_tags(dbo, a):
         "LOGCOMMENTS":              "COMMENTS",
         "LOGCREATEDBY":             "CREATEDBY"
     }
-    tags.update(table_tags(dbo, d, log.get_logs(dbo, log.ANIMAL, a["ID"], 0, log.ASCENDING), "LOGTYPENAME", "DATE"))
+    if tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("animal", a["ID"], "logs"), lambda: table_tags(dbo, d, 
+            log.get_logs(dbo, log.ANIMAL, a["ID"], 0, log.ASCENDING), "LOGTYPENAME", "DATE")))
 
     return tags
 
-def animalcontrol_tags(dbo, ac):
+def animalcontrol_tags(dbo, ac, used = None, cache = None):
     """
     Generates a list of tags from an animalcontrol incident.
     ac: An animalcontrol incident record
+    used, cache: As for animal_tags
     """
     l = dbo.locale
     tags = {
@@ -573,7 +659,9 @@ def animalcontrol_tags(dbo, ac):
         "FINEDUEDATE":          "d:FINEDUEDATE",
         "FINEPAIDDATE":         "d:FINEPAIDDATE"
     }
-    tags.update(table_tags(dbo, d, financial.get_incident_citations(dbo, ac["ID"]), "CITATIONNAME", "CITATIONDATE"))
+    if tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("animalcontrol", ac["ID"], "citations"), lambda: table_tags(dbo, d, 
+            financial.get_incident_citations(dbo, ac["ID"]), "CITATIONNAME", "CITATIONDATE")))
 
     # Logs
     d = {
@@ -582,7 +670,9 @@ def animalcontrol_tags(dbo, ac):
         "INCIDENTLOGCOMMENTS":        "COMMENTS",
         "INCIDENTLOGCREATEDBY":       "CREATEDBY"
     }
-    tags.update(table_tags(dbo, d, log.get_logs(dbo, log.ANIMALCONTROL, ac["ID"], 0, log.ASCENDING), "LOGTYPENAME", "DATE"))
+    if tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("animalcontrol", ac["ID"], "logs"), lambda: table_tags(dbo, d, 
+            log.get_logs(dbo, log.ANIMALCONTROL, ac["ID"], 0, log.ASCENDING), "LOGTYPENAME", "DATE")))
 
     return tags
 
@@ -729,10 +819,11 @@ def movement_tags(dbo, m):
     }
     return tags    
 
-def person_tags(dbo, p):
+def person_tags(dbo, p, used = None, cache = None):
     """
     Generates a list of tags from a person result (the deep type from
     calling person.get_person)
+    used, cache: As for animal_tags
     """
     l = dbo.locale
     tags = { 
@@ -790,15 +881,8 @@ def person_tags(dbo, p):
     }
 
     # Additional fields
-    add = additional.get_additional_fields(dbo, p["ID"], "person")
-    for af in add:
-        val = af["VALUE"]
-        if val is None: val = ""
-        if af["FIELDTYPE"] == additional.YESNO:
-            val = additional_yesno(l, af)
-        if af["FIELDTYPE"] == additional.MONEY:
-            val = format_currency_no_symbol(l, af["VALUE"])
-        tags[af["FIELDNAME"].upper()] = val
+    if additional_tags_needed(dbo, used, "person", cache):
+        tags.update(cached_tags(cache, ("person", p["ID"], "additional"), lambda: additional_tags(dbo, p["ID"], "person")))
 
     # Citations
     d = {
@@ -809,7 +893,9 @@ def person_tags(dbo, p):
         "FINEDUEDATE":          "d:FINEDUEDATE",
         "FINEPAIDDATE":         "d:FINEPAIDDATE"
     }
-    tags.update(table_tags(dbo, d, financial.get_person_citations(dbo, p["ID"]), "CITATIONNAME", "CITATIONDATE"))
+    if tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("person", p["ID"], "citations"), lambda: table_tags(dbo, d, 
+            financial.get_person_citations(dbo, p["ID"]), "CITATIONNAME", "CITATIONDATE")))
 
     # Logs
     d = {
@@ -818,7 +904,9 @@ def person_tags(dbo, p):
         "PERSONLOGCOMMENTS":        "COMMENTS",
         "PERSONLOGCREATEDBY":       "CREATEDBY"
     }
-    tags.update(table_tags(dbo, d, log.get_logs(dbo, log.PERSON, p["ID"], 0, log.ASCENDING), "LOGTYPENAME", "DATE"))
+    if tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("person", p["ID"], "logs"), lambda: table_tags(dbo, d, 
+            log.get_logs(dbo, log.PERSON, p["ID"], 0, log.ASCENDING), "LOGTYPENAME", "DATE")))
 
     # Trap loans
     d = {
@@ -831,7 +919,9 @@ def person_tags(dbo, p):
         "TRAPRETURNDATE":           "d:RETURNDATE",
         "TRAPCOMMENTS":             "COMMENTS"
     }
-    tags.update(table_tags(dbo, d, animalcontrol.get_person_traploans(dbo, p["ID"], animalcontrol.ASCENDING), "TRAPTYPENAME", "RETURNDATE"))
+    if tags_needed(used, d.keys()):
+        tags.update(cached_tags(cache, ("person", p["ID"], "traploans"), lambda: table_tags(dbo, d, 
+            animalcontrol.get_person_traploans(dbo, p["ID"], animalcontrol.ASCENDING), "TRAPTYPENAME", "RETURNDATE")))
 
     return tags
 
@@ -931,6 +1021,16 @@ def table_tags(dbo, d, rows, typefield = "", recentdatefield = ""):
                         tags[k + "RECENT" + t] = table_get_value(l, r, v)
     return tags
 
+def get_tags_used(searchin, use_xml_escaping = True, opener = "&lt;&lt;", closer = "&gt;&gt;"):
+    """
+    Returns the set of tag names (upper case) referenced in searchin.
+    opener, closer and use_xml_escaping are as for substitute_tags.
+    """
+    if not use_xml_escaping:
+        opener = opener.replace("&lt;", "<").replace("&gt;", ">")
+        closer = closer.replace("&lt;", "<").replace("&gt;", ">")
+    return set(utils.compile_tags(searchin, opener, closer)[1::2])
+
 def substitute_tags_plain(searchin, tags):
     """
     Substitutes the dictionary of tags in "tags" for any found in
@@ -945,47 +1045,55 @@ def substitute_tags(searchin, tags, use_xml_escaping = True, opener = "&lt;&lt;"
     in "searchin". opener and closer denote the start of a tag,
     if use_xml_escaping is set to true, then tags are XML escaped when
     output and opener/closer are escaped.
+    The template is compiled once (see utils.compile_tags) and
+    rendered in a single pass.
     """
+    def xml_escape(newval):
+        # Escape xml entities unless the replacement tag is an image
+        # or it contains HTML entities or <br tags
+        lv = newval.lower()
+        if lv.startswith("<img") or lv.find("&#") != -1 or lv.find("<br/>") != -1: 
+            return newval
+        return newval.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    escape = xml_escape
     if not use_xml_escaping:
         opener = opener.replace("&lt;", "<").replace("&gt;", ">")
         closer = closer.replace("&lt;", "<").replace("&gt;", ">")
+        escape = None
+    return utils.render_tags(utils.compile_tags(searchin, opener, closer), tags, escape)
 
-    s = searchin
-    sp = s.find(opener)
-    while sp != -1:
-        ep = s.find(closer, sp + len(opener))
-        if ep != -1:
-            matchtag = s[sp + len(opener):ep].upper()
-            newval = ""
-            if tags.has_key(matchtag):
-                newval = tags[matchtag]
-                if newval is not None:
-                    newval = str(newval)
-                    # Escape xml entities unless the replacement tag is an image
-                    # or it contains HTML entities or <br tags
-                    if use_xml_escaping and \
-                       not newval.lower().startswith("<img") and \
-                       not newval.lower().find("&#") != -1 and \
-                       not newval.lower().find("<br/>") != -1:
-                        newval = newval.replace("&", "&amp;")
-                        newval = newval.replace("<", "&lt;")
-                        newval = newval.replace(">", "&gt;")
-            s = s[0:sp] + str(newval) + s[ep + len(closer):]
-            sp = s.find(opener, sp)
-        else:
-            # No end marker for this tag, stop processing
-            break
-    return s
+def get_template(dbo, template):
+    """
+    Reads the template specified by dbfs id "template". Returns a tuple
+    of the template name, its data and the set of tags it uses.
+    """
+    templatedata = dbfs.get_string_id(dbo, template)
+    templatename = dbfs.get_name_for_id(dbo, template)
+    used = set()
+    if templatename.endswith(".html"):
+        used = get_tags_used(templatedata.replace("signature:user", "&lt;&lt;UserSignatureSrc&gt;&gt;"))
+    elif templatename.endswith(".odt"):
+        try:
+            zf = zipfile.ZipFile(StringIO(templatedata), "r")
+            used = get_tags_used(zf.open("content.xml").read())
+            zf.close()
+        except Exception,zderr:
+            raise utils.ASMError("Failed generating odt document: %s" % str(zderr))
+    return (templatename, templatedata, used)
 
 def substitute_template(dbo, template, tags, imdata = None):
     """
-    Reads the template specified by dbfs id "template" and substitutes
-    according to the tags in "tags". Returns the built file.
+    Reads the template specified by dbfs id "template" (or a tuple
+    returned by get_template) and substitutes according to the tags 
+    in "tags". Returns the built file.
     imdata is the preferred image for the record and since html uses
     URLs, only applies to ODT templates.
     """
-    templatedata = dbfs.get_string_id(dbo, template)
-    templatename = dbfs.get_name_for_id(dbo, template)
+    if type(template) == tuple:
+        templatename, templatedata, used = template
+    else:
+        templatedata = dbfs.get_string_id(dbo, template)
+        templatename = dbfs.get_name_for_id(dbo, template)
     if templatename.endswith(".html"):
         # Translate any user signature placeholder
         templatedata = templatedata.replace("signature:user", "&lt;&lt;UserSignatureSrc&gt;&gt;")
@@ -1025,11 +1133,13 @@ def generate_animal_doc(dbo, template, animalid, username):
     a = animal.get_animal(dbo, animalid)
     im = media.get_image_file_data(dbo, "animal", animalid)[1]
     if a is None: raise utils.ASMValidationError("%d is not a valid animal ID" % animalid)
-    tags = animal_tags(dbo, a)
+    template = get_template(dbo, template)
+    used = template[2]
+    tags = animal_tags(dbo, a, used)
     if a["CURRENTOWNERID"] is not None and a["CURRENTOWNERID"] != 0:
-        tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, a["CURRENTOWNERID"])))
+        tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, a["CURRENTOWNERID"]), used))
     elif a["RESERVEDOWNERID"] is not None and a["RESERVEDOWNERID"] != 0:
-        tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, a["RESERVEDOWNERID"])))
+        tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, a["RESERVEDOWNERID"]), used))
     if a["ACTIVEMOVEMENTID"] is not None and a["ACTIVEMOVEMENTID"] != 0:
         m = movement.get_movement(dbo, a["ACTIVEMOVEMENTID"])
         md = financial.get_movement_donations(dbo, a["ACTIVEMOVEMENTID"])
@@ -1048,7 +1158,8 @@ def generate_animalcontrol_doc(dbo, template, acid, username):
     """
     ac = animalcontrol.get_animalcontrol(dbo, acid)
     if ac is None: raise utils.ASMValidationError("%d is not a valid incident ID" % acid)
-    tags = animalcontrol_tags(dbo, ac)
+    template = get_template(dbo, template)
+    tags = animalcontrol_tags(dbo, ac, template[2])
     tags = append_tags(tags, org_tags(dbo, username))
     return substitute_template(dbo, template, tags)
 
@@ -1061,12 +1172,14 @@ def generate_person_doc(dbo, template, personid, username):
     p = person.get_person(dbo, personid)
     im = media.get_image_file_data(dbo, "person", personid)[1]
     if p is None: raise utils.ASMValidationError("%d is not a valid person ID" % personid)
-    tags = person_tags(dbo, p)
+    template = get_template(dbo, template)
+    used = template[2]
+    tags = person_tags(dbo, p, used)
     tags = append_tags(tags, org_tags(dbo, username))
     m = movement.get_person_movements(dbo, personid)
     if len(m) > 0: 
         tags = append_tags(tags, movement_tags(dbo, m[0]))
-        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, m[0]["ANIMALID"])))
+        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, m[0]["ANIMALID"]), used))
     return substitute_template(dbo, template, tags, im)
 
 def generate_donation_doc(dbo, template, donationids, username):
@@ -1079,9 +1192,11 @@ def generate_donation_doc(dbo, template, donationids, username):
     if len(dons) == 0: 
         raise utils.ASMValidationError("%s does not contain any valid donation IDs" % donationids)
     d = dons[0]
-    tags = person_tags(dbo, person.get_person(dbo, d["OWNERID"]))
+    template = get_template(dbo, template)
+    used = template[2]
+    tags = person_tags(dbo, person.get_person(dbo, d["OWNERID"]), used)
     if d["ANIMALID"] is not None and d["ANIMALID"] != 0:
-        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, d["ANIMALID"])))
+        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, d["ANIMALID"]), used))
     if d["MOVEMENTID"] is not None and d["MOVEMENTID"] != 0:
         tags = append_tags(tags, movement_tags(dbo, movement.get_movement(dbo, d["MOVEMENTID"])))
     tags = append_tags(tags, donation_tags(dbo, dons))
@@ -1097,9 +1212,11 @@ def generate_licence_doc(dbo, template, licenceid, username):
     l = financial.get_licence(dbo, licenceid)
     if l is None:
         raise utils.ASMValidationError("%d is not a valid licence ID" % licenceid)
-    tags = person_tags(dbo, person.get_person(dbo, l["OWNERID"]))
+    template = get_template(dbo, template)
+    used = template[2]
+    tags = person_tags(dbo, person.get_person(dbo, l["OWNERID"]), used)
     if l["ANIMALID"] is not None and l["ANIMALID"] != 0:
-        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, l["ANIMALID"])))
+        tags = append_tags(tags, animal_tags(dbo, animal.get_animal(dbo, l["ANIMALID"]), used))
     tags = append_tags(tags, licence_tags(dbo, l))
     tags = append_tags(tags, org_tags(dbo, username))
     return substitute_template(dbo, template, tags)
@@ -1113,9 +1230,11 @@ def generate_movement_doc(dbo, template, movementid, username):
     m = movement.get_movement(dbo, movementid)
     if m is None:
         raise utils.ASMValidationError("%d is not a valid movement ID" % movementid)
-    tags = animal_tags(dbo, animal.get_animal(dbo, m["ANIMALID"]))
+    template = get_template(dbo, template)
+    used = template[2]
+    tags = animal_tags(dbo, animal.get_animal(dbo, m["ANIMALID"]), used)
     if m["OWNERID"] is not None and m["OWNERID"] != 0:
-        tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, m["OWNERID"])))
+        tags = append_tags(tags, person_tags(dbo, person.get_person(dbo, m["OWNERID"]), used))
     tags = append_tags(tags, movement_tags(dbo, m))
     tags = append_tags(tags, donation_tags(dbo, financial.get_movement_donations(dbo, movementid)))
     tags = append_tags(tags, org_tags(dbo, username))
@@ -0,0 +1,56 @@
+#!/usr/bin/python env
+
+"""
+Benchmarks converting query results to rows, comparing the original
+per cell encode_str loop with db.rows_to_dicts.
+Uses a synthetic resultset so it does not need a database:
+
+    python bench_db.py [rows]
+"""
+
+import base
+import datetime
+import sys
+import time
+
+import db
+
+def old_rows_to_dicts(dbo, cols, d):
+    """ The conversion db.query used to do """
+    l = []
+    for row in d:
+        rowmap = {}
+        for i in xrange(0, len(row)):
+            v = db.encode_str(dbo, row[i])
+            rowmap[cols[i]] = v
+        l.append(rowmap)
+    return l
+
+def make_rows(n):
+    cols = [ "ID", "ANIMALNAME", "SHELTERCODE", "SPECIESID", "BREEDID", "DATEBROUGHTIN",
+        "DATEOFBIRTH", "DECEASEDDATE", "ARCHIVED", "ANIMALCOMMENTS", "FEE", "LASTCHANGEDBY" ]
+    now = datetime.datetime.today()
+    rows = []
+    for i in xrange(0, n):
+        rows.append(( i, u"Animal %d" % i, u"C%06d" % i, 1, 221, now, now, None, 0,
+            u"Some comments with an apostrophe` and caf\xe9 %d" % i, 5000, u"user" ))
+    return cols, rows
+
+def bench(name, fn, *args):
+    start = time.time()
+    fn(*args)
+    tt = time.time() - start
+    print "%-25s %0.3f sec" % (name, tt)
+    return tt
+
+if __name__ == "__main__":
+    n = 100000
+    if len(sys.argv) > 1: n = int(sys.argv[1])
+    dbo = base.get_dbo()
+    cols, rows = make_rows(n)
+    print "Converting %d rows of %d columns" % (n, len(cols))
+    old = bench("encode_str per cell", old_rows_to_dicts, dbo, cols, rows)
+    new = bench("db.rows_to_dicts", db.rows_to_dicts, dbo, cols, rows)
+    print "rows_to_dicts speedup: %0.1fx" % (old / new)
+    assert old_rows_to_dicts(dbo, cols, rows[:100]) == db.rows_to_dicts(dbo, cols, rows[:100])
+
@@ -26,6 +26,10 @@ import test_csvimport
 suitecsv = unittest.makeSuite(test_csvimport.TestCSVImport, 'test')
 fullsuite.append(suitecsv)
 
+import test_db
+suitedb = unittest.makeSuite(test_db.TestDB, 'test')
+fullsuite.append(suitedb)
+
 import test_dbfs
 suitedbfs = unittest.makeSuite(test_dbfs.TestDBFS, 'test')
 fullsuite.append(suitedbfs)
@@ -82,6 +86,10 @@ import test_publish
 suitepublish = unittest.makeSuite(test_publish.TestPublish, 'test')
 fullsuite.append(suitepublish)
 
+import test_reports
+suitereports = unittest.makeSuite(test_reports.TestReports, 'test')
+fullsuite.append(suitereports)
+
 import test_search
 suitesearch = unittest.makeSuite(test_search.TestSearch, 'test')
 fullsuite.append(suitesearch)
@@ -102,6 +110,10 @@ import test_waitinglist
 suitewl = unittest.makeSuite(test_waitinglist.TestWaitingList, 'test')
 fullsuite.append(suitewl)
 
+import test_wordprocessor
+suitewp = unittest.makeSuite(test_wordprocessor.TestWordProcessor, 'test')
+fullsuite.append(suitewp)
+
 if __name__ == "__main__":
     dbupdate.perform_updates(base.get_dbo())
     s = unittest.TestSuite(fullsuite)
@@ -36,6 +36,13 @@ class TestAdditional(unittest.TestCase):
     def test_get_additional_fields_ids(self):
         additional.get_additional_fields_ids(base.get_dbo(), [], "animal")
 
+    def test_get_additional_fields_many(self):
+        dbo = base.get_dbo()
+        add = additional.get_additional_fields_many(dbo, [ 1, 2 ], "animal")
+        for linkid in ( 1, 2 ):
+            single = additional.get_additional_fields(dbo, linkid, "animal")
+            assert [ (x["ID"], x["VALUE"]) for x in add[linkid] ] == [ (x["ID"], x["VALUE"]) for x in single ]
+
     def test_get_field_definitions(self):
         assert len(additional.get_field_definitions(base.get_dbo(), "animal")) > 0
 
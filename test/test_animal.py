@@ -3,7 +3,13 @@
 import unittest
 import base
 
+import alerts
 import animal
+import db
+import configuration
+import datetime
+import stats
+import timeline
 import utils
 
 class TestAnimal(unittest.TestCase):
@@ -47,9 +53,94 @@ class TestAnimal(unittest.TestCase):
     def test_get_alerts(self):
         assert len(animal.get_alerts(base.get_dbo())) > 0
 
+    def test_stored_alerts(self):
+        dbo = base.get_dbo()
+        calc = db.query(dbo, alerts.get_alerts_query(dbo))[0]
+        assert alerts.rebuild(dbo)[0] == calc
+        assert alerts.get_alerts(dbo)[0] == calc
+        alerts.invalidate(dbo, "animalvaccination")
+        valid = "SELECT COUNT(*) FROM alertcount WHERE AlertName = '%s' AND CalcVersion = Version"
+        assert db.query_int(dbo, valid % "duevacc") == 0
+        assert db.query_int(dbo, valid % "notchip") == 1
+        assert alerts.get_alerts(dbo)[0] == calc
+        assert db.query_int(dbo, valid % "duevacc") == 1
+        # Updating an animal's status without changing it leaves the totals alone
+        animal.update_animal_status(dbo, self.nid)
+        db.execute(dbo, "UPDATE animal SET DisplayLocation = 'Moved' WHERE ID = %d" % self.nid)
+        animal.update_animal_status(dbo, self.nid)
+        assert db.query_int(dbo, valid % "notchip") == 1
+        # A total calculated before an invalidation is not stored
+        query = db.query
+        def invalidate_during_query(dbo, sql):
+            if sql.find("AS duevacc") != -1: alerts.invalidate(dbo, "animalvaccination")
+            return query(dbo, sql)
+        alerts.invalidate(dbo, "animalvaccination")
+        db.query = invalidate_during_query
+        try:
+            assert alerts.get_alerts(dbo)[0] == calc
+        finally:
+            db.query = query
+        assert db.query_int(dbo, valid % "duevacc") == 0
+        assert alerts.get_alerts(dbo)[0] == calc
+
     def test_get_stats(self):
         assert len(animal.get_stats(base.get_dbo())) > 0
 
+    def test_daily_stats(self):
+        dbo = base.get_dbo()
+        stats.rebuild_daily_stats(dbo)
+        assert stats.check_daily_stats(dbo, rebuild = False) == 0
+        before = stats.get_totals(dbo, datetime.datetime(1900, 1, 1))[0]
+        data = {
+            "animalid": self.nid,
+            "type": "1",
+            "costdate": base.today_display(),
+            "cost": "2000"
+        }
+        post = utils.PostedData(data, "en")
+        cid = animal.insert_cost_from_form(dbo, "test", post)
+        assert stats.get_totals(dbo, datetime.datetime(1900, 1, 1))[0]["COSTS"] == before["COSTS"] + 2000
+        assert stats.check_daily_stats(dbo, rebuild = False) == 0
+        # Rebuilding corrects the wrong days in place
+        db.execute(dbo, "UPDATE dailystats SET Costs = Costs + 1 WHERE StatDate = %s" % db.dd(base.today()))
+        assert stats.check_daily_stats(dbo, rebuild = False) == 1
+        stats.rebuild_daily_stats(dbo)
+        assert stats.daily_stats_built(dbo)
+        assert stats.check_daily_stats(dbo, rebuild = False) == 0
+        animal.delete_cost(dbo, "test", cid)
+        assert stats.get_totals(dbo, datetime.datetime(1900, 1, 1))[0] == before
+
+    def test_timeline(self):
+        dbo = base.get_dbo()
+        timeline.rebuild(dbo)
+        entered = "SELECT COUNT(*) FROM timeline WHERE LinkID = %d AND Category = 'ENTERED'" % self.nid
+        assert db.query_int(dbo, entered) == 1
+        timeline.update(dbo, timeline.ANIMAL, self.nid)
+        assert db.query_int(dbo, entered) == 1
+        evts = animal.get_timeline(dbo, 5)
+        assert len(evts) > 0
+        older = animal.get_timeline(dbo, 5, evts[-1]["EVENTDATE"], evts[-1]["EVENTID"])
+        assert len(set([ e["EVENTID"] for e in evts ]).intersection([ e["EVENTID"] for e in older ])) == 0
+        data = {
+            "animalname": "Testio2",
+            "estimatedage": "1",
+            "animaltype": "1",
+            "entryreason": "1",
+            "species": "1"
+        }
+        nid, code = animal.insert_animal_from_form(dbo, utils.PostedData(data, "en"), "test")
+        entered = "SELECT COUNT(*) FROM timeline WHERE LinkID = %d AND Category = 'ENTERED'" % nid
+        assert db.query_int(dbo, entered) == 1
+        animal.delete_animal(dbo, "test", nid)
+        assert db.query_int(dbo, entered) == 0
+        # Changes made without updating the timeline are corrected by the check
+        assert timeline.check_timeline(dbo) == 0
+        db.execute(dbo, "UPDATE animal SET AnimalName = 'Testio3' WHERE ID = %d" % self.nid)
+        db.execute(dbo, "DELETE FROM timeline WHERE LinkID = %d AND Category = 'ENTERED'" % self.nid)
+        assert timeline.check_timeline(dbo) > 0
+        assert timeline.check_timeline(dbo, correct = False) == 0
+        assert db.query_int(dbo, "SELECT COUNT(*) FROM timeline WHERE LinkID = %d AND Text2 = 'Testio3'" % self.nid) > 0
+
     def test_calc_fields(self):
         assert animal.calc_most_recent_entry(base.get_dbo(), self.nid) is not None
         assert animal.calc_time_on_shelter(base.get_dbo(), self.nid) is not None
@@ -239,7 +330,13 @@ class TestAnimal(unittest.TestCase):
 
     def test_update_all_variable_animal_data(self):
         base.execute("DELETE FROM configuration WHERE ItemName LIKE 'VariableAnimalDataUpdated'")
-        animal.update_all_variable_animal_data(base.get_dbo())
+        configuration.invalidate(base.get_dbo())
+        animal.update_all_variable_animal_data(base.get_dbo(), chunksize=2)
+
+    def test_calc_age_group(self):
+        dbo = base.get_dbo()
+        bands = animal.get_age_group_bands(dbo)
+        assert animal.calc_age_group(dbo, self.nid, bands=bands) == animal.calc_age_group(dbo, self.nid)
 
     def test_update_all_animal_statuses(self):
         animal.update_all_animal_statuses(base.get_dbo())
@@ -258,6 +355,14 @@ class TestAnimal(unittest.TestCase):
         animal.get_number_litters_on_shelter(base.get_dbo(), base.today())
         animal.get_number_animals_on_foster(base.get_dbo(), base.today(), 1)
 
+    def test_get_number_animals_on_shelter_foster_days(self):
+        dbo = base.get_dbo()
+        d = base.today()
+        o = animal.get_number_animals_on_shelter_foster_days(dbo, [ d ])
+        assert o["onshelter"][("SP", 1, 0)][0] == animal.get_number_animals_on_shelter(dbo, d, 1)
+        assert o["onfoster"].get(("SP", 1), [0])[0] == animal.get_number_animals_on_foster(dbo, d, 1)
+        assert o["litters"].get(0, [0])[0] == animal.get_number_litters_on_shelter(dbo, d)
+
     def test_animal_figures(self):
         animal.update_animal_figures(base.get_dbo())
         animal.update_animal_figures_annual(base.get_dbo())
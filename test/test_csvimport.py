@@ -4,13 +4,62 @@ import unittest
 import base
 
 import csvimport
+import db
+import stats
 
 class TestCSVImport(unittest.TestCase):
 
     def tearDown(self):
         base.execute("DELETE FROM animal WHERE AnimalName = 'TestioCSV'")
+        base.execute("DELETE FROM ownerdonation WHERE OwnerID IN (SELECT ID FROM owner WHERE OwnerSurname = 'TestioCSV')")
+        base.execute("DELETE FROM owner WHERE OwnerSurname = 'TestioCSV'")
 
     def test_csvimport(self):
         csvdata = "ANIMALNAME,ANIMALSEX,ANIMALAGE\n\"TestioCSV\",\"Male\",\"2\"\n"
         csvimport.csvimport(base.get_dbo(), csvdata)
 
+    def test_csvimport_batch(self):
+        csvdata = "PERSONFIRSTNAME,PERSONLASTNAME,PERSONADDRESS,PERSONEMAIL,DONATIONAMOUNT,DONATIONDATE\n" \
+            "\"Bob\",\"TestioCSV\",\"1 Some Street\",\"bob@testio.com\",\"10.00\",\"2014-01-15\"\n" \
+            "\"Bob\",\"TestioCSV\",\"1 Some Street\",\"bob@testio.com\",\"5.00\",\"2014-01-15\"\n" \
+            "\"Jim\",\"TestioCSV\",\"2 Some Street\",\"\",\"2.50\",\"2014-01-16\"\n"
+        stats.rebuild_daily_stats(base.get_dbo())
+        csvimport.BATCH_SIZE = 2
+        try:
+            assert len(csvimport.csvimport(base.get_dbo(), csvdata, checkduplicates = True)) == 0
+        finally:
+            csvimport.BATCH_SIZE = 500
+        assert 2 == db.query_int(base.get_dbo(), "SELECT COUNT(*) FROM owner WHERE OwnerSurname = 'TestioCSV'")
+        assert 1750 == db.query_int(base.get_dbo(), "SELECT SUM(Donation) FROM ownerdonation " \
+            "WHERE OwnerID IN (SELECT ID FROM owner WHERE OwnerSurname = 'TestioCSV')")
+        assert 0 == stats.check_daily_stats(base.get_dbo(), rebuild = False)
+
+    def test_write_batch_rollback(self):
+        dbo = base.get_dbo()
+        batch = csvimport.new_batch()
+        p = { "title": "", "initials": "", "forenames": "Bob", "surname": "TestioCSV", "address": "1 Some Street",
+            "town": "", "county": "", "postcode": "", "hometelephone": "", "worktelephone": "", "mobiletelephone": "", "emailaddress": "" }
+        csvimport.batch_person(dbo, batch, p)
+        batch["ownerdonation"].append({ "ID": 0, "NoSuchColumn": 1 })
+        self.assertRaises(Exception, csvimport.write_batch, dbo, batch)
+        assert 0 == db.query_int(dbo, "SELECT COUNT(*) FROM owner WHERE OwnerSurname = 'TestioCSV'")
+
+    def test_write_rows_batch(self):
+        dbo = base.get_dbo()
+        batch = csvimport.new_batch()
+        p = { "title": "", "initials": "", "forenames": "Bob", "surname": "TestioCSV", "address": "1 Some Street",
+            "town": "", "county": "", "postcode": "", "hometelephone": "", "worktelephone": "", "mobiletelephone": "", "emailaddress": "" }
+        good = csvimport.batch_person(dbo, batch, p, 0, 1)
+        bad = csvimport.batch_person(dbo, batch, dict(p, forenames = "Jim"), 0, 2)
+        csvimport.batch_add(batch, "ownerdonation", { "ID": 0, "NoSuchColumn": 1 }, 2)
+        errors = []
+        failed = csvimport.write_rows_batch(dbo, batch, [ (1, {}), (2, {}) ], errors)
+        assert failed == set([ 2 ])
+        assert len(errors) == 1 and errors[0][0] == 2
+        assert good["ID"] != 0 and bad["ID"] == 0
+        assert 1 == db.query_int(dbo, "SELECT COUNT(*) FROM owner WHERE OwnerSurname = 'TestioCSV'")
+
+    def test_get_ids(self):
+        ids = db.get_ids(base.get_dbo(), "owner", 3)
+        assert len(ids) == 3 and ids[0] < ids[1] < ids[2]
+
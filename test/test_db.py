@@ -0,0 +1,127 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+
+import db
+
+class FakeConnection(object):
+    closed = False
+    def cursor(self):
+        return FakeCursor()
+    def commit(self):
+        pass
+    def close(self):
+        self.closed = True
+
+class FakeCursor(object):
+    def execute(self, sql):
+        pass
+    def fetchall(self):
+        return []
+    def close(self):
+        pass
+
+class RecordingPool(object):
+    """ A pool that hands out real connections and records them being returned """
+    def __init__(self):
+        self.puts = 0
+        self.discards = 0
+    def get(self, dbo):
+        return db.connection(dbo)
+    def put(self, c):
+        self.puts += 1
+        c.close()
+    def discard(self, c):
+        self.discards += 1
+        c.close()
+    def set_timeout(self, dbo, c, s, ms):
+        pass
+
+class TestDB(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = db.connection
+        self.pool = db.pool
+        db.connection = lambda dbo: FakeConnection()
+        db.pools_idle["count"] = 0
+
+    def tearDown(self):
+        db.connection = self.connection
+        db.pool = self.pool
+
+    def test_pool_reuse(self):
+        p = db.ConnectionPool(base.get_dbo())
+        c = p.get(base.get_dbo())
+        p.put(c)
+        assert p.get(base.get_dbo()) is c
+        assert not c.closed
+
+    def test_pool_discard(self):
+        p = db.ConnectionPool(base.get_dbo())
+        c = p.get(base.get_dbo())
+        p.discard(c)
+        p.put(c)
+        assert c.closed
+        assert len(p.idle) == 0
+        assert p.get(base.get_dbo()) is not c
+
+    def test_pool_max_size(self):
+        p = db.ConnectionPool(base.get_dbo())
+        conns = [ p.get(base.get_dbo()) for dummy in xrange(0, db.DB_POOL_MAX_SIZE + 2) ]
+        assert len(set([ id(c) for c in conns ])) == len(conns)
+        for c in conns: p.put(c)
+        assert len(p.idle) == db.DB_POOL_MAX_SIZE
+        assert len([ c for c in conns if c.closed ]) == 2
+
+    def test_pool_max_total(self):
+        p1 = db.ConnectionPool(base.get_dbo())
+        p2 = db.ConnectionPool(base.get_dbo())
+        db.pools_idle["count"] = db.DB_POOL_MAX_TOTAL - 1
+        c1 = p1.get(base.get_dbo())
+        c2 = p2.get(base.get_dbo())
+        p1.put(c1)
+        p2.put(c2)
+        assert len(p1.idle) == 1 and not c1.closed
+        assert len(p2.idle) == 0 and c2.closed
+        p1.get(base.get_dbo())
+        assert db.pools_idle["count"] == db.DB_POOL_MAX_TOTAL - 1
+
+    def test_pool_reap(self):
+        p = db.ConnectionPool(base.get_dbo())
+        c1 = p.get(base.get_dbo())
+        c2 = p.get(base.get_dbo())
+        p.put(c1)
+        p.put(c2)
+        p.idle[0]["returned"] -= db.DB_POOL_MAX_IDLE + 1
+        p.reap()
+        assert c1.closed and not c2.closed
+        assert len(p.idle) == 1
+        assert db.pools_idle["count"] == 1
+
+    def test_pool_timeout(self):
+        sent = []
+        settimeout = db.set_timeout
+        db.set_timeout = lambda dbo, c, s, ms: sent.append(ms)
+        try:
+            p = db.ConnectionPool(base.get_dbo())
+            c = p.get(base.get_dbo())
+            p.set_timeout(base.get_dbo(), c, None, 100)
+            p.put(c)
+            c = p.get(base.get_dbo())
+            p.set_timeout(base.get_dbo(), c, None, 100)
+            p.set_timeout(base.get_dbo(), c, None, 0)
+            assert sent == [ 100, 0 ]
+        finally:
+            db.set_timeout = settimeout
+
+    def test_query_returns_connection_once(self):
+        db.connection = self.connection
+        rp = RecordingPool()
+        db.pool = lambda dbo: rp
+        db.query(base.get_dbo(), "SELECT COUNT(*) FROM lksex")
+        db.query_tuple(base.get_dbo(), "SELECT COUNT(*) FROM lksex")
+        db.execute(base.get_dbo(), "UPDATE lksex SET Sex = Sex WHERE ID = 0")
+        assert rp.puts == 3
+        assert rp.discards == 0
+
@@ -2,6 +2,7 @@
 
 import unittest
 import base
+import datetime
 
 import financial
 import utils
@@ -130,6 +131,27 @@ class TestFinancial(unittest.TestCase):
         financial.update_trx_from_form(base.get_dbo(), "test", post)
         financial.delete_trx(base.get_dbo(), "test", tid)
 
+    def test_account_balances(self):
+        dbo = base.get_dbo()
+        financial.rebuild_account_balances(dbo)
+        data = {
+            "trxdate": base.today_display(),
+            "deposit": "1000",
+            "withdrawal": "0",
+            "accountid": "1",
+            "otheraccount": "Income::Donation",
+            "description": "Test"
+        }
+        post = utils.PostedData(data, "en")
+        before = financial.get_balance_to_date(dbo, 1, base.today() + datetime.timedelta(days=1))
+        tid = financial.insert_trx_from_form(dbo, "test", post)
+        assert financial.get_balance_to_date(dbo, 1, base.today() + datetime.timedelta(days=1)) == before + 1000
+        financial.mark_reconciled(dbo, tid)
+        assert 0 == financial.check_account_balances(dbo, rebuild = False)
+        financial.delete_trx(dbo, "test", tid)
+        assert financial.get_balance_to_date(dbo, 1, base.today() + datetime.timedelta(days=1)) == before
+        assert 0 == financial.check_account_balances(dbo, rebuild = False)
+
     def test_voucher_crud(self):
         data = {
             "personid": "1",
@@ -2,11 +2,56 @@
 
 import unittest
 import base
+import datetime
 
+import cachemem
+import db
 import geo
+import utils
 
 class TestGeo(unittest.TestCase):
  
     def test_get_lat_long(self):
         assert geo.get_lat_long(base.get_dbo(), "109 Greystones Road", "Rotherham", "South Yorkshire", "S60 2AH", "England") is not None
 
+    def test_get_cached_lat_long(self):
+        dbo = base.get_dbo()
+        q, url = geo.get_query(dbo, "1 Test Street", "Testtown", "Testshire", "TT1 1TT", "England")
+        geo.put_cached_lat_long(dbo, q, "1.0,2.0,na")
+        assert geo.get_cached_lat_long(dbo, q) == "1.0,2.0,na"
+        assert geo.get_lat_long(dbo, "1 Test Street", "Testtown", "Testshire", "TT1 1TT", "England") == "1.0,2.0,na"
+        geo.put_cached_lat_long(dbo, q, None)
+        assert geo.get_cached_lat_long(dbo, q) == ""
+        assert geo.get_lat_long(dbo, "1 Test Street", "Testtown", "Testshire", "TT1 1TT", "England") is None
+
+    def test_get_cached_lat_long_expiry(self):
+        dbo = base.get_dbo()
+        q, url = geo.get_query(dbo, "2 Test Street", "Testtown", "Testshire", "TT1 1TT", "England")
+        geo.put_cached_lat_long(dbo, q, None)
+        db.execute(dbo, "UPDATE geocache SET CreatedDate = %s WHERE Query = %s" % (db.ddt(base.today() - datetime.timedelta(days = 365)), db.ds(q)))
+        cachemem.delete(geo._cache_key(q))
+        assert geo.get_cached_lat_long(dbo, q) is None
+
+    def test_lookup_errors_not_cached(self):
+        dbo = base.get_dbo()
+        q, url = geo.get_query(dbo, "3 Test Street", "Testtown", "Testshire", "TT1 1TT", "England")
+        db.execute(dbo, "DELETE FROM geocache WHERE Query = %s" % db.ds(q))
+        get_url = utils.get_url
+        try:
+            utils.get_url = lambda url, timeout: { "response": "{\"error\": \"Too many requests\"}" }
+            assert geo._lookup(dbo, q, url) is None
+            assert geo.get_cached_lat_long(dbo, q) is None
+            utils.get_url = lambda url, timeout: { "response": "[]" }
+            assert geo._lookup(dbo, q, url) is None
+            assert geo.get_cached_lat_long(dbo, q) == ""
+        finally:
+            utils.get_url = get_url
+
+    def test_token_bucket(self):
+        b = geo.TokenBucket(0)
+        b.consume()
+        b = geo.TokenBucket(1000, 2)
+        b.consume()
+        b.consume()
+        b.consume()
+
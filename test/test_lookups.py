@@ -3,6 +3,7 @@
 import unittest
 import base
 
+import cachemem
 import lookups
 
 class TestLookups(unittest.TestCase):
@@ -22,6 +23,26 @@ class TestLookups(unittest.TestCase):
         nid = lookups.insert_lookup(base.get_dbo(), "vaccinationtype", "Test")
         lookups.update_lookup(base.get_dbo(), nid, "vaccinationtype", "Test")
         lookups.delete_lookup(base.get_dbo(), "vaccinationtype", nid)
+
+    def test_lookup_cache(self):
+        dbo = base.get_dbo()
+        nid = lookups.insert_lookup(dbo, "species", "Test")
+        assert lookups.get_species_name(dbo, nid) == "Test"
+        assert nid in [ x["ID"] for x in lookups.get_species(dbo) ]
+        lookups.update_lookup(dbo, nid, "species", "Test2")
+        assert lookups.get_species_name(dbo, nid) == "Test2"
+        lookups.delete_lookup(dbo, "species", nid)
+        assert lookups.get_species_name(dbo, nid) == ""
+        assert nid not in [ x["ID"] for x in lookups.get_species(dbo) ]
+
+    def test_lookup_cache_version_check(self):
+        dbo = base.get_dbo()
+        snap = lookups._snapshot(dbo)
+        # Changes from another process are only seen when the token is next checked
+        cachemem.put(lookups._version_key(dbo), "another", 86400)
+        assert lookups._snapshot(dbo) is snap
+        snap["checked"] = 0
+        assert lookups._snapshot(dbo) is not snap
              
     def test_get(self):
         assert lookups.get_account_types(base.get_dbo()) > 0
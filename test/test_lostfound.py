@@ -69,6 +69,13 @@ class TestLostFound(unittest.TestCase):
     def test_get_foundanimal_satellite_counts(self):
         assert len(lostfound.get_foundanimal_satellite_counts(base.get_dbo(), self.faid)) > 0
 
+    def test_match(self):
+        dbo = base.get_dbo()
+        assert self.faid in [ m.fid for m in lostfound.match(dbo, self.laid) ]
+        lostfound.update_matches(dbo)
+        lostfound.update_matches(dbo)
+        assert 1 == len([ m for m in lostfound.get_matches(dbo) if m.lid == self.laid and m.fid == self.faid ])
+
     def test_update_match_report(self):
         lostfound.update_match_report(base.get_dbo())
 
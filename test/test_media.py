@@ -1,7 +1,7 @@
 #!/usr/bin/python env
 
 import unittest
-import base, base64
+import base, base64, datetime, time
 
 import animal, media
 import utils
@@ -26,3 +26,44 @@ class TestMedia(unittest.TestCase):
         animal.delete_animal(base.get_dbo(), "test", nid)
  
 
+
+    def test_get_scaled_image(self):
+        f = open(base.PATH + "../src/media/reports/nopic.jpg", "rb")
+        data = f.read()
+        f.close()
+        dbo = base.get_dbo()
+        media.cache_scaled_images(dbo, 0, None, data)
+        row = { "ID": 0, "DATE": None, "MEDIANAME": "nopic.jpg" }
+        assert media.get_scaled_image(dbo, row, "thumbnail") == media.scale_thumbnail(data)
+        media.delete_scaled_images(dbo, 0, None)
+
+    def test_rotate_media(self):
+        data = {
+            "animalname": "Testio",
+            "estimatedage": "1",
+            "animaltype": "1",
+            "entryreason": "1",
+            "species": "1"
+        }
+        dbo = base.get_dbo()
+        post = utils.PostedData(data, "en")
+        nid, code = animal.insert_animal_from_form(dbo, post, "test")
+        f = open(base.PATH + "../src/media/reports/nopic.jpg", "rb")
+        data = f.read()
+        f.close()
+        post = utils.PostedData({ "filedata": "data:image/jpeg;base64," + base64.b64encode(data), "filetype": "image/jpeg",
+            "filename": "nopic.jpg", "comments": "" }, "en")
+        media.attach_file_from_form(dbo, "test", media.ANIMAL, nid, post)
+        m = media.get_image_media(dbo, media.ANIMAL, nid)[0]
+        time.sleep(1)
+        media.rotate_media(dbo, "test", m["ID"])
+        # A rotation on the same day must still change the ETag
+        assert media.get_image_etag(dbo, m) != media.get_image_etag(dbo, media.get_media_by_id(dbo, m["ID"])[0])
+        animal.delete_animal(dbo, "test", nid)
+
+    def test_get_image_last_modified(self):
+        dbo = base.get_dbo()
+        d = datetime.datetime(2015, 6, 1, 12, 0, 0)
+        utc = datetime.datetime.utcfromtimestamp(time.mktime(d.timetuple()))
+        assert media.get_image_last_modified(dbo, { "DATE": d + datetime.timedelta(hours = dbo.timezone) }) == utc
+        assert media.get_image_last_modified(dbo, { "DATE": None }) is None
@@ -111,6 +111,19 @@ class TestPerson(unittest.TestCase):
     def test_update_missing_geocodes(self):
         person.update_missing_geocodes(base.get_dbo())
 
+    def test_get_lookingfor_predicates(self):
+        p = { "MATCHANIMALTYPE": -1, "MATCHSPECIES": 1, "MATCHBREED": 2, "MATCHSEX": -1, "MATCHSIZE": -1, "MATCHCOLOUR": -1,
+            "MATCHGOODWITHCHILDREN": -1, "MATCHGOODWITHCATS": 0, "MATCHGOODWITHDOGS": -1, "MATCHHOUSETRAINED": -1,
+            "MATCHAGEFROM": 0, "MATCHAGETO": 0, "MATCHCOMMENTSCONTAIN": "friendly" }
+        a = { "SPECIESID": 1, "BREEDID": 1, "BREED2ID": 2, "ISGOODWITHCATS": 0, "ANIMALCOMMENTS": "Very Friendly" }
+        preds = person.get_lookingfor_predicates(base.get_dbo(), p)
+        assert all(f(a) for f in preds)
+        a["ISGOODWITHCATS"] = 1
+        assert not all(f(a) for f in preds)
+        p["MATCHCOMMENTSCONTAIN"] = "owner's"
+        a = { "SPECIESID": 1, "BREEDID": 1, "BREED2ID": 2, "ISGOODWITHCATS": 0, "ANIMALCOMMENTS": "Left at the owner's house" }
+        assert all(f(a) for f in person.get_lookingfor_predicates(base.get_dbo(), p))
+
     def test_update_lookingfor_report(self):
         person.update_lookingfor_report(base.get_dbo())
 
@@ -3,8 +3,40 @@
 import unittest
 import base
 
+import dbfs
+import os
 import publish
 
+class FakeFTP:
+    """ Stands in for ftplib.FTP, failing the first upload of each file """
+    files = {}
+    attempts = {}
+    def __init__(self, host = "", timeout = 0): self.dir = ""
+    def login(self, user, password): pass
+    def set_pasv(self, passive): pass
+    def cwd(self, d): 
+        for x in d.split("/"):
+            if x == "..": self.dir = self.dir[0:max(self.dir.rfind("/"), 0)]
+            elif self.dir == "": self.dir = x
+            else: self.dir += "/" + x
+    def mkd(self, d): pass
+    def retrlines(self, cmd, callback = None): pass
+    def nlst(self): return [ k[1] for k in FakeFTP.files.keys() if k[0] == self.dir ]
+    def quit(self): pass
+    def storbinary(self, cmd, f, callback = None):
+        name = cmd[5:]
+        FakeFTP.attempts[name] = FakeFTP.attempts.get(name, 0) + 1
+        if FakeFTP.attempts[name] == 1: raise IOError("connection reset")
+        FakeFTP.files[(self.dir, name)] = f.read()
+
+class FailingPublisher(publish.FTPPublisher):
+    """ Queues an upload and then fails """
+    def publish(self):
+        self.openFTPSocket()
+        self.saveFile(os.path.join(self.publishDir, "fail.jpg"), "fail")
+        self.queueUpload("fail.jpg")
+        raise IOError("publisher failed")
+
 class TestPublish(unittest.TestCase):
  
     def test_gen_avid_pdf(self):
@@ -45,3 +77,129 @@ class TestPublish(unittest.TestCase):
         f.flush()
         f.close()
 
+
+    def test_publish_snapshot(self):
+        dbo = base.get_dbo()
+        pc = publish.PublishCriteria()
+        s = publish.PublishSnapshot(dbo)
+        try:
+            rows = s.getAnimalData(pc)
+            assert len(rows) == len(publish.get_animal_data(dbo, pc))
+            assert len(s.animals) == 1
+            s.getAnimalData(pc)
+            assert len(s.animals) == 1
+            if len(rows) > 0: 
+                rows[0]["ANIMALNAME"] = "Changed"
+                assert s.getAnimalData(pc)[0]["ANIMALNAME"] != "Changed"
+        finally:
+            s.cleanup()
+
+
+    def test_merge_bonded_animals(self):
+        rows = [
+            { "ID": 1, "ANIMALNAME": "Alpha", "BONDEDANIMALID": 2, "BONDEDANIMAL2ID": 3 },
+            { "ID": 2, "ANIMALNAME": "Beta", "BONDEDANIMALID": 1, "BONDEDANIMAL2ID": 3 },
+            { "ID": 3, "ANIMALNAME": "Gamma", "BONDEDANIMALID": 1, "BONDEDANIMAL2ID": 2 },
+            { "ID": 4, "ANIMALNAME": "Delta", "BONDEDANIMALID": 0, "BONDEDANIMAL2ID": None },
+            { "ID": 5, "ANIMALNAME": "Epsilon", "BONDEDANIMALID": 99, "BONDEDANIMAL2ID": 0 }
+        ]
+        rows = publish.merge_bonded_animals(rows)
+        assert [ r["ANIMALNAME"] for r in rows ] == [ "Alpha, Beta, Gamma", "Delta", "Epsilon" ]
+
+    def test_ftp_upload_pool(self):
+        dbo = base.get_dbo()
+        realftp = publish.ftplib.FTP
+        publish.ftplib.FTP = FakeFTP
+        FakeFTP.files = {}
+        FakeFTP.attempts = {}
+        try:
+            pc = publish.PublishCriteria()
+            pc.uploadDirectly = True
+            p = publish.FTPPublisher(dbo, pc, "localhost", "user", "pass")
+            p.setLogName("testpool")
+            p.currentDir = "photos"
+            for i in xrange(0, 10):
+                p.saveFile(os.path.join(p.publishDir, "test-%d.jpg" % i), "image %d" % i)
+                p.queueUpload("test-%d.jpg" % i)
+            p.closeFTPSocket()
+            assert len(FakeFTP.files) == 10
+            assert FakeFTP.files[("photos", "test-3.jpg")] == "image 3"
+            # Unchanged files are skipped on the next run, changed ones are sent
+            p.saveFile(os.path.join(p.publishDir, "test-3.jpg"), "changed")
+            for i in xrange(0, 10):
+                p.queueUpload("test-%d.jpg" % i)
+            p.closeFTPSocket()
+            assert FakeFTP.attempts["test-3.jpg"] == 3
+            assert FakeFTP.attempts["test-4.jpg"] == 2
+            assert FakeFTP.files[("photos", "test-3.jpg")] == "changed"
+        finally:
+            publish.ftplib.FTP = realftp
+            p.deletePublishDirectory()
+
+    def test_ftp_upload_pool_root(self):
+        dbo = base.get_dbo()
+        realftp = publish.ftplib.FTP
+        publish.ftplib.FTP = FakeFTP
+        FakeFTP.files = {}
+        FakeFTP.attempts = {}
+        try:
+            pc = publish.PublishCriteria()
+            pc.uploadDirectly = True
+            p = publish.FTPPublisher(dbo, pc, "localhost", "user", "pass", ftproot = "public_html")
+            p.setLogName("testpoolroot")
+            p.openFTPSocket()
+            p.saveFile(os.path.join(p.publishDir, "root.jpg"), "root")
+            p.queueUpload("root.jpg")
+            p.chdir("photos")
+            p.saveFile(os.path.join(p.publishDir, "photo.jpg"), "photo")
+            p.queueUpload("photo.jpg")
+            p.closeFTPSocket()
+            assert FakeFTP.files[("public_html", "root.jpg")] == "root"
+            assert FakeFTP.files[("public_html/photos", "photo.jpg")] == "photo"
+            assert FakeFTP.attempts["root.jpg"] == 2
+        finally:
+            publish.ftplib.FTP = realftp
+            p.deletePublishDirectory()
+
+    def test_ftp_upload_pool_run_fails(self):
+        dbo = base.get_dbo()
+        realftp = publish.ftplib.FTP
+        publish.ftplib.FTP = FakeFTP
+        FakeFTP.files = {}
+        FakeFTP.attempts = {}
+        try:
+            pc = publish.PublishCriteria()
+            pc.uploadDirectly = True
+            p = FailingPublisher(dbo, pc, "localhost", "user", "pass")
+            p.setLogName("testpoolfail")
+            self.assertRaises(IOError, p.run)
+            assert p.uploadPool is None
+            assert FakeFTP.files[("", "fail.jpg")] == "fail"
+        finally:
+            publish.ftplib.FTP = realftp
+            p.deletePublishDirectory()
+    def test_ftp_upload_pool_manifest_expiry(self):
+        dbo = base.get_dbo()
+        realftp = publish.ftplib.FTP
+        publish.ftplib.FTP = FakeFTP
+        FakeFTP.files = {}
+        FakeFTP.attempts = {}
+        try:
+            pc = publish.PublishCriteria()
+            pc.uploadDirectly = True
+            p = publish.FTPPublisher(dbo, pc, "localhost", "user", "pass")
+            p.setLogName("testpoolexpiry")
+            name = "%s_%s.manifest" % (p.publisherKey, p.ftphost)
+            dbfs.put_string(dbo, name, "/publish", "old.jpg\tabc\t2000-01-01\nrecent.jpg\tdef")
+            p.openFTPSocket()
+            p.saveFile(os.path.join(p.publishDir, "new.jpg"), "new")
+            p.queueUpload("new.jpg")
+            p.closeFTPSocket()
+            manifest = dbfs.get_string(dbo, name, "/publish")
+            assert manifest.find("old.jpg") == -1
+            assert manifest.find("recent.jpg\tdef\t") != -1
+            assert manifest.find("new.jpg\t") != -1
+        finally:
+            publish.ftplib.FTP = realftp
+            p.deletePublishDirectory()
+
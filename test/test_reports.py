@@ -0,0 +1,70 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+
+import reports
+
+HTML = "$$HEADER\n<table>\nHEADER$$\n$$BODY\n<tr><td>$ID</td><td>$SPECIESNAME</td></tr>\nBODY$$\n$$FOOTER\n</table>\nFOOTER$$\n"
+
+class TestReports(unittest.TestCase):
+
+    def new_report(self, sql, html):
+        r = reports.Report(base.get_dbo())
+        r.title = "Test"
+        r.sql = sql
+        r.html = html
+        r.omitCriteria = True
+        r.omitHeaderFooter = True
+        return r
+
+    def test_execute_stream(self):
+        sql = "SELECT ID, SpeciesName FROM species ORDER BY ID"
+        s = self.new_report(sql, HTML).Execute()
+        chunkrows = reports.STREAM_CHUNK_ROWS
+        try:
+            reports.STREAM_CHUNK_ROWS = 1
+            chunks = list(self.new_report(sql, HTML).ExecuteStream())
+        finally:
+            reports.STREAM_CHUNK_ROWS = chunkrows
+        assert len(chunks) > 2
+        assert "".join(chunks) == s
+        assert s.find("<td>1</td>") != -1
+
+    def test_execute_stream_validates(self):
+        self.assertRaises(Exception, self.new_report("DELETE FROM species", HTML).ExecuteStream)
+
+    def test_uses_resultset(self):
+        r = self.new_report("", HTML)
+        assert not r._UsesResultset("<style>td { color: red }</style><h1>$$TITLE$$</h1>{QR.1}")
+        assert r._UsesResultset("<p>{COUNT.ID}</p>")
+        assert r._UsesResultset("<p>$SPECIESNAME</p>")
+
+    def test_get_parentkey_criteria(self):
+        assert reports.get_parentkey_criteria("SELECT * FROM animal a WHERE a.ID = $PARENTKEY$") is not None
+        assert reports.get_parentkey_criteria("SELECT * FROM animal a WHERE a.Archived = 0 AND a.ID = $PARENTKEY$ ORDER BY a.ID").group(1) == "a.ID"
+        assert reports.get_parentkey_criteria("SELECT * FROM animal a WHERE a.ID = $PARENTKEY$ AND (a.Archived = 0 OR a.Sex = 1)") is not None
+        assert reports.get_parentkey_criteria("SELECT * FROM animal a WHERE a.ID = $PARENTKEY$ AND a.AnimalName <> 'or (not'") is not None
+        assert reports.get_parentkey_criteria("SELECT * FROM animal a WHERE a.Archived = 0 OR a.ID = $PARENTKEY$") is None
+        assert reports.get_parentkey_criteria("SELECT * FROM animal a WHERE (a.ID = $PARENTKEY$ OR a.ID = 0)") is None
+        assert reports.get_parentkey_criteria("SELECT * FROM animal a WHERE NOT a.ID = $PARENTKEY$") is None
+        assert reports.get_parentkey_criteria("SELECT * FROM animal a LEFT OUTER JOIN adoption ad ON ad.AnimalID = $PARENTKEY$ WHERE a.Archived = 0") is None
+        assert reports.get_parentkey_criteria("SELECT * FROM animal a LEFT OUTER JOIN adoption ad ON ad.AnimalID = $PARENTKEY$") is None
+
+    def test_query_subreport_rows(self):
+        r = self.new_report("SELECT ID FROM species", HTML)
+        d = { "TITLE": "sub", "CATEGORY": "", "HTMLBODY": HTML, "OMITCRITERIA": 1, "OMITHEADERFOOTER": 1,
+            "SQLCOMMAND": "SELECT ID, SpeciesName FROM species WHERE ID = $PARENTKEY$ ORDER BY ID" }
+        rows = r._QuerySubReportRows(d, [ "1", "2" ])
+        assert rows["1"][0]["SPECIESNAME"] is not None
+        assert not rows["1"][0].has_key("ASM_PARENTKEY")
+        d["SQLCOMMAND"] = "SELECT ID, SpeciesName FROM species WHERE ID = $PARENTKEY$ OR ID = 1"
+        assert r._QuerySubReportRows(d, [ "1", "2" ]) is None
+
+    def test_report_template(self):
+        t = reports.ReportTemplate("<td>$ID</td><td>$ANIMALNAME, $ANIMALNAMEX $IDs</td>", [ "ID", "ANIMAL", "ANIMALNAME" ])
+        assert t.fields == [ "ID", "ANIMALNAME" ]
+        s = t.render({ "ID": 1, "ANIMAL": "x", "ANIMALNAME": "{$Rex}" }, lambda k, v: str(v))
+        assert s == "<td>1</td><td>&#123;&#36;Rex&#125;, $ANIMALNAMEX $IDs</td>"
+        assert reports.ReportTemplate("no fields", [ "ID" ]).render({ "ID": 1 }, lambda k, v: str(v)) == "no fields"
+
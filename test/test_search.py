@@ -3,7 +3,10 @@
 import unittest
 import base, base64
 
+import animal
+import lookups
 import search
+import searchindex
 import utils
 
 class FakeSession:
@@ -22,3 +25,69 @@ class TestSearch(unittest.TestCase):
         for k in keywords:
             search.search(base.get_dbo(), FakeSession(), k)
 
+    def test_search_index(self):
+        assert searchindex.get_trigrams("Fido Rex") == set([ "fid", "ido", "rex" ])
+        dbo = base.get_dbo()
+        searchindex.rebuild(dbo)
+        assert searchindex.is_built(dbo)
+        data = {
+            "animalname": "Indexio",
+            "estimatedage": "1",
+            "animaltype": "1",
+            "entryreason": "1",
+            "species": "1"
+        }
+        post = utils.PostedData(data, "en")
+        nid, code = animal.insert_animal_from_form(dbo, post, "test")
+        assert nid in searchindex.get_candidates(dbo, searchindex.ANIMAL, "dexi")
+        assert len(animal.get_animal_find_simple(dbo, "dexi")) > 0
+        maxcandidates = searchindex.MAX_CANDIDATES
+        try:
+            searchindex.MAX_CANDIDATES = 0
+            assert searchindex.get_candidates(dbo, searchindex.ANIMAL, "dexi") is None
+        finally:
+            searchindex.MAX_CANDIDATES = maxcandidates
+        animal.delete_animal(dbo, "test", nid)
+        assert nid not in searchindex.get_candidates(dbo, searchindex.ANIMAL, "dexi")
+        assert searchindex.get_candidates(dbo, searchindex.ANIMALCONTROL, "1") is None
+
+
+    def test_search_index_apostrophe(self):
+        assert searchindex.get_trigrams("O'Brien") == searchindex.get_trigrams("o`brien")
+        dbo = base.get_dbo()
+        searchindex.rebuild(dbo)
+        data = {
+            "animalname": "O'Indexio",
+            "estimatedage": "1",
+            "animaltype": "1",
+            "entryreason": "1",
+            "species": "1"
+        }
+        post = utils.PostedData(data, "en")
+        nid, code = animal.insert_animal_from_form(dbo, post, "test")
+        assert nid in [ a["ID"] for a in animal.get_animal_find_simple(dbo, "o'indexio") ]
+        searchindex.rebuild(dbo)
+        assert nid in searchindex.get_candidates(dbo, searchindex.ANIMAL, "o'indexio")
+        animal.delete_animal(dbo, "test", nid)
+        searchindex.rebuild(dbo)
+        assert nid not in searchindex.get_candidates(dbo, searchindex.ANIMAL, "o'indexio")
+
+    def test_search_index_lookup_rename(self):
+        dbo = base.get_dbo()
+        searchindex.rebuild(dbo)
+        sid = lookups.insert_lookup(dbo, "species", "Indexspecies")
+        data = {
+            "animalname": "Indexio",
+            "estimatedage": "1",
+            "animaltype": "1",
+            "entryreason": "1",
+            "species": str(sid)
+        }
+        post = utils.PostedData(data, "en")
+        nid, code = animal.insert_animal_from_form(dbo, post, "test")
+        assert nid in searchindex.get_candidates(dbo, searchindex.ANIMAL, "indexspecies")
+        lookups.update_lookup(dbo, sid, "species", "Renamedspecies")
+        assert nid in searchindex.get_candidates(dbo, searchindex.ANIMAL, "renamedspecies")
+        assert nid not in searchindex.get_candidates(dbo, searchindex.ANIMAL, "indexspecies")
+        animal.delete_animal(dbo, "test", nid)
+        lookups.delete_lookup(dbo, "species", sid)
@@ -3,6 +3,8 @@
 import unittest
 #import base
 
+import hashlib
+import pbkdf2
 import users
 
 class TestUsers(unittest.TestCase):
@@ -22,3 +24,12 @@ class TestUsers(unittest.TestCase):
         assert users.verify_password("letmein", "md5java:d107d09f5bbe40cade3de5c71e9e9b7")
         assert users.verify_password("letmein", "md5:0d107d09f5bbe40cade3de5c71e9e9b7")
 
+    def test_pbkdf2(self):
+        native = pbkdf2.pbkdf2_hex("guest", "kFppt9JrIHxSepxvgaAJyg==", 1000, 24, hashlib.sha1)
+        saved = pbkdf2._pbkdf2_hmac
+        pbkdf2._pbkdf2_hmac = None
+        try:
+            assert native == pbkdf2.pbkdf2_hex("guest", "kFppt9JrIHxSepxvgaAJyg==", 1000, 24, hashlib.sha1)
+        finally:
+            pbkdf2._pbkdf2_hmac = saved
+
@@ -0,0 +1,51 @@
+#!/usr/bin/python env
+
+import unittest
+import base
+
+import animal
+import utils
+import wordprocessor
+
+class TestWordProcessor(unittest.TestCase):
+
+    nid = 0
+
+    def setUp(self):
+        data = {
+            "animalname": "Testio",
+            "estimatedage": "1",
+            "animaltype": "1",
+            "entryreason": "1",
+            "species": "1"
+        }
+        post = utils.PostedData(data, "en")
+        self.nid, self.code = animal.insert_animal_from_form(base.get_dbo(), post, "test")
+
+    def tearDown(self):
+        animal.delete_animal(base.get_dbo(), "test", self.nid)
+
+    def test_get_tags_used(self):
+        used = wordprocessor.get_tags_used("&lt;&lt;AnimalName&gt;&gt; and &lt;&lt;VaccinationName1&gt;&gt;")
+        assert used == set([ "ANIMALNAME", "VACCINATIONNAME1" ])
+        assert wordprocessor.get_tags_used("$$ANIMALNAME$$ $$SEX$$", True, "$$", "$$") == set([ "ANIMALNAME", "SEX" ])
+
+    def test_animal_tags(self):
+        dbo = base.get_dbo()
+        a = animal.get_animal(dbo, self.nid)
+        alltags = wordprocessor.animal_tags(dbo, a)
+        cache = {}
+        tags = wordprocessor.animal_tags(dbo, a, set([ "ANIMALNAME", "ANIMALISVACCINATED" ]), cache)
+        assert tags["ANIMALNAME"] == "Testio"
+        assert tags["ANIMALISVACCINATED"] == alltags["ANIMALISVACCINATED"]
+        assert not tags.has_key("ADOPTIONSTATUS")
+        assert cache.has_key(("animal", self.nid, "vaccinated"))
+        assert wordprocessor.animal_tags(dbo, a, set([ "ANIMALISVACCINATED" ]), cache)["ANIMALISVACCINATED"] == alltags["ANIMALISVACCINATED"]
+
+    def test_substitute_tags(self):
+        tags = { "NAME": "Bob & Jim", "IMG": "<img src=\"x\">", "EMPTY": None }
+        assert wordprocessor.substitute_tags("&lt;&lt;Name&gt;&gt;, &lt;&lt;Img&gt;&gt; &lt;&lt;Missing&gt;&gt;.", tags) == \
+            "Bob &amp; Jim, <img src=\"x\"> ."
+        assert wordprocessor.substitute_tags("$$NAME$$ $$NAME", tags, True, "$$", "$$") == "Bob &amp; Jim $$NAME"
+        assert utils.substitute_tags("<<Name>>!", tags, False, "<<", ">>") == "Bob & Jim!"
+